@@ -2,20 +2,37 @@
 
 from __future__ import annotations
 
+import argparse
+import bisect
 import csv
+import hashlib
+import io
 import json
 import os
+import pickle
+import sqlite3
+import sys
+import threading
+import time
+import zipfile
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager, redirect_stdout
 from dataclasses import dataclass, asdict
 from datetime import datetime, date
+from functools import lru_cache, wraps
 from pathlib import Path
-from typing import Any, Dict, List, Optional, Tuple
+from string import Template
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
 # =========================================================
 # CONFIG / PATHS
 # =========================================================
 APP_NAME = "Sistema Python - Lançamento de Notas Fiscais (sem MySQL)"
 BASE_DIR = Path(__file__).parent
-DATA_DIR = BASE_DIR / "data"
+# SISTEMA_NFE_DATA aponta outra pasta de dados (ex.: base sintética do benchmark)
+DATA_DIR = Path(os.environ.get("SISTEMA_NFE_DATA") or BASE_DIR / "data")
 
 FILE_FILIAIS = DATA_DIR / "filiais.json"
 FILE_PESSOAS = DATA_DIR / "pessoas.json"
@@ -29,13 +46,74 @@ FILE_TBL_ST = DATA_DIR / "tabela_st_regras.json"
 FILE_UF_PADRAO_CSV = DATA_DIR / "uf_aliquotas_padrao.csv"
 FILE_ST_PADRAO_CSV = DATA_DIR / "st_regras_padrao.csv"
 
+FILE_DB = DATA_DIR / "sistema_nfe.db"
+FILE_LOCK = DATA_DIR / "sistema_nfe.lock"
+
+FILE_ESTOQUE_MOV = DATA_DIR / "estoque_mov.jsonl"
+DIR_ESTOQUE_SNAP = DATA_DIR / "estoque_snapshots"
+
 ALLOW_NEGATIVE_STOCK = False
 
+# persistência de filiais/pessoas/produtos/nfs/estoque: "json" (padrão) ou "sqlite"
+# (migre antes com a opção 27 do menu)
+STORE_BACKEND = os.environ.get("SISTEMA_NFE_BACKEND", "json").strip().lower()
+
 UFS_BRASIL = [
     "AC","AL","AP","AM","BA","CE","DF","ES","GO","MA","MT","MS",
     "MG","PA","PB","PR","PE","PI","RJ","RN","RS","RO","RR","SC","SP","SE","TO"
 ]
 
+# =========================================================
+# MÉTRICAS: instrumentação (arquivo e resumo na seção MÉTRICAS, no fim)
+# =========================================================
+# As fases (@medir_fase) e operações (@medir_operacao) ficam marcadas nas
+# próprias funções. A operação em andamento é da thread: o que outras threads
+# fazem no meio dela (compactação em segundo plano, escritor da API) não entra
+# na conta. Sem operação medida na thread, a fase custa só essa checagem.
+class _OperacaoMedida(threading.local):
+    op: Optional[Dict[str, Any]] = None
+
+_OP_MEDIDA = _OperacaoMedida()
+_METRICAS: Dict[str, Any] = {"ativas": False}
+
+def medir_fase(fase: str) -> Callable[[Callable[..., Any]], Callable[..., Any]]:
+    def embrulhar(func: Callable[..., Any]) -> Callable[..., Any]:
+        @wraps(func)
+        def medida(*args: Any, **kwargs: Any) -> Any:
+            op = _OP_MEDIDA.op
+            if op is None:
+                return func(*args, **kwargs)
+            t0 = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                acc = op["fases"].setdefault(fase, {"n": 0, "s": 0.0})
+                acc["n"] += 1
+                acc["s"] += time.perf_counter() - t0
+        return medida
+    return embrulhar
+
+def medir_operacao(func: Callable[..., Any]) -> Callable[..., Any]:
+    nome = func.__name__
+
+    @wraps(func)
+    def medida(*args: Any, **kwargs: Any) -> Any:
+        if not _METRICAS["ativas"] or _OP_MEDIDA.op is not None:
+            # desligadas, ou chamada por outra operação (emitir_nf -> emitir_nfs): conta na de fora
+            return func(*args, **kwargs)
+        op: Dict[str, Any] = {"fases": {}, "examinadas": 0}
+        _OP_MEDIDA.op = op
+        t0 = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            total = time.perf_counter() - t0
+            _OP_MEDIDA.op = None
+            if "st.regra" in op["fases"]:
+                op["fases"]["st.regra"]["examinadas"] = op["examinadas"]
+            gravar_metrica(nome, total, op["fases"])
+    return medida
+
 # =========================================================
 # REGIÕES / ICMS INTERESTADUAL (4/7/12)
 # =========================================================
@@ -47,12 +125,10 @@ REGIOES = {
     "S": {"PR","RS","SC"},
 }
 
+_REGIAO_DE_UF = {uf: reg for reg, ufs in REGIOES.items() for uf in ufs}
+
 def uf_regiao(uf: str) -> str:
-    uf = (uf or "").strip().upper()
-    for reg, ufs in REGIOES.items():
-        if uf in ufs:
-            return reg
-    return "SE"
+    return _REGIAO_DE_UF.get((uf or "").strip().upper(), "SE")
 
 def aliq_interestadual(uf_origem: str, uf_destino: str, flag_importado: int) -> float:
     """
@@ -243,6 +319,7 @@ def parse_uf_list(s: str) -> List[str]:
 # =========================================================
 # STORAGE: JSON atomic
 # =========================================================
+@medir_fase("json.read")
 def read_json(path: Path, default: Any) -> Any:
     ensure_data_dir()
     if not path.exists():
@@ -250,6 +327,7 @@ def read_json(path: Path, default: Any) -> Any:
     with path.open("r", encoding="utf-8") as f:
         return json.load(f)
 
+@medir_fase("json.write")
 def write_json(path: Path, data: Any) -> None:
     ensure_data_dir()
     tmp = path.with_suffix(path.suffix + ".tmp")
@@ -257,22 +335,873 @@ def write_json(path: Path, data: Any) -> None:
         json.dump(data, f, ensure_ascii=False, indent=2)
     tmp.replace(path)
 
+# =========================================================
+# STORAGE: trava entre processos
+# =========================================================
+# CLI, robô e GUI podem gravar em data/ ao mesmo tempo. Toda gravação passa
+# por trava_dados(): lock exclusivo em data/sistema_nfe.lock (fcntl no
+# Linux/macOS, msvcrt no Windows), reentrante dentro do processo. A trava
+# cobre só "conferir versão + gravar"; a leitura dos arquivos fica fora dela
+# e quem leu uma versão antiga sincroniza antes de gravar (sincronizar_store).
+TRAVA_TIMEOUT_S = 30.0
+_TRAVA: Dict[str, Any] = {"lock": threading.RLock(), "depth": 0, "fh": None}
+
+class ConflitoVersao(RuntimeError):
+    """Registro alterado por outro processo depois de lido; recarregue e repita."""
+
+def _travar_arquivo(fh: Any) -> bool:
+    try:
+        import fcntl
+    except ImportError:
+        import msvcrt
+        try:
+            msvcrt.locking(fh.fileno(), msvcrt.LK_NBLCK, 1)
+            return True
+        except OSError:
+            return False
+    try:
+        fcntl.flock(fh.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return True
+    except OSError:
+        return False
+
+def _destravar_arquivo(fh: Any) -> None:
+    try:
+        import fcntl
+    except ImportError:
+        import msvcrt
+        fh.seek(0)
+        msvcrt.locking(fh.fileno(), msvcrt.LK_UNLCK, 1)
+        return
+    fcntl.flock(fh.fileno(), fcntl.LOCK_UN)
+
+@contextmanager
+def trava_dados():
+    lock = _TRAVA["lock"]
+    lock.acquire()
+    try:
+        if _TRAVA["depth"] == 0:
+            ensure_data_dir()
+            fh = open(FILE_LOCK, "a+b")
+            limite = time.monotonic() + TRAVA_TIMEOUT_S
+            espera = 0.002
+            while not _travar_arquivo(fh):
+                if time.monotonic() > limite:
+                    fh.close()
+                    raise TimeoutError(f"{FILE_LOCK.name}: dados em uso por outro processo há mais de {TRAVA_TIMEOUT_S:.0f}s")
+                time.sleep(espera)
+                espera = min(espera * 2, 0.05)
+            _TRAVA["fh"] = fh
+        _TRAVA["depth"] += 1
+        try:
+            yield
+        finally:
+            _TRAVA["depth"] -= 1
+            if _TRAVA["depth"] == 0:
+                fh = _TRAVA["fh"]
+                _TRAVA["fh"] = None
+                _destravar_arquivo(fh)
+                fh.close()
+    finally:
+        lock.release()
+
+def _stamp(path: Path) -> Optional[Tuple[int, int, int]]:
+    """
+    Carimbo (mtime_ns, tamanho, inode) do arquivo, ou None se não existir.
+    Único critério de "o arquivo mudou" do sistema: journal dos stores,
+    caches das tabelas UF/ST, conflito na importação ST e a GUI (via load_store).
+    """
+    try:
+        st = path.stat()
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+# =========================================================
+# STORAGE: journal (snapshot JSON + log append-only)
+# =========================================================
+# O arquivo original (ex.: data/nfs.json) continua sendo o snapshot, no mesmo
+# formato {"seq": N, "items": [...]}. Cada save_store acrescenta UMA linha em
+# <arquivo>.journal com apenas os registros alterados:
+#   {"seq": N, "v": versão, "put": [registro, ...], "del": [id, ...]}
+# A leitura replica o journal sobre o snapshot. Quando o journal passa de
+# JOURNAL_COMPACT_BYTES, uma thread em segundo plano grava um novo snapshot
+# (tmp -> replace) e zera o journal. Replicar o journal é idempotente, então
+# uma queda entre gravar o snapshot e apagar o journal não perde nada.
+#
+# Versão: cada gravação incrementa "v" (o snapshot compactado guarda a última
+# em "versao"). O Store lembra até onde leu o journal; se outro processo gravou
+# depois, save_store incorpora essas linhas antes de acrescentar a sua.
+STORE_JOURNAL = True
+JOURNAL_COMPACT_BYTES = 4 * 1024 * 1024
+
+_STORE_LOCKS: Dict[str, threading.Lock] = {}
+_COMPACT_THREADS: Dict[str, threading.Thread] = {}
+
+class Store(dict):
+    """
+    Store {"seq", "items"} carregado por load_store. Continua sendo um dict
+    comum para quem usa; os atributos guardam o estado do journal e os
+    índices id -> posição e SKU -> posições usados por find_by_id/find_by_sku.
+
+    Os índices são montados no primeiro uso e acompanham store["items"]:
+    itens acrescentados no fim são indexados na próxima consulta e, se a
+    lista for trocada, encolher ou mudar o último item indexado (remoção
+    seguida de append, mesmo tamanho), o índice é refeito. por_id também
+    refaz o índice antes de responder que o id não existe.
+    """
+    path: Optional[Path] = None
+    versao: int = 0
+    _fp: Dict[int, str]
+    _seq_disk: int = 0
+    _jofs: int = 0
+    _snap: Optional[Tuple[int, int, int]] = None
+    _idx_items: Optional[List[Dict[str, Any]]] = None
+    _idx_len: int = 0
+    _idx_ult: Optional[Dict[str, Any]] = None
+    _idx_id: Dict[int, int]
+    _idx_sku: Dict[str, List[int]]
+
+    def _indexar(self) -> List[Dict[str, Any]]:
+        items = self["items"]
+        if (self._idx_items is not items or self._idx_len > len(items)
+                or (self._idx_len and items[self._idx_len - 1] is not self._idx_ult)):
+            self._idx_items = items
+            self._idx_len = 0
+            self._idx_id = {}
+            self._idx_sku = {}
+        for pos in range(self._idx_len, len(items)):
+            it = items[pos]
+            self._idx_id.setdefault(int(it.get("id", 0)), pos)
+            self._idx_sku.setdefault(str(it.get("sku", "")).upper(), []).append(pos)
+        self._idx_len = len(items)
+        self._idx_ult = items[-1] if items else None
+        return items
+
+    def _reindexar(self) -> List[Dict[str, Any]]:
+        self._idx_items = None
+        return self._indexar()
+
+    def por_id(self, rid: int) -> Optional[Dict[str, Any]]:
+        items = self._indexar()
+        pos = self._idx_id.get(rid)
+        if pos is None or int(items[pos].get("id", 0)) != rid:
+            # ausente ou a lista foi alterada no meio (remoção/troca): refaz e tenta de novo
+            items = self._reindexar()
+            pos = self._idx_id.get(rid)
+            return items[pos] if pos is not None else None
+        return items[pos]
+
+    def por_sku(self, sku: str) -> List[Dict[str, Any]]:
+        sku = (sku or "").upper()
+        items = self._indexar()
+        hits = [items[pos] for pos in self._idx_sku.get(sku, [])]
+        if any(str(it.get("sku", "")).upper() != sku for it in hits):
+            items = self._reindexar()
+            hits = [items[pos] for pos in self._idx_sku.get(sku, [])]
+        return hits
+
+def _journal_path(path: Path) -> Path:
+    return path.with_suffix(path.suffix + ".journal")
+
+def _store_lock(path: Path) -> threading.Lock:
+    key = str(path)
+    lock = _STORE_LOCKS.get(key)
+    if lock is None:
+        lock = _STORE_LOCKS.setdefault(key, threading.Lock())
+    return lock
+
+def _rec_fp(rec: Dict[str, Any]) -> str:
+    return json.dumps(rec, ensure_ascii=False, separators=(",", ":"))
+
+def _ler_journal(path: Path, offset: int = 0) -> Tuple[List[Dict[str, Any]], int]:
+    """Linhas completas do journal a partir de offset e o offset final lido."""
+    jpath = _journal_path(path)
+    entries: List[Dict[str, Any]] = []
+    if not jpath.exists():
+        return entries, 0
+    with jpath.open("rb") as f:
+        f.seek(offset)
+        for raw in f:
+            if not raw.strip():
+                offset += len(raw)
+                continue
+            try:
+                if not raw.endswith(b"\n"):
+                    raise ValueError
+                entries.append(json.loads(raw))
+            except ValueError:
+                # última linha incompleta (queda ou gravação em andamento): ignora
+                break
+            offset += len(raw)
+    return entries, offset
+
+def _cortar_journal(path: Path, valido: int) -> None:
+    """
+    Corta do journal o que passa de `valido` (linha incompleta deixada por uma
+    gravação interrompida). Só dentro de trava_dados: sem a trava, a linha
+    pode ser uma gravação em andamento de outro processo. Sem o corte, a
+    próxima linha acrescentada ficaria emendada nela e seria descartada na
+    leitura junto com tudo o que viesse depois.
+    """
+    jpath = _journal_path(path)
+    try:
+        size = jpath.stat().st_size
+    except FileNotFoundError:
+        return
+    if size > valido:
+        with jpath.open("r+b") as f:
+            f.truncate(valido)
+            f.flush()
+            os.fsync(f.fileno())
+
+def _aplicar_journal(data: Dict[str, Any], entries: List[Dict[str, Any]]) -> Dict[str, Any]:
+    items: List[Dict[str, Any]] = data.setdefault("items", [])
+    pos = {int(it.get("id", 0)): i for i, it in enumerate(items)}
+    removed = False
+    for entry in entries:
+        for rec in entry.get("put", []):
+            rid = int(rec.get("id", 0))
+            if rid in pos and pos[rid] is not None:
+                items[pos[rid]] = rec
+            else:
+                pos[rid] = len(items)
+                items.append(rec)
+        for rid in entry.get("del", []):
+            i = pos.get(int(rid))
+            if i is not None:
+                items[i] = None  # type: ignore[call-overload]
+                pos[int(rid)] = None  # type: ignore[assignment]
+                removed = True
+        data["seq"] = max(int(data.get("seq", 0) or 0), int(entry.get("seq", 0) or 0))
+    if removed:
+        data["items"] = [it for it in items if it is not None]
+    return data
+
+def _replay_journal(path: Path, data: Dict[str, Any]) -> Dict[str, Any]:
+    entries, _ = _ler_journal(path)
+    return _aplicar_journal(data, entries)
+
+def _read_store_disk(path: Path) -> Tuple[Dict[str, Any], int, int, Any]:
+    """
+    Snapshot + journal, com a versão e o offset do journal lidos. Se outro
+    processo compactou no meio da leitura, lê de novo.
+    """
+    # o journal é sempre replicado, mesmo com STORE_JOURNAL desligado,
+    # para não perder o que foi gravado antes de trocar a configuração
+    while True:
+        snap = _stamp(path)
+        data = read_json(path, {"seq": 0, "items": []})
+        entries, jofs = _ler_journal(path)
+        if _stamp(path) == snap:
+            break
+    versao = int(data.pop("versao", 0) or 0)
+    if entries:
+        versao = max(versao, int(entries[-1].get("v", 0) or 0))
+    return _aplicar_journal(data, entries), versao, jofs, snap
+
+@medir_fase("store.load")
 def load_store(path: Path) -> Dict[str, Any]:
-    return read_json(path, {"seq": 0, "items": []})
+    if usa_sqlite() and path.name in _SQL_TABELAS:
+        return _sql_load_store(path)
+    with _store_lock(path):
+        data, versao, jofs, snap = _read_store_disk(path)
+    if jofs < (_stamp(_journal_path(path)) or (0, 0, 0))[1]:
+        # sobra no fim do journal: gravação em andamento ou interrompida.
+        # Com a trava, a que estava em andamento já terminou e entra na releitura.
+        with trava_dados(), _store_lock(path):
+            data, versao, jofs, snap = _read_store_disk(path)
+            _cortar_journal(path, jofs)
+    store = Store(data)
+    _marcar_gravado(store, path)
+    store.versao, store._jofs, store._snap = versao, jofs, snap
+    return store
+
+def _marcar_gravado(store: "Store", path: Path) -> None:
+    """Registra o estado atual do store como o que está em disco."""
+    store.path = path
+    store._seq_disk = int(store.get("seq", 0) or 0)
+    store._fp = {int(it.get("id", 0)): _rec_fp(it) for it in store.get("items", [])}
+
+def sincronizar_store(path: Path, store: Dict[str, Any]) -> None:
+    """
+    Traz para o store o que outros processos gravaram depois da leitura.
+    Chame dentro de trava_dados() antes de conferir o estado de um registro
+    que vai ser gravado (ex.: status da NF na emissão); depois disso use
+    find_by_id de novo, porque o registro pode ter sido substituído.
+    """
+    if isinstance(store, SqliteStore):
+        _sql_sincronizar(store)
+    elif isinstance(store, Store) and store.path == path:
+        _sincronizar(path, store, [], [])
+
+# Stores mantidos entre operações do menu (como o Estado da API): cada uso só
+# traz o que foi gravado depois (sincronizar_store lê o fim do journal), sem
+# reler o arquivo nem refazer a impressão de todos os registros. Quem altera
+# um store aberto grava com save_store ou o descarta se a operação falhar.
+_STORES_ABERTOS: Dict[str, Dict[str, Any]] = {}
+
+def store_aberto(path: Path) -> Dict[str, Any]:
+    """Store de path mantido em memória e atualizado com as gravações de fora."""
+    st = _STORES_ABERTOS.get(str(path))
+    if st is None:
+        st = _STORES_ABERTOS[str(path)] = load_store(path)
+    else:
+        sincronizar_store(path, st)
+    return st
+
+def descartar_store_aberto(path: Path) -> None:
+    _STORES_ABERTOS.pop(str(path), None)
+
+def _sincronizar(path: Path, store: "Store", puts: List[Dict[str, Any]], dels: List[int]) -> None:
+    """
+    Incorpora gravações de outros processos (em trava_dados). puts/dels são as
+    alterações locais ainda não gravadas: registro existente alterado dos dois
+    lados -> ConflitoVersao; registro novo cujo id foi usado lá fora ganha o
+    próximo id livre.
+    """
+    snap = _stamp(path)
+    jsize = (_stamp(_journal_path(path)) or (0, 0, 0))[1]
+    if snap == store._snap and jsize == store._jofs:
+        return
+
+    if snap == store._snap and jsize > store._jofs:
+        entries, jofs = _ler_journal(path, store._jofs)
+        versao = max([store.versao] + [int(e.get("v", 0) or 0) for e in entries])
+    else:
+        # snapshot regravado (compactação): compara o disco com o que foi lido
+        data, versao, jofs, snap = _read_store_disk(path)
+        disco = {int(it.get("id", 0)): it for it in data["items"]}
+        entries = [{
+            "seq": data.get("seq", 0),
+            "put": [it for rid, it in disco.items() if store._fp.get(rid) != _rec_fp(it)],
+            "del": [rid for rid in store._fp if rid not in disco],
+        }]
+
+    fora = {int(r.get("id", 0)) for e in entries for r in e.get("put", [])}
+    fora.update(int(rid) for e in entries for rid in e.get("del", []))
+    seq_lido = store._seq_disk
+    seq_disco = max([seq_lido] + [int(e.get("seq", 0) or 0) for e in entries])
+
+    for rid in [int(r.get("id", 0)) for r in puts] + list(dels):
+        if rid <= seq_lido and rid in fora:
+            raise ConflitoVersao(
+                f"{path.name}: registro {rid} foi alterado por outro processo; recarregue e repita a operação."
+            )
+
+    items = store.setdefault("items", [])
+    base = [it for it in items if int(it.get("id", 0)) <= seq_lido]
+    novos = [it for it in items if int(it.get("id", 0)) > seq_lido]
+    if seq_disco > seq_lido:
+        # ids criados aqui depois da leitura colidem com os criados lá fora
+        desloc = seq_disco - seq_lido
+        for it in novos:
+            it["id"] = int(it["id"]) + desloc
+        store["seq"] = int(store.get("seq", 0) or 0) + desloc
+
+    # as gravações de fora entram antes dos registros novos locais, na mesma
+    # ordem em que ficam no journal
+    merged = _aplicar_journal({"seq": seq_disco, "items": base}, entries)
+    store["items"] = merged["items"] + novos
+    store._reindexar()
+    for e in entries:
+        for rec in e.get("put", []):
+            store._fp[int(rec.get("id", 0))] = _rec_fp(rec)
+        for rid in e.get("del", []):
+            store._fp.pop(int(rid), None)
+    store._seq_disk = seq_disco
+    store.versao, store._jofs, store._snap = versao, jofs, snap
+
+@medir_fase("store.save")
+def save_store(path: Path, store: Dict[str, Any], changed: Optional[List[Dict[str, Any]]] = None) -> None:
+    """
+    Grava o store. Com journal ativo, só os registros alterados vão para o log.
+    changed: registros que o chamador sabe que mudaram (evita comparar todos);
+    sem ele, todos os registros são comparados com o que foi carregado.
+    Se outro processo gravou depois da leitura, as gravações dele são
+    incorporadas antes (ver _sincronizar).
+    """
+    if isinstance(store, SqliteStore):
+        _sql_save_store(store, changed)
+        return
+    if not STORE_JOURNAL or not isinstance(store, Store) or store.path != path or not path.exists():
+        _write_store_full(path, store, changed)
+        return
+
+    fps = store._fp
+    puts, dels = _alteracoes(store, changed)
+    if not puts and not dels and int(store.get("seq", 0) or 0) == store._seq_disk:
+        return
+
+    jpath = _journal_path(path)
+    with trava_dados(), _store_lock(path):
+        _sincronizar(path, store, puts, dels)
+        _cortar_journal(path, store._jofs)
+        seq = int(store.get("seq", 0) or 0)
+        versao = store.versao + 1
+        line = json.dumps({"seq": seq, "v": versao, "put": puts, "del": dels}, ensure_ascii=False, separators=(",", ":"))
+        with jpath.open("ab") as f:
+            f.write((line + "\n").encode("utf-8"))
+            f.flush()
+            os.fsync(f.fileno())
+        size = jpath.stat().st_size
+
+    for rec in puts:
+        fps[int(rec.get("id", 0))] = _rec_fp(rec)
+    for rid in dels:
+        fps.pop(rid, None)
+    store._seq_disk = seq
+    store.versao, store._jofs = versao, size
+
+    if size >= JOURNAL_COMPACT_BYTES:
+        compactar_store_background(path)
+
+def _alteracoes(store: "Store", changed: Optional[List[Dict[str, Any]]]) -> Tuple[List[Dict[str, Any]], List[int]]:
+    """Registros alterados/incluídos e ids removidos desde a leitura (ou o último save)."""
+    fps = store._fp
+    candidates = changed if changed is not None else store.get("items", [])
+    puts = [rec for rec in candidates if fps.get(int(rec.get("id", 0))) != _rec_fp(rec)]
+    dels: List[int] = []
+    if changed is None:
+        current = {int(it.get("id", 0)) for it in store.get("items", [])}
+        dels = [rid for rid in fps if rid not in current]
+    return puts, dels
+
+def _write_store_full(path: Path, store: Dict[str, Any], changed: Optional[List[Dict[str, Any]]] = None) -> None:
+    """
+    Grava o snapshot inteiro e apaga o journal. Um Store lido deste arquivo
+    incorpora antes o que outros processos gravaram (journal ou snapshot) -
+    senão essas gravações sumiriam com o journal. Um dict comum substitui o
+    conteúdo do arquivo.
+    """
+    with trava_dados(), _store_lock(path):
+        if isinstance(store, Store) and store.path == path:
+            _sincronizar(path, store, *_alteracoes(store, changed))
+        versao = int(getattr(store, "versao", 0)) + 1
+        write_json(path, {**store, "versao": versao})
+        jpath = _journal_path(path)
+        if jpath.exists():
+            jpath.unlink()
+        snap = _stamp(path)
+    if isinstance(store, Store):
+        _marcar_gravado(store, path)
+        store.versao, store._jofs, store._snap = versao, 0, snap
+
+def compactar_store(path: Path) -> None:
+    """Incorpora o journal num novo snapshot (tmp -> replace) e zera o log."""
+    with trava_dados(), _store_lock(path):
+        jpath = _journal_path(path)
+        if not jpath.exists():
+            return
+        data, versao, _, _ = _read_store_disk(path)
+        write_json(path, {**data, "versao": versao})
+        jpath.unlink()
+
+def compactar_store_background(path: Path) -> None:
+    key = str(path)
+    th = _COMPACT_THREADS.get(key)
+    if th is not None and th.is_alive():
+        return
+    th = threading.Thread(target=compactar_store, args=(path,), name=f"compact-{path.name}", daemon=True)
+    _COMPACT_THREADS[key] = th
+    th.start()
 
-def save_store(path: Path, store: Dict[str, Any]) -> None:
-    write_json(path, store)
+def aguardar_compactacoes() -> None:
+    for th in list(_COMPACT_THREADS.values()):
+        th.join()
+
+def compactar_todos_stores() -> None:
+    title("Compactar arquivos de dados (journal -> snapshot)")
+    aguardar_compactacoes()
+    for p in [FILE_FILIAIS, FILE_PESSOAS, FILE_PRODUTOS, FILE_NFS]:
+        jpath = _journal_path(p)
+        if jpath.exists():
+            size = jpath.stat().st_size
+            compactar_store(p)
+            print(f"{p.name}: journal de {size} bytes incorporado.")
+        else:
+            print(f"{p.name}: nada a compactar.")
 
 def next_id(store: Dict[str, Any]) -> int:
     store["seq"] = int(store.get("seq", 0)) + 1
     return int(store["seq"])
 
+def append_record(store: Dict[str, Any], rec: Dict[str, Any]) -> None:
+    """Acrescenta um registro novo (no SQLite não carrega a tabela inteira)."""
+    if isinstance(store, SqliteStore):
+        store.acrescentar(rec)
+        return
+    store["items"].append(rec)
+
 def find_by_id(store: Dict[str, Any], _id: int) -> Optional[Dict[str, Any]]:
+    if isinstance(store, SqliteStore):
+        return store.buscar(int(_id))
+    if isinstance(store, Store):
+        return store.por_id(int(_id))
     for it in store.get("items", []):
         if int(it.get("id", 0)) == int(_id):
             return it
     return None
 
+def find_by_sku(store: Dict[str, Any], sku: str, active_only: bool = False) -> Optional[Dict[str, Any]]:
+    """Primeiro registro com o SKU (comparação sem diferenciar maiúsculas)."""
+    sku = (sku or "").upper()
+    if isinstance(store, SqliteStore):
+        hits = store.buscar_sku(sku)
+    elif isinstance(store, Store):
+        hits = store.por_sku(sku)
+    else:
+        hits = [it for it in store.get("items", []) if str(it.get("sku", "")).upper() == sku]
+    for it in hits:
+        if not active_only or int(it.get("ativo", 1)) == 1:
+            return it
+    return None
+
+# =========================================================
+# STORAGE: backend SQLite (opcional, STORE_BACKEND = "sqlite")
+# =========================================================
+# Cada store vira uma tabela (id, colunas indexadas, doc JSON); o estoque vira
+# a tabela estoque(filial_id, produto_id, qtd). Os registros só são lidos
+# quando pedidos: find_by_id faz um SELECT pela chave primária e store["items"]
+# carrega a tabela inteira apenas para quem realmente precisa da lista.
+_SQL_TABELAS = {
+    "filiais.json": "filiais",
+    "pessoas.json": "pessoas",
+    "produtos.json": "produtos",
+    "nfs.json": "nfs",
+}
+# colunas copiadas do documento para consulta/índice
+_SQL_COLUNAS = {
+    "filiais": ["ativo"],
+    "pessoas": ["ativo"],
+    "produtos": ["sku", "descricao", "ativo"],
+    "nfs": ["data_emissao", "status", "filial_id"],
+}
+class _ConexaoSql(threading.local):
+    """Uma conexão (e profundidade de transação) por thread: a API grava numa
+    thread própria enquanto o event loop lê; o WAL isola uma da outra."""
+    conn: Optional[sqlite3.Connection] = None
+    path: Optional[Path] = None
+    depth = 0
+
+_SQL = _ConexaoSql()
+
+def usa_sqlite() -> bool:
+    return STORE_BACKEND == "sqlite"
+
+def _sql_conn() -> sqlite3.Connection:
+    if _SQL.conn is not None and _SQL.path == FILE_DB:
+        return _SQL.conn
+    ensure_data_dir()
+    conn = sqlite3.connect(str(FILE_DB), isolation_level=None, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA busy_timeout=5000")
+    # lower() do SQLite só trata ASCII; a busca precisa do mesmo lower() do Python
+    conn.create_function("py_lower", 1, lambda v: str(v or "").lower(), deterministic=True)
+    conn.create_function("py_upper", 1, lambda v: str(v or "").upper(), deterministic=True)
+    conn.execute("CREATE TABLE IF NOT EXISTS meta (nome TEXT PRIMARY KEY, seq INTEGER NOT NULL DEFAULT 0)")
+    conn.execute("CREATE TABLE IF NOT EXISTS versao (nome TEXT PRIMARY KEY, v INTEGER NOT NULL DEFAULT 0)")
+    for tabela, cols in _SQL_COLUNAS.items():
+        conn.execute(f"CREATE TABLE IF NOT EXISTS {tabela} (id INTEGER PRIMARY KEY, {', '.join(cols)}, doc TEXT NOT NULL)")
+        for c in cols:
+            conn.execute(f"CREATE INDEX IF NOT EXISTS ix_{tabela}_{c} ON {tabela}({c})")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS estoque ("
+        "filial_id INTEGER NOT NULL, produto_id INTEGER NOT NULL, qtd REAL NOT NULL, "
+        "PRIMARY KEY (filial_id, produto_id))"
+    )
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS estoque_mov ("
+        "seq INTEGER PRIMARY KEY, data TEXT NOT NULL, ts TEXT NOT NULL, "
+        "filial_id INTEGER NOT NULL, produto_id INTEGER NOT NULL, delta REAL NOT NULL, "
+        "nf_id INTEGER, item_id INTEGER, tipo TEXT NOT NULL)"
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS ix_estoque_mov_nf ON estoque_mov(nf_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS ix_estoque_mov_data ON estoque_mov(data)")
+    conn.execute("CREATE TABLE IF NOT EXISTS estoque_snapshot (seq INTEGER PRIMARY KEY, data TEXT NOT NULL, doc TEXT NOT NULL)")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS resumo_fiscal ("
+        "chave TEXT PRIMARY KEY, periodo TEXT NOT NULL, filial_id INTEGER NOT NULL, uf_destino TEXT NOT NULL, "
+        "cfop TEXT NOT NULL, tipo_operacao TEXT NOT NULL, valores TEXT NOT NULL)"
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS ix_resumo_fiscal_periodo ON resumo_fiscal(periodo)")
+    _SQL.conn = conn
+    _SQL.path = FILE_DB
+    _SQL.depth = 0
+    return conn
+
+@contextmanager
+def _sql_tx():
+    conn = _sql_conn()
+    if _SQL.depth == 0:
+        conn.execute("BEGIN IMMEDIATE")
+    _SQL.depth += 1
+    try:
+        yield conn
+    except BaseException:
+        _SQL.depth -= 1
+        if _SQL.depth == 0:
+            conn.execute("ROLLBACK")
+        raise
+    _SQL.depth -= 1
+    if _SQL.depth == 0:
+        conn.execute("COMMIT")
+
+@contextmanager
+def transacao():
+    """
+    Agrupa gravações (ex.: estoque + status da NF) numa única transação.
+    No backend JSON segura trava_dados() durante o bloco: cada arquivo
+    continua sendo gravado sozinho, mas nenhum outro processo grava no meio.
+    """
+    if not usa_sqlite():
+        with trava_dados():
+            yield
+        return
+    with _sql_tx():
+        yield
+
+def _sql_upsert(conn: sqlite3.Connection, tabela: str, docs: List[Tuple[int, str, Dict[str, Any]]]) -> None:
+    cols = _SQL_COLUNAS[tabela]
+    marks = ", ".join("?" for _ in range(len(cols) + 2))
+    conn.executemany(
+        f"INSERT OR REPLACE INTO {tabela} (id, {', '.join(cols)}, doc) VALUES ({marks})",
+        [(rid, *[rec.get(c) for c in cols], doc) for rid, doc, rec in docs],
+    )
+
+def _sql_set_seq(conn: sqlite3.Connection, tabela: str, seq: int) -> None:
+    conn.execute("INSERT OR REPLACE INTO meta (nome, seq) VALUES (?, ?)", (tabela, int(seq)))
+
+class SqliteStore(Store):
+    """
+    Store do backend SQLite. "items" só é lido do banco no primeiro acesso;
+    os registros já entregues por buscar() são reaproveitados nessa carga.
+    """
+    tabela: str
+    _docs: Dict[int, Dict[str, Any]]
+    _sku_minusculo: Optional[bool] = None
+
+    def __missing__(self, key: str) -> Any:
+        if key != "items":
+            raise KeyError(key)
+        items = []
+        for rid, doc in _sql_conn().execute(f"SELECT id, doc FROM {self.tabela} ORDER BY id"):
+            rec = self._docs.get(rid)
+            if rec is None:
+                rec = self._doc(rid, doc)
+            items.append(rec)
+        for rid, rec in self._docs.items():
+            if rid not in self._fp:  # acrescentados e ainda não gravados
+                items.append(rec)
+        dict.__setitem__(self, "items", items)
+        return items
+
+    def get(self, key: str, default: Any = None) -> Any:
+        if key == "items" and not dict.__contains__(self, "items"):
+            return self["items"]
+        return dict.get(self, key, default)
+
+    def carregado(self) -> bool:
+        return dict.__contains__(self, "items")
+
+    def buscar(self, rid: int) -> Optional[Dict[str, Any]]:
+        if self.carregado():
+            return self.por_id(rid)
+        rec = self._docs.get(rid)
+        if rec is not None:
+            return rec
+        row = _sql_conn().execute(f"SELECT doc FROM {self.tabela} WHERE id = ?", (rid,)).fetchone()
+        if not row:
+            return None
+        return self._doc(rid, row[0])
+
+    def buscar_sku(self, sku: str) -> List[Dict[str, Any]]:
+        if self.carregado():
+            return self.por_sku(sku)
+        conn = _sql_conn()
+        # SKUs são gravados em maiúsculas; o segundo SELECT cobre cadastros antigos
+        rows = conn.execute(f"SELECT id, doc FROM {self.tabela} WHERE sku = ? ORDER BY id", (sku,)).fetchall()
+        if self._sku_minusculo is None:
+            self._sku_minusculo = conn.execute(
+                f"SELECT 1 FROM {self.tabela} WHERE sku <> py_upper(sku) LIMIT 1"
+            ).fetchone() is not None
+        if not rows and self._sku_minusculo:
+            rows = conn.execute(
+                f"SELECT id, doc FROM {self.tabela} WHERE py_upper(sku) = ? ORDER BY id", (sku,)
+            ).fetchall()
+        hits = [self._docs.get(rid) or self._doc(rid, doc) for rid, doc in rows]
+        hits += [
+            rec for rid, rec in self._docs.items()
+            if rid not in self._fp and str(rec.get("sku", "")).upper() == sku
+        ]
+        return hits
+
+    def _doc(self, rid: int, doc: str) -> Dict[str, Any]:
+        rec = json.loads(doc)
+        self._docs[rid] = rec
+        self._fp[rid] = doc
+        return rec
+
+    def acrescentar(self, rec: Dict[str, Any]) -> None:
+        if self.carregado():
+            self["items"].append(rec)
+        self._docs[int(rec.get("id", 0))] = rec
+
+    def descartar_cache(self) -> None:
+        """Esquece os registros já gravados (importações grandes não acumulam tudo em memória)."""
+        if self.carregado():
+            return
+        for rid in list(self._fp):
+            self._docs.pop(rid, None)
+        self._fp.clear()
+
+def _sql_versao(conn: sqlite3.Connection, tabela: str) -> int:
+    row = conn.execute("SELECT v FROM versao WHERE nome = ?", (tabela,)).fetchone()
+    return int(row[0]) if row else 0
+
+def _sql_load_store(path: Path) -> "SqliteStore":
+    tabela = _SQL_TABELAS[path.name]
+    conn = _sql_conn()
+    row = conn.execute("SELECT seq FROM meta WHERE nome = ?", (tabela,)).fetchone()
+    store = SqliteStore({"seq": int(row[0]) if row else 0})
+    store.path = path
+    store.tabela = tabela
+    store._docs = {}
+    store._fp = {}
+    store._seq_disk = store["seq"]
+    store.versao = _sql_versao(conn, tabela)
+    return store
+
+def _sql_sincronizar(store: "SqliteStore") -> None:
+    """Descarta os registros lidos antes de outra gravação (relidos sob demanda)."""
+    conn = _sql_conn()
+    versao = _sql_versao(conn, store.tabela)
+    if versao == store.versao:
+        return
+    for rid in list(store._fp):
+        store._docs.pop(rid, None)
+        store._fp.pop(rid, None)
+    if store.carregado():
+        dict.__delitem__(store, "items")
+    row = conn.execute("SELECT seq FROM meta WHERE nome = ?", (store.tabela,)).fetchone()
+    seq_disco = int(row[0]) if row else 0
+    store["seq"] = max(int(store.get("seq", 0) or 0), seq_disco)
+    store._seq_disk = seq_disco
+    store.versao = versao
+
+def _sql_save_store(store: "SqliteStore", changed: Optional[List[Dict[str, Any]]]) -> None:
+    if changed is not None:
+        candidates = changed
+    elif store.carregado():
+        candidates = store["items"]
+    else:
+        candidates = list(store._docs.values())
+
+    puts: List[Tuple[int, str, Dict[str, Any]]] = []
+    for rec in candidates:
+        rid = int(rec.get("id", 0))
+        doc = _rec_fp(rec)
+        if store._fp.get(rid) != doc:
+            puts.append((rid, doc, rec))
+    dels: List[int] = []
+    if changed is None and store.carregado():
+        current = {int(it.get("id", 0)) for it in store["items"]}
+        dels = [rid for rid in store._fp if rid not in current]
+
+    if not puts and not dels and int(store.get("seq", 0) or 0) == store._seq_disk:
+        return
+    with _sql_tx() as conn:
+        versao = _sql_versao(conn, store.tabela)
+        if versao != store.versao:
+            # outro processo gravou depois da leitura: confere os registros
+            # alterados aqui e renumera os novos que colidirem
+            for rid in [rid for rid, _, _ in puts if rid in store._fp] + dels:
+                row = conn.execute(f"SELECT doc FROM {store.tabela} WHERE id = ?", (rid,)).fetchone()
+                if (row[0] if row else None) != store._fp.get(rid):
+                    raise ConflitoVersao(
+                        f"{store.tabela}: registro {rid} foi alterado por outro processo; recarregue e repita a operação."
+                    )
+            row = conn.execute("SELECT seq FROM meta WHERE nome = ?", (store.tabela,)).fetchone()
+            seq_disco = int(row[0]) if row else 0
+            if seq_disco > store._seq_disk:
+                desloc = seq_disco - store._seq_disk
+                novos = [rec for rid, rec in store._docs.items() if rid not in store._fp]
+                for rec in novos:
+                    store._docs.pop(int(rec["id"]), None)
+                for rec in novos:
+                    rec["id"] = int(rec["id"]) + desloc
+                    store._docs[rec["id"]] = rec
+                store["seq"] = int(store.get("seq", 0) or 0) + desloc
+                store._seq_disk = seq_disco
+                puts = [(int(rec.get("id", 0)), _rec_fp(rec), rec) for _, _, rec in puts]
+                if store.carregado():
+                    store._reindexar()
+        seq = int(store.get("seq", 0) or 0)
+        _sql_upsert(conn, store.tabela, puts)
+        if dels:
+            conn.executemany(f"DELETE FROM {store.tabela} WHERE id = ?", [(rid,) for rid in dels])
+        _sql_set_seq(conn, store.tabela, seq)
+        conn.execute("INSERT OR REPLACE INTO versao (nome, v) VALUES (?, ?)", (store.tabela, versao + 1))
+    store.versao = versao + 1
+
+    for rid, doc, rec in puts:
+        store._fp[rid] = doc
+        store._docs[rid] = rec
+    for rid in dels:
+        store._fp.pop(rid, None)
+        store._docs.pop(rid, None)
+    store._seq_disk = seq
+
+def migrar_json_para_sqlite() -> None:
+    title("Migrar dados JSON -> SQLite")
+    with _sql_tx() as conn:
+        for path in [FILE_FILIAIS, FILE_PESSOAS, FILE_PRODUTOS, FILE_NFS]:
+            tabela = _SQL_TABELAS[path.name]
+            data = _read_store_disk(path)[0]
+            items = data.get("items", [])
+            conn.execute(f"DELETE FROM {tabela}")
+            _sql_upsert(conn, tabela, [(int(it.get("id", 0)), _rec_fp(it), it) for it in items])
+            _sql_set_seq(conn, tabela, int(data.get("seq", 0) or 0))
+            print(f"{path.name}: {len(items)} registros -> tabela {tabela}")
+
+        estoque = _ler_estoque_json()
+        rows = [
+            (int(fid), int(pid), float(qtd))
+            for fid, mp in estoque["by_filial"].items()
+            for pid, qtd in mp.items()
+        ]
+        conn.execute("DELETE FROM estoque")
+        conn.executemany("INSERT INTO estoque (filial_id, produto_id, qtd) VALUES (?, ?, ?)", rows)
+        print(f"{FILE_ESTOQUE.name}: {len(rows)} saldos -> tabela estoque")
+
+        conn.execute("DELETE FROM estoque_mov")
+        movs = [mov for mov, _ in _ler_ledger(0)]
+        conn.executemany(
+            "INSERT INTO estoque_mov (seq, data, ts, filial_id, produto_id, delta, nf_id, item_id, tipo) "
+            "VALUES (:seq, :data, :ts, :filial_id, :produto_id, :delta, :nf_id, :item_id, :tipo)",
+            movs,
+        )
+        conn.execute("DELETE FROM estoque_snapshot")
+        snaps = _snapshots_estoque()
+        for snap_path in snaps:
+            snap = read_json(snap_path, {})
+            info = snap.get("ledger") or {}
+            conn.execute(
+                "INSERT INTO estoque_snapshot (seq, data, doc) VALUES (?, ?, ?)",
+                (int(info.get("seq", 0)), str(info.get("data", "")), json.dumps(snap.get("by_filial", {}))),
+            )
+        if not snaps:
+            # ledger ainda não começou: o estoque.json (anterior aos movimentos,
+            # se houver) vira o snapshot inicial, como faria _gravar_ledger_json
+            base = read_json(FILE_ESTOQUE, {"by_filial": {}}).get("by_filial", {})
+            conn.execute(
+                "INSERT INTO estoque_snapshot (seq, data, doc) VALUES (0, '0000-00-00', ?)", (json.dumps(base),)
+            )
+        print(f"{FILE_ESTOQUE_MOV.name}: {len(movs)} movimentos -> tabela estoque_mov")
+
+    print(f"\nBanco gerado: {FILE_DB}")
+    print("Para usar: defina a variável de ambiente SISTEMA_NFE_BACKEND=sqlite (ou STORE_BACKEND no código).")
+
 # =========================================================
 # (1) UF TABLE: bootstrap + import
 # =========================================================
@@ -282,6 +1211,92 @@ def load_tabela_uf() -> Dict[str, Dict[str, Any]]:
 
 def save_tabela_uf(ufs: Dict[str, Dict[str, Any]]) -> None:
     write_json(FILE_TBL_UF, {"updated_at": datetime.now().isoformat(timespec="seconds"), "ufs": ufs})
+    _invalidar_cache_uf()
+
+# =========================================================
+# UF: contexto fiscal pré-compilado (pares origem/destino)
+# =========================================================
+# código inteiro de cada UF (posição em UFS_BRASIL)
+UF_CODIGO = {uf: i for i, uf in enumerate(UFS_BRASIL)}
+
+class ContextoFiscal:
+    """
+    Alíquotas por par de UFs montadas uma vez por versão da tabela de UFs.
+
+    pares[(o * 27 + d) * 2 + importado] -> (p_interestadual, p_interna_dest,
+    p_fcp_dest, interestadual), com o/d = UF_CODIGO e importado 0/1 (nacional/
+    importado). interestadual (o != d) é a condição de UF do DIFAL; o resto
+    (consumidor final não contribuinte) vem da NF. Os valores são os mesmos
+    de aliq_interestadual e tabela_uf[uf_destino]; UF fora de UFS_BRASIL cai
+    no cálculo direto.
+    """
+
+    def __init__(self, ufs: Dict[str, Dict[str, Any]]) -> None:
+        self.ufs = ufs
+        n = len(UFS_BRASIL)
+        self.p_interna = [float(ufs.get(uf, {}).get("aliq_icms_interna", 0.0)) for uf in UFS_BRASIL]
+        self.p_fcp = [float(ufs.get(uf, {}).get("aliq_fcp", 0.0)) for uf in UFS_BRASIL]
+        self.pares: List[Tuple[float, float, float, bool]] = []
+        for o, uf_o in enumerate(UFS_BRASIL):
+            for d, uf_d in enumerate(UFS_BRASIL):
+                for importado in (0, 1):
+                    self.pares.append((aliq_interestadual(uf_o, uf_d, importado), self.p_interna[d], self.p_fcp[d], o != d))
+        self.n = n
+
+    def par(self, uf_origem: str, uf_destino: str, flag_importado: int) -> Tuple[float, float, float, bool]:
+        """(p_interestadual, p_interna_dest, p_fcp_dest, interestadual) para UFs já em maiúsculas."""
+        o = UF_CODIGO.get(uf_origem)
+        d = UF_CODIGO.get(uf_destino)
+        importado = 1 if int(flag_importado) == 1 else 0
+        if o is not None and d is not None:
+            return self.pares[(o * self.n + d) * 2 + importado]
+        uf_row = self.ufs.get(uf_destino, {})
+        return (
+            aliq_interestadual(uf_origem, uf_destino, importado),
+            float(uf_row.get("aliq_icms_interna", 0.0)),
+            float(uf_row.get("aliq_fcp", 0.0)),
+            uf_origem != uf_destino,
+        )
+
+class TabelaUF(dict):
+    """Tabela de UFs (compatível com dict) que carrega o ContextoFiscal."""
+    contexto: ContextoFiscal
+    versao: Optional[Tuple[int, int, int]] = None  # carimbo do arquivo (entra na impressão dos itens)
+
+def compilar_tabela_uf(ufs: Dict[str, Dict[str, Any]]) -> TabelaUF:
+    out = TabelaUF(ufs)
+    out.contexto = ContextoFiscal(out)
+    return out
+
+# cache da tabela de UFs já compilada (mesma ideia de _ST_CACHE)
+_UF_CACHE: Dict[str, Any] = {"stamp": None, "tabela": None}
+
+def _invalidar_cache_uf() -> None:
+    _UF_CACHE["stamp"] = None
+    _UF_CACHE["tabela"] = None
+
+@medir_fase("tabela.uf")
+def load_contexto_fiscal() -> TabelaUF:
+    """
+    Retorna a tabela de UFs compilada (TabelaUF com .contexto), preenchendo
+    as UFs genéricas se a tabela estiver vazia. Montada uma vez por versão do
+    arquivo; save_tabela_uf/import_uf_aliquotas_csv invalidam. Use em
+    calcular_impostos_item/aplicar_calculo_nf(s) no lugar de load_tabela_uf.
+    Não altere o dict retornado: para editar use load_tabela_uf/save_tabela_uf.
+    """
+    stamp = _stamp(FILE_TBL_UF)
+    if stamp is not None and _UF_CACHE["stamp"] == stamp:
+        return _UF_CACHE["tabela"]
+    ufs = load_tabela_uf()
+    if not ufs:
+        bootstrap_ufs_generic()
+        stamp = _stamp(FILE_TBL_UF)
+        ufs = load_tabela_uf()
+    tabela = compilar_tabela_uf(ufs)
+    tabela.versao = stamp
+    _UF_CACHE["stamp"] = stamp
+    _UF_CACHE["tabela"] = tabela
+    return tabela
 
 def bootstrap_ufs_generic() -> None:
     """
@@ -324,6 +1339,98 @@ def import_uf_aliquotas_csv(path: str) -> None:
     save_tabela_uf(tabela)
     print(f"Importação concluída. UFs carregadas: {len(tabela)}")
 
+# =========================================================
+# IMPORTAÇÃO CSV: leitura em lotes + linhas recusadas
+# =========================================================
+# Os importadores de produtos e regras ST leem o CSV em lotes de IMPORT_LOTE
+# linhas, validam cada linha e gravam lote a lote; o arquivo nunca fica
+# inteiro em memória. Linhas recusadas vão para <csv>.rejeitados.csv
+# (linha;motivo;colunas originais) e o resumo mostra linhas/s e os motivos.
+IMPORT_LOTE = 5000
+
+class LinhaInvalida(ValueError):
+    """Motivo de recusa de uma linha do CSV."""
+
+def _lotes_csv(reader: csv.DictReader, tamanho: int) -> Any:
+    """Gera listas de (nº da linha no arquivo, linha) com até `tamanho` itens."""
+    bloco: List[Tuple[int, Dict[str, Any]]] = []
+    for row in reader:
+        bloco.append((reader.line_num, row))
+        if len(bloco) >= tamanho:
+            yield bloco
+            bloco = []
+    if bloco:
+        yield bloco
+
+@lru_cache(maxsize=4096)
+def _data_iso_valida(s: str) -> bool:
+    try:
+        parse_date(s)
+    except ValueError:
+        return False
+    return True
+
+def _num_csv(row: Dict[str, Any], campo: str, padrao: str = "0") -> float:
+    valor = str(row.get(campo) or padrao).strip() or padrao
+    try:
+        return float(valor.replace(",", "."))
+    except ValueError:
+        raise LinhaInvalida(f"{campo} não numérico") from None
+
+def _int_csv(row: Dict[str, Any], campo: str, padrao: str = "0") -> int:
+    valor = str(row.get(campo) or padrao).strip() or padrao
+    try:
+        return int(valor)
+    except ValueError:
+        raise LinhaInvalida(f"{campo} não inteiro") from None
+
+class RelatorioImport:
+    """Contadores de uma importação e as linhas recusadas (gravadas conforme chegam)."""
+
+    def __init__(self, path: str, fieldnames: List[str]) -> None:
+        self.path_rejeitados = Path(path).with_suffix(".rejeitados.csv")
+        # o arquivo só é criado se houver recusa: apaga o da importação anterior
+        self.path_rejeitados.unlink(missing_ok=True)
+        self.fieldnames = list(fieldnames)
+        self.lidas = 0
+        self.contagem: Dict[str, int] = {}
+        self.motivos: Dict[str, int] = {}
+        self.rejeitadas = 0
+        self._fh: Any = None
+        self._writer: Any = None
+        self._t0 = time.perf_counter()
+
+    def contar(self, chave: str, n: int = 1) -> None:
+        self.contagem[chave] = self.contagem.get(chave, 0) + n
+
+    def rejeitar(self, linha: int, motivo: str, row: Dict[str, Any]) -> None:
+        if self._writer is None:
+            self._fh = self.path_rejeitados.open("w", encoding="utf-8", newline="")
+            self._writer = csv.writer(self._fh, delimiter=";")
+            self._writer.writerow(["linha", "motivo"] + self.fieldnames)
+        self._writer.writerow([linha, motivo] + [row.get(c, "") for c in self.fieldnames])
+        self.motivos[motivo] = self.motivos.get(motivo, 0) + 1
+        self.rejeitadas += 1
+
+    def fechar(self) -> None:
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+
+    def imprimir(self) -> None:
+        self.fechar()
+        dt = max(time.perf_counter() - self._t0, 1e-9)
+        partes = [f"Linhas lidas: {self.lidas}"]
+        partes += [f"{k}: {v}" for k, v in self.contagem.items()]
+        partes.append(f"Rejeitadas: {self.rejeitadas}")
+        print(" | ".join(partes))
+        print(f"Tempo: {dt:.2f}s ({self.lidas / dt:,.0f} linhas/s)")
+        if self.rejeitadas:
+            print("Motivos de recusa:")
+            for motivo, n in sorted(self.motivos.items(), key=lambda kv: -kv[1]):
+                print(f"  {motivo}: {n}")
+            print(f"Linhas recusadas em: {self.path_rejeitados}")
+
 # =========================================================
 # ST TABLE: load/save compat + ids + import + match
 # =========================================================
@@ -367,20 +1474,104 @@ def save_tabela_st_data(data: Dict[str, Any]) -> None:
     data = _normalize_st_file(data)
     data["updated_at"] = datetime.now().isoformat(timespec="seconds")
     write_json(FILE_TBL_ST, data)
+    _invalidar_cache_st()
 
+# cache do arquivo de regras já compilado (ver IndiceRegrasST)
+_ST_CACHE: Dict[str, Any] = {"stamp": None, "regras": None}
+
+def _invalidar_cache_st() -> None:
+    _ST_CACHE["stamp"] = None
+    _ST_CACHE["regras"] = None
+
+@medir_fase("tabela.st")
 def load_tabela_st() -> List[Dict[str, Any]]:
-    return load_tabela_st_data().get("regras", [])
+    """
+    Retorna as regras ST já com o índice compilado (RegrasST).
+    O índice é montado uma vez por versão do arquivo e refeito quando
+    save_tabela_st_data grava. Não altere a lista retornada: para editar
+    regras use load_tabela_st_data/save_tabela_st_data.
+    """
+    stamp = _stamp(FILE_TBL_ST)
+    if stamp is not None and _ST_CACHE["stamp"] == stamp:
+        return _ST_CACHE["regras"]
+    regras = compilar_regras_st(load_tabela_st_data().get("regras", []))
+    regras.versao = stamp
+    _ST_CACHE["stamp"] = stamp
+    _ST_CACHE["regras"] = regras
+    return regras
+
+def _regra_st_de_linha(row: Dict[str, Any]) -> Dict[str, Any]:
+    """Converte uma linha do CSV de regras ST (sem id) ou levanta LinhaInvalida."""
+    uf_or = (row.get("uf_origem") or "").strip().upper()
+    uf_de = (row.get("uf_destino") or "").strip().upper()
+    if not uf_or or not uf_de:
+        raise LinhaInvalida("uf_origem/uf_destino vazia")
+    if uf_or not in UFS_BRASIL:
+        raise LinhaInvalida("uf_origem inválida")
+    if uf_de not in UFS_BRASIL:
+        raise LinhaInvalida("uf_destino inválida")
+
+    r = {
+        "uf_origem": uf_or,
+        "uf_destino": uf_de,
+        "ncm": normalize_digits(str(row.get("ncm") or "").strip(), 8),
+        "cest": normalize_digits(str(row.get("cest") or "").strip(), 7),
+        "cfop": normalize_digits(str(row.get("cfop") or "").strip(), 4),
+        "mva": _num_csv(row, "mva"),
+        "red_bc_st": _num_csv(row, "red_bc_st"),
+        "aliq_icms_interna_dest": None,
+        "aliq_fcp_dest": None,
+        "vig_ini": str(row.get("vig_ini") or "").strip(),
+        "vig_fim": str(row.get("vig_fim") or "").strip(),
+        "prioridade": _int_csv(row, "prioridade"),
+        "ativo": _int_csv(row, "ativo", "1"),
+    }
+    if not r["vig_ini"]:
+        r["vig_ini"] = date.today().strftime("%Y-%m-%d")
+    for campo in ("vig_ini", "vig_fim"):
+        if r[campo] and not _data_iso_valida(r[campo]):
+            raise LinhaInvalida(f"{campo} fora do formato YYYY-MM-DD")
+    for campo in ("aliq_icms_interna_dest", "aliq_fcp_dest"):
+        if str(row.get(campo) or "").strip() != "":
+            r[campo] = _num_csv(row, campo)
+    return r
+
+def _assinatura_digest(r: Dict[str, Any]) -> bytes:
+    """
+    _rule_signature reduzida a 16 bytes: o conjunto de regras já vistas num
+    import grande ocupa uma fração do que ocuparia com as tuplas completas.
+    Números entram como float (18 e 18.0 são a mesma regra).
+    """
+    sig = [float(v) if isinstance(v, int) else v for v in _rule_signature(r)]
+    return hashlib.blake2b(repr(sig).encode("utf-8"), digest_size=16).digest()
+
+def _json_item_lista(rec: Dict[str, Any]) -> str:
+    # uma regra por linha: sem indent o json usa o encoder em C (bem mais rápido)
+    return "    " + json.dumps(rec, ensure_ascii=False)
 
-def import_st_regras_csv(path: str) -> None:
+def import_st_regras_csv(path: str, lote: int = IMPORT_LOTE) -> None:
+    """
+    Importa regras ST em lotes. Regras com a mesma assinatura de uma já
+    cadastrada (ou de uma linha anterior do arquivo) são recusadas.
+
+    As regras existentes e as novas são escritas direto num arquivo
+    temporário, lote a lote, que substitui a tabela no fim; só as
+    assinaturas (16 bytes cada) ficam em memória.
+    """
     title("Importar Regras ST (CSV)")
     if not os.path.exists(path):
         print("Arquivo não encontrado.")
         return
 
+    stamp = _stamp(FILE_TBL_ST)
     data = load_tabela_st_data()
     regras: List[Dict[str, Any]] = data.get("regras", [])
     seq = int(data.get("seq", 0) or 0)
+    vistas = {_assinatura_digest(r) for r in regras}
+    total_antes = len(regras)
 
+    ensure_data_dir()
+    tmp = FILE_TBL_ST.with_suffix(FILE_TBL_ST.suffix + ".import")
     with open(path, "r", encoding="utf-8-sig", newline="") as f:
         reader = csv.DictReader(f, delimiter=";")
         required = {
@@ -392,50 +1583,54 @@ def import_st_regras_csv(path: str) -> None:
             print(f"CSV inválido. Cabeçalho esperado: {sorted(required)}")
             return
 
-        count = 0
-        for row in reader:
-            uf_or = (row.get("uf_origem") or "").strip().upper()
-            uf_de = (row.get("uf_destino") or "").strip().upper()
-            if not uf_or or not uf_de:
-                continue
-
-            seq += 1
-            r = {
-                "id": seq,
-                "uf_origem": uf_or,
-                "uf_destino": uf_de,
-                "ncm": normalize_digits(str(row.get("ncm") or "").strip(), 8),
-                "cest": normalize_digits(str(row.get("cest") or "").strip(), 7),
-                "cfop": normalize_digits(str(row.get("cfop") or "").strip(), 4),
-                "mva": float(str(row.get("mva") or "0").replace(",", ".")),
-                "red_bc_st": float(str(row.get("red_bc_st") or "0").replace(",", ".")),
-                "aliq_icms_interna_dest": str(row.get("aliq_icms_interna_dest") or "").strip(),
-                "aliq_fcp_dest": str(row.get("aliq_fcp_dest") or "").strip(),
-                "vig_ini": str(row.get("vig_ini") or "").strip(),
-                "vig_fim": str(row.get("vig_fim") or "").strip(),
-                "prioridade": int(str(row.get("prioridade") or "0").strip() or "0"),
-                "ativo": int(str(row.get("ativo") or "1").strip() or "1"),
-            }
-            if not r["vig_ini"]:
-                r["vig_ini"] = date.today().strftime("%Y-%m-%d")
-
-            if r["aliq_icms_interna_dest"] != "":
-                r["aliq_icms_interna_dest"] = float(r["aliq_icms_interna_dest"].replace(",", "."))
-            else:
-                r["aliq_icms_interna_dest"] = None
-
-            if r["aliq_fcp_dest"] != "":
-                r["aliq_fcp_dest"] = float(r["aliq_fcp_dest"].replace(",", "."))
-            else:
-                r["aliq_fcp_dest"] = None
-
-            regras.append(r)
-            count += 1
-
-    data["seq"] = seq
-    data["regras"] = regras
-    save_tabela_st_data(data)
-    print(f"Importação concluída. Regras ST importadas: {count} | Total no sistema: {len(regras)}")
+        rel = RelatorioImport(path, reader.fieldnames)
+        try:
+            with tmp.open("w", encoding="utf-8") as out:
+                out.write("{\n")
+                out.write(f'  "updated_at": {json.dumps(datetime.now().isoformat(timespec="seconds"))},\n')
+                out.write('  "regras": [')
+                primeiro = True
+                for r in regras:
+                    out.write(("\n" if primeiro else ",\n") + _json_item_lista(r))
+                    primeiro = False
+                del regras
+                data.pop("regras", None)
+
+                for bloco in _lotes_csv(reader, lote):
+                    partes = []
+                    for linha, row in bloco:
+                        rel.lidas += 1
+                        try:
+                            r = _regra_st_de_linha(row)
+                        except LinhaInvalida as e:
+                            rel.rejeitar(linha, str(e), row)
+                            continue
+                        dig = _assinatura_digest(r)
+                        if dig in vistas:
+                            rel.rejeitar(linha, "regra duplicada (mesma assinatura)", row)
+                            continue
+                        vistas.add(dig)
+                        seq += 1
+                        partes.append(_json_item_lista({"id": seq, **r}))
+                    if partes:
+                        out.write(("\n" if primeiro else ",\n") + ",\n".join(partes))
+                        primeiro = False
+                    rel.contar("Importadas", len(partes))
+                out.write("\n  ]" if not primeiro else "]")
+                out.write(f',\n  "seq": {seq}\n}}')
+
+            with trava_dados():
+                if _stamp(FILE_TBL_ST) != stamp:
+                    raise ConflitoVersao(f"{FILE_TBL_ST.name} foi alterado durante a importação; importe de novo.")
+                tmp.replace(FILE_TBL_ST)
+            _invalidar_cache_st()
+        finally:
+            rel.fechar()
+            if tmp.exists():
+                tmp.unlink()
+
+    rel.imprimir()
+    print(f"Importação concluída. Regras ST importadas: {rel.contagem.get('Importadas', 0)} | Total no sistema: {total_antes + rel.contagem.get('Importadas', 0)}")
 
 def in_vigencia(vig_ini: str, vig_fim: str, dt: str) -> bool:
     d = parse_date(dt)
@@ -454,6 +1649,37 @@ def spec_score(rule: Dict[str, Any]) -> int:
     if rule.get("cfop"): score += 1
     return score
 
+# Uma regra vale para um par (uf_origem, uf_destino) ou para um conjunto:
+# uf_origem/uf_destino podem ser listas de UFs, e "excluir_iguais": 1 tira
+# os pares origem=destino do produto cartesiano. A regra em conjunto casa
+# exatamente como as cópias por par que ela substitui.
+def ufs_regra(v: Any) -> List[str]:
+    """uf_origem/uf_destino de uma regra como lista (UF única ou conjunto)."""
+    if isinstance(v, (list, tuple)):
+        return [str(x).upper() for x in v]
+    return [str(v if v is not None else "").upper()]
+
+def pares_regra(r: Dict[str, Any]) -> List[Tuple[str, str]]:
+    excluir = int(r.get("excluir_iguais", 0) or 0) == 1
+    return [
+        (o, d)
+        for o in ufs_regra(r.get("uf_origem", ""))
+        for d in ufs_regra(r.get("uf_destino", ""))
+        if not (excluir and o == d)
+    ]
+
+def regra_cobre(r: Dict[str, Any], uf_origem: str, uf_destino: str) -> bool:
+    o, d = r.get("uf_origem", ""), r.get("uf_destino", "")
+    if not isinstance(o, (list, tuple)) and not isinstance(d, (list, tuple)):
+        return str(o).upper() == uf_origem and str(d).upper() == uf_destino
+    if int(r.get("excluir_iguais", 0) or 0) == 1 and uf_origem == uf_destino:
+        return False
+    return uf_origem in ufs_regra(o) and uf_destino in ufs_regra(d)
+
+def ufs_texto(v: Any) -> str:
+    return ",".join(ufs_regra(v))
+
+@medir_fase("st.regra")
 def escolher_regra_st(
     regras: List[Dict[str, Any]],
     uf_origem: str,
@@ -463,6 +1689,10 @@ def escolher_regra_st(
     cfop: str,
     data_emissao: str
 ) -> Optional[Dict[str, Any]]:
+    indice = getattr(regras, "indice", None)
+    if indice is not None:
+        return indice.escolher(uf_origem, uf_destino, ncm, cest, cfop, data_emissao)
+
     uf_origem = (uf_origem or "").upper()
     uf_destino = (uf_destino or "").upper()
     ncm = normalize_digits(ncm, 8)
@@ -473,9 +1703,7 @@ def escolher_regra_st(
     for r in regras:
         if int(r.get("ativo", 1)) != 1:
             continue
-        if str(r.get("uf_origem","")).upper() != uf_origem:
-            continue
-        if str(r.get("uf_destino","")).upper() != uf_destino:
+        if not regra_cobre(r, uf_origem, uf_destino):
             continue
         if not in_vigencia(str(r.get("vig_ini","1900-01-01")), str(r.get("vig_fim","")), data_emissao):
             continue
@@ -499,6 +1727,101 @@ def escolher_regra_st(
     candidatas.sort(key=lambda x: (int(x.get("prioridade",0)), spec_score(x)), reverse=True)
     return candidatas[0]
 
+# =========================================================
+# ST: índice compilado (UF origem/destino -> camadas NCM/CEST/CFOP)
+# =========================================================
+class IndiceRegrasST:
+    """
+    Índice das regras ST montado uma vez por carga da tabela.
+
+    buckets[(uf_origem, uf_destino)][(ncm, cest, cfop)] -> lista de entradas,
+    onde cada campo vazio da chave é curinga (camada de especificidade).
+    Regra com conjunto de UFs entra no bucket de cada par que cobre.
+    Cada entrada: (prioridade, spec_score, posição, ini, fim, vig_raw, regra),
+    com a vigência já convertida para ordinal de data. A lista de cada camada
+    fica ordenada por (prioridade desc, spec desc, posição asc), que é
+    exatamente a ordem do sort estável usado em escolher_regra_st.
+    """
+
+    def __init__(self, regras: List[Dict[str, Any]]) -> None:
+        self.buckets: Dict[Tuple[str, str], Dict[Tuple[str, str, str], List[tuple]]] = {}
+        for pos, r in enumerate(regras):
+            if int(r.get("ativo", 1)) != 1:
+                continue
+            chave = (
+                normalize_digits(str(r.get("ncm","")), 8),
+                normalize_digits(str(r.get("cest","")), 7),
+                normalize_digits(str(r.get("cfop","")), 4),
+            )
+            vig_ini = str(r.get("vig_ini","1900-01-01"))
+            vig_fim = str(r.get("vig_fim",""))
+            try:
+                ini = parse_date(vig_ini).toordinal()
+                fim = parse_date(vig_fim).toordinal() if vig_fim else None
+                vig_raw = None
+            except ValueError:
+                # vigência inválida: mantém o texto para falhar igual à varredura
+                ini = fim = None
+                vig_raw = (vig_ini, vig_fim)
+            entrada = (int(r.get("prioridade",0)), spec_score(r), pos, ini, fim, vig_raw, r)
+            for par in pares_regra(r):
+                self.buckets.setdefault(par, {}).setdefault(chave, []).append(entrada)
+
+        for camadas in self.buckets.values():
+            for lst in camadas.values():
+                lst.sort(key=lambda e: (-e[0], -e[1], e[2]))
+
+    def escolher(
+        self,
+        uf_origem: str,
+        uf_destino: str,
+        ncm: str,
+        cest: str,
+        cfop: str,
+        data_emissao: str
+    ) -> Optional[Dict[str, Any]]:
+        camadas = self.buckets.get(((uf_origem or "").upper(), (uf_destino or "").upper()))
+        if not camadas:
+            return None
+
+        d = parse_date(data_emissao).toordinal()
+        ncm = normalize_digits(ncm, 8)
+        cest = normalize_digits(cest, 7)
+        cfop = normalize_digits(cfop, 4)
+
+        melhor: Optional[tuple] = None
+        examinadas = 0
+        for n in {ncm, ""}:
+            for c in {cest, ""}:
+                for f in {cfop, ""}:
+                    lst = camadas.get((n, c, f))
+                    if not lst:
+                        continue
+                    for e in lst:
+                        examinadas += 1
+                        if e[5] is not None:
+                            if not in_vigencia(e[5][0], e[5][1], data_emissao):
+                                continue
+                        elif d < e[3] or (e[4] is not None and d > e[4]):
+                            continue
+                        if melhor is None or (e[0], e[1], -e[2]) > (melhor[0], melhor[1], -melhor[2]):
+                            melhor = e
+                        break
+        op = _OP_MEDIDA.op
+        if op is not None:
+            op["examinadas"] += examinadas
+        return melhor[6] if melhor else None
+
+class RegrasST(list):
+    """Lista de regras ST (compatível com list) que carrega o índice compilado."""
+    indice: IndiceRegrasST
+    versao: Optional[Tuple[int, int, int]] = None  # carimbo do arquivo (entra na impressão dos itens)
+
+def compilar_regras_st(regras: List[Dict[str, Any]]) -> RegrasST:
+    out = RegrasST(regras)
+    out.indice = IndiceRegrasST(out)
+    return out
+
 # =========================================================
 # (AUTOMAÇÃO) Parâmetros padrão prontos (gera CSV e importa)
 # =========================================================
@@ -568,7 +1891,8 @@ def listar_regras_st(limit: int = 200) -> List[Dict[str, Any]]:
     regras_sorted = sorted(regras, key=lambda r: int(r.get("id",0)), reverse=True)[:limit]
     for r in regras_sorted:
         print(
-            f"[{r.get('id')}] {r.get('uf_origem')}->{r.get('uf_destino')} | "
+            f"[{r.get('id')}] {ufs_texto(r.get('uf_origem'))}->{ufs_texto(r.get('uf_destino'))}"
+            f"{' (sem origem=destino)' if int(r.get('excluir_iguais', 0) or 0) == 1 else ''} | "
             f"NCM={r.get('ncm','')} CEST={r.get('cest','')} CFOP={r.get('cfop','')} | "
             f"MVA={r.get('mva',0)} Red={r.get('red_bc_st',0)} | "
             f"vig {r.get('vig_ini')}..{r.get('vig_fim','')} | pri={r.get('prioridade',0)} ativo={r.get('ativo',1)}"
@@ -627,8 +1951,9 @@ def _rule_signature(r: Dict[str, Any]) -> Tuple:
     Assinatura usada para evitar duplicatas “idênticas”.
     """
     return (
-        str(r.get("uf_origem","")).upper(),
-        str(r.get("uf_destino","")).upper(),
+        ufs_texto(r.get("uf_origem","")),
+        ufs_texto(r.get("uf_destino","")),
+        int(r.get("excluir_iguais", 0) or 0),
         str(r.get("ncm","")),
         str(r.get("cest","")),
         str(r.get("cfop","")),
@@ -665,15 +1990,15 @@ def duplicar_regra_st_em_lote() -> None:
     print(" 1) Manter ORIGEM da base e escolher múltiplos DESTINOS")
     print(" 2) Manter DESTINO da base e escolher múltiplas ORIGENS")
     print(" 3) Cartesiano: ORIGENS x DESTINOS")
-    print(" 4) Todas as UFs (27x26) usando a regra base (atenção: gera muitas regras)")
+    print(" 4) Todas as UFs (27x26) usando a regra base")
     modo = ask_int("Modo [3]: ", required=False, min_v=1) or 3
 
     if modo == 1:
-        origens = [str(base.get("uf_origem","")).upper()]
+        origens = ufs_regra(base.get("uf_origem",""))
         destinos = parse_uf_list(ask_str("Destinos (ex.: MG,RJ,ES ou TODAS): "))
     elif modo == 2:
         origens = parse_uf_list(ask_str("Origens (ex.: SP,PR,SC ou TODAS): "))
-        destinos = [str(base.get("uf_destino","")).upper()]
+        destinos = ufs_regra(base.get("uf_destino",""))
     elif modo == 4:
         origens = list(UFS_BRASIL)
         destinos = list(UFS_BRASIL)
@@ -696,41 +2021,177 @@ def duplicar_regra_st_em_lote() -> None:
         vig_ini = str(base.get("vig_ini","")) or date.today().strftime("%Y-%m-%d")
         vig_fim = str(base.get("vig_fim","") or "")
 
-    # evita duplicatas por assinatura
-    existing = set(_rule_signature(r) for r in regras)
-    seq = int(data.get("seq", 0) or 0)
-    created = 0
-    skipped = 0
-
-    for uf_or in origens:
-        for uf_de in destinos:
-            if excluir_iguais and uf_or == uf_de:
-                continue
-
-            newr = dict(base)
-            # id novo
-            newr["id"] = None
-            newr["uf_origem"] = uf_or
-            newr["uf_destino"] = uf_de
-            newr["vig_ini"] = vig_ini
-            newr["vig_fim"] = vig_fim
-
-            sig = _rule_signature(newr)
-            if sig in existing:
-                skipped += 1
-                continue
+    # uma única regra com os conjuntos de UFs (em vez de uma cópia por par);
+    # pares que já têm uma regra idêntica ficam de fora
+    modelo = dict(base)
+    modelo.pop("excluir_iguais", None)
+    modelo["vig_ini"] = vig_ini
+    modelo["vig_fim"] = vig_fim
+    carga = _carga_regra_st(modelo)
+    existentes = {par for r in regras if _carga_regra_st(r) == carga for par in pares_regra(r)}
+    pedidos = [(o, d) for o in origens for d in destinos if not (excluir_iguais and o == d)]
+    pares = [par for par in pedidos if par not in existentes]
+    if not pares:
+        print(f"\nNada a criar: todos os pares já têm essa regra. Total: {len(regras)}")
+        return
 
-            seq += 1
-            newr["id"] = seq
-            regras.append(newr)
-            existing.add(sig)
-            created += 1
+    seq = int(data.get("seq", 0) or 0)
+    novas = []
+    for ufs_or, ufs_de, excluir in _retangulos_ufs(pares):
+        seq += 1
+        novas.append(_regra_st_em_conjunto(modelo, seq, ufs_or, ufs_de, excluir))
+    regras.extend(novas)
 
     data["seq"] = seq
     data["regras"] = regras
     save_tabela_st_data(data)
 
-    print(f"\nDuplicação concluída. Criadas: {created} | Ignoradas (já existiam): {skipped} | Total: {len(regras)}")
+    ids = ", ".join(str(r["id"]) for r in novas)
+    print(f"\nDuplicação concluída. Regras criadas: {len(novas)} (ID {ids}) cobrindo {len(pares)} pares UF | "
+          f"Ignorados (já existiam): {len(pedidos) - len(pares)} | Total: {len(regras)}")
+
+# =========================================================
+# ST: regras por conjunto de UFs (montagem e compactação)
+# =========================================================
+def _carga_regra_st(r: Dict[str, Any]) -> str:
+    """Tudo da regra menos id e UFs: cópias por par de uma mesma regra têm a mesma carga."""
+    resto = {k: v for k, v in r.items() if k not in ("id", "uf_origem", "uf_destino", "excluir_iguais")}
+    return json.dumps(resto, sort_keys=True, ensure_ascii=False)
+
+def _ordem_ufs(ufs: Any) -> List[str]:
+    return sorted(ufs, key=lambda uf: (UF_CODIGO.get(uf, len(UFS_BRASIL)), uf))
+
+def _retangulos_ufs(pares: Any) -> List[Tuple[List[str], List[str], int]]:
+    """
+    Cobre um conjunto de pares (origem, destino) com poucos produtos
+    ORIGENS x DESTINOS (opcionalmente sem origem=destino). Origens com o
+    mesmo conjunto de destinos viram um produto só; 27x26 vira uma regra.
+    """
+    por_origem: Dict[str, set] = {}
+    for o, d in pares:
+        por_origem.setdefault(o, set()).add(d)
+
+    cont_simples: Dict[frozenset, int] = {}
+    cont_excl: Dict[frozenset, int] = {}
+    for o, ds in por_origem.items():
+        k = frozenset(ds)
+        cont_simples[k] = cont_simples.get(k, 0) + 1
+        if o not in ds:
+            k = frozenset(ds | {o})
+            cont_excl[k] = cont_excl.get(k, 0) + 1
+
+    grupos: Dict[Tuple[frozenset, int], List[str]] = {}
+    for o, ds in por_origem.items():
+        chave = (frozenset(ds), 0)
+        if o not in ds and cont_excl[frozenset(ds | {o})] > cont_simples[frozenset(ds)]:
+            chave = (frozenset(ds | {o}), 1)
+        grupos.setdefault(chave, []).append(o)
+
+    out = [(_ordem_ufs(origens), _ordem_ufs(ds), excl) for (ds, excl), origens in grupos.items()]
+    out.sort(key=lambda x: [UF_CODIGO.get(uf, len(UFS_BRASIL)) for uf in x[0]])
+    return out
+
+def _regra_st_em_conjunto(modelo: Dict[str, Any], rid: int, origens: List[str], destinos: List[str], excluir: int) -> Dict[str, Any]:
+    r = {"id": rid, **{k: v for k, v in modelo.items() if k != "id"}}
+    r["uf_origem"] = origens[0] if len(origens) == 1 else origens
+    r["uf_destino"] = destinos[0] if len(destinos) == 1 else destinos
+    r.pop("excluir_iguais", None)
+    if excluir and set(origens) & set(destinos):
+        r["excluir_iguais"] = 1
+    return r
+
+def _sequencias_st(regras: List[Dict[str, Any]], buckets: set) -> Dict[Tuple, List[str]]:
+    """
+    Para cada bucket (uf_origem, uf_destino, ncm, cest, cfop) pedido, as cargas
+    das regras ativas na ordem em que IndiceRegrasST as testa. Mesma sequência
+    em todos os buckets = mesma regra escolhida para qualquer NF.
+    """
+    seqs: Dict[Tuple, List[Tuple[int, int, str]]] = {}
+    for pos, r in enumerate(regras):
+        if int(r.get("ativo", 1)) != 1:
+            continue
+        chave = (
+            normalize_digits(str(r.get("ncm","")), 8),
+            normalize_digits(str(r.get("cest","")), 7),
+            normalize_digits(str(r.get("cfop","")), 4),
+        )
+        carga = None
+        for par in pares_regra(r):
+            b = par + chave
+            if b in buckets:
+                carga = carga or _carga_regra_st(r)
+                seqs.setdefault(b, []).append((-int(r.get("prioridade",0)), pos, carga))
+    return {b: [c for _, _, c in sorted(lst)] for b, lst in seqs.items()}
+
+def compactar_regras_st_lista(regras: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Junta cópias de uma mesma regra (mesma carga, UFs diferentes) em regras
+    por conjunto de UFs, na posição da primeira cópia e reaproveitando os
+    IDs das cópias. Só aplica um agrupamento se a ordem de teste das regras
+    continuar igual em todos os pares que ele cobre; os demais ficam como estão.
+    """
+    por_carga: Dict[str, List[int]] = {}
+    for pos, r in enumerate(regras):
+        por_carga.setdefault(_carga_regra_st(r), []).append(pos)
+
+    grupos = []
+    for posicoes in por_carga.values():
+        if len(posicoes) < 2:
+            continue
+        pares = {par for p in posicoes for par in pares_regra(regras[p])}
+        retangulos = _retangulos_ufs(pares)
+        if len(retangulos) >= len(posicoes):
+            continue
+        base = regras[posicoes[0]]
+        ids = sorted(int(regras[p].get("id", 0) or 0) for p in posicoes)
+        novas = [_regra_st_em_conjunto(base, rid, o, d, e) for rid, (o, d, e) in zip(ids, retangulos)]
+        chave = (
+            normalize_digits(str(base.get("ncm","")), 8),
+            normalize_digits(str(base.get("cest","")), 7),
+            normalize_digits(str(base.get("cfop","")), 4),
+        )
+        grupos.append({"posicoes": posicoes, "novas": novas, "buckets": {par + chave for par in pares}})
+
+    aplicar = list(range(len(grupos)))
+    while aplicar:
+        primeira: Dict[int, int] = {}
+        removidas = set()
+        for g in aplicar:
+            primeira[grupos[g]["posicoes"][0]] = g
+            removidas.update(grupos[g]["posicoes"])
+        nova: List[Dict[str, Any]] = []
+        for pos, r in enumerate(regras):
+            if pos in primeira:
+                nova.extend(grupos[primeira[pos]]["novas"])
+            elif pos not in removidas:
+                nova.append(r)
+
+        buckets = set().union(*(grupos[g]["buckets"] for g in aplicar))
+        antes = _sequencias_st(regras, buckets)
+        depois = _sequencias_st(nova, buckets)
+        ruins = {b for b in buckets if antes.get(b) != depois.get(b)}
+        if not ruins:
+            return nova
+        aplicar = [g for g in aplicar if not (grupos[g]["buckets"] & ruins)]
+    return list(regras)
+
+def compactar_regras_st() -> None:
+    title("Compactar regras ST (cópias por UF -> conjuntos de UFs)")
+    stamp = _stamp(FILE_TBL_ST)
+    data = load_tabela_st_data()
+    regras = data.get("regras", [])
+    antes = len(regras)
+    t0 = time.perf_counter()
+    nova = compactar_regras_st_lista(regras)
+    if len(nova) == antes:
+        print(f"Nada a compactar. Regras: {antes}")
+        return
+    data["regras"] = nova
+    with trava_dados():
+        if _stamp(FILE_TBL_ST) != stamp:
+            raise ConflitoVersao(f"{FILE_TBL_ST.name} foi alterado durante a compactação; rode de novo.")
+        save_tabela_st_data(data)
+    print(f"Regras: {antes} -> {len(nova)} | tempo: {time.perf_counter() - t0:.2f}s")
 
 def remover_regra_st() -> None:
     title("Remover regra ST")
@@ -789,6 +2250,19 @@ def calc_difal_fcp(
     uf_rem = round(difal_total - uf_dest, 2)
     return {"v_difal_total": difal_total, "v_icms_ufdest": uf_dest, "v_icms_ufremet": uf_rem, "v_fcp_ufdest": v_fcp_ufdest}
 
+def regra_st_aplicada(regra: Dict[str, Any], uf_origem: str, uf_destino: str, p_mva: float, p_red: float) -> Dict[str, Any]:
+    """Resumo da regra ST usada no item; regra em conjunto de UFs registra o par da NF."""
+    return {
+        "id": regra.get("id"),
+        "uf_origem": uf_origem if isinstance(regra.get("uf_origem"), (list, tuple)) else regra.get("uf_origem"),
+        "uf_destino": uf_destino if isinstance(regra.get("uf_destino"), (list, tuple)) else regra.get("uf_destino"),
+        "ncm": regra.get("ncm",""), "cest": regra.get("cest",""), "cfop": regra.get("cfop",""),
+        "mva": p_mva, "red_bc_st": p_red,
+        "vig_ini": regra.get("vig_ini"), "vig_fim": regra.get("vig_fim",""),
+        "prioridade": regra.get("prioridade",0),
+    }
+
+@medir_fase("impostos.item")
 def calcular_impostos_item(
     uf_origem: str,
     uf_destino: str,
@@ -807,11 +2281,15 @@ def calcular_impostos_item(
     uf_origem = uf_origem.upper()
     uf_destino = uf_destino.upper()
 
-    p_inter = aliq_interestadual(uf_origem, uf_destino, int(flag_importado))
-
-    uf_row = tabela_uf.get(uf_destino, {})
-    p_interna = float(uf_row.get("aliq_icms_interna", 0.0))
-    p_fcp = float(uf_row.get("aliq_fcp", 0.0))
+    contexto = getattr(tabela_uf, "contexto", None)
+    if contexto is not None:
+        p_inter, p_interna, p_fcp, interestadual = contexto.par(uf_origem, uf_destino, flag_importado)
+    else:
+        p_inter = aliq_interestadual(uf_origem, uf_destino, int(flag_importado))
+        uf_row = tabela_uf.get(uf_destino, {})
+        p_interna = float(uf_row.get("aliq_icms_interna", 0.0))
+        p_fcp = float(uf_row.get("aliq_fcp", 0.0))
+        interestadual = uf_origem != uf_destino
 
     out: Dict[str, Any] = {
         "p_interestadual": p_inter,
@@ -822,7 +2300,7 @@ def calcular_impostos_item(
         "regra_st_aplicada": None,
     }
 
-    if ind_final == 1 and ind_ie_dest == 9 and uf_origem != uf_destino:
+    if ind_final == 1 and ind_ie_dest == 9 and interestadual:
         out["difal"] = calc_difal_fcp(v_operacao, p_interna, p_fcp, p_inter, 100.0)
 
     if aplicar_st == 1:
@@ -834,68 +2312,607 @@ def calcular_impostos_item(
             p_fcp_eff = float(regra.get("aliq_fcp_dest", p_fcp) or p_fcp)
 
             out["st"] = calc_st(v_operacao, p_interna_eff, p_fcp_eff, p_mva, p_red, p_inter)
-            out["regra_st_aplicada"] = {
-                "id": regra.get("id"),
-                "uf_origem": regra.get("uf_origem"), "uf_destino": regra.get("uf_destino"),
-                "ncm": regra.get("ncm",""), "cest": regra.get("cest",""), "cfop": regra.get("cfop",""),
-                "mva": p_mva, "red_bc_st": p_red,
-                "vig_ini": regra.get("vig_ini"), "vig_fim": regra.get("vig_fim",""),
-                "prioridade": regra.get("prioridade",0),
-            }
+            out["regra_st_aplicada"] = regra_st_aplicada(regra, uf_origem, uf_destino, p_mva, p_red)
 
     return out
 
 # =========================================================
-# ESTOQUE
+# CÁLCULOS vetorizados (NumPy opcional)
 # =========================================================
-def load_estoque() -> Dict[str, Any]:
-    return read_json(FILE_ESTOQUE, {"by_filial": {}})
+# Mesmas fórmulas de calc_item_totais/calc_st/calc_difal_fcp aplicadas a
+# vetores inteiros. As operações são feitas na mesma ordem das versões
+# escalares e round2_vec reproduz round(x, 2) do Python, então o resultado
+# é idêntico bit a bit. Sem NumPy instalado tudo cai no cálculo item a item.
+VETOR_MIN_ITENS = 256  # abaixo disso o laço escalar é mais rápido
 
-def save_estoque(data: Dict[str, Any]) -> None:
-    write_json(FILE_ESTOQUE, data)
+def _numpy() -> Any:
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+def round2_vec(x: Any) -> Any:
+    """round(x, 2) do Python para cada elemento de um array float64."""
+    np = _numpy()
+    y = x * 100.0
+    out = np.rint(y) / 100.0
+    # perto de k+0,5 o produto x*100 pode cair do lado errado do empate;
+    # esses (raros) elementos são refeitos com o round do Python
+    duvida = np.abs(y - np.floor(y) - 0.5) <= 1e-6 * np.maximum(1.0, np.abs(y))
+    if duvida.any():
+        idx = np.nonzero(duvida)[0]
+        out[idx] = [round(v, 2) for v in x[idx].tolist()]
+    return out
 
-def get_stock(estoque: Dict[str, Any], filial_id: int, produto_id: int) -> float:
-    return float(estoque.get("by_filial", {}).get(str(filial_id), {}).get(str(produto_id), 0.0))
+def _max0_vec(x: Any) -> Any:
+    # igual a max(x, 0.0): preserva -0.0 e NaN como o max() do Python
+    return _numpy().where(x < 0.0, 0.0, x)
 
-def set_stock(estoque: Dict[str, Any], filial_id: int, produto_id: int, qty: float) -> None:
-    estoque.setdefault("by_filial", {}).setdefault(str(filial_id), {})[str(produto_id)] = round(float(qty), 4)
+def calc_item_totais_vec(qtd: Any, v_unit: Any, desconto: Any, frete: Any, seguro: Any, outras: Any) -> Tuple[Any, Any]:
+    v_bruto = round2_vec(qtd * v_unit)
+    v_total = round2_vec(v_bruto - desconto + frete + seguro + outras)
+    return v_bruto, v_total
 
-def apply_stock_delta(estoque: Dict[str, Any], filial_id: int, produto_id: int, delta: float) -> Tuple[bool, str]:
-    current = get_stock(estoque, filial_id, produto_id)
-    new = current + float(delta)
-    if not ALLOW_NEGATIVE_STOCK and new < -1e-9:
-        return False, f"Estoque insuficiente. Atual={current} | Delta={delta} | Resultaria={new}"
-    set_stock(estoque, filial_id, produto_id, new)
-    return True, ""
+def calc_st_vec(
+    v_operacao: Any,
+    p_icms_interna_dest: Any,
+    p_fcp_dest: Any,
+    p_mva: Any,
+    p_red_bc_st: Any,
+    p_icms_inter: Any
+) -> Dict[str, Any]:
+    mva_factor = 1.0 + (p_mva / 100.0)
+    red_factor = 1.0 - (p_red_bc_st / 100.0)
 
-# =========================================================
-# CADASTROS / IMPORTS
-# =========================================================
-def listar_filiais(active_only: bool = True) -> List[Dict[str, Any]]:
-    store = load_store(FILE_FILIAIS)
-    items = store.get("items", [])
-    if active_only:
-        items = [x for x in items if int(x.get("ativo",1)) == 1]
-    if not items:
-        print("Nenhuma filial cadastrada.")
-        return []
-    for x in items:
-        print(f"[{x['id']}] {x['nome']} - UF {x['uf']} | ativo={x.get('ativo',1)}")
-    return items
+    v_bc_st = round2_vec(v_operacao * mva_factor * red_factor)
+    v_icms_proprio = round2_vec(v_operacao * (p_icms_inter / 100.0))
+    v_icms_st = _max0_vec(round2_vec((v_bc_st * (p_icms_interna_dest / 100.0)) - v_icms_proprio))
+    v_fcp_st = round2_vec(v_bc_st * (p_fcp_dest / 100.0))
 
-def cadastrar_filial() -> None:
-    title("Cadastrar Filial")
-    store = load_store(FILE_FILIAIS)
-    _id = next_id(store)
-    nome = ask_str("Nome: ")
-    uf = ask_uf("UF: ")
-    store["items"].append(asdict(Filial(id=_id, nome=nome, uf=uf, ativo=1)))
-    save_store(FILE_FILIAIS, store)
-    print("Filial cadastrada.")
+    return {"v_bc_st": v_bc_st, "v_icms_proprio": v_icms_proprio, "v_icms_st": v_icms_st, "v_fcp_st": v_fcp_st}
 
-def listar_pessoas(active_only: bool = True) -> List[Dict[str, Any]]:
-    store = load_store(FILE_PESSOAS)
-    items = store.get("items", [])
+def calc_difal_fcp_vec(
+    v_operacao: Any,
+    p_icms_interna_dest: Any,
+    p_fcp_dest: Any,
+    p_icms_inter: Any,
+    partilha_ufdest_pct: Any = 100.0
+) -> Dict[str, Any]:
+    difal_total = _max0_vec(round2_vec(v_operacao * ((p_icms_interna_dest - p_icms_inter) / 100.0)))
+    v_fcp_ufdest = round2_vec(v_operacao * (p_fcp_dest / 100.0))
+    uf_dest = round2_vec(difal_total * (partilha_ufdest_pct / 100.0))
+    uf_rem = round2_vec(difal_total - uf_dest)
+    return {"v_difal_total": difal_total, "v_icms_ufdest": uf_dest, "v_icms_ufremet": uf_rem, "v_fcp_ufdest": v_fcp_ufdest}
+
+@medir_fase("impostos.lote")
+def calcular_impostos_lote(
+    linhas: List[Dict[str, Any]],
+    tabela_uf: Dict[str, Any],
+    tabela_st_regras: List[Dict[str, Any]]
+) -> List[Dict[str, Any]]:
+    """
+    Versão em lote de calcular_impostos_item. Cada linha traz os mesmos
+    argumentos nomeados (uf_origem, uf_destino, ind_final, ind_ie_dest,
+    flag_importado, data_emissao, cfop, ncm, cest, v_operacao e, opcional,
+    aplicar_st). A escolha da regra ST continua item a item (pelo índice);
+    alíquotas viram vetores e bases/impostos saem numa passada só.
+    """
+    np = _numpy()
+    if np is None or len(linhas) < VETOR_MIN_ITENS:
+        return [calcular_impostos_item(tabela_uf=tabela_uf, tabela_st_regras=tabela_st_regras, **ln) for ln in linhas]
+
+    n = len(linhas)
+    outs: List[Dict[str, Any]] = []
+    v_op = np.empty(n)
+    p_inter = np.empty(n)
+    p_interna = np.empty(n)
+    p_fcp = np.empty(n)
+    idx_difal: List[int] = []
+    idx_st: List[int] = []
+    st_params: List[Tuple[float, float, float, float]] = []
+
+    contexto = getattr(tabela_uf, "contexto", None) or ContextoFiscal(tabela_uf)
+    for i, ln in enumerate(linhas):
+        uf_origem = str(ln["uf_origem"]).upper()
+        uf_destino = str(ln["uf_destino"]).upper()
+        pi, pint, pfcp, interestadual = contexto.par(uf_origem, uf_destino, ln["flag_importado"])
+        v_op[i] = float(ln["v_operacao"])
+        p_inter[i] = pi
+        p_interna[i] = pint
+        p_fcp[i] = pfcp
+
+        out: Dict[str, Any] = {
+            "p_interestadual": pi,
+            "p_interna_dest": pint,
+            "p_fcp_dest": pfcp,
+            "difal": None,
+            "st": None,
+            "regra_st_aplicada": None,
+        }
+        if ln["ind_final"] == 1 and ln["ind_ie_dest"] == 9 and interestadual:
+            idx_difal.append(i)
+
+        if ln.get("aplicar_st", 1) == 1:
+            regra = escolher_regra_st(tabela_st_regras, uf_origem, uf_destino, ln["ncm"], ln["cest"], ln["cfop"], ln["data_emissao"])
+            if regra:
+                p_mva = float(regra.get("mva", 0.0))
+                p_red = float(regra.get("red_bc_st", 0.0))
+                p_interna_eff = float(regra.get("aliq_icms_interna_dest", pint) or pint)
+                p_fcp_eff = float(regra.get("aliq_fcp_dest", pfcp) or pfcp)
+                idx_st.append(i)
+                st_params.append((p_interna_eff, p_fcp_eff, p_mva, p_red))
+                out["regra_st_aplicada"] = regra_st_aplicada(regra, uf_origem, uf_destino, p_mva, p_red)
+        outs.append(out)
+
+    if idx_difal:
+        ix = np.array(idx_difal)
+        df = calc_difal_fcp_vec(v_op[ix], p_interna[ix], p_fcp[ix], p_inter[ix], 100.0)
+        cols = {k: v.tolist() for k, v in df.items()}
+        for j, i in enumerate(idx_difal):
+            outs[i]["difal"] = {k: cols[k][j] for k in ("v_difal_total", "v_icms_ufdest", "v_icms_ufremet", "v_fcp_ufdest")}
+
+    if idx_st:
+        ix = np.array(idx_st)
+        prm = np.array(st_params)
+        st = calc_st_vec(v_op[ix], prm[:, 0], prm[:, 1], prm[:, 2], prm[:, 3], p_inter[ix])
+        cols = {k: v.tolist() for k, v in st.items()}
+        for j, i in enumerate(idx_st):
+            outs[i]["st"] = {k: cols[k][j] for k in ("v_bc_st", "v_icms_proprio", "v_icms_st", "v_fcp_st")}
+
+    return outs
+
+def aplicar_calculo_nfs(
+    nfs: List[Dict[str, Any]],
+    tabela_uf: Dict[str, Any],
+    tabela_st: List[Dict[str, Any]],
+    ind_ie_dest_de: Callable[[int], int],
+    flag_importado_de: Callable[[int], int]
+) -> None:
+    """
+    aplicar_calculo_nf para várias NFs de uma vez: com NumPy e itens
+    suficientes, totais de item e impostos de todas as NFs saem numa
+    passada vetorizada (sempre completa, já renovando as impressões dos
+    itens); os totais da NF continuam somados item a item.
+    """
+    np = _numpy()
+    todos = [(nf, it) for nf in nfs for it in nf.get("itens", [])]
+    if np is None or len(todos) < VETOR_MIN_ITENS:
+        for nf in nfs:
+            aplicar_calculo_nf(nf, tabela_uf, tabela_st, ind_ie_dest_de(int(nf["destinatario_id"])), flag_importado_de)
+        return
+
+    cols = {k: np.array([float(it.get(k, 0.0)) for _, it in todos]) for k in ("qtd", "v_unit", "desconto", "frete", "seguro", "outras")}
+    v_bruto, v_total = calc_item_totais_vec(cols["qtd"], cols["v_unit"], cols["desconto"], cols["frete"], cols["seguro"], cols["outras"])
+    v_bruto = v_bruto.tolist()
+    v_total = v_total.tolist()
+
+    ind_ie = {id(nf): ind_ie_dest_de(int(nf["destinatario_id"])) for nf in nfs}
+    linhas = []
+    for i, (nf, it) in enumerate(todos):
+        it["v_bruto"] = v_bruto[i]
+        it["v_total"] = v_total[i]
+        linhas.append({
+            "uf_origem": str(nf["uf_origem"]),
+            "uf_destino": str(nf["uf_destino"]),
+            "ind_final": int(nf.get("ind_final", 0)),
+            "ind_ie_dest": ind_ie[id(nf)],
+            "flag_importado": flag_importado_de(int(it["produto_id"])),
+            "data_emissao": str(nf["data_emissao"]),
+            "cfop": str(it.get("cfop","")),
+            "ncm": str(it.get("ncm","")),
+            "cest": str(it.get("cest","")),
+            "v_operacao": v_total[i],
+        })
+
+    versao = _versao_calculo(tabela_uf, tabela_st)
+    for (nf, it), ln, impostos in zip(todos, linhas, calcular_impostos_lote(linhas, tabela_uf, tabela_st)):
+        it["impostos"] = impostos
+        if versao is None:
+            it.pop("calc", None)
+        else:
+            fp = impressao_item(nf, it, ln["ind_ie_dest"], ln["flag_importado"], versao)
+            it["calc"] = {"fp": fp, "parcelas": _parcelas_item(it)}
+    for nf in nfs:
+        nf["totais"] = totais_nf(nf.get("itens", []))
+        somas = _somas_de_itens(nf.get("itens", [])) if versao is not None else None
+        if somas is None:
+            nf.pop("somas", None)
+        else:
+            nf["somas"] = somas
+
+# =========================================================
+# ESTOQUE
+# =========================================================
+# Saldo atual = último snapshot (data/estoque.json) + movimentos gravados
+# depois dele no ledger append-only (data/estoque_mov.jsonl, uma linha por
+# movimento com filial/produto/NF/item). Emitir e cancelar só acrescentam
+# linhas; a cada ESTOQUE_SNAPSHOT_CADA movimentos o saldo vira um novo
+# snapshot, também arquivado em data/estoque_snapshots/ para responder
+# "qual era o saldo em tal data" sem replicar o ledger inteiro.
+# A data do movimento é a data em que ele foi lançado (não a da NF).
+ESTOQUE_SNAPSHOT_CADA = 5000
+
+class Estoque(dict):
+    """
+    {"by_filial": {filial: {produto: qtd}}} com os movimentos ainda não
+    gravados (_movs). Depois de save_estoque, ultimo_lote referencia no
+    ledger os movimentos gravados (usado para estornar a NF no cancelamento).
+    """
+    _movs: List[Dict[str, Any]]
+    ultimo_lote: Optional[Dict[str, Any]] = None
+    _seq: int = 0
+    _offset: int = 0
+    _data: str = ""
+    _snap_seq: int = 0
+
+def _ler_ledger(offset: int) -> Any:
+    """Gera (movimento, offset_final) a partir de offset; para numa linha incompleta."""
+    if not FILE_ESTOQUE_MOV.exists():
+        return
+    with FILE_ESTOQUE_MOV.open("rb") as f:
+        f.seek(offset)
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            offset += len(line)
+            if line.strip():
+                yield json.loads(line), offset
+
+def _aplicar_mov(by_filial: Dict[str, Dict[str, float]], mov: Dict[str, Any]) -> None:
+    mp = by_filial.setdefault(str(mov["filial_id"]), {})
+    key = str(mov["produto_id"])
+    mp[key] = round(float(mp.get(key, 0.0)) + float(mov["delta"]), 4)
+
+def _ler_estoque_json() -> Estoque:
+    data = read_json(FILE_ESTOQUE, {"by_filial": {}})
+    est = Estoque({"by_filial": data.get("by_filial", {})})
+    est._movs = []
+    info = data.get("ledger") or {}
+    est._seq = est._snap_seq = int(info.get("seq", 0) or 0)
+    est._data = str(info.get("data", "") or "")
+    est._offset = int(info.get("offset", 0) or 0)
+    _replicar_ledger(est)
+    return est
+
+def _replicar_ledger(est: Estoque) -> None:
+    for mov, fim in _ler_ledger(est._offset):
+        _aplicar_mov(est["by_filial"], mov)
+        est._seq = int(mov["seq"])
+        est._data = str(mov["data"])
+        est._offset = fim
+
+def _snapshots_estoque() -> List[Path]:
+    if not DIR_ESTOQUE_SNAP.exists():
+        return []
+    return sorted(DIR_ESTOQUE_SNAP.glob("estoque_*.json"))
+
+def _gravar_snapshot_estoque(est: Estoque, seq: int, offset: int, data: str) -> None:
+    snap = {"by_filial": est["by_filial"], "ledger": {"seq": seq, "offset": offset, "data": data}}
+    DIR_ESTOQUE_SNAP.mkdir(parents=True, exist_ok=True)
+    write_json(DIR_ESTOQUE_SNAP / f"estoque_{seq:010d}_{data or '0000-00-00'}.json", snap)
+    write_json(FILE_ESTOQUE, snap)
+    est._snap_seq = seq
+
+def _gravar_ledger_json(est: Estoque) -> None:
+    ensure_data_dir()
+    if not FILE_ESTOQUE_MOV.exists() and not _snapshots_estoque():
+        # primeira gravação: o estoque.json antigo vira o snapshot inicial
+        base = Estoque(read_json(FILE_ESTOQUE, {"by_filial": {}}))
+        base.setdefault("by_filial", {})
+        _gravar_snapshot_estoque(base, 0, 0, "")
+
+    size = FILE_ESTOQUE_MOV.stat().st_size if FILE_ESTOQUE_MOV.exists() else 0
+    if size != est._offset:
+        # outra gravação entrou depois da leitura (ou sobrou linha incompleta):
+        # incorpora o que estiver completo e descarta o resto
+        _replicar_ledger(est)
+        if FILE_ESTOQUE_MOV.stat().st_size != est._offset:
+            with FILE_ESTOQUE_MOV.open("r+b") as f:
+                f.truncate(est._offset)
+        if not ALLOW_NEGATIVE_STOCK:
+            for mov in est._movs:
+                saldo = get_stock(est, mov["filial_id"], mov["produto_id"])
+                if mov["delta"] < 0 and saldo < -1e-9:
+                    raise ConflitoVersao(
+                        f"estoque: saldo do produto {mov['produto_id']} (filial {mov['filial_id']}) "
+                        f"mudou em outro processo e ficaria {saldo}; recarregue e repita a operação."
+                    )
+
+    inicio = est._offset
+    hoje = date.today().strftime("%Y-%m-%d")
+    ts = datetime.now().isoformat(timespec="seconds")
+    linhas = []
+    for mov in est._movs:
+        est._seq += 1
+        mov.update(seq=est._seq, data=hoje, ts=ts)
+        linhas.append(json.dumps(mov, ensure_ascii=False, separators=(",", ":")))
+    payload = ("\n".join(linhas) + "\n").encode("utf-8")
+    with FILE_ESTOQUE_MOV.open("ab") as f:
+        f.write(payload)
+        f.flush()
+        os.fsync(f.fileno())
+    est._offset = inicio + len(payload)
+    est._data = hoje
+    est.ultimo_lote = {"seq": est._seq - len(linhas) + 1, "n": len(linhas), "offset": inicio}
+
+    if est._seq - est._snap_seq >= ESTOQUE_SNAPSHOT_CADA:
+        _gravar_snapshot_estoque(est, est._seq, est._offset, est._data)
+
+@medir_fase("estoque.load")
+def load_estoque() -> Dict[str, Any]:
+    if usa_sqlite():
+        return EstoqueSqlite()
+    return _ler_estoque_json()
+
+def estoque_atualizado(est: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Para quem mantém o estoque em memória entre consultas (ex.: API): traz
+    para est os movimentos gravados no ledger desde a leitura, sem reler o
+    snapshot. Estoque com movimentos pendentes, ou de outro backend, é relido.
+    """
+    if usa_sqlite() or not isinstance(est, Estoque) or est._movs:
+        return load_estoque()
+    size = FILE_ESTOQUE_MOV.stat().st_size if FILE_ESTOQUE_MOV.exists() else 0
+    if size < est._offset:
+        return load_estoque()
+    if size > est._offset:
+        _replicar_ledger(est)
+    return est
+
+# Estoque mantido entre emissões/cancelamentos (como _STORES_ABERTOS): cada uso
+# só replica o fim do ledger. Com movimentos pendentes (operação que falhou no
+# meio), estoque_atualizado relê do disco.
+_ESTOQUE_ABERTO: Dict[str, Any] = {"est": None}
+
+def estoque_aberto() -> Dict[str, Any]:
+    est = _ESTOQUE_ABERTO["est"] = estoque_atualizado(_ESTOQUE_ABERTO["est"])
+    return est
+
+@medir_fase("estoque.save")
+def save_estoque(data: Dict[str, Any]) -> None:
+    if isinstance(data, EstoqueSqlite):
+        data.gravar()
+        return
+    if isinstance(data, Estoque):
+        if data._movs:
+            with trava_dados():
+                _gravar_ledger_json(data)
+            data._movs = []
+        return
+    write_json(FILE_ESTOQUE, data)
+
+def get_stock(estoque: Dict[str, Any], filial_id: int, produto_id: int) -> float:
+    if isinstance(estoque, EstoqueSqlite):
+        return estoque.saldo(filial_id, produto_id)
+    return float(estoque.get("by_filial", {}).get(str(filial_id), {}).get(str(produto_id), 0.0))
+
+def set_stock(estoque: Dict[str, Any], filial_id: int, produto_id: int, qty: float) -> None:
+    """Ajusta o saldo para qty (lançado no ledger como movimento AJUSTE)."""
+    delta = round(float(qty), 4) - get_stock(estoque, filial_id, produto_id)
+    _movimentar(estoque, filial_id, produto_id, delta, {"tipo": "AJUSTE"}, round(float(qty), 4))
+
+@medir_fase("estoque.lancar")
+def apply_stock_delta(
+    estoque: Dict[str, Any],
+    filial_id: int,
+    produto_id: int,
+    delta: float,
+    ref: Optional[Dict[str, Any]] = None
+) -> Tuple[bool, str]:
+    """
+    ref: origem do movimento no ledger, ex. {"tipo": "EMISSAO", "nf_id": 1, "item_id": 2}.
+    """
+    current = get_stock(estoque, filial_id, produto_id)
+    new = current + float(delta)
+    if not ALLOW_NEGATIVE_STOCK and new < -1e-9:
+        return False, f"Estoque insuficiente. Atual={current} | Delta={delta} | Resultaria={new}"
+    _movimentar(estoque, filial_id, produto_id, float(delta), ref or {"tipo": "AJUSTE"}, round(new, 4))
+    return True, ""
+
+def _movimentar(estoque: Dict[str, Any], filial_id: int, produto_id: int, delta: float, ref: Dict[str, Any], novo: float) -> None:
+    if isinstance(estoque, EstoqueSqlite):
+        estoque.definir(filial_id, produto_id, novo)
+    else:
+        estoque.setdefault("by_filial", {}).setdefault(str(filial_id), {})[str(produto_id)] = novo
+    if isinstance(estoque, Estoque):
+        estoque._movs.append({
+            "filial_id": int(filial_id),
+            "produto_id": int(produto_id),
+            "delta": float(delta),
+            "nf_id": ref.get("nf_id"),
+            "item_id": ref.get("item_id"),
+            "tipo": ref.get("tipo", "AJUSTE"),
+        })
+
+def movimentos_emissao_nf(nf: Dict[str, Any]) -> Optional[List[Dict[str, Any]]]:
+    """
+    Movimentos lançados na emissão da NF (pela referência gravada em
+    nf["estoque_mov"]). None para NFs emitidas antes do ledger existir.
+    """
+    ref = nf.get("estoque_mov")
+    if not ref:
+        return None
+    nf_id = int(nf["id"])
+    if usa_sqlite():
+        rows = _sql_conn().execute(
+            "SELECT seq, data, ts, filial_id, produto_id, delta, nf_id, item_id, tipo FROM estoque_mov "
+            "WHERE nf_id = ? AND tipo = 'EMISSAO' ORDER BY seq",
+            (nf_id,),
+        ).fetchall()
+        cols = ["seq", "data", "ts", "filial_id", "produto_id", "delta", "nf_id", "item_id", "tipo"]
+        return [dict(zip(cols, r)) for r in rows]
+
+    movs: List[Dict[str, Any]] = []
+    for mov, _ in _ler_ledger(int(ref.get("offset", 0))):
+        if len(movs) >= int(ref.get("n", 0)):
+            break
+        movs.append(mov)
+    if len(movs) == int(ref.get("n", 0)) and all(m.get("nf_id") == nf_id and m.get("tipo") == "EMISSAO" for m in movs):
+        return movs
+    # referência não bate (ledger copiado/reconstruído): procura no ledger todo
+    return [m for m, _ in _ler_ledger(0) if m.get("nf_id") == nf_id and m.get("tipo") == "EMISSAO"]
+
+def estoque_em(data_ref: str) -> Dict[str, Dict[str, float]]:
+    """
+    Saldo por filial/produto no fim do dia data_ref (YYYY-MM-DD): parte do
+    snapshot mais recente até essa data e replica os movimentos seguintes.
+    """
+    if usa_sqlite():
+        return _sql_estoque_em(data_ref)
+
+    snaps = _snapshots_estoque()
+    if not snaps:
+        # ledger ainda não começou: só existe o saldo atual
+        return _ler_estoque_json()["by_filial"]
+    base: Dict[str, Any] = {"by_filial": {}, "ledger": {"offset": 0}}
+    for snap_path in reversed(snaps):
+        snap_data = snap_path.stem.split("_")[-1]
+        if snap_data == "0000-00-00" or snap_data <= data_ref:
+            base = read_json(snap_path, base)
+            break
+    by_filial = base.get("by_filial", {})
+    for mov, _ in _ler_ledger(int((base.get("ledger") or {}).get("offset", 0))):
+        if str(mov["data"]) > data_ref:
+            break
+        _aplicar_mov(by_filial, mov)
+    return by_filial
+
+class EstoqueSqlite(Estoque):
+    """
+    Estoque do backend SQLite: get_stock/set_stock leem e gravam saldo a saldo;
+    estoque["by_filial"] monta o mapa completo só quando alguém pede. Os
+    movimentos vão para estoque_mov na mesma transação dos saldos.
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self._movs = []
+        self._saldos: Dict[Tuple[int, int], float] = {}
+        self._sujos: set = set()
+
+    def __missing__(self, key: str) -> Any:
+        if key != "by_filial":
+            raise KeyError(key)
+        by: Dict[str, Dict[str, float]] = {}
+        for fid, pid, qtd in _sql_conn().execute("SELECT filial_id, produto_id, qtd FROM estoque"):
+            by.setdefault(str(fid), {})[str(pid)] = float(qtd)
+        for (fid, pid), qtd in self._saldos.items():
+            by.setdefault(str(fid), {})[str(pid)] = qtd
+        dict.__setitem__(self, "by_filial", by)
+        return by
+
+    def get(self, key: str, default: Any = None) -> Any:
+        if key == "by_filial" and not dict.__contains__(self, "by_filial"):
+            return self["by_filial"]
+        return dict.get(self, key, default)
+
+    def saldo(self, filial_id: int, produto_id: int) -> float:
+        k = (int(filial_id), int(produto_id))
+        if k not in self._saldos:
+            row = _sql_conn().execute(
+                "SELECT qtd FROM estoque WHERE filial_id = ? AND produto_id = ?", k
+            ).fetchone()
+            self._saldos[k] = float(row[0]) if row else 0.0
+        return self._saldos[k]
+
+    def definir(self, filial_id: int, produto_id: int, qty: float) -> None:
+        k = (int(filial_id), int(produto_id))
+        self._saldos[k] = qty
+        self._sujos.add(k)
+        if dict.__contains__(self, "by_filial"):
+            self["by_filial"].setdefault(str(k[0]), {})[str(k[1])] = qty
+
+    def gravar(self) -> None:
+        if not self._sujos and not self._movs:
+            return
+        hoje = date.today().strftime("%Y-%m-%d")
+        ts = datetime.now().isoformat(timespec="seconds")
+        with _sql_tx() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO estoque (filial_id, produto_id, qtd) VALUES (?, ?, ?)",
+                [(f, p, self._saldos[(f, p)]) for f, p in sorted(self._sujos)],
+            )
+            seq = int(conn.execute("SELECT coalesce(max(seq), 0) FROM estoque_mov").fetchone()[0])
+            ini = seq + 1
+            for mov in self._movs:
+                seq += 1
+                mov.update(seq=seq, data=hoje, ts=ts)
+            conn.executemany(
+                "INSERT INTO estoque_mov (seq, data, ts, filial_id, produto_id, delta, nf_id, item_id, tipo) "
+                "VALUES (:seq, :data, :ts, :filial_id, :produto_id, :delta, :nf_id, :item_id, :tipo)",
+                self._movs,
+            )
+            if self._movs:
+                self.ultimo_lote = {"seq": ini, "n": len(self._movs)}
+                snap_seq = int(conn.execute("SELECT coalesce(max(seq), 0) FROM estoque_snapshot").fetchone()[0])
+                if seq - snap_seq >= ESTOQUE_SNAPSHOT_CADA:
+                    by: Dict[str, Dict[str, float]] = {}
+                    for fid, pid, qtd in conn.execute("SELECT filial_id, produto_id, qtd FROM estoque"):
+                        by.setdefault(str(fid), {})[str(pid)] = float(qtd)
+                    conn.execute(
+                        "INSERT INTO estoque_snapshot (seq, data, doc) VALUES (?, ?, ?)",
+                        (seq, hoje, json.dumps(by)),
+                    )
+        self._sujos.clear()
+        self._movs = []
+
+def _sql_estoque_em(data_ref: str) -> Dict[str, Dict[str, float]]:
+    conn = _sql_conn()
+    row = conn.execute(
+        "SELECT seq, doc FROM estoque_snapshot WHERE data <= ? OR seq = 0 ORDER BY seq DESC LIMIT 1", (data_ref,)
+    ).fetchone()
+    seq, by_filial = (int(row[0]), json.loads(row[1])) if row else (0, {})
+    for fid, pid, delta in conn.execute(
+        "SELECT filial_id, produto_id, delta FROM estoque_mov WHERE seq > ? AND data <= ? ORDER BY seq",
+        (seq, data_ref),
+    ):
+        _aplicar_mov(by_filial, {"filial_id": fid, "produto_id": pid, "delta": delta})
+    return by_filial
+
+def visualizar_estoque_em_data() -> None:
+    title("Estoque em uma data (por filial)")
+    data_ref = ask_date_yyyy_mm_dd("Data (YYYY-MM-DD) [hoje]: ", required=False, default_today=True)
+    by_filial = estoque_em(data_ref)
+    if not by_filial:
+        print("Sem saldo nessa data.")
+        return
+    prod_store = load_store(FILE_PRODUTOS)
+    for fkey, mp in sorted(by_filial.items(), key=lambda kv: int(kv[0])):
+        print(f"\nFilial [{fkey}] em {data_ref}")
+        for pkey, qty in sorted(mp.items(), key=lambda kv: int(kv[0])):
+            prod = find_by_id(prod_store, int(pkey)) or {}
+            print(f"  {prod.get('sku', f'PID{pkey}')} | {prod.get('descricao', '')} => {qty}")
+
+# =========================================================
+# CADASTROS / IMPORTS
+# =========================================================
+def listar_filiais(active_only: bool = True) -> List[Dict[str, Any]]:
+    store = load_store(FILE_FILIAIS)
+    items = store.get("items", [])
+    if active_only:
+        items = [x for x in items if int(x.get("ativo",1)) == 1]
+    if not items:
+        print("Nenhuma filial cadastrada.")
+        return []
+    for x in items:
+        print(f"[{x['id']}] {x['nome']} - UF {x['uf']} | ativo={x.get('ativo',1)}")
+    return items
+
+def cadastrar_filial() -> None:
+    title("Cadastrar Filial")
+    store = load_store(FILE_FILIAIS)
+    _id = next_id(store)
+    nome = ask_str("Nome: ")
+    uf = ask_uf("UF: ")
+    rec = asdict(Filial(id=_id, nome=nome, uf=uf, ativo=1))
+    append_record(store, rec)
+    save_store(FILE_FILIAIS, store, changed=[rec])
+    print("Filial cadastrada.")
+
+def listar_pessoas(active_only: bool = True) -> List[Dict[str, Any]]:
+    store = load_store(FILE_PESSOAS)
+    items = store.get("items", [])
     if active_only:
         items = [x for x in items if int(x.get("ativo",1)) == 1]
     if not items:
@@ -918,8 +2935,9 @@ def cadastrar_pessoa() -> None:
     ind_ie_dest = ask_int("Indicador IE (1=Contribuinte,2=Isento,9=Não contribuinte): ", required=True, min_v=1) or 9
     if ind_ie_dest not in (1,2,9):
         ind_ie_dest = 9
-    store["items"].append(asdict(Pessoa(id=_id, nome=nome, tipo=tipo, documento=documento, uf=uf, ind_ie_dest=ind_ie_dest, ativo=1)))
-    save_store(FILE_PESSOAS, store)
+    rec = asdict(Pessoa(id=_id, nome=nome, tipo=tipo, documento=documento, uf=uf, ind_ie_dest=ind_ie_dest, ativo=1))
+    append_record(store, rec)
+    save_store(FILE_PESSOAS, store, changed=[rec])
     print("Pessoa cadastrada.")
 
 def listar_produtos(active_only: bool = True) -> List[Dict[str, Any]]:
@@ -945,21 +2963,42 @@ def cadastrar_produto() -> None:
     preco = ask_float("Preço venda: ", required=True, min_v=0.0) or 0.0
     flag_importado = ask_int("Produto importado (RSF 13/2012)? 1=Sim 0=Não: ", required=True, min_v=0) or 0
     flag_importado = 1 if flag_importado == 1 else 0
-    store["items"].append(asdict(Produto(id=_id, sku=sku, descricao=descricao, ncm=ncm, cest=cest, preco_venda=float(preco), flag_importado=flag_importado, ativo=1)))
-    save_store(FILE_PRODUTOS, store)
+    rec = asdict(Produto(id=_id, sku=sku, descricao=descricao, ncm=ncm, cest=cest, preco_venda=float(preco), flag_importado=flag_importado, ativo=1))
+    append_record(store, rec)
+    save_store(FILE_PRODUTOS, store, changed=[rec])
+    indexar_produtos(store, [rec])
     print("Produto cadastrado.")
 
-def import_produtos_csv(path: str) -> None:
+def _produto_de_linha(row: Dict[str, Any]) -> Dict[str, Any]:
+    """Campos de produto de uma linha do CSV ou LinhaInvalida."""
+    sku = (row.get("sku") or "").strip().upper()
+    if not sku:
+        raise LinhaInvalida("sku vazio")
+    preco = _num_csv(row, "preco_venda")
+    if preco < 0:
+        raise LinhaInvalida("preco_venda negativo")
+    flag = _int_csv(row, "flag_importado")
+    return {
+        "sku": sku,
+        "descricao": (row.get("descricao") or "").strip(),
+        "ncm": normalize_digits(str(row.get("ncm") or ""), 8),
+        "cest": normalize_digits(str(row.get("cest") or ""), 7),
+        "preco_venda": preco,
+        "flag_importado": 1 if flag == 1 else 0,
+    }
+
+def import_produtos_csv(path: str, lote: int = IMPORT_LOTE) -> None:
+    """
+    Importa produtos em lotes: SKU já cadastrado (ou repetido no arquivo) é
+    atualizado, SKU novo é inserido. Cada lote é gravado de uma vez (uma
+    linha no journal / uma transação no SQLite).
+    """
     title("Importar Produtos (CSV)")
     if not os.path.exists(path):
         print("Arquivo não encontrado.")
         return
 
     store = load_store(FILE_PRODUTOS)
-    existing = {str(x.get("sku","")).strip().upper(): x for x in store.get("items", [])}
-
-    inserted = 0
-    updated = 0
 
     with open(path, "r", encoding="utf-8-sig", newline="") as f:
         reader = csv.DictReader(f, delimiter=";")
@@ -968,49 +3007,312 @@ def import_produtos_csv(path: str) -> None:
             print(f"CSV inválido. Cabeçalho esperado: {sorted(required)}")
             return
 
-        for row in reader:
-            sku = (row.get("sku") or "").strip().upper()
-            if not sku:
-                continue
-            desc = (row.get("descricao") or "").strip()
-            ncm = normalize_digits(str(row.get("ncm") or ""), 8)
-            cest = normalize_digits(str(row.get("cest") or ""), 7)
-            preco = float(str(row.get("preco_venda") or "0").replace(",", "."))
-            flag = int(str(row.get("flag_importado") or "0").strip() or "0")
-            flag = 1 if flag == 1 else 0
-
-            if sku in existing:
-                p = existing[sku]
-                p["descricao"] = desc
-                p["ncm"] = ncm
-                p["cest"] = cest
-                p["preco_venda"] = preco
-                p["flag_importado"] = flag
-                updated += 1
-            else:
-                pid = next_id(store)
-                store["items"].append(asdict(Produto(id=pid, sku=sku, descricao=desc, ncm=ncm, cest=cest, preco_venda=preco, flag_importado=flag, ativo=1)))
-                inserted += 1
+        rel = RelatorioImport(path, reader.fieldnames)
+        try:
+            for bloco in _lotes_csv(reader, lote):
+                changed: Dict[int, Dict[str, Any]] = {}
+                for linha, row in bloco:
+                    rel.lidas += 1
+                    try:
+                        campos = _produto_de_linha(row)
+                    except LinhaInvalida as e:
+                        rel.rejeitar(linha, str(e), row)
+                        continue
+                    p = find_by_sku(store, campos["sku"])
+                    if p is not None:
+                        if all(p.get(k) == v for k, v in campos.items()):
+                            rel.contar("Sem alteração")
+                            continue
+                        p.update(campos)
+                        rel.contar("Atualizados")
+                    else:
+                        p = asdict(Produto(id=next_id(store), ativo=1, **campos))
+                        append_record(store, p)
+                        rel.contar("Inseridos")
+                    changed[int(p["id"])] = p
+                if changed:
+                    save_store(FILE_PRODUTOS, store, changed=list(changed.values()))
+                    indexar_produtos(store, list(changed.values()), salvar=False)
+                    if isinstance(store, SqliteStore):
+                        store.descartar_cache()
+        finally:
+            rel.fechar()
+            salvar_indice_busca()
+
+    rel.imprimir()
+    print(f"Importação concluída. Inseridos: {rel.contagem.get('Inseridos', 0)} | Atualizados: {rel.contagem.get('Atualizados', 0)}")
 
-    save_store(FILE_PRODUTOS, store)
-    print(f"Importação concluída. Inseridos: {inserted} | Atualizados: {updated}")
+# =========================================================
+# BUSCA DE PRODUTOS: índice persistente (SKU/EAN, prefixo, trigramas)
+# =========================================================
+# data/produtos_busca.idx guarda, para cada produto, o registro e o texto
+# "sku descricao" em minúsculas, mais:
+#   - SKU e EAN -> ids (busca exata do item);
+#   - lista ordenada de SKUs (busca por prefixo com bisect);
+#   - trigrama do texto -> ids (busca por trecho da descrição).
+# O índice lembra até que ponto do journal de produtos.json está atualizado e
+# aplica só as linhas novas (de qualquer processo); se o snapshot mudou, ou no
+# SQLite se a versão da tabela não é a seguinte à indexada, é refeito.
+# Os trigramas de um produto alterado não são apagados: toda busca confere o
+# texto atual, então entradas antigas só viram candidatos descartados.
+FILE_BUSCA_IDX = DATA_DIR / "produtos_busca.idx"
+BUSCA_SALVAR_CADA = 1000
+_BUSCA: Dict[str, Any] = {"idx": None, "chave": None}
+
+def _trigramas(texto: str) -> set:
+    return {texto[i:i + 3] for i in range(len(texto) - 2)}
+
+class IndiceBusca:
+    def __init__(self) -> None:
+        self.docs: Dict[int, Dict[str, Any]] = {}
+        self.textos: Dict[int, str] = {}
+        self.por_sku: Dict[str, List[int]] = {}
+        self.por_ean: Dict[str, List[int]] = {}
+        self.skus: List[Tuple[str, int]] = []
+        self.tri: Dict[str, array] = {}
+        self.fonte: Dict[str, Any] = {}
+        self.pendentes = 0
+
+    def estado(self) -> Dict[str, Any]:
+        # dict simples: o pickle não depende do nome do módulo (script ou import)
+        return {
+            "formato": 1, "docs": self.docs, "textos": self.textos, "por_sku": self.por_sku,
+            "por_ean": self.por_ean, "skus": self.skus, "tri": self.tri, "fonte": self.fonte,
+        }
+
+    @classmethod
+    def de_estado(cls, st: Dict[str, Any]) -> "IndiceBusca":
+        idx = cls()
+        for k in ("docs", "textos", "por_sku", "por_ean", "skus", "tri", "fonte"):
+            setattr(idx, k, st[k])
+        return idx
+
+    def remover(self, rid: int, da_lista_skus: bool = True) -> None:
+        old = self.docs.pop(rid, None)
+        self.textos.pop(rid, None)
+        if old is None:
+            return
+        sku = str(old.get("sku", "")).upper()
+        ids = self.por_sku.get(sku, [])
+        if rid in ids:
+            ids.remove(rid)
+            if not ids:
+                del self.por_sku[sku]
+        ean = str(old.get("ean", "") or "")
+        if ean and rid in self.por_ean.get(ean, []):
+            self.por_ean[ean].remove(rid)
+            if not self.por_ean[ean]:
+                del self.por_ean[ean]
+        if da_lista_skus:
+            i = bisect.bisect_left(self.skus, (sku, rid))
+            if i < len(self.skus) and self.skus[i] == (sku, rid):
+                del self.skus[i]
+
+    def aplicar(self, rec: Dict[str, Any]) -> None:
+        rid = int(rec.get("id", 0))
+        old_texto = self.textos.get(rid)
+        self.remover(rid)
+        self._incluir(rec, old_texto, ordenar=True)
+
+    def aplicar_lote(self, recs: List[Dict[str, Any]]) -> None:
+        """Como aplicar() para muitos registros: a lista de SKUs é reordenada uma vez só."""
+        if len(recs) < 64:
+            for rec in recs:
+                self.aplicar(rec)
+            return
+        ultimos = {int(rec.get("id", 0)): rec for rec in recs}
+        old_textos = {rid: self.textos.get(rid) for rid in ultimos}
+        saindo = [rid for rid in ultimos if rid in self.docs]
+        for rid in saindo:
+            self.remover(rid, da_lista_skus=False)
+        if saindo:
+            fora = set(saindo)
+            self.skus = [t for t in self.skus if t[1] not in fora]
+        for rid, rec in ultimos.items():
+            self._incluir(rec, old_textos[rid], ordenar=False)
+        self.skus.sort()
+
+    def _incluir(self, rec: Dict[str, Any], old_texto: Optional[str], ordenar: bool) -> None:
+        rid = int(rec.get("id", 0))
+        rec = dict(rec)
+        sku = str(rec.get("sku", "")).upper()
+        texto = f"{rec.get('sku','')} {rec.get('descricao','')}".lower()
+        self.docs[rid] = rec
+        self.textos[rid] = texto
+        self.por_sku.setdefault(sku, []).append(rid)
+        ean = str(rec.get("ean", "") or "")
+        if ean:
+            self.por_ean.setdefault(ean, []).append(rid)
+        if ordenar:
+            bisect.insort(self.skus, (sku, rid))
+        else:
+            self.skus.append((sku, rid))
+        novos = _trigramas(texto)
+        if old_texto is not None:
+            novos -= _trigramas(old_texto)
+        tri = self.tri
+        for t in novos:
+            lst = tri.get(t)
+            if lst is None:
+                lst = tri[t] = array("i")
+            lst.append(rid)
+        self.pendentes += 1
+
+    def _ativos(self, ids: Any) -> List[Dict[str, Any]]:
+        out = []
+        for rid in ids:
+            rec = self.docs.get(rid)
+            if rec is not None and int(rec.get("ativo", 1)) == 1:
+                out.append(rec)
+        return out
+
+    def buscar_codigo(self, codigo: str) -> Optional[Dict[str, Any]]:
+        """Produto ativo com o SKU (sem diferenciar maiúsculas) ou EAN exato."""
+        codigo = (codigo or "").strip()
+        hits = self._ativos(sorted(self.por_sku.get(codigo.upper(), [])))
+        if not hits and codigo:
+            hits = self._ativos(sorted(self.por_ean.get(codigo, [])))
+        return hits[0] if hits else None
+
+    def buscar_prefixo(self, prefixo: str, limit: int = 10) -> List[Dict[str, Any]]:
+        prefixo = (prefixo or "").strip().upper()
+        out: List[Dict[str, Any]] = []
+        i = bisect.bisect_left(self.skus, (prefixo, -1))
+        while i < len(self.skus) and len(out) < limit:
+            sku, rid = self.skus[i]
+            if not sku.startswith(prefixo):
+                break
+            out += self._ativos([rid])
+            i += 1
+        return out
+
+    def buscar_texto(self, q: str, limit: int = 10) -> List[Dict[str, Any]]:
+        """Mesmo resultado do antigo search_produtos: trecho de "sku descricao"."""
+        return self.buscar_texto_pagina(q, 0, limit)[1]
+
+    def buscar_texto_pagina(self, q: str, offset: int = 0, limit: int = 10) -> Tuple[int, List[Dict[str, Any]]]:
+        """(total de produtos encontrados, página [offset:offset+limit])."""
+        q = (q or "").strip().lower()
+        if not q:
+            return 0, []
+        if len(q) < 3:
+            cand: Any = self.textos.keys()
+        else:
+            listas = []
+            for t in _trigramas(q):
+                lst = self.tri.get(t)
+                if lst is None:
+                    return 0, []
+                listas.append(lst)
+            cand = set(min(listas, key=len))
+        hits = self._ativos(rid for rid in cand if q in self.textos.get(rid, ""))
+        hits.sort(key=lambda x: (x.get("sku", ""), x.get("descricao", "")))
+        return len(hits), hits[offset:offset + limit]
+
+def _indice_busca_chave() -> Tuple[str, str]:
+    return (str(FILE_BUSCA_IDX), STORE_BACKEND)
+
+def _reconstruir_indice_busca() -> IndiceBusca:
+    idx = IndiceBusca()
+    if usa_sqlite():
+        # versão lida antes dos registros: se alguém gravar no meio, a próxima
+        # sincronização vê a diferença e refaz
+        conn = _sql_conn()
+        idx.fonte = {"versao": _sql_versao(conn, "produtos")}
+        docs = [json.loads(r[0]) for r in conn.execute("SELECT doc FROM produtos ORDER BY id")]
+    else:
+        store = load_store(FILE_PRODUTOS)
+        docs = store.get("items", [])
+        idx.fonte = {"versao": store.versao, "snap": store._snap, "jofs": store._jofs}
+    idx.aplicar_lote(docs)
+    idx.pendentes = BUSCA_SALVAR_CADA
+    return idx
+
+def _sincronizar_indice_busca(idx: IndiceBusca) -> IndiceBusca:
+    """Aplica ao índice o que foi gravado em produtos depois dele (ou refaz)."""
+    if usa_sqlite():
+        if _sql_versao(_sql_conn(), "produtos") != idx.fonte.get("versao"):
+            return _reconstruir_indice_busca()
+        return idx
+    snap = _stamp(FILE_PRODUTOS)
+    jsize = (_stamp(_journal_path(FILE_PRODUTOS)) or (0, 0, 0))[1]
+    if snap != idx.fonte.get("snap") or jsize < idx.fonte.get("jofs", 0):
+        return _reconstruir_indice_busca()
+    if jsize > idx.fonte["jofs"]:
+        entries, jofs = _ler_journal(FILE_PRODUTOS, idx.fonte["jofs"])
+        for e in entries:
+            idx.aplicar_lote(e.get("put", []))
+            for rid in e.get("del", []):
+                idx.remover(int(rid))
+            idx.fonte["versao"] = int(e.get("v", idx.fonte.get("versao", 0)) or 0)
+        idx.fonte["jofs"] = jofs
+    return idx
+
+def salvar_indice_busca(idx: Optional[IndiceBusca] = None) -> None:
+    idx = idx or _BUSCA["idx"]
+    if idx is None:
+        return
+    ensure_data_dir()
+    tmp = FILE_BUSCA_IDX.with_suffix(FILE_BUSCA_IDX.suffix + f".{os.getpid()}.tmp")
+    with tmp.open("wb") as f:
+        pickle.dump(idx.estado(), f, protocol=pickle.HIGHEST_PROTOCOL)
+    tmp.replace(FILE_BUSCA_IDX)
+    idx.pendentes = 0
+
+def _indice_busca_carregado() -> Optional[IndiceBusca]:
+    """Índice em memória ou, na primeira vez, o gravado em disco (sem sincronizar)."""
+    if _BUSCA["chave"] != _indice_busca_chave():
+        _BUSCA["idx"] = None
+        _BUSCA["chave"] = _indice_busca_chave()
+    idx = _BUSCA["idx"]
+    if idx is None and FILE_BUSCA_IDX.exists():
+        try:
+            with FILE_BUSCA_IDX.open("rb") as f:
+                st = pickle.load(f)
+            if st.get("formato") == 1:
+                idx = IndiceBusca.de_estado(st)
+        except (OSError, EOFError, pickle.UnpicklingError, KeyError, AttributeError):
+            idx = None
+    _BUSCA["idx"] = idx
+    return idx
+
+def indice_busca() -> IndiceBusca:
+    """Índice de busca atualizado (lido do disco uma vez e mantido em memória)."""
+    idx = _indice_busca_carregado()
+    idx = _reconstruir_indice_busca() if idx is None else _sincronizar_indice_busca(idx)
+    _BUSCA["idx"] = idx
+    if idx.pendentes >= BUSCA_SALVAR_CADA:
+        salvar_indice_busca(idx)
+    return idx
+
+def indexar_produtos(store: Dict[str, Any], recs: List[Dict[str, Any]], salvar: bool = True) -> None:
+    """
+    Leva ao índice os produtos recém-gravados por save_store. No JSON lê a
+    linha nova do journal; no SQLite aplica recs se a gravação foi a única
+    desde a versão indexada (senão o índice é refeito).
+    """
+    idx = _indice_busca_carregado()
+    if idx is None:
+        idx = _reconstruir_indice_busca()
+    elif isinstance(store, SqliteStore) and idx.fonte.get("versao") == store.versao - 1:
+        idx.aplicar_lote(recs)
+        idx.fonte["versao"] = store.versao
+    else:
+        idx = _sincronizar_indice_busca(idx)
+    _BUSCA["idx"] = idx
+    if salvar:
+        salvar_indice_busca(idx)
 
 # =========================================================
 # ASSISTENTE: busca por SKU/descrição e CFOP sugerido
 # =========================================================
 def search_produtos(query: str, limit: int = 10) -> List[Dict[str, Any]]:
-    q = (query or "").strip().lower()
-    if not q:
-        return []
-    store = load_store(FILE_PRODUTOS)
-    items = [x for x in store.get("items", []) if int(x.get("ativo",1)) == 1]
-    hits = []
-    for x in items:
-        hay = f"{x.get('sku','')} {x.get('descricao','')}".lower()
-        if q in hay:
-            hits.append(x)
-    hits.sort(key=lambda x: (x.get("sku",""), x.get("descricao","")))
-    return hits[:limit]
+    """Produtos ativos cujo "sku descricao" contém o texto (via índice de busca)."""
+    return indice_busca().buscar_texto(query, limit)
+
+def search_produtos_pagina(query: str, offset: int = 0, limit: int = 10) -> Tuple[int, List[Dict[str, Any]]]:
+    """Como search_produtos, com paginação: (total encontrado, produtos da página)."""
+    return indice_busca().buscar_texto_pagina(query, offset, limit)
 
 def cfop_sugerido(tipo_operacao: str, uf_origem: str, uf_destino: str) -> str:
     mesma_uf = uf_origem.upper() == uf_destino.upper()
@@ -1018,6 +3320,695 @@ def cfop_sugerido(tipo_operacao: str, uf_origem: str, uf_destino: str) -> str:
         return "1102" if mesma_uf else "2102"
     return "5102" if mesma_uf else "6102"
 
+# =========================================================
+# RESUMO FISCAL materializado (período x filial x UF destino x CFOP x tipo)
+# =========================================================
+# Fechamento mensal sem varrer nfs.json: cada emissão soma e cada
+# cancelamento de NF emitida desconta a contribuição da NF em
+#   "AAAA-MM|filial_id|uf_destino|cfop|tipo_operacao" -> [nfs, itens, centavos de TOTAIS_CAMPOS...]
+# (uma NF com itens em dois CFOPs conta nas duas chaves). A contribuição
+# lançada fica na própria NF (nf["resumo_fiscal"]), para o cancelamento
+# descontar exatamente o que a emissão somou.
+# JSON: snapshot data/resumo_fiscal.json + log data/resumo_fiscal.jsonl (uma
+# linha por emissão/cancelamento). O snapshot é regravado a cada
+# RESUMO_SNAPSHOT_CADA linhas com uma geração nova, e o log recomeça só com
+# o cabeçalho {"gen": N} dessa geração. Log com cabeçalho de outra geração
+# (queda entre gravar o snapshot e zerar o log) já está no snapshot e é
+# ignorado. Snapshot antigo, sem "gen", guarda o offset do log até onde
+# incorporou. SQLite: tabela resumo_fiscal, gravada na mesma transação da NF.
+# Base sem resumo (criada antes dele): a primeira leitura monta a partir das
+# NFs emitidas. reconstruir_resumo_fiscal refaz tudo e informa divergências.
+FILE_RESUMO_FISCAL = DATA_DIR / "resumo_fiscal.json"
+FILE_RESUMO_FISCAL_LOG = DATA_DIR / "resumo_fiscal.jsonl"
+RESUMO_SNAPSHOT_CADA = 2000
+DIMENSOES_RESUMO = ["periodo", "filial_id", "uf_destino", "cfop", "tipo_operacao"]
+
+_RESUMO_CACHE: Dict[str, Any] = {"snap": None, "chaves": None, "gen": None, "offset": 0, "linhas": 0, "log_ok": False}
+
+def chave_resumo(nf: Dict[str, Any], cfop: Any) -> str:
+    return "|".join([
+        str(nf.get("data_emissao", ""))[:7],
+        str(int(nf.get("filial_id", 0) or 0)),
+        str(nf.get("uf_destino", "")).upper(),
+        normalize_digits(str(cfop or ""), 4),
+        str(nf.get("tipo_operacao", "")).upper(),
+    ])
+
+def contribuicao_resumo(nf: Dict[str, Any]) -> Dict[str, List[int]]:
+    """Contribuição da NF para o resumo, a partir dos itens (centavos por item)."""
+    out: Dict[str, List[int]] = {}
+    for it in nf.get("itens") or []:
+        k = chave_resumo(nf, it.get("cfop"))
+        v = out.get(k)
+        if v is None:
+            v = out[k] = [1, 0] + [0] * len(TOTAIS_CAMPOS)
+        v[1] += 1
+        for i, x in enumerate(_valores_totais_item(it)):
+            v[2 + i] += round(float(x or 0.0) * 100)
+    return out
+
+def _somar_resumo(chaves: Dict[str, List[int]], contrib: Dict[str, List[int]], sinal: int) -> None:
+    for k, v in contrib.items():
+        atual = chaves.get(k)
+        novo = [a + sinal * b for a, b in zip(atual, v)] if atual else [sinal * b for b in v]
+        if any(novo):
+            chaves[k] = novo
+        else:
+            chaves.pop(k, None)
+
+def _ler_log_resumo(offset: int) -> Any:
+    """
+    Gera (linha, offset_final) a partir de offset; para numa linha incompleta
+    ou inválida (sobra de gravação interrompida, cortada no próximo lançamento).
+    """
+    if not FILE_RESUMO_FISCAL_LOG.exists():
+        return
+    with FILE_RESUMO_FISCAL_LOG.open("rb") as f:
+        f.seek(offset)
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            if line.strip():
+                try:
+                    e = json.loads(line)
+                except ValueError:
+                    break
+                if not isinstance(e, dict):
+                    break
+                offset += len(line)
+                yield e, offset
+            else:
+                offset += len(line)
+
+def _cabecalho_log_resumo(gen: int) -> Optional[int]:
+    """Offset logo depois do cabeçalho se o log é da geração gen; senão None."""
+    try:
+        with FILE_RESUMO_FISCAL_LOG.open("rb") as f:
+            primeira = f.readline()
+    except FileNotFoundError:
+        return None
+    try:
+        ok = primeira.endswith(b"\n") and json.loads(primeira) == {"gen": gen}
+    except ValueError:
+        ok = False
+    return len(primeira) if ok else None
+
+def _resumo_json() -> Optional[Dict[str, List[int]]]:
+    """Resumo do backend JSON (cache por versão do snapshot + linhas novas do log); None se não existe."""
+    snap = _stamp(FILE_RESUMO_FISCAL)
+    if snap is None:
+        return None
+    cache = _RESUMO_CACHE
+    if cache["snap"] != snap or cache["chaves"] is None:
+        data = read_json(FILE_RESUMO_FISCAL, {})
+        gen = data.get("gen")
+        cache.update(snap=snap, chaves=data.get("chaves", {}), gen=gen, linhas=0,
+                     offset=int(data.get("offset", 0) or 0), log_ok=gen is None)
+    if not cache["log_ok"]:
+        inicio = _cabecalho_log_resumo(int(cache["gen"]))
+        if inicio is None:
+            return cache["chaves"]  # log de geração anterior: já está no snapshot
+        cache.update(offset=inicio, log_ok=True)
+    for e, fim in _ler_log_resumo(cache["offset"]):
+        _somar_resumo(cache["chaves"], e.get("d") or {}, int(e.get("s", 1)))
+        cache["offset"] = fim
+        cache["linhas"] += 1
+    return cache["chaves"]
+
+def _resumo_sqlite() -> Optional[Dict[str, List[int]]]:
+    conn = _sql_conn()
+    if not conn.execute("SELECT 1 FROM meta WHERE nome = 'resumo_fiscal'").fetchone():
+        return None
+    return {k: json.loads(v) for k, v in conn.execute("SELECT chave, valores FROM resumo_fiscal")}
+
+def _gravar_resumo(chaves: Dict[str, List[int]]) -> None:
+    """Substitui o resumo inteiro (em trava_dados/transação)."""
+    if usa_sqlite():
+        with _sql_tx() as conn:
+            conn.execute("DELETE FROM resumo_fiscal")
+            conn.executemany(
+                "INSERT INTO resumo_fiscal (chave, periodo, filial_id, uf_destino, cfop, tipo_operacao, valores) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(k, *k.split("|"), json.dumps(v)) for k, v in chaves.items()],
+            )
+            conn.execute("INSERT OR IGNORE INTO meta (nome, seq) VALUES ('resumo_fiscal', 0)")
+        return
+    gen = int(read_json(FILE_RESUMO_FISCAL, {}).get("gen", 0) or 0) + 1
+    write_json(FILE_RESUMO_FISCAL, {
+        "gerado_em": datetime.now().isoformat(timespec="seconds"), "gen": gen, "chaves": chaves,
+    })
+    snap = _stamp(FILE_RESUMO_FISCAL)
+    _RESUMO_CACHE.update(snap=snap, chaves=dict(chaves), gen=gen, offset=0, linhas=0, log_ok=False)
+    _zerar_log_resumo(gen)
+
+def _zerar_log_resumo(gen: int) -> None:
+    """Log novo só com o cabeçalho da geração (em trava_dados)."""
+    cabecalho = (json.dumps({"gen": gen}) + "\n").encode("utf-8")
+    tmp = FILE_RESUMO_FISCAL_LOG.with_suffix(FILE_RESUMO_FISCAL_LOG.suffix + ".tmp")
+    tmp.write_bytes(cabecalho)
+    tmp.replace(FILE_RESUMO_FISCAL_LOG)
+    _RESUMO_CACHE.update(offset=len(cabecalho), log_ok=True)
+
+def _preparar_log_resumo() -> None:
+    """
+    Antes de acrescentar (em trava_dados, com _resumo_json já lido): zera o
+    log se for de outra geração e corta uma linha incompleta no fim, para a
+    próxima linha não ficar emendada nela.
+    """
+    cache = _RESUMO_CACHE
+    if not cache["log_ok"]:
+        _zerar_log_resumo(int(cache["gen"]))
+        return
+    try:
+        size = FILE_RESUMO_FISCAL_LOG.stat().st_size
+    except FileNotFoundError:
+        return
+    if size > cache["offset"]:
+        with FILE_RESUMO_FISCAL_LOG.open("r+b") as f:
+            f.truncate(cache["offset"])
+
+def _montar_resumo_de_nfs(store_nf: Dict[str, Any]) -> Tuple[Dict[str, List[int]], int]:
+    chaves: Dict[str, List[int]] = {}
+    n = 0
+    for nf in store_nf.get("items", []):
+        if nf.get("status") == "EMITIDA":
+            _somar_resumo(chaves, nf.get("resumo_fiscal") or contribuicao_resumo(nf), 1)
+            n += 1
+    return chaves, n
+
+def reconstruir_resumo_fiscal() -> Dict[str, Any]:
+    """Refaz o resumo a partir das NFs emitidas. Retorna {"nfs", "chaves", "divergentes"}."""
+    with transacao():
+        anterior = _resumo_sqlite() if usa_sqlite() else _resumo_json()
+        chaves, n = _montar_resumo_de_nfs(load_store(FILE_NFS))
+        divergentes = None
+        if anterior is not None:
+            divergentes = sum(1 for k in set(anterior) | set(chaves) if anterior.get(k) != chaves.get(k))
+        _gravar_resumo(chaves)
+    return {"nfs": n, "chaves": len(chaves), "divergentes": divergentes}
+
+def load_resumo_fiscal() -> Dict[str, List[int]]:
+    """Resumo atual (chave -> valores). Não altere o dict retornado."""
+    chaves = _resumo_sqlite() if usa_sqlite() else _resumo_json()
+    if chaves is None:
+        reconstruir_resumo_fiscal()
+        chaves = _resumo_sqlite() if usa_sqlite() else _resumo_json()
+    return chaves or {}
+
+@medir_fase("resumo.lancar")
+def lancar_resumo_fiscal(nf_id: int, contrib: Dict[str, List[int]], sinal: int) -> None:
+    """
+    Soma (sinal=1, emissão) ou desconta (sinal=-1, cancelamento) a
+    contribuição de uma NF. Chame depois de gravar o novo status da NF,
+    dentro da mesma transacao(): se o resumo ainda não existe, ele é montado
+    das NFs já gravadas (e já reflete esta).
+    """
+    if not contrib:
+        return
+    if usa_sqlite():
+        with _sql_tx() as conn:
+            if not conn.execute("SELECT 1 FROM meta WHERE nome = 'resumo_fiscal'").fetchone():
+                reconstruir_resumo_fiscal()
+                return
+            for k, v in contrib.items():
+                row = conn.execute("SELECT valores FROM resumo_fiscal WHERE chave = ?", (k,)).fetchone()
+                chaves = {k: json.loads(row[0])} if row else {}
+                _somar_resumo(chaves, {k: v}, sinal)
+                if k in chaves:
+                    conn.execute(
+                        "INSERT OR REPLACE INTO resumo_fiscal (chave, periodo, filial_id, uf_destino, cfop, tipo_operacao, valores) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        (k, *k.split("|"), json.dumps(chaves[k])),
+                    )
+                else:
+                    conn.execute("DELETE FROM resumo_fiscal WHERE chave = ?", (k,))
+        return
+
+    with trava_dados():
+        chaves = _resumo_json()
+        if chaves is None:
+            reconstruir_resumo_fiscal()
+            return
+        _preparar_log_resumo()
+        line = json.dumps({"nf": int(nf_id), "s": int(sinal), "d": contrib}, separators=(",", ":"))
+        with FILE_RESUMO_FISCAL_LOG.open("ab") as f:
+            f.write((line + "\n").encode("utf-8"))
+            f.flush()
+            os.fsync(f.fileno())
+        chaves = _resumo_json()
+        if _RESUMO_CACHE["linhas"] >= RESUMO_SNAPSHOT_CADA:
+            _gravar_resumo(chaves)
+
+def relatorio_fiscal(
+    periodo_ini: str = "",
+    periodo_fim: str = "",
+    por: Optional[List[str]] = None,
+    filial_id: Optional[int] = None,
+    uf_destino: str = "",
+    cfop: str = "",
+    tipo_operacao: str = "",
+) -> List[Dict[str, Any]]:
+    """
+    Totais do resumo materializado agrupados pelas dimensões em por
+    (padrão: uf_destino, cfop), no intervalo de períodos AAAA-MM (inclusivo).
+    "nfs" conta NF por chave do resumo (NF com dois CFOPs conta duas vezes
+    se o agrupamento juntar os dois).
+    """
+    por = por or ["uf_destino", "cfop"]
+    invalidas = [d for d in por if d not in DIMENSOES_RESUMO]
+    if invalidas:
+        raise ValueError(f"dimensão inválida: {', '.join(invalidas)} (use {', '.join(DIMENSOES_RESUMO)})")
+    periodo_ini, periodo_fim = periodo_ini[:7], periodo_fim[:7]
+    uf_destino, tipo_operacao = uf_destino.upper(), tipo_operacao.upper()
+    cfop = normalize_digits(cfop, 4) if cfop else ""
+
+    grupos: Dict[Tuple, List[int]] = {}
+    for k, v in load_resumo_fiscal().items():
+        periodo, fil, uf, cf, tipo = k.split("|")
+        if (periodo_ini and periodo < periodo_ini) or (periodo_fim and periodo > periodo_fim):
+            continue
+        if (filial_id is not None and int(fil) != int(filial_id)) or (uf_destino and uf != uf_destino):
+            continue
+        if (cfop and cf != cfop) or (tipo_operacao and tipo != tipo_operacao):
+            continue
+        dims = {"periodo": periodo, "filial_id": int(fil), "uf_destino": uf, "cfop": cf, "tipo_operacao": tipo}
+        g = tuple(dims[d] for d in por)
+        acc = grupos.get(g)
+        grupos[g] = list(v) if acc is None else [a + b for a, b in zip(acc, v)]
+
+    out = []
+    for g in sorted(grupos):
+        v = grupos[g]
+        out.append({
+            **dict(zip(por, g)), "nfs": v[0], "itens": v[1],
+            **{campo: round(c / 100, 2) for campo, c in zip(TOTAIS_CAMPOS, v[2:])},
+        })
+    return out
+
+def relatorio_fiscal_menu() -> None:
+    title("Relatório fiscal por período (resumo materializado)")
+    ini = ask_str("Período inicial (AAAA-MM) [todos]: ", required=False).strip()
+    fim = ask_str("Período final (AAAA-MM) [= inicial]: ", required=False).strip() or ini
+    por_txt = ask_str("Agrupar por (periodo,filial_id,uf_destino,cfop,tipo_operacao) [uf_destino,cfop]: ", required=False)
+    por = [x.strip() for x in por_txt.split(",") if x.strip()] or None
+    tipo = ask_str("Tipo (ENTRADA/SAIDA) [todos]: ", required=False).strip()
+    try:
+        linhas = relatorio_fiscal(ini, fim, por, tipo_operacao=tipo)
+    except ValueError as e:
+        print(str(e))
+        return
+    if not linhas:
+        print("Nenhuma NF emitida no período.")
+        return
+    dims = por or ["uf_destino", "cfop"]
+    tot = {c: 0.0 for c in ("v_nf", "total_icms_st", "total_fcp_st", "total_icms_ufdest", "total_fcp_ufdest")}
+    for r in linhas:
+        chave = " | ".join(str(r[d]) for d in dims)
+        print(f"{chave:<28} NFs={r['nfs']:>6} vNF={money(r['v_nf']):>16} ST={money(r['total_icms_st']):>14} "
+              f"FCP-ST={money(r['total_fcp_st']):>12} DIFAL={money(r['total_icms_ufdest']):>14} FCP-DIFAL={money(r['total_fcp_ufdest']):>12}")
+        for c in tot:
+            tot[c] += r[c]
+    print(f"{'TOTAL':<28} {'':>11} vNF={money(tot['v_nf']):>16} ST={money(tot['total_icms_st']):>14} "
+          f"FCP-ST={money(tot['total_fcp_st']):>12} DIFAL={money(tot['total_icms_ufdest']):>14} FCP-DIFAL={money(tot['total_fcp_ufdest']):>12}")
+
+def reconstruir_resumo_fiscal_menu() -> None:
+    title("Reconstruir resumo fiscal (a partir das NFs emitidas)")
+    res = reconstruir_resumo_fiscal()
+    print(f"NFs emitidas: {res['nfs']} | chaves: {res['chaves']}")
+    if res["divergentes"] is None:
+        print("Resumo criado.")
+    elif res["divergentes"]:
+        print(f"Atenção: {res['divergentes']} chave(s) estavam diferentes e foram corrigidas.")
+    else:
+        print("Resumo já estava consistente.")
+
+# =========================================================
+# NF: operações sem prompt (usadas pelo menu, pela CLI e pela API)
+# =========================================================
+class OperacaoInvalida(ValueError):
+    """Dados de NF/item recebidos sem prompt (job, API) que não podem ser aplicados."""
+
+def _int_op(dados: Dict[str, Any], campo: str, padrao: Optional[int] = None, min_v: Optional[int] = None) -> int:
+    v = dados.get(campo)
+    if v is None or str(v).strip() == "":
+        if padrao is None:
+            raise OperacaoInvalida(f"{campo} obrigatório")
+        return padrao
+    try:
+        n = int(str(v).strip())
+    except ValueError:
+        raise OperacaoInvalida(f"{campo} deve ser inteiro: {v!r}") from None
+    if min_v is not None and n < min_v:
+        raise OperacaoInvalida(f"{campo} deve ser >= {min_v}")
+    return n
+
+def _float_op(dados: Dict[str, Any], campo: str, padrao: Optional[float] = None, min_v: Optional[float] = None) -> float:
+    v = dados.get(campo)
+    if v is None or str(v).strip() == "":
+        if padrao is None:
+            raise OperacaoInvalida(f"{campo} obrigatório")
+        return padrao
+    try:
+        x = float(str(v).strip().replace(",", "."))
+    except ValueError:
+        raise OperacaoInvalida(f"{campo} deve ser número: {v!r}") from None
+    if min_v is not None and x < min_v:
+        raise OperacaoInvalida(f"{campo} deve ser >= {min_v}")
+    return x
+
+def montar_nf(dados: Dict[str, Any], nf_id: int) -> Dict[str, Any]:
+    """NF em RASCUNHO (dict, sem itens) a partir dos campos de criar_nf; não grava."""
+    tipo = str(dados.get("tipo_operacao") or "").strip().upper()
+    if tipo not in ("ENTRADA", "SAIDA"):
+        raise OperacaoInvalida("tipo_operacao deve ser ENTRADA ou SAIDA")
+    uf_origem = str(dados.get("uf_origem") or "").strip().upper()
+    uf_destino = str(dados.get("uf_destino") or "").strip().upper()
+    if not is_valid_uf(uf_origem) or not is_valid_uf(uf_destino):
+        raise OperacaoInvalida(f"UF inválida: {uf_origem or '-'}->{uf_destino or '-'}")
+    data_emissao = str(dados.get("data_emissao") or "").strip() or date.today().strftime("%Y-%m-%d")
+    if not _data_iso_valida(data_emissao):
+        raise OperacaoInvalida("data_emissao fora do formato YYYY-MM-DD")
+
+    nf = NF(
+        id=int(nf_id), tipo_operacao=tipo, filial_id=_int_op(dados, "filial_id", min_v=1),
+        emitente_id=_int_op(dados, "emitente_id", min_v=1), destinatario_id=_int_op(dados, "destinatario_id", min_v=1),
+        uf_origem=uf_origem, uf_destino=uf_destino, ind_final=1 if _int_op(dados, "ind_final", 0) == 1 else 0,
+        modelo=str(dados.get("modelo") or "55"), serie=_int_op(dados, "serie", 1, min_v=1), numero=_int_op(dados, "numero", 0, min_v=0),
+        data_emissao=data_emissao, status="RASCUNHO", estoque_postado=0,
+        itens=[], totais={}
+    )
+    return asdict(nf)
+
+def produto_do_item(store_prod: Dict[str, Any], dados: Dict[str, Any]) -> Dict[str, Any]:
+    """Produto ativo indicado por produto_id ou sku num item de job/API."""
+    prod = None
+    if str(dados.get("produto_id") or "").strip():
+        prod = find_by_id(store_prod, _int_op(dados, "produto_id", min_v=1))
+    elif str(dados.get("sku") or "").strip():
+        prod = find_by_sku(store_prod, str(dados["sku"]).strip(), active_only=True)
+    else:
+        raise OperacaoInvalida("item sem produto_id/sku")
+    if not prod or int(prod.get("ativo", 1)) != 1:
+        raise OperacaoInvalida(f"produto não encontrado/inativo: {dados.get('produto_id') or dados.get('sku')}")
+    return prod
+
+def novo_item_nf(nf: Dict[str, Any], prod: Dict[str, Any], dados: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Acrescenta à NF (sem gravar) um item do produto. dados: qtd e, opcionais,
+    v_unit (padrão preço de venda), cfop (padrão cfop_sugerido), desconto,
+    frete, seguro e outras.
+    """
+    cfop = normalize_digits(str(dados.get("cfop") or "").strip(), 4) or normalize_digits(
+        cfop_sugerido(nf["tipo_operacao"], nf["uf_origem"], nf["uf_destino"]), 4)
+    qtd = _float_op(dados, "qtd", min_v=0.0001)
+    v_unit = _float_op(dados, "v_unit", 0.0, min_v=0.0) or float(prod.get("preco_venda", 0.0))
+    desconto = _float_op(dados, "desconto", 0.0, min_v=0.0)
+    frete = _float_op(dados, "frete", 0.0, min_v=0.0)
+    seguro = _float_op(dados, "seguro", 0.0, min_v=0.0)
+    outras = _float_op(dados, "outras", 0.0, min_v=0.0)
+
+    v_bruto, v_total = calc_item_totais(qtd, v_unit, desconto, frete, seguro, outras)
+
+    item = asdict(NFItem(
+        id=len(nf.get("itens", [])) + 1,
+        produto_id=int(prod["id"]),
+        sku=str(prod.get("sku","")),
+        descricao=str(prod.get("descricao","")),
+        ncm=str(prod.get("ncm","")),
+        cest=str(prod.get("cest","")),
+        cfop=cfop,
+        qtd=qtd,
+        v_unit=v_unit,
+        desconto=desconto,
+        frete=frete,
+        seguro=seguro,
+        outras=outras,
+        v_bruto=float(v_bruto),
+        v_total=float(v_total),
+        impostos=None
+    ))
+    nf["itens"].append(item)
+    return item
+
+def montar_pessoa(dados: Dict[str, Any], pessoa_id: int) -> Dict[str, Any]:
+    """Pessoa ativa (dict) com os campos de cadastrar_pessoa; não grava."""
+    nome = str(dados.get("nome") or "").strip()
+    if not nome:
+        raise OperacaoInvalida("nome obrigatório")
+    uf = str(dados.get("uf") or "").strip().upper()
+    if not is_valid_uf(uf):
+        raise OperacaoInvalida(f"UF inválida: {uf or '-'}")
+    tipo = str(dados.get("tipo") or "C").strip().upper()
+    ind_ie_dest = _int_op(dados, "ind_ie_dest", 9)
+    return asdict(Pessoa(
+        id=int(pessoa_id), nome=nome, tipo=tipo if tipo in ("C", "F", "A") else "C",
+        documento=str(dados.get("documento") or "").strip(), uf=uf,
+        ind_ie_dest=ind_ie_dest if ind_ie_dest in (1, 2, 9) else 9, ativo=1,
+    ))
+
+def montar_produto(store_prod: Dict[str, Any], dados: Dict[str, Any], produto_id: int) -> Dict[str, Any]:
+    """Produto ativo (dict) com os campos do CSV de produtos; SKU ativo repetido é recusado. Não grava."""
+    try:
+        campos = _produto_de_linha({k: ("" if v is None else str(v)) for k, v in dados.items()})
+    except LinhaInvalida as e:
+        raise OperacaoInvalida(str(e)) from None
+    if find_by_sku(store_prod, campos["sku"], active_only=True):
+        raise OperacaoInvalida(f"SKU já cadastrado: {campos['sku']}")
+    return asdict(Produto(id=int(produto_id), ativo=1, **campos))
+
+def cotar_impostos(
+    dados: Dict[str, Any],
+    store_prod: Dict[str, Any],
+    store_pes: Dict[str, Any],
+    tabela_uf: Dict[str, Any],
+    tabela_st: List[Dict[str, Any]],
+) -> Dict[str, Any]:
+    """
+    Cálculo avulso de ST/DIFAL/FCP, sem NF gravada. dados: uf_origem,
+    uf_destino, ind_final, data_emissao, tipo_operacao (padrão SAIDA),
+    ind_ie_dest ou destinatario_id (padrão 9) e "itens" como em novo_item_nf;
+    item sem produto_id/sku informa ncm, cest e flag_importado.
+    Retorna {"itens": [...], "totais": {...}}.
+    """
+    uf_origem = str(dados.get("uf_origem") or "").strip().upper()
+    uf_destino = str(dados.get("uf_destino") or "").strip().upper()
+    if not is_valid_uf(uf_origem) or not is_valid_uf(uf_destino):
+        raise OperacaoInvalida(f"UF inválida: {uf_origem or '-'}->{uf_destino or '-'}")
+    data_emissao = str(dados.get("data_emissao") or "").strip() or date.today().strftime("%Y-%m-%d")
+    if not _data_iso_valida(data_emissao):
+        raise OperacaoInvalida("data_emissao fora do formato YYYY-MM-DD")
+    if str(dados.get("ind_ie_dest") or "").strip():
+        ind_ie_dest = _int_op(dados, "ind_ie_dest")
+    elif str(dados.get("destinatario_id") or "").strip():
+        dest = find_by_id(store_pes, _int_op(dados, "destinatario_id", min_v=1))
+        if not dest:
+            raise OperacaoInvalida("destinatário não encontrado")
+        ind_ie_dest = int(dest.get("ind_ie_dest", 9))
+    else:
+        ind_ie_dest = 9
+    itens = dados.get("itens") or []
+    if not isinstance(itens, list) or not itens:
+        raise OperacaoInvalida("itens obrigatório (lista)")
+
+    nf = {
+        "tipo_operacao": "ENTRADA" if str(dados.get("tipo_operacao") or "").strip().upper() == "ENTRADA" else "SAIDA",
+        "uf_origem": uf_origem, "uf_destino": uf_destino, "itens": [],
+    }
+    ind_final = 1 if _int_op(dados, "ind_final", 0) == 1 else 0
+    for dados_item in itens:
+        if str(dados_item.get("produto_id") or "").strip() or str(dados_item.get("sku") or "").strip():
+            prod = produto_do_item(store_prod, dados_item)
+        else:
+            prod = {
+                "id": 0, "sku": "", "descricao": str(dados_item.get("descricao") or ""),
+                "ncm": normalize_digits(str(dados_item.get("ncm") or ""), 8),
+                "cest": normalize_digits(str(dados_item.get("cest") or ""), 7),
+                "preco_venda": 0.0, "flag_importado": 1 if _int_op(dados_item, "flag_importado", 0) == 1 else 0,
+            }
+        it = novo_item_nf(nf, prod, dados_item)
+        it["impostos"] = calcular_impostos_item(
+            uf_origem=uf_origem,
+            uf_destino=uf_destino,
+            ind_final=ind_final,
+            ind_ie_dest=ind_ie_dest,
+            flag_importado=int(prod.get("flag_importado", 0)),
+            data_emissao=data_emissao,
+            cfop=it["cfop"],
+            ncm=it["ncm"],
+            cest=it["cest"],
+            v_operacao=float(it["v_total"]),
+            tabela_uf=tabela_uf,
+            tabela_st_regras=tabela_st,
+            aplicar_st=1
+        )
+    return {"itens": nf["itens"], "totais": totais_nf(nf["itens"])}
+
+@medir_operacao
+def calcular_nfs(store_nf: Dict[str, Any], nf_ids: List[int], completo: bool = False) -> List[Dict[str, Any]]:
+    """
+    Calcula várias NFs já carregadas com tabelas e cadastros lidos uma vez e
+    grava tudo num save_store. Retorna [{"nf_id", "ok", "msg", "totais"}].
+    """
+    tabela_uf = load_contexto_fiscal()
+    tabela_st = load_tabela_st()
+    store_pes = store_aberto(FILE_PESSOAS)
+    store_prod = store_aberto(FILE_PRODUTOS)
+
+    def ind_ie_dest_de(pid: int) -> int:
+        dest = find_by_id(store_pes, pid)
+        return int(dest.get("ind_ie_dest", 9)) if dest else 9
+
+    def flag_importado_de(pid: int) -> int:
+        return int((find_by_id(store_prod, pid) or {}).get("flag_importado", 0))
+
+    out: List[Dict[str, Any]] = []
+    alvo: List[Dict[str, Any]] = []
+    for nf_id in nf_ids:
+        nf = find_by_id(store_nf, nf_id)
+        if not nf:
+            out.append({"nf_id": nf_id, "ok": False, "msg": "NF não encontrada."})
+        elif not nf.get("itens"):
+            out.append({"nf_id": nf_id, "ok": False, "msg": "NF sem itens."})
+        else:
+            alvo.append(nf)
+            out.append({"nf_id": nf_id, "ok": True, "msg": "Cálculo concluído.", "nf": nf})
+
+    if completo:
+        aplicar_calculo_nfs(alvo, tabela_uf, tabela_st, ind_ie_dest_de, flag_importado_de)
+    else:
+        for nf in alvo:
+            aplicar_calculo_nf(nf, tabela_uf, tabela_st, ind_ie_dest_de(int(nf["destinatario_id"])), flag_importado_de)
+    if alvo:
+        save_store(FILE_NFS, store_nf, changed=alvo)
+    for r in out:
+        nf = r.pop("nf", None)
+        if nf is not None:
+            r["totais"] = dict(nf["totais"])
+    return out
+
+def _postar_emissao(nf: Dict[str, Any], estoque: Dict[str, Any]) -> Optional[str]:
+    """Lança no estoque (em memória) a emissão da NF; devolve a mensagem de bloqueio/falha."""
+    itens = nf.get("itens", [])
+    filial_id = int(nf["filial_id"])
+    sign = 1.0 if nf["tipo_operacao"] == "ENTRADA" else -1.0
+
+    if sign < 0 and not ALLOW_NEGATIVE_STOCK:
+        for it in itens:
+            pid = int(it["produto_id"])
+            qtd = float(it.get("qtd", 0.0))
+            current = get_stock(estoque, filial_id, pid)
+            if current - qtd < -1e-9:
+                return f"Bloqueado: estoque insuficiente | produto_id={pid} | atual={current} | saída={qtd}"
+
+    for it in itens:
+        pid = int(it["produto_id"])
+        qtd = float(it.get("qtd", 0.0))
+        ref = {"tipo": "EMISSAO", "nf_id": int(nf["id"]), "item_id": it.get("id")}
+        ok, msg = apply_stock_delta(estoque, filial_id, pid, sign * qtd, ref)
+        if not ok:
+            return f"Falha ao postar estoque: {msg}"
+    return None
+
+@medir_operacao
+def emitir_nfs(store_nf: Dict[str, Any], nf_ids: List[int]) -> List[Dict[str, Any]]:
+    """
+    Emite várias NFs numa transação, com o estoque carregado uma vez. Cada
+    NF é gravada logo após postar o seu estoque; a que falha não altera nada.
+    Retorna [{"nf_id", "ok", "msg"}] na ordem de nf_ids.
+    """
+    out: List[Dict[str, Any]] = []
+    # no SQLite, estoque e status da NF são gravados na mesma transação; no
+    # JSON a transação segura a trava entre processos
+    with transacao():
+        sincronizar_store(FILE_NFS, store_nf)
+        estoque = estoque_aberto()
+        for nf_id in nf_ids:
+            nf = find_by_id(store_nf, nf_id)
+            if not nf:
+                out.append({"nf_id": nf_id, "ok": False, "msg": "NF não encontrada."})
+                continue
+            if nf.get("status") != "RASCUNHO":
+                out.append({"nf_id": nf_id, "ok": False, "msg": "NF não está em RASCUNHO."})
+                continue
+            if not nf.get("itens"):
+                out.append({"nf_id": nf_id, "ok": False, "msg": "NF sem itens."})
+                continue
+            erro = _postar_emissao(nf, estoque)
+            if erro:
+                estoque = estoque_aberto()  # descarta os movimentos não gravados
+                out.append({"nf_id": nf_id, "ok": False, "msg": erro})
+                continue
+            nf["status"] = "EMITIDA"
+            nf["estoque_postado"] = 1
+            save_estoque(estoque)
+            if getattr(estoque, "ultimo_lote", None):
+                nf["estoque_mov"] = estoque.ultimo_lote
+            nf["resumo_fiscal"] = contribuicao_resumo(nf)
+            save_store(FILE_NFS, store_nf, changed=[nf])
+            lancar_resumo_fiscal(int(nf["id"]), nf["resumo_fiscal"], 1)
+            out.append({"nf_id": nf_id, "ok": True, "msg": "NF emitida e estoque atualizado."})
+    return out
+
+def _estornar_emissao(nf: Dict[str, Any], estoque: Dict[str, Any]) -> Optional[str]:
+    """Reverte no estoque (em memória) o que a emissão lançou; devolve a mensagem de bloqueio/falha."""
+    filial_id = int(nf["filial_id"])
+
+    # estorna exatamente o que a emissão lançou no ledger; NFs emitidas
+    # antes do ledger revertem pelos itens atuais
+    movs = movimentos_emissao_nf(nf)
+    if movs is not None:
+        estornos = [(int(m["produto_id"]), -float(m["delta"]), m.get("item_id")) for m in movs]
+    else:
+        sign = -1.0 if nf["tipo_operacao"] == "ENTRADA" else 1.0
+        estornos = [(int(it["produto_id"]), sign * float(it.get("qtd", 0.0)), it.get("id")) for it in nf.get("itens", [])]
+
+    if not ALLOW_NEGATIVE_STOCK:
+        for pid, delta, _ in estornos:
+            current = get_stock(estoque, filial_id, pid)
+            if delta < 0 and current + delta < -1e-9:
+                return f"Bloqueado: reverter ENTRADA geraria negativo | produto_id={pid} | atual={current} | reverter={-delta}"
+
+    for pid, delta, item_id in estornos:
+        ref = {"tipo": "CANCELAMENTO", "nf_id": int(nf["id"]), "item_id": item_id}
+        ok, msg = apply_stock_delta(estoque, filial_id, pid, delta, ref)
+        if not ok:
+            return f"Falha ao reverter estoque: {msg}"
+    return None
+
+@medir_operacao
+def cancelar_nfs(store_nf: Dict[str, Any], nf_ids: List[int]) -> List[Dict[str, Any]]:
+    """Cancela várias NFs numa transação (estoque carregado uma vez). Mesmo retorno de emitir_nfs."""
+    out: List[Dict[str, Any]] = []
+    with transacao():
+        sincronizar_store(FILE_NFS, store_nf)
+        estoque = None
+        for nf_id in nf_ids:
+            nf = find_by_id(store_nf, nf_id)
+            if not nf:
+                out.append({"nf_id": nf_id, "ok": False, "msg": "NF não encontrada."})
+                continue
+            if nf.get("status") == "CANCELADA":
+                out.append({"nf_id": nf_id, "ok": False, "msg": "NF já está cancelada."})
+                continue
+            if int(nf.get("estoque_postado", 0)) == 1:
+                if estoque is None:
+                    estoque = estoque_aberto()
+                erro = _estornar_emissao(nf, estoque)
+                if erro:
+                    estoque = None  # descarta os movimentos não gravados
+                    out.append({"nf_id": nf_id, "ok": False, "msg": erro})
+                    continue
+                save_estoque(estoque)
+                nf["estoque_postado"] = 0
+            emitida = nf.get("status") == "EMITIDA"
+            contrib = (nf.pop("resumo_fiscal", None) or contribuicao_resumo(nf)) if emitida else None
+            nf["status"] = "CANCELADA"
+            save_store(FILE_NFS, store_nf, changed=[nf])
+            if contrib:
+                lancar_resumo_fiscal(int(nf["id"]), contrib, -1)
+            out.append({"nf_id": nf_id, "ok": True, "msg": "NF cancelada."})
+    return out
+
 # =========================================================
 # NF: criar, itens, calcular, emitir, cancelar
 # =========================================================
@@ -1050,18 +4041,16 @@ def criar_nf(tipo_operacao: str) -> int:
     data_emissao = ask_date_yyyy_mm_dd("Data emissão (YYYY-MM-DD) [hoje]: ", required=False, default_today=True)
 
     store = load_store(FILE_NFS)
-    nf_id = next_id(store)
-
-    nf = NF(
-        id=nf_id, tipo_operacao=tipo_operacao, filial_id=int(filial_id),
-        emitente_id=int(emitente_id), destinatario_id=int(destinatario_id),
-        uf_origem=uf_origem, uf_destino=uf_destino, ind_final=ind_final,
-        modelo=modelo, serie=int(serie), numero=int(numero),
-        data_emissao=data_emissao, status="RASCUNHO", estoque_postado=0,
-        itens=[], totais={}
-    )
-    store["items"].append(asdict(nf))
-    save_store(FILE_NFS, store)
+    rec = montar_nf({
+        "tipo_operacao": tipo_operacao, "filial_id": filial_id,
+        "emitente_id": emitente_id, "destinatario_id": destinatario_id,
+        "uf_origem": uf_origem, "uf_destino": uf_destino, "ind_final": ind_final,
+        "modelo": modelo, "serie": serie, "numero": numero, "data_emissao": data_emissao,
+    }, next_id(store))
+    append_record(store, rec)
+    save_store(FILE_NFS, store, changed=[rec])
+    # o id pode mudar se outro processo criou uma NF ao mesmo tempo
+    nf_id = int(rec["id"])
     print(f"NF criada. ID={nf_id}")
     return nf_id
 
@@ -1077,9 +4066,9 @@ def add_itens_nf_assistente(nf_id: int) -> None:
         print("Só é possível editar NF em RASCUNHO.")
         return
 
-    store_prod = load_store(FILE_PRODUTOS)
-    produtos = [x for x in store_prod.get("items", []) if int(x.get("ativo",1)) == 1]
-    if not produtos:
+    # SKU/EAN, prefixo e texto saem do índice de busca, sem carregar o catálogo
+    idx = indice_busca()
+    if not idx.buscar_prefixo("", limit=1):
         print("Cadastre/import produtos primeiro.")
         return
 
@@ -1093,13 +4082,20 @@ def add_itens_nf_assistente(nf_id: int) -> None:
             break
 
         if sku_in:
-            for p in produtos:
-                if str(p.get("sku","")).upper() == sku_in:
-                    prod = p
-                    break
+            idx = indice_busca()
+            prod = idx.buscar_codigo(sku_in)
             if not prod:
-                print("SKU não encontrado. Use ENTER para buscar por texto.")
-                continue
+                sugestoes = idx.buscar_prefixo(sku_in, limit=10)
+                if not sugestoes:
+                    print("SKU não encontrado. Use ENTER para buscar por texto.")
+                    continue
+                print("SKU não encontrado. Começando com o que foi digitado:")
+                for x in sugestoes:
+                    print(f"[{x['id']}] {x['sku']} | {x['descricao']} | preço={money(float(x.get('preco_venda',0)))}")
+                pid = ask_int("Produto ID (ENTER para voltar): ", required=False, min_v=1)
+                prod = idx.docs.get(int(pid)) if pid else None
+                if not prod or int(prod.get("ativo", 1)) != 1:
+                    continue
         else:
             q = ask_str("Buscar por texto (SKU/descrição): ", required=True)
             hits = search_produtos(q, limit=10)
@@ -1109,7 +4105,7 @@ def add_itens_nf_assistente(nf_id: int) -> None:
             for x in hits:
                 print(f"[{x['id']}] {x['sku']} | {x['descricao']} | preço={money(float(x.get('preco_venda',0)))}")
             pid = ask_int("Produto ID: ", required=True, min_v=1) or 0
-            prod = find_by_id(store_prod, int(pid))
+            prod = indice_busca().docs.get(int(pid))
             if not prod:
                 print("Produto inválido.")
                 continue
@@ -1127,30 +4123,12 @@ def add_itens_nf_assistente(nf_id: int) -> None:
         seguro = ask_float("Seguro (R$) [0]: ", required=False, min_v=0.0) or 0.0
         outras = ask_float("Outras despesas (R$) [0]: ", required=False, min_v=0.0) or 0.0
 
-        v_bruto, v_total = calc_item_totais(float(qtd), float(v_unit), float(desconto), float(frete), float(seguro), float(outras))
-
-        item_id = len(nf.get("itens", [])) + 1
-        item = asdict(NFItem(
-            id=item_id,
-            produto_id=int(prod["id"]),
-            sku=str(prod.get("sku","")),
-            descricao=str(prod.get("descricao","")),
-            ncm=str(prod.get("ncm","")),
-            cest=str(prod.get("cest","")),
-            cfop=cfop_in,
-            qtd=float(qtd),
-            v_unit=float(v_unit),
-            desconto=float(desconto),
-            frete=float(frete),
-            seguro=float(seguro),
-            outras=float(outras),
-            v_bruto=float(v_bruto),
-            v_total=float(v_total),
-            impostos=None
-        ))
-        nf["itens"].append(item)
-        save_store(FILE_NFS, store_nf)
-        print(f"Item inserido. Total item: {money(v_total)}")
+        item = novo_item_nf(nf, prod, {
+            "cfop": cfop_in, "qtd": qtd, "v_unit": v_unit,
+            "desconto": desconto, "frete": frete, "seguro": seguro, "outras": outras,
+        })
+        save_store(FILE_NFS, store_nf, changed=[nf])
+        print(f"Item inserido. Total item: {money(item['v_total'])}")
 
         cont = (ask_str("Adicionar outro item? (S/N) [S]: ", required=False) or "S").strip().upper()
         if cont != "S":
@@ -1176,46 +4154,165 @@ def remove_item_nf(nf_id: int) -> None:
         print(f"[{it['id']}] {it['sku']} | {it['descricao']} | qtd={it['qtd']} | total={money(float(it['v_total']))}")
     iid = ask_int("Item ID para remover: ", required=True, min_v=1) or 0
 
+    for it in itens:
+        if int(it.get("id",0)) == int(iid):
+            descontar_item_somas(nf, it)
     nf["itens"] = [x for x in itens if int(x.get("id",0)) != int(iid)]
     for idx, it in enumerate(nf["itens"], start=1):
         it["id"] = idx
 
-    save_store(FILE_NFS, store_nf)
+    save_store(FILE_NFS, store_nf, changed=[nf])
     print("Item removido.")
 
-def calcular_nf(nf_id: int) -> None:
+@medir_operacao
+def calcular_nf(nf_id: int, completo: bool = False) -> None:
     title(f"Calcular NF {nf_id} (ST/DIFAL/FCP + Totais)")
-    store_nf = load_store(FILE_NFS)
+    store_nf = store_aberto(FILE_NFS)
     nf = find_by_id(store_nf, nf_id)
     if not nf:
         print("NF não encontrada.")
         return
 
-    tabela_uf = load_tabela_uf()
-    if not tabela_uf:
-        bootstrap_ufs_generic()
-        tabela_uf = load_tabela_uf()
-
+    tabela_uf = load_contexto_fiscal()
     tabela_st = load_tabela_st()
 
-    store_pes = load_store(FILE_PESSOAS)
+    store_pes = store_aberto(FILE_PESSOAS)
     dest = find_by_id(store_pes, int(nf["destinatario_id"]))
     ind_ie_dest = int(dest.get("ind_ie_dest", 9)) if dest else 9
 
-    store_prod = load_store(FILE_PRODUTOS)
+    store_prod = store_aberto(FILE_PRODUTOS)
 
     itens = nf.get("itens", [])
     if not itens:
         print("NF sem itens.")
         return
 
-    tot_v_prod = tot_desc = tot_frete = tot_seg = tot_out = tot_nf = 0.0
-    tot_icms_st = tot_fcp_st = 0.0
-    tot_icms_ufdest = tot_icms_ufremet = tot_fcp_ufdest = 0.0
+    def flag_importado_de(pid: int) -> int:
+        return int((find_by_id(store_prod, pid) or {}).get("flag_importado", 0))
+
+    try:
+        recalculados = aplicar_calculo_nf(nf, tabela_uf, tabela_st, ind_ie_dest, flag_importado_de, completo=completo)
+        save_store(FILE_NFS, store_nf, changed=[nf])
+    except BaseException:
+        descartar_store_aberto(FILE_NFS)  # a NF em memória pode ter ficado pela metade
+        raise
+    print(f"Cálculo concluído. Itens recalculados: {recalculados} de {len(itens)}")
+
+# ---------------------------------------------------------
+# Cálculo incremental: cada item guarda em it["calc"] a impressão das
+# entradas do cálculo (valores, CFOP/NCM/CEST, par de UFs, data, cadastros e
+# versões das tabelas UF/ST) e a sua parcela de cada total em centavos; a NF
+# guarda em nf["somas"] a soma dessas parcelas. Item com a mesma impressão
+# não é recalculado e os totais são ajustados pela diferença das parcelas.
+# Como as parcelas são inteiras, o resultado é o mesmo do recálculo completo
+# (totais_nf). Se algum valor não fecha em centavos, usa-se totais_nf.
+# ---------------------------------------------------------
+def _versao_calculo(tabela_uf: Dict[str, Any], tabela_st: List[Dict[str, Any]]) -> Optional[Tuple]:
+    v_uf = getattr(tabela_uf, "versao", None)
+    v_st = getattr(tabela_st, "versao", None)
+    if v_uf is None or v_st is None:
+        return None
+    return (v_uf, v_st)
+
+def impressao_item(nf: Dict[str, Any], it: Dict[str, Any], ind_ie_dest: int, flag_importado: int, versao: Tuple) -> str:
+    chave = (
+        float(it.get("qtd", 0.0)), float(it.get("v_unit", 0.0)), float(it.get("desconto", 0.0)),
+        float(it.get("frete", 0.0)), float(it.get("seguro", 0.0)), float(it.get("outras", 0.0)),
+        str(it.get("cfop","")), str(it.get("ncm","")), str(it.get("cest","")),
+        str(nf["uf_origem"]).upper(), str(nf["uf_destino"]).upper(), str(nf["data_emissao"]),
+        int(nf.get("ind_final", 0)), int(ind_ie_dest), int(flag_importado), versao,
+    )
+    return hashlib.blake2b(repr(chave).encode("utf-8"), digest_size=8).hexdigest()
+
+def _valores_totais_item(it: Dict[str, Any]) -> Tuple[Any, ...]:
+    """Valores do item na ordem de TOTAIS_CAMPOS."""
+    imp = it.get("impostos") or {}
+    st = imp.get("st") or {}
+    df = imp.get("difal") or {}
+    return (
+        it.get("v_bruto", 0.0), it.get("desconto", 0.0), it.get("frete", 0.0), it.get("seguro", 0.0),
+        it.get("outras", 0.0), it.get("v_total", 0.0),
+        st.get("v_icms_st", 0.0), st.get("v_fcp_st", 0.0),
+        df.get("v_icms_ufdest", 0.0), df.get("v_icms_ufremet", 0.0), df.get("v_fcp_ufdest", 0.0),
+    )
+
+def _parcelas_item(it: Dict[str, Any]) -> Optional[List[int]]:
+    """Contribuição do item para cada campo de TOTAIS_CAMPOS, em centavos (None se não fecha)."""
+    out = []
+    for v in _valores_totais_item(it):
+        v = float(v)
+        c = round(v * 100)
+        if c / 100 != v:
+            return None
+        out.append(c)
+    return out
 
+def _somas_de_itens(itens: List[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    cent = [0] * len(TOTAIS_CAMPOS)
     for it in itens:
-        prod = find_by_id(store_prod, int(it["produto_id"])) or {}
-        flag_importado = int(prod.get("flag_importado", 0))
+        parcelas = (it.get("calc") or {}).get("parcelas")
+        if parcelas is None:
+            return None
+        for i, c in enumerate(parcelas):
+            cent[i] += c
+    return {"n": len(itens), "cent": cent}
+
+def _somas_validas(nf: Dict[str, Any]) -> Optional[List[int]]:
+    """Somas correntes da NF, se ainda batem com os itens já calculados."""
+    somas = nf.get("somas")
+    if not isinstance(somas, dict) or len(somas.get("cent") or []) != len(TOTAIS_CAMPOS):
+        return None
+    if sum(1 for it in nf.get("itens", []) if it.get("calc")) != somas.get("n"):
+        return None
+    return list(somas["cent"])
+
+def _totais_de_somas(cent: List[int]) -> Dict[str, float]:
+    return {k: c / 100 for k, c in zip(TOTAIS_CAMPOS, cent)}
+
+def descontar_item_somas(nf: Dict[str, Any], it: Dict[str, Any]) -> None:
+    """Tira das somas/totais da NF a parcela de um item que está saindo."""
+    cent = _somas_validas(nf)
+    calc = it.get("calc")
+    if not calc:
+        return
+    parcelas = calc.get("parcelas")
+    if cent is None or parcelas is None:
+        nf.pop("somas", None)
+        return
+    cent = [a - b for a, b in zip(cent, parcelas)]
+    nf["somas"] = {"n": nf["somas"]["n"] - 1, "cent": cent}
+    nf["totais"] = _totais_de_somas(cent)
+
+def aplicar_calculo_nf(
+    nf: Dict[str, Any],
+    tabela_uf: Dict[str, Any],
+    tabela_st: List[Dict[str, Any]],
+    ind_ie_dest: int,
+    flag_importado_de: Callable[[int], int],
+    completo: bool = False
+) -> int:
+    """
+    Recalcula itens (v_bruto/v_total/impostos) e nf["totais"] no próprio dict.
+    Não lê nem grava nada em disco: quem chama fornece tabelas e cadastros.
+    Só recalcula itens cuja impressão mudou (completo=True recalcula todos);
+    retorna quantos itens foram recalculados.
+    """
+    itens = nf.get("itens", [])
+    versao = _versao_calculo(tabela_uf, tabela_st)
+    cent = None if completo or versao is None else _somas_validas(nf)
+    recalculados = 0
+
+    for it in itens:
+        flag_importado = flag_importado_de(int(it["produto_id"]))
+        fp = impressao_item(nf, it, ind_ie_dest, flag_importado, versao) if versao is not None else None
+        calc = it.get("calc")
+        if not completo and fp is not None and calc and calc.get("fp") == fp:
+            continue
+        if cent is not None and calc:
+            if calc.get("parcelas") is None:
+                cent = None
+            else:
+                cent = [a - b for a, b in zip(cent, calc["parcelas"])]
 
         v_bruto, v_total = calc_item_totais(
             float(it.get("qtd", 0.0)),
@@ -1244,7 +4341,35 @@ def calcular_nf(nf_id: int) -> None:
             aplicar_st=1
         )
         it["impostos"] = impostos
+        recalculados += 1
+
+        parcelas = _parcelas_item(it)
+        if fp is None:
+            it.pop("calc", None)
+        else:
+            it["calc"] = {"fp": fp, "parcelas": parcelas}
+        if cent is not None:
+            cent = None if parcelas is None else [a + b for a, b in zip(cent, parcelas)]
+
+    if cent is not None:
+        nf["totais"] = _totais_de_somas(cent)
+        nf["somas"] = {"n": len(itens), "cent": cent}
+    else:
+        nf["totais"] = totais_nf(itens)
+        somas = _somas_de_itens(itens) if versao is not None else None
+        if somas is None:
+            nf.pop("somas", None)
+        else:
+            nf["somas"] = somas
+    return recalculados
+
+def totais_nf(itens: List[Dict[str, Any]]) -> Dict[str, float]:
+    tot_v_prod = tot_desc = tot_frete = tot_seg = tot_out = tot_nf = 0.0
+    tot_icms_st = tot_fcp_st = 0.0
+    tot_icms_ufdest = tot_icms_ufremet = tot_fcp_ufdest = 0.0
 
+    for it in itens:
+        impostos = it.get("impostos") or {}
         tot_v_prod += float(it.get("v_bruto", 0.0))
         tot_desc += float(it.get("desconto", 0.0))
         tot_frete += float(it.get("frete", 0.0))
@@ -1260,7 +4385,7 @@ def calcular_nf(nf_id: int) -> None:
             tot_icms_ufremet += float(impostos["difal"].get("v_icms_ufremet", 0.0))
             tot_fcp_ufdest += float(impostos["difal"].get("v_fcp_ufdest", 0.0))
 
-    nf["totais"] = {
+    return {
         "v_prod": round(tot_v_prod, 2),
         "v_desc": round(tot_desc, 2),
         "v_frete": round(tot_frete, 2),
@@ -1273,12 +4398,11 @@ def calcular_nf(nf_id: int) -> None:
         "total_icms_ufremet": round(tot_icms_ufremet, 2),
         "total_fcp_ufdest": round(tot_fcp_ufdest, 2),
     }
-    save_store(FILE_NFS, store_nf)
-    print("Cálculo concluído.")
 
+@medir_operacao
 def emitir_nf(nf_id: int) -> None:
     title(f"Emitir NF {nf_id} (postar estoque)")
-    store_nf = load_store(FILE_NFS)
+    store_nf = store_aberto(FILE_NFS)
     nf = find_by_id(store_nf, nf_id)
     if not nf:
         print("NF não encontrada.")
@@ -1293,36 +4417,17 @@ def emitir_nf(nf_id: int) -> None:
     if not nf.get("totais"):
         print("Aviso: NF não calculada. Recomendado rodar 'Calcular NF' antes.")
 
-    estoque = load_estoque()
-    filial_id = int(nf["filial_id"])
-    sign = 1.0 if nf["tipo_operacao"] == "ENTRADA" else -1.0
-
-    if sign < 0 and not ALLOW_NEGATIVE_STOCK:
-        for it in itens:
-            pid = int(it["produto_id"])
-            qtd = float(it.get("qtd", 0.0))
-            current = get_stock(estoque, filial_id, pid)
-            if current - qtd < -1e-9:
-                print(f"Bloqueado: estoque insuficiente | produto_id={pid} | atual={current} | saída={qtd}")
-                return
-
-    for it in itens:
-        pid = int(it["produto_id"])
-        qtd = float(it.get("qtd", 0.0))
-        ok, msg = apply_stock_delta(estoque, filial_id, pid, sign * qtd)
-        if not ok:
-            print(f"Falha ao postar estoque: {msg}")
-            return
-
-    nf["status"] = "EMITIDA"
-    nf["estoque_postado"] = 1
-    save_estoque(estoque)
-    save_store(FILE_NFS, store_nf)
-    print("NF emitida e estoque atualizado.")
+    try:
+        res = emitir_nfs(store_nf, [nf_id])
+    except BaseException:
+        descartar_store_aberto(FILE_NFS)  # a NF em memória pode ter ficado pela metade
+        raise
+    print(res[0]["msg"])
 
+@medir_operacao
 def cancelar_nf(nf_id: int) -> None:
     title(f"Cancelar NF {nf_id} (reverter estoque se postado)")
-    store_nf = load_store(FILE_NFS)
+    store_nf = store_aberto(FILE_NFS)
     nf = find_by_id(store_nf, nf_id)
     if not nf:
         print("NF não encontrada.")
@@ -1331,45 +4436,27 @@ def cancelar_nf(nf_id: int) -> None:
         print("NF já está cancelada.")
         return
 
-    estoque_postado = int(nf.get("estoque_postado", 0))
-    itens = nf.get("itens", [])
-
-    if estoque_postado == 1:
-        estoque = load_estoque()
-        filial_id = int(nf["filial_id"])
-        sign = -1.0 if nf["tipo_operacao"] == "ENTRADA" else 1.0
-
-        if sign < 0 and not ALLOW_NEGATIVE_STOCK:
-            for it in itens:
-                pid = int(it["produto_id"])
-                qtd = float(it.get("qtd", 0.0))
-                current = get_stock(estoque, filial_id, pid)
-                if current - qtd < -1e-9:
-                    print(f"Bloqueado: reverter ENTRADA geraria negativo | produto_id={pid} | atual={current} | reverter={qtd}")
-                    return
-
-        for it in itens:
-            pid = int(it["produto_id"])
-            qtd = float(it.get("qtd", 0.0))
-            ok, msg = apply_stock_delta(estoque, filial_id, pid, sign * qtd)
-            if not ok:
-                print(f"Falha ao reverter estoque: {msg}")
-                return
-
-        save_estoque(estoque)
-        nf["estoque_postado"] = 0
-
-    nf["status"] = "CANCELADA"
-    save_store(FILE_NFS, store_nf)
-    print("NF cancelada.")
+    try:
+        res = cancelar_nfs(store_nf, [nf_id])
+    except BaseException:
+        descartar_store_aberto(FILE_NFS)
+        raise
+    print(res[0]["msg"])
 
 def listar_nfs(limit: int = 50) -> List[Dict[str, Any]]:
-    store_nf = load_store(FILE_NFS)
-    items = store_nf.get("items", [])
-    if not items:
-        print("Nenhuma NF lançada.")
-        return []
-    items_sorted = sorted(items, key=lambda x: int(x.get("id",0)), reverse=True)[:limit]
+    if usa_sqlite():
+        rows = _sql_conn().execute("SELECT doc FROM nfs ORDER BY id DESC LIMIT ?", (int(limit),)).fetchall()
+        items_sorted = [json.loads(r[0]) for r in rows]
+        if not items_sorted:
+            print("Nenhuma NF lançada.")
+            return []
+    else:
+        store_nf = load_store(FILE_NFS)
+        items = store_nf.get("items", [])
+        if not items:
+            print("Nenhuma NF lançada.")
+            return []
+        items_sorted = sorted(items, key=lambda x: int(x.get("id",0)), reverse=True)[:limit]
     for nf in items_sorted:
         print(f"[{nf['id']}] {nf['tipo_operacao']} {nf['modelo']}-{nf['serie']}/{nf['numero']} | {nf['data_emissao']} | {nf['status']} | {nf['uf_origem']}->{nf['uf_destino']} | itens={len(nf.get('itens',[]))}")
     return items_sorted
@@ -1459,37 +4546,445 @@ def toggle_ativo(path: Path, entity_name: str) -> None:
         print("ID não encontrado.")
         return
     it["ativo"] = 0 if int(it.get("ativo",1)) == 1 else 1
-    save_store(path, store)
+    save_store(path, store, changed=[it])
+    if path == FILE_PRODUTOS:
+        indexar_produtos(store, [it])
     print("Atualizado.")
 
 # =========================================================
-# EXPORT HTML/PDF (mantido do seu modelo anterior)
+# NF: recálculo em lote (período/status/filial) com pool de processos
 # =========================================================
-def export_nf_html(nf_id: int, out_path: str) -> None:
-    title(f"Exportar NF {nf_id} para HTML")
+LOTE_MIN_POR_PROCESSO = 50  # abaixo disso o pool custa mais do que economiza
+
+TOTAIS_CAMPOS = [
+    "v_prod","v_desc","v_frete","v_seg","v_outro","v_nf",
+    "total_icms_st","total_fcp_st","total_icms_ufdest","total_icms_ufremet","total_fcp_ufdest",
+]
+
+# contexto fiscal do processo (preenchido uma vez por processo do pool)
+_LOTE_CTX: Dict[str, Any] = {}
+
+def _lote_init(ctx: Dict[str, Any]) -> None:
+    _LOTE_CTX.clear()
+    _LOTE_CTX.update(ctx)
+    _LOTE_CTX["tabela_st"] = compilar_regras_st(ctx["tabela_st"])
+    _LOTE_CTX["tabela_st"].versao = ctx.get("versao_st")
+
+def _lote_calcular(nfs: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    ctx = _LOTE_CTX
+    flags = ctx["flags_importado"]
+    ind_ie = ctx["ind_ie_dest"]
+    aplicar_calculo_nfs(
+        nfs, ctx["tabela_uf"], ctx["tabela_st"],
+        lambda dest_id: ind_ie.get(dest_id, 9),
+        lambda pid: flags.get(pid, 0),
+    )
+    return nfs
+
+def filtrar_nfs(
+    items: List[Dict[str, Any]],
+    data_ini: str = "",
+    data_fim: str = "",
+    status: Optional[List[str]] = None,
+    filial_id: Optional[int] = None
+) -> List[Dict[str, Any]]:
+    """Filtra NFs por período (YYYY-MM-DD, inclusivo), lista de status e filial."""
+    out = []
+    for nf in items:
+        dt = str(nf.get("data_emissao", ""))
+        if data_ini and dt < data_ini:
+            continue
+        if data_fim and dt > data_fim:
+            continue
+        if status and str(nf.get("status", "")) not in status:
+            continue
+        if filial_id is not None and int(nf.get("filial_id", 0)) != int(filial_id):
+            continue
+        out.append(nf)
+    return out
+
+def _em_pool(func: Callable[[List[Any]], List[Any]], itens: List[Any], workers: Optional[int],
+             initializer: Optional[Callable[..., None]] = None, initargs: Tuple = ()) -> List[Any]:
+    """
+    Executa func em blocos de itens num ProcessPoolExecutor e devolve os
+    resultados na ordem original. Lotes pequenos (ou workers=1) rodam no
+    próprio processo; se o pool não puder ser criado (processos, pickle de
+    func/initializer) ou quebrar, também. Erros de func sobem normalmente.
+    """
+    def no_processo(motivo: Optional[BaseException] = None) -> List[Any]:
+        if motivo is not None:
+            print(f"Aviso: pool de processos indisponível ({motivo}); processando no processo atual.")
+        if initializer:
+            initializer(*initargs)
+        return func(itens)
+
+    workers = workers or os.cpu_count() or 1
+    workers = max(1, min(workers, len(itens) // LOTE_MIN_POR_PROCESSO or 1))
+    if workers == 1:
+        return no_processo()
+
+    chunk = (len(itens) + workers * 4 - 1) // (workers * 4)
+    blocos = [itens[i:i + chunk] for i in range(0, len(itens), chunk)]
+    ex: Optional[ProcessPoolExecutor] = None
+    try:
+        # func/initializer vão por referência para os processos: lambda ou
+        # função local falha aqui (AttributeError/PicklingError), não no meio
+        pickle.dumps((func, initializer))
+        ex = ProcessPoolExecutor(max_workers=workers, initializer=initializer, initargs=initargs)
+        futuros = [ex.submit(func, b) for b in blocos]  # cria os processos (OSError se não der)
+    except (OSError, BrokenProcessPool, pickle.PicklingError, AttributeError) as e:
+        if ex is not None:
+            ex.shutdown(wait=True, cancel_futures=True)
+        return no_processo(e)
+    with ex:
+        try:
+            out: List[Any] = []
+            for fut in futuros:
+                out.extend(fut.result())
+            return out
+        except BrokenProcessPool as e:
+            # processo do pool morreu (memória, initializer): refaz tudo aqui
+            return no_processo(e)
+
+@medir_operacao
+def recalcular_nfs_lote(
+    data_ini: str = "",
+    data_fim: str = "",
+    status: Optional[List[str]] = None,
+    filial_id: Optional[int] = None,
+    workers: Optional[int] = None
+) -> List[Dict[str, Any]]:
+    """
+    Recalcula todas as NFs do filtro carregando tabelas e cadastros uma vez,
+    distribui as NFs entre processos e grava tudo num único save_store.
+    Retorna [{"id", "antes": totais, "depois": totais}] das NFs alteradas.
+    """
     store_nf = load_store(FILE_NFS)
-    nf = find_by_id(store_nf, nf_id)
-    if not nf:
-        print("NF não encontrada.")
+    alvo = [nf for nf in filtrar_nfs(store_nf.get("items", []), data_ini, data_fim, status, filial_id) if nf.get("itens")]
+    if not alvo:
+        return []
+
+    tabela_st = load_tabela_st()
+    ctx = {
+        "tabela_uf": load_contexto_fiscal(),
+        "tabela_st": list(tabela_st),
+        "versao_st": tabela_st.versao,
+        "ind_ie_dest": {int(x["id"]): int(x.get("ind_ie_dest", 9)) for x in load_store(FILE_PESSOAS).get("items", [])},
+        "flags_importado": {int(x["id"]): int(x.get("flag_importado", 0)) for x in load_store(FILE_PRODUTOS).get("items", [])},
+    }
+
+    antes_por_nf = [dict(nf.get("totais") or {}) for nf in alvo]
+    calculadas = _em_pool(_lote_calcular, alvo, workers, initializer=_lote_init, initargs=(ctx,))
+
+    resumo: List[Dict[str, Any]] = []
+    alteradas: List[Dict[str, Any]] = []
+    for nf, nova, antes in zip(alvo, calculadas, antes_por_nf):
+        if nova is not nf:  # veio de outro processo
+            nf["itens"] = nova["itens"]
+            nf["totais"] = nova["totais"]
+            nf["somas"] = nova.get("somas")
+        alteradas.append(nf)
+        if antes != nf["totais"]:
+            resumo.append({"id": nf["id"], "antes": antes, "depois": dict(nf["totais"])})
+
+    save_store(FILE_NFS, store_nf, changed=alteradas)
+    return resumo
+
+def recalcular_nfs_lote_menu() -> None:
+    title("Recalcular NFs em lote (período/status/filial)")
+    data_ini = ask_date_yyyy_mm_dd("Data inicial (YYYY-MM-DD) [vazio=sem limite]: ", required=False, default_today=False)
+    data_fim = ask_date_yyyy_mm_dd("Data final (YYYY-MM-DD) [vazio=sem limite]: ", required=False, default_today=False)
+    st_in = (ask_str("Status (RASCUNHO/EMITIDA/CANCELADA, separados por vírgula; TODOS) [RASCUNHO]: ", required=False) or "RASCUNHO").upper()
+    status = None if st_in in ("TODOS", "*") else [x.strip() for x in st_in.replace(";", ",").split(",") if x.strip()]
+    filial_id = ask_int("Filial ID [vazio=todas]: ", required=False, min_v=1)
+
+    t0 = time.perf_counter()
+    resumo = recalcular_nfs_lote(data_ini, data_fim, status, filial_id)
+    dt = time.perf_counter() - t0
+
+    for r in resumo:
+        a, d = r["antes"], r["depois"]
+        difs = [
+            f"{k}: {money(float(a.get(k, 0.0)))} -> {money(float(d.get(k, 0.0)))}"
+            for k in TOTAIS_CAMPOS if float(a.get(k, 0.0)) != float(d.get(k, 0.0))
+        ]
+        print(f"NF {r['id']}: " + (" | ".join(difs) if difs else "totais calculados"))
+    print(f"\nNFs com totais alterados: {len(resumo)} | tempo: {dt:.2f}s")
+
+# =========================================================
+# ST: simulação de regras candidatas sobre NFs existentes (what-if)
+# =========================================================
+# Recalcula os impostos dos itens já lançados com a tabela ST em vigor e com
+# uma tabela candidata, no mesmo contexto de UF, e compara ST, FCP-ST e
+# DIFAL. Nada é gravado: as NFs vão para os processos como tuplas compactas
+# e só o resultado volta. DIFAL não depende das regras ST; entra no relatório
+# para mostrar que ficou igual (ou para acusar diferença inesperada).
+CAMPOS_SIMULACAO = ["icms_st", "fcp_st", "difal"]
+
+_SIM_CTX: Dict[str, Any] = {}
+
+VIG_INI_SIMULACAO = "1900-01-01"  # regra candidata sem vig_ini: vale desde sempre
+
+def carregar_regras_st_candidatas(path: str) -> List[Dict[str, Any]]:
+    """
+    Lê uma tabela ST candidata: JSON no formato de tabela_st_regras.json
+    (ou só a lista de regras) ou CSV (;) no layout do import. No CSV a
+    tabela é o arquivo inteiro, com IDs na ordem das linhas. vig_ini vazia
+    vale como "sem início" (no import ela vira a data de hoje, o que
+    tiraria a regra de todas as NFs já emitidas).
+    """
+    if path.lower().endswith(".csv"):
+        regras = []
+        with open(path, "r", encoding="utf-8-sig", newline="") as f:
+            for n, row in enumerate(csv.DictReader(f, delimiter=";"), start=2):
+                sem_inicio = not str(row.get("vig_ini") or "").strip()
+                try:
+                    r = _regra_st_de_linha(row)
+                except LinhaInvalida as e:
+                    raise ValueError(f"{path}, linha {n}: {e}") from None
+                if sem_inicio:
+                    r["vig_ini"] = VIG_INI_SIMULACAO
+                regras.append({"id": len(regras) + 1, **r})
+        return regras
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    if isinstance(data, list):
+        data = {"regras": data}
+    if not isinstance(data, dict) or not isinstance(data.get("regras"), list):
+        raise ValueError(f"{path}: esperado {{\"regras\": [...]}} ou uma lista de regras.")
+    regras = _normalize_st_file(data)["regras"]
+    for r in regras:
+        if not str(r.get("vig_ini") or "").strip():
+            r["vig_ini"] = VIG_INI_SIMULACAO
+    return regras
+
+def rotulo_regra_candidata(rid: Any) -> Optional[str]:
+    """IDs da tabela candidata têm numeração própria: no resultado vão como "C<id>"."""
+    return None if rid is None else f"C{rid}"
+
+def _simular_init(ctx: Dict[str, Any]) -> None:
+    _SIM_CTX.clear()
+    _SIM_CTX.update(ctx)
+    # a troca de regra é decidida pelo conteúdo (_rule_signature), não pelo id:
+    # a numeração da tabela candidata não tem relação com a da tabela em vigor
+    _SIM_CTX["assinaturas"] = {
+        nome: {r.get("id"): _rule_signature(r) for r in reversed(ctx[nome])} for nome in ("atual", "candidata")
+    }
+    for nome in ("atual", "candidata"):
+        regras = compilar_regras_st(ctx[nome])
+        # NFs de um período repetem (UFs, NCM, CEST, CFOP, data): cada combinação escolhe a regra uma vez
+        regras.indice.escolher = lru_cache(maxsize=1 << 16)(regras.indice.escolher)
+        _SIM_CTX[nome] = regras
+
+def _valores_simulacao(impostos: Dict[str, Any]) -> Tuple[int, int, int]:
+    st = impostos.get("st") or {}
+    difal = impostos.get("difal") or {}
+    return (
+        round(float(st.get("v_icms_st", 0.0)) * 100),
+        round(float(st.get("v_fcp_st", 0.0)) * 100),
+        round(float(difal.get("v_difal_total", 0.0)) * 100),
+    )
+
+def _simular_bloco(nfs: List[Tuple]) -> List[Dict[str, Any]]:
+    ctx = _SIM_CTX
+    linhas = []
+    for _nf_id, _numero, data_emissao, uf_origem, uf_destino, ind_final, ind_ie_dest, itens in nfs:
+        for _item_id, _sku, cfop, ncm, cest, flag_importado, v_operacao in itens:
+            linhas.append({
+                "uf_origem": uf_origem, "uf_destino": uf_destino,
+                "ind_final": ind_final, "ind_ie_dest": ind_ie_dest,
+                "flag_importado": flag_importado, "data_emissao": data_emissao,
+                "cfop": cfop, "ncm": ncm, "cest": cest, "v_operacao": v_operacao,
+            })
+    antes = calcular_impostos_lote(linhas, ctx["tabela_uf"], ctx["atual"])
+    depois = calcular_impostos_lote(linhas, ctx["tabela_uf"], ctx["candidata"])
+    sig_a, sig_d = ctx["assinaturas"]["atual"], ctx["assinaturas"]["candidata"]
+
+    out: List[Dict[str, Any]] = []
+    i = 0
+    for nf_id, numero, data_emissao, uf_origem, uf_destino, _f, _ie, itens in nfs:
+        soma_a = [0, 0, 0]
+        soma_d = [0, 0, 0]
+        alterados = []
+        for item_id, sku, *_ in itens:
+            a, d = antes[i], depois[i]
+            i += 1
+            va, vd = _valores_simulacao(a), _valores_simulacao(d)
+            ra = (a.get("regra_st_aplicada") or {}).get("id")
+            rd = (d.get("regra_st_aplicada") or {}).get("id")
+            for k in range(3):
+                soma_a[k] += va[k]
+                soma_d[k] += vd[k]
+            trocou = (None if ra is None else sig_a.get(ra)) != (None if rd is None else sig_d.get(rd))
+            if trocou or va != vd:
+                alterados.append({
+                    "item_id": item_id, "sku": sku, "regra_atual": ra, "regra_nova": rotulo_regra_candidata(rd),
+                    "trocou_regra": trocou, "antes": va, "depois": vd,
+                })
+        out.append({
+            "id": nf_id, "numero": numero, "data_emissao": data_emissao,
+            "uf_origem": uf_origem, "uf_destino": uf_destino,
+            "itens": len(itens), "antes": soma_a, "depois": soma_d, "alterados": alterados,
+        })
+    return out
+
+def _reais_simulacao(cent: List[int]) -> Dict[str, float]:
+    return {c: v / 100 for c, v in zip(CAMPOS_SIMULACAO, cent)}
+
+@medir_operacao
+def simular_regras_st(
+    regras_candidatas: List[Dict[str, Any]],
+    data_ini: str = "",
+    data_fim: str = "",
+    status: Optional[List[str]] = None,
+    filial_id: Optional[int] = None,
+    workers: Optional[int] = None
+) -> Dict[str, Any]:
+    """
+    Reavalia os itens das NFs do filtro (padrão: EMITIDA) com as regras
+    atuais e com regras_candidatas, distribuindo as NFs entre processos.
+    Retorna totais antes/depois/delta, as trocas de regra (regra_atual ->
+    regra_nova com a contagem de itens) e, por NF afetada, os deltas e os
+    itens que mudaram. Valores somados em centavos, sem erro de arredondamento.
+    regra_nova é o id da tabela candidata como "C<id>"; há troca quando a
+    regra aplicada muda de conteúdo, mesmo que o id coincida.
+    """
+    status = ["EMITIDA"] if status is None else status
+    store_nf = load_store(FILE_NFS)
+    alvo = [nf for nf in filtrar_nfs(store_nf.get("items", []), data_ini, data_fim, status, filial_id) if nf.get("itens")]
+
+    ind_ie = {int(x["id"]): int(x.get("ind_ie_dest", 9)) for x in load_store(FILE_PESSOAS).get("items", [])}
+    flags = {int(x["id"]): int(x.get("flag_importado", 0)) for x in load_store(FILE_PRODUTOS).get("items", [])}
+    compactas = [(
+        int(nf["id"]), nf.get("numero"), str(nf["data_emissao"]),
+        str(nf["uf_origem"]).upper(), str(nf["uf_destino"]).upper(),
+        int(nf.get("ind_final", 0)), ind_ie.get(int(nf["destinatario_id"]), 9),
+        [(
+            it.get("id"), it.get("sku", ""),
+            str(it.get("cfop","")), str(it.get("ncm","")), str(it.get("cest","")),
+            flags.get(int(it["produto_id"]), 0), float(it.get("v_total", 0.0)),
+        ) for it in nf["itens"]],
+    ) for nf in alvo]
+
+    ctx = {
+        "tabela_uf": load_contexto_fiscal(),
+        "atual": list(load_tabela_st()),
+        "candidata": list(regras_candidatas),
+    }
+    por_nf = _em_pool(_simular_bloco, compactas, workers, initializer=_simular_init, initargs=(ctx,)) if compactas else []
+
+    antes = [0, 0, 0]
+    depois = [0, 0, 0]
+    itens = itens_alterados = 0
+    trocas: Dict[Tuple[Any, Any], int] = {}
+    afetadas = []
+    for r in por_nf:
+        itens += r["itens"]
+        for k in range(3):
+            antes[k] += r["antes"][k]
+            depois[k] += r["depois"][k]
+        for it in r["alterados"]:
+            itens_alterados += 1
+            if it["trocou_regra"]:
+                par = (it["regra_atual"], it["regra_nova"])
+                trocas[par] = trocas.get(par, 0) + 1
+            it["antes"] = _reais_simulacao(it["antes"])
+            it["depois"] = _reais_simulacao(it["depois"])
+        if r["alterados"]:
+            delta = [d - a for a, d in zip(r["antes"], r["depois"])]
+            afetadas.append({**r, "antes": _reais_simulacao(r["antes"]), "depois": _reais_simulacao(r["depois"]), "delta": _reais_simulacao(delta)})
+
+    return {
+        "nfs": len(por_nf),
+        "itens": itens,
+        "nfs_afetadas": len(afetadas),
+        "itens_afetados": itens_alterados,
+        "antes": _reais_simulacao(antes),
+        "depois": _reais_simulacao(depois),
+        "delta": _reais_simulacao([d - a for a, d in zip(antes, depois)]),
+        "trocas_regra": [
+            {"regra_atual": a, "regra_nova": d, "itens": n}
+            for (a, d), n in sorted(trocas.items(), key=lambda x: -x[1])
+        ],
+        "por_nf": afetadas,
+    }
+
+def simular_regras_st_menu() -> None:
+    title("Simular regras ST candidatas (NFs existentes, sem gravar)")
+    path = ask_str("Arquivo de regras candidato (.json ou .csv): ")
+    if not os.path.exists(path):
+        print("Arquivo não encontrado.")
         return
+    data_ini = ask_date_yyyy_mm_dd("Data inicial (YYYY-MM-DD) [vazio=sem limite]: ", required=False, default_today=False)
+    data_fim = ask_date_yyyy_mm_dd("Data final (YYYY-MM-DD) [vazio=sem limite]: ", required=False, default_today=False)
+    st_in = (ask_str("Status (RASCUNHO/EMITIDA/CANCELADA, separados por vírgula; TODOS) [EMITIDA]: ", required=False) or "EMITIDA").upper()
+    status = [] if st_in in ("TODOS", "*") else [x.strip() for x in st_in.replace(";", ",").split(",") if x.strip()]
 
-    itens = nf.get("itens", [])
-    totais = nf.get("totais") or {}
+    t0 = time.perf_counter()
+    try:
+        res = simular_regras_st(carregar_regras_st_candidatas(path), data_ini, data_fim, status)
+    except (OSError, ValueError) as e:
+        print(f"Erro: {e}")
+        return
+    dt = time.perf_counter() - t0
+
+    for r in res["por_nf"][:50]:
+        d = r["delta"]
+        print(f"NF {r['id']} ({r['data_emissao']} {r['uf_origem']}->{r['uf_destino']}): itens alterados={len(r['alterados'])} "
+              f"ΔST={money(d['icms_st'])} ΔFCP-ST={money(d['fcp_st'])} ΔDIFAL={money(d['difal'])}")
+    if len(res["por_nf"]) > 50:
+        print(f"... e mais {len(res['por_nf']) - 50} NF(s) afetadas.")
+    for t in res["trocas_regra"][:20]:
+        print(f"Regra {t['regra_atual'] or '-'} -> {t['regra_nova'] or '-'}: {t['itens']} item(ns)")
+    a, d, x = res["antes"], res["depois"], res["delta"]
+    print(f"\nNFs: {res['nfs']} | itens: {res['itens']} | NFs afetadas: {res['nfs_afetadas']} | itens afetados: {res['itens_afetados']}")
+    for c, nome in zip(CAMPOS_SIMULACAO, ("ST", "FCP-ST", "DIFAL")):
+        print(f"{nome:<7} atual={money(a[c]):>16} candidata={money(d[c]):>16} delta={money(x[c]):>14}")
+    print(f"tempo: {dt:.2f}s")
 
-    html = []
-    html.append("<html><head><meta charset='utf-8'>")
-    html.append("<style>body{font-family:Arial; margin:20px;} table{border-collapse:collapse;width:100%;} th,td{border:1px solid #ccc;padding:6px;font-size:12px;} th{background:#f2f2f2;} .row{display:flex; gap:20px;} .box{border:1px solid #ccc; padding:10px; flex:1;} h2{margin:0 0 10px 0;}</style>")
-    html.append("</head><body>")
-    html.append(f"<h1>{APP_NAME}</h1>")
-    html.append(f"<h2>NF {nf['id']} - {nf['tipo_operacao']} - {nf['status']}</h2>")
-    html.append(f"<div class='row'>"
-                f"<div class='box'><b>Chave interna</b>: {nf['id']}<br><b>Modelo/Série/Número</b>: {nf['modelo']}-{nf['serie']}/{nf['numero']}<br><b>Data</b>: {nf['data_emissao']}<br><b>UF Origem</b>: {nf['uf_origem']}<br><b>UF Destino</b>: {nf['uf_destino']}</div>"
-                f"<div class='box'><b>Filial</b>: {nf['filial_id']}<br><b>Emitente</b>: {nf['emitente_id']}<br><b>Destinatário</b>: {nf['destinatario_id']}<br><b>Consumidor final</b>: {nf.get('ind_final',0)}<br><b>Estoque postado</b>: {nf.get('estoque_postado',0)}</div>"
-                f"</div>")
-
-    html.append("<h3>Itens</h3>")
-    html.append("<table><tr><th>#</th><th>SKU</th><th>Descrição</th><th>NCM</th><th>CEST</th><th>CFOP</th><th>Qtd</th><th>V.Unit</th><th>Total</th><th>ST</th><th>DIFAL/FCP</th></tr>")
-    for it in itens:
+# =========================================================
+# EXPORT HTML/PDF (mantido do seu modelo anterior)
+# =========================================================
+# modelo HTML compilado uma vez no carregamento do módulo; cada NF só faz substitute()
+_HTML_NF_CAB = Template("\n".join([
+    "<html><head><meta charset='utf-8'>",
+    "<style>body{font-family:Arial; margin:20px;} table{border-collapse:collapse;width:100%;} th,td{border:1px solid #ccc;padding:6px;font-size:12px;} th{background:#f2f2f2;} .row{display:flex; gap:20px;} .box{border:1px solid #ccc; padding:10px; flex:1;} h2{margin:0 0 10px 0;}</style>",
+    "</head><body>",
+    "<h1>$app</h1>",
+    "<h2>NF $id - $tipo_operacao - $status</h2>",
+    "<div class='row'>"
+    "<div class='box'><b>Chave interna</b>: $id<br><b>Modelo/Série/Número</b>: $modelo-$serie/$numero<br><b>Data</b>: $data_emissao<br><b>UF Origem</b>: $uf_origem<br><b>UF Destino</b>: $uf_destino</div>"
+    "<div class='box'><b>Filial</b>: $filial_id<br><b>Emitente</b>: $emitente_id<br><b>Destinatário</b>: $destinatario_id<br><b>Consumidor final</b>: $ind_final<br><b>Estoque postado</b>: $estoque_postado</div>"
+    "</div>",
+    "<h3>Itens</h3>",
+    "<table><tr><th>#</th><th>SKU</th><th>Descrição</th><th>NCM</th><th>CEST</th><th>CFOP</th><th>Qtd</th><th>V.Unit</th><th>Total</th><th>ST</th><th>DIFAL/FCP</th></tr>",
+]))
+_HTML_NF_ITEM = Template(
+    "<tr>"
+    "<td>$id</td><td>$sku</td><td>$descricao</td>"
+    "<td>$ncm</td><td>$cest</td><td>$cfop</td>"
+    "<td>$qtd</td><td>$v_unit</td><td>$v_total</td>"
+    "<td>$st</td><td>$difal</td>"
+    "</tr>"
+)
+_HTML_NF_TOTAL = Template("<tr><th>$k</th><td>$v</td></tr>")
+_HTML_NF_RODAPE = "\n".join([
+    "</table>",
+    "<p><i>Observação: Documento gerado para controle interno/demonstração.</i></p>",
+    "</body></html>",
+])
+
+def render_nf_html(nf: Dict[str, Any]) -> str:
+    """Monta o HTML (estilo DANFE simplificado) de uma NF já carregada."""
+    totais = nf.get("totais") or {}
+    partes = [_HTML_NF_CAB.substitute(
+        app=APP_NAME, id=nf["id"], tipo_operacao=nf["tipo_operacao"], status=nf["status"],
+        modelo=nf["modelo"], serie=nf["serie"], numero=nf["numero"], data_emissao=nf["data_emissao"],
+        uf_origem=nf["uf_origem"], uf_destino=nf["uf_destino"], filial_id=nf["filial_id"],
+        emitente_id=nf["emitente_id"], destinatario_id=nf["destinatario_id"],
+        ind_final=nf.get("ind_final", 0), estoque_postado=nf.get("estoque_postado", 0),
+    )]
+    for it in nf.get("itens", []):
         imp = it.get("impostos") or {}
         st = imp.get("st") or {}
         df = imp.get("difal") or {}
@@ -1499,54 +4994,53 @@ def export_nf_html(nf_id: int, out_path: str) -> None:
         df_txt = ""
         if df:
             df_txt = f"UFDest {money(float(df.get('v_icms_ufdest',0)))}<br>UFRem {money(float(df.get('v_icms_ufremet',0)))}<br>FCP {money(float(df.get('v_fcp_ufdest',0)))}"
+        partes.append(_HTML_NF_ITEM.substitute(
+            id=it["id"], sku=it.get("sku", ""), descricao=it.get("descricao", ""),
+            ncm=it.get("ncm", ""), cest=it.get("cest", ""), cfop=it.get("cfop", ""),
+            qtd=it.get("qtd", 0), v_unit=money(float(it.get("v_unit", 0))), v_total=money(float(it.get("v_total", 0))),
+            st=st_txt, difal=df_txt,
+        ))
+    partes.append("</table>")
+    partes.append("<h3>Totais</h3>")
+    partes.append("<table>")
+    for k in TOTAIS_CAMPOS:
+        partes.append(_HTML_NF_TOTAL.substitute(k=k, v=money(float(totais.get(k, 0.0)))))
+    partes.append(_HTML_NF_RODAPE)
+    return "\n".join(partes)
 
-        html.append(
-            "<tr>"
-            f"<td>{it['id']}</td><td>{it.get('sku','')}</td><td>{it.get('descricao','')}</td>"
-            f"<td>{it.get('ncm','')}</td><td>{it.get('cest','')}</td><td>{it.get('cfop','')}</td>"
-            f"<td>{it.get('qtd',0)}</td><td>{money(float(it.get('v_unit',0)))}</td><td>{money(float(it.get('v_total',0)))}</td>"
-            f"<td>{st_txt}</td><td>{df_txt}</td>"
-            "</tr>"
-        )
-    html.append("</table>")
-
-    html.append("<h3>Totais</h3>")
-    html.append("<table>")
-    for k in ["v_prod","v_desc","v_frete","v_seg","v_outro","v_nf","total_icms_st","total_fcp_st","total_icms_ufdest","total_icms_ufremet","total_fcp_ufdest"]:
-        v = totais.get(k, 0.0)
-        html.append(f"<tr><th>{k}</th><td>{money(float(v))}</td></tr>")
-    html.append("</table>")
-
-    html.append("<p><i>Observação: Documento gerado para controle interno/demonstração.</i></p>")
-    html.append("</body></html>")
+def export_nf_html(nf_id: int, out_path: str) -> None:
+    title(f"Exportar NF {nf_id} para HTML")
+    store_nf = load_store(FILE_NFS)
+    nf = find_by_id(store_nf, nf_id)
+    if not nf:
+        print("NF não encontrada.")
+        return
 
     with open(out_path, "w", encoding="utf-8") as f:
-        f.write("\n".join(html))
+        f.write(render_nf_html(nf))
 
     print(f"HTML gerado: {out_path}")
     print("Dica: abra no navegador e use Imprimir > Salvar como PDF.")
 
-def export_nf_pdf_reportlab(nf_id: int, out_path: str) -> None:
-    title(f"Exportar NF {nf_id} para PDF (reportlab)")
+def _reportlab_disponivel() -> bool:
     try:
-        from reportlab.lib.pagesizes import A4
-        from reportlab.pdfgen import canvas
-        from reportlab.lib.units import mm
+        import reportlab  # noqa: F401
     except Exception:
         print("reportlab não está instalado.")
         print("Instale com: pip install reportlab")
-        return
+        return False
+    return True
 
-    store_nf = load_store(FILE_NFS)
-    nf = find_by_id(store_nf, nf_id)
-    if not nf:
-        print("NF não encontrada.")
-        return
+def render_nf_pdf(nf: Dict[str, Any], destino: Any) -> None:
+    """Desenha o resumo em PDF de uma NF em destino (caminho ou arquivo binário). Requer reportlab."""
+    from reportlab.lib.pagesizes import A4
+    from reportlab.pdfgen import canvas
+    from reportlab.lib.units import mm
 
     itens = nf.get("itens", [])
     totais = nf.get("totais") or {}
 
-    c = canvas.Canvas(out_path, pagesize=A4)
+    c = canvas.Canvas(destino, pagesize=A4)
     width, height = A4
 
     y = height - 20*mm
@@ -1589,13 +5083,172 @@ def export_nf_pdf_reportlab(nf_id: int, out_path: str) -> None:
     c.setFont("Helvetica-Bold", 11)
     line("Totais")
     c.setFont("Helvetica", 9)
-    for k in ["v_prod","v_desc","v_frete","v_seg","v_outro","v_nf","total_icms_st","total_fcp_st","total_icms_ufdest","total_icms_ufremet","total_fcp_ufdest"]:
+    for k in TOTAIS_CAMPOS:
         v = totais.get(k, 0.0)
         line(f"  {k}: {money(float(v))}")
 
     c.save()
+
+def export_nf_pdf_reportlab(nf_id: int, out_path: str) -> None:
+    title(f"Exportar NF {nf_id} para PDF (reportlab)")
+    if not _reportlab_disponivel():
+        return
+
+    store_nf = load_store(FILE_NFS)
+    nf = find_by_id(store_nf, nf_id)
+    if not nf:
+        print("NF não encontrada.")
+        return
+
+    render_nf_pdf(nf, out_path)
     print(f"PDF gerado: {out_path}")
 
+# =========================================================
+# EXPORT em lote (faixa de ID ou período) com pool de processos
+# =========================================================
+# contexto de exportação do processo (formato e diretório de saída)
+_EXPORT_CTX: Dict[str, Any] = {}
+
+def _export_init(ctx: Dict[str, Any]) -> None:
+    _EXPORT_CTX.clear()
+    _EXPORT_CTX.update(ctx)
+
+def nome_arquivo_nf(nf: Dict[str, Any], formato: str) -> str:
+    return f"nf_{int(nf['id']):06d}.{formato}"
+
+def _export_renderizar(nfs: List[Dict[str, Any]]) -> List[Tuple[str, Optional[bytes]]]:
+    """
+    Renderiza um bloco de NFs. Com diretório de saída o próprio processo grava
+    os arquivos e devolve só o nome; sem ele (zip) devolve o conteúdo.
+    """
+    formato = _EXPORT_CTX["formato"]
+    pasta = _EXPORT_CTX.get("pasta")
+    out: List[Tuple[str, Optional[bytes]]] = []
+    for nf in nfs:
+        nome = nome_arquivo_nf(nf, formato)
+        if formato == "pdf":
+            buf = io.BytesIO()
+            render_nf_pdf(nf, buf)
+            dados = buf.getvalue()
+        else:
+            dados = render_nf_html(nf).encode("utf-8")
+        if pasta:
+            (Path(pasta) / nome).write_bytes(dados)
+            out.append((nome, None))
+        else:
+            out.append((nome, dados))
+    return out
+
+def render_indice_html(nfs: List[Dict[str, Any]], arquivos: List[str]) -> str:
+    linhas = [
+        "<html><head><meta charset='utf-8'>",
+        "<style>body{font-family:Arial; margin:20px;} table{border-collapse:collapse;width:100%;} th,td{border:1px solid #ccc;padding:6px;font-size:12px;} th{background:#f2f2f2;} td.v{text-align:right;}</style>",
+        "</head><body>",
+        f"<h1>{APP_NAME}</h1>",
+        f"<h2>NFs exportadas: {len(nfs)}</h2>",
+        "<table><tr><th>NF</th><th>Modelo/Série/Número</th><th>Data</th><th>Tipo</th><th>Status</th><th>UF</th><th>Itens</th><th>Total NF</th><th>Arquivo</th></tr>",
+    ]
+    for nf, nome in zip(nfs, arquivos):
+        tot = nf.get("totais") or {}
+        linhas.append(
+            "<tr>"
+            f"<td>{nf['id']}</td><td>{nf.get('modelo','')}-{nf.get('serie','')}/{nf.get('numero','')}</td>"
+            f"<td>{nf.get('data_emissao','')}</td><td>{nf.get('tipo_operacao','')}</td><td>{nf.get('status','')}</td>"
+            f"<td>{nf.get('uf_origem','')} -> {nf.get('uf_destino','')}</td><td>{len(nf.get('itens', []))}</td>"
+            f"<td class='v'>{money(float(tot.get('v_nf', 0.0)))}</td><td><a href='{nome}'>{nome}</a></td>"
+            "</tr>"
+        )
+    linhas.append("</table>")
+    linhas.append(f"<p><i>Gerado em {datetime.now().isoformat(timespec='seconds')}.</i></p>")
+    linhas.append("</body></html>")
+    return "\n".join(linhas)
+
+@medir_operacao
+def exportar_nfs_lote(
+    destino: str,
+    formato: str = "html",
+    id_ini: Optional[int] = None,
+    id_fim: Optional[int] = None,
+    data_ini: str = "",
+    data_fim: str = "",
+    status: Optional[List[str]] = None,
+    workers: Optional[int] = None,
+    ids: Optional[List[int]] = None
+) -> Dict[str, Any]:
+    """
+    Exporta em HTML ou PDF todas as NFs da faixa de ID e/ou período.
+    ids: só estas NFs (lista que não precisa ser contínua; soma-se aos filtros).
+    Carrega o store uma vez e renderiza em pool de processos. Se destino
+    termina em .zip grava um zip; senão grava num diretório. Em ambos os
+    casos inclui index.html com a lista das NFs e links para os arquivos.
+    Retorna {"destino", "nfs", "arquivos"} (vazio se nada foi exportado).
+    """
+    formato = formato.lower()
+    if formato not in ("html", "pdf"):
+        raise ValueError(f"Formato inválido: {formato} (use html ou pdf)")
+    if formato == "pdf" and not _reportlab_disponivel():
+        return {}
+
+    store_nf = load_store(FILE_NFS)
+    sel = None if ids is None else set(ids)
+    alvo = [
+        nf for nf in filtrar_nfs(store_nf.get("items", []), data_ini, data_fim, status)
+        if (id_ini is None or int(nf["id"]) >= id_ini) and (id_fim is None or int(nf["id"]) <= id_fim)
+        and (sel is None or int(nf["id"]) in sel)
+    ]
+    alvo.sort(key=lambda nf: int(nf["id"]))
+    if not alvo:
+        return {}
+
+    em_zip = destino.lower().endswith(".zip")
+    pasta = None
+    if not em_zip:
+        pasta = Path(destino)
+        pasta.mkdir(parents=True, exist_ok=True)
+
+    ctx = {"formato": formato, "pasta": str(pasta) if pasta else None}
+    gerados = _em_pool(_export_renderizar, alvo, workers, initializer=_export_init, initargs=(ctx,))
+    arquivos = [nome for nome, _ in gerados]
+    indice = render_indice_html(alvo, arquivos).encode("utf-8")
+
+    if em_zip:
+        Path(destino).parent.mkdir(parents=True, exist_ok=True)
+        tmp = Path(destino + ".tmp")
+        # PDF já vem comprimido; só o HTML ganha com deflate
+        metodo = zipfile.ZIP_STORED if formato == "pdf" else zipfile.ZIP_DEFLATED
+        with zipfile.ZipFile(tmp, "w", compression=metodo) as zf:
+            for nome, dados in gerados:
+                zf.writestr(nome, dados or b"")
+            zf.writestr("index.html", indice, compress_type=zipfile.ZIP_DEFLATED)
+        os.replace(tmp, destino)
+    else:
+        (pasta / "index.html").write_bytes(indice)
+
+    return {"destino": destino, "nfs": len(alvo), "arquivos": arquivos}
+
+def exportar_nfs_lote_menu() -> None:
+    title("Exportar NFs em lote (HTML/PDF)")
+    formato = (ask_str("Formato (HTML/PDF) [HTML]: ", required=False) or "HTML").strip().lower()
+    if formato not in ("html", "pdf"):
+        print("Formato inválido.")
+        return
+    id_ini = ask_int("NF ID inicial [vazio=sem limite]: ", required=False, min_v=1)
+    id_fim = ask_int("NF ID final [vazio=sem limite]: ", required=False, min_v=1)
+    data_ini = ask_date_yyyy_mm_dd("Data inicial (YYYY-MM-DD) [vazio=sem limite]: ", required=False, default_today=False)
+    data_fim = ask_date_yyyy_mm_dd("Data final (YYYY-MM-DD) [vazio=sem limite]: ", required=False, default_today=False)
+    st_in = (ask_str("Status (RASCUNHO/EMITIDA/CANCELADA, separados por vírgula; TODOS) [TODOS]: ", required=False) or "TODOS").upper()
+    status = None if st_in in ("TODOS", "*") else [x.strip() for x in st_in.replace(";", ",").split(",") if x.strip()]
+    destino = ask_str("Destino (pasta ou arquivo .zip) [nfs_export]: ", required=False) or "nfs_export"
+
+    t0 = time.perf_counter()
+    res = exportar_nfs_lote(destino, formato, id_ini, id_fim, data_ini, data_fim, status)
+    dt = time.perf_counter() - t0
+
+    if not res:
+        print("Nenhuma NF exportada.")
+        return
+    print(f"NFs exportadas: {res['nfs']} | destino: {res['destino']} (index.html) | tempo: {dt:.2f}s")
+
 # =========================================================
 # MENU
 # =========================================================
@@ -1697,6 +5350,16 @@ def menu() -> None:
     print("23) Exportar NF para HTML")
     print("24) Exportar NF para PDF (reportlab)")
     print("25) Auditar e corrigir UFs (cadastros) [automático]")
+    print("26) Compactar arquivos de dados (journal)")
+    print("27) Migrar dados JSON -> SQLite")
+    print("28) Recalcular NFs em lote (período/status/filial)")
+    print("29) Visualizar estoque em uma data (ledger)")
+    print("30) Exportar NFs em lote (HTML/PDF, faixa de ID ou período)")
+    print("31) Compactar regras ST (agrupar cópias por conjunto de UFs)")
+    print("32) Métricas por fase (p50/p95)  [SISTEMA_NFE_METRICAS=1]")
+    print("33) Relatório fiscal por período (UF destino/CFOP) [resumo materializado]")
+    print("34) Reconstruir resumo fiscal (a partir das NFs emitidas)")
+    print("35) Simular regras ST candidatas nas NFs existentes (sem gravar)")
     print(" 0) Sair")
 
 def bootstrap_files() -> None:
@@ -1711,11 +5374,436 @@ def bootstrap_files() -> None:
     if not FILE_TBL_ST.exists():
         write_json(FILE_TBL_ST, {"updated_at":"", "seq": 0, "regras": []})
 
+    if usa_sqlite():
+        _sql_conn()
+
     bootstrap_ufs_generic()
     # normaliza ST ids se precisar
     st = load_tabela_st_data()
     save_tabela_st_data(st)
 
+# =========================================================
+# CLI sem prompts (jobs JSON/CSV, resultado em JSON)
+# =========================================================
+# Exemplos:
+#   python Sistema_nfe.py.py criar-nf notas.json --calcular --emitir
+#   python Sistema_nfe.py.py adicionar-itens itens.csv
+#   python Sistema_nfe.py.py calcular 1-500
+#   python Sistema_nfe.py.py emitir 10,11,20-30
+#   python Sistema_nfe.py.py exportar --formato html --destino nfs.zip --de 2025-01-01 --ate 2025-01-31
+#   python Sistema_nfe.py.py --metricas emitir 10-20   (grava tempos por fase)
+#   python Sistema_nfe.py.py metricas --op emitir_nfs
+#   python Sistema_nfe.py.py relatorio-fiscal --de 2025-03 --ate 2025-03 --por uf_destino,cfop
+#   python Sistema_nfe.py.py simular-st regras_novas.json --de 2025-01-01 --ate 2025-12-31
+# Job de NFs em JSON: lista (ou {"nfs": [...]}) com os campos de criar_nf e
+# "itens": [{"sku" ou "produto_id", "qtd", "v_unit", "cfop", ...}]. Em CSV
+# (delimitador ;) cada linha é um item e a coluna "ref" agrupa as linhas da
+# mesma NF (o cabeçalho da NF vem da primeira linha do grupo).
+# Job de itens: lista (ou {"itens": [...]}) / CSV com nf_id + campos do item.
+CAMPOS_NF_JOB = [
+    "tipo_operacao", "filial_id", "emitente_id", "destinatario_id", "uf_origem", "uf_destino",
+    "ind_final", "modelo", "serie", "numero", "data_emissao",
+]
+CAMPOS_ITEM_JOB = ["produto_id", "sku", "qtd", "v_unit", "cfop", "desconto", "frete", "seguro", "outras"]
+
+IDS_MAX = 1_000_000  # IDs que uma lista/faixa pode gerar (parse_ids)
+
+def parse_ids(texto: str, limite: int = IDS_MAX) -> List[int]:
+    """
+    Lista/faixas de IDs: "1,2,10-20" -> [1, 2, 10, ..., 20]. Levanta
+    OperacaoInvalida se o texto for inválido ou gerar mais de `limite` IDs
+    (a faixa é conferida antes de ser expandida).
+    """
+    ids: List[int] = []
+    for parte in (texto or "").replace(";", ",").split(","):
+        parte = parte.strip()
+        if not parte:
+            continue
+        try:
+            if "-" in parte:
+                a, b = (int(x) for x in parte.split("-", 1))
+            else:
+                a = b = int(parte)
+        except ValueError:
+            raise OperacaoInvalida(f"ID/faixa inválida: {parte}") from None
+        if b < a:
+            continue
+        if len(ids) + (b - a + 1) > limite:
+            raise OperacaoInvalida(f"lista de IDs grande demais (máximo {limite})")
+        ids.extend(range(a, b + 1))
+    return ids
+
+def _ler_job(path: str, chave: str) -> List[Dict[str, Any]]:
+    if path.lower().endswith(".csv"):
+        with open(path, "r", encoding="utf-8-sig", newline="") as f:
+            return list(csv.DictReader(f, delimiter=";"))
+    with open(path, "r", encoding="utf-8-sig") as f:
+        data = json.load(f)
+    if isinstance(data, dict):
+        data = data.get(chave, [])
+    if not isinstance(data, list):
+        raise OperacaoInvalida(f"job inválido: esperado lista ou {{\"{chave}\": [...]}}")
+    return data
+
+def _nfs_de_linhas_csv(linhas: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    por_ref: Dict[str, Dict[str, Any]] = {}
+    for i, row in enumerate(linhas, start=1):
+        ref = str(row.get("ref") or "").strip() or str(i)
+        nf = por_ref.get(ref)
+        if nf is None:
+            nf = {k: row.get(k) for k in CAMPOS_NF_JOB}
+            nf["ref"] = ref
+            nf["itens"] = []
+            por_ref[ref] = nf
+        if str(row.get("sku") or "").strip() or str(row.get("produto_id") or "").strip():
+            nf["itens"].append({k: row.get(k) for k in CAMPOS_ITEM_JOB})
+    return list(por_ref.values())
+
+@medir_operacao
+def executar_job_nfs(
+    jobs: List[Dict[str, Any]],
+    calcular: bool = False,
+    emitir: bool = False,
+    store_nf: Optional[Dict[str, Any]] = None,
+    store_prod: Optional[Dict[str, Any]] = None,
+) -> List[Dict[str, Any]]:
+    """
+    Cria as NFs do job (com itens) num único save_store; opcionalmente calcula
+    e emite todas de uma vez. NF com algum dado inválido não é criada.
+    store_nf/store_prod: stores já carregados (ex.: API); sem eles, lê do disco.
+    Retorna um resultado por NF do job: {"ref", "ok", "nf_id", "status", "totais", "erro"}.
+    """
+    store_nf = load_store(FILE_NFS) if store_nf is None else store_nf
+    store_prod = load_store(FILE_PRODUTOS) if store_prod is None else store_prod
+    resultados: List[Dict[str, Any]] = []
+    criadas: List[Dict[str, Any]] = []
+    for i, job in enumerate(jobs, start=1):
+        res: Dict[str, Any] = {"ref": job.get("ref", i), "ok": False}
+        resultados.append(res)
+        try:
+            rec = montar_nf(job, 0)
+            for item in job.get("itens") or []:
+                novo_item_nf(rec, produto_do_item(store_prod, item), item)
+        except OperacaoInvalida as e:
+            res["erro"] = str(e)
+            continue
+        rec["id"] = next_id(store_nf)
+        append_record(store_nf, rec)
+        criadas.append(rec)
+        res.update({"ok": True, "nf": rec})
+
+    if criadas:
+        save_store(FILE_NFS, store_nf, changed=criadas)
+
+    def etapa(func: Callable[..., List[Dict[str, Any]]]) -> None:
+        ativos = [r for r in resultados if r["ok"]]
+        for r, out in zip(ativos, func(store_nf, [int(r["nf"]["id"]) for r in ativos])):
+            if not out["ok"]:
+                r["ok"] = False
+                r["erro"] = out["msg"]
+
+    if calcular or emitir:
+        etapa(calcular_nfs)
+    if emitir:
+        etapa(emitir_nfs)
+
+    for r in resultados:
+        nf = r.pop("nf", None)
+        if nf is not None:
+            # o id só é definitivo depois do save (outro processo pode ter criado NFs)
+            r.update({"nf_id": int(nf["id"]), "status": nf["status"], "totais": nf.get("totais") or {}})
+    return resultados
+
+@medir_operacao
+def executar_job_itens(
+    jobs: List[Dict[str, Any]],
+    store_nf: Optional[Dict[str, Any]] = None,
+    store_prod: Optional[Dict[str, Any]] = None,
+    tudo_ou_nada: bool = False,
+) -> List[Dict[str, Any]]:
+    """
+    Acrescenta itens a NFs existentes em RASCUNHO (um save_store no fim).
+    tudo_ou_nada: com algum item inválido nenhum é gravado (os válidos voltam
+    com ok False e "desfeito": True).
+    """
+    store_nf = load_store(FILE_NFS) if store_nf is None else store_nf
+    store_prod = load_store(FILE_PRODUTOS) if store_prod is None else store_prod
+    resultados: List[Dict[str, Any]] = []
+    alteradas: Dict[int, Dict[str, Any]] = {}
+    novos: List[Dict[str, Any]] = []  # NFs que ganharam item, na ordem (para desfazer)
+    for i, job in enumerate(jobs, start=1):
+        res: Dict[str, Any] = {"ref": job.get("ref", i), "ok": False}
+        resultados.append(res)
+        try:
+            nf_id = _int_op(job, "nf_id", min_v=1)
+            nf = find_by_id(store_nf, nf_id)
+            if not nf:
+                raise OperacaoInvalida("NF não encontrada.")
+            if nf.get("status") != "RASCUNHO":
+                raise OperacaoInvalida("Só é possível editar NF em RASCUNHO.")
+            item = novo_item_nf(nf, produto_do_item(store_prod, job), job)
+        except OperacaoInvalida as e:
+            res["erro"] = str(e)
+            continue
+        alteradas[nf_id] = nf
+        novos.append(nf)
+        res.update({"ok": True, "nf_id": nf_id, "item_id": item["id"], "v_total": item["v_total"]})
+    if tudo_ou_nada and any(not r["ok"] for r in resultados):
+        for nf in reversed(novos):
+            nf["itens"].pop()
+        for r in resultados:
+            if r["ok"]:
+                r.update({"ok": False, "desfeito": True, "erro": "não gravado: outro item do pedido é inválido"})
+        return resultados
+    if alteradas:
+        save_store(FILE_NFS, store_nf, changed=list(alteradas.values()))
+    return resultados
+
+def resultado_operacoes(out: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Resultados de calcular/emitir/cancelar_nfs no formato da CLI/API: "msg" no sucesso, "erro" na falha."""
+    return [{**{k: v for k, v in r.items() if k != "msg"}, ("msg" if r["ok"] else "erro"): r["msg"]} for r in out]
+
+def cli(argv: List[str]) -> int:
+    """Entrada sem prompts. Imprime (ou grava em --saida) um JSON com os resultados; 0 = tudo ok."""
+    ap = argparse.ArgumentParser(prog="Sistema_nfe", description=f"{APP_NAME} - modo sem prompts (resultado em JSON)")
+    ap.add_argument("--saida", help="grava o JSON de resultado neste arquivo em vez de imprimir")
+    ap.add_argument("--metricas", action="store_true", help="grava tempos por fase em data/metricas.jsonl")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+
+    p = sub.add_parser("criar-nf", help="cria NFs (com itens) a partir de um job JSON/CSV")
+    p.add_argument("job")
+    p.add_argument("--calcular", action="store_true", help="calcula as NFs criadas")
+    p.add_argument("--emitir", action="store_true", help="calcula e emite as NFs criadas")
+
+    p = sub.add_parser("adicionar-itens", help="acrescenta itens a NFs em RASCUNHO (job JSON/CSV com nf_id)")
+    p.add_argument("job")
+
+    p = sub.add_parser("calcular", help="calcula NFs (ST/DIFAL/FCP + totais)")
+    p.add_argument("ids", help="ex.: 1,2,10-20")
+    p.add_argument("--completo", action="store_true", help="recalcula todos os itens")
+
+    p = sub.add_parser("emitir", help="emite NFs (posta estoque)")
+    p.add_argument("ids")
+
+    p = sub.add_parser("cancelar", help="cancela NFs (reverte estoque se postado)")
+    p.add_argument("ids")
+
+    p = sub.add_parser("exportar", help="exporta NFs para HTML/PDF (pasta ou .zip com index.html)")
+    p.add_argument("--formato", choices=["html", "pdf"], default="html")
+    p.add_argument("--destino", required=True)
+    p.add_argument("--ids", help="IDs, ex.: 100-200 ou 1,5,10-12")
+    p.add_argument("--de", default="", help="data inicial YYYY-MM-DD")
+    p.add_argument("--ate", default="", help="data final YYYY-MM-DD")
+    p.add_argument("--status", help="ex.: EMITIDA,CANCELADA")
+
+    p = sub.add_parser("relatorio-fiscal", help="totais do resumo fiscal materializado por período")
+    p.add_argument("--de", default="", help="período inicial AAAA-MM")
+    p.add_argument("--ate", default="", help="período final AAAA-MM")
+    p.add_argument("--por", default="uf_destino,cfop", help=f"dimensões: {','.join(DIMENSOES_RESUMO)}")
+    p.add_argument("--filial", type=int)
+    p.add_argument("--uf-destino", default="")
+    p.add_argument("--cfop", default="")
+    p.add_argument("--tipo", default="", help="ENTRADA ou SAIDA")
+
+    sub.add_parser("reconstruir-resumo", help="refaz o resumo fiscal a partir das NFs emitidas")
+
+    p = sub.add_parser("simular-st", help="compara regras ST candidatas com as atuais nas NFs existentes (não grava)")
+    p.add_argument("regras", help="tabela candidata (.json como tabela_st_regras.json ou .csv do import)")
+    p.add_argument("--de", default="", help="data inicial YYYY-MM-DD")
+    p.add_argument("--ate", default="", help="data final YYYY-MM-DD")
+    p.add_argument("--status", default="EMITIDA", help="ex.: EMITIDA,CANCELADA ou TODOS")
+    p.add_argument("--filial", type=int)
+    p.add_argument("--workers", type=int, help="processos (padrão: núcleos da máquina)")
+
+    p = sub.add_parser("metricas", help="p50/p95 por operação e fase (data/metricas.jsonl)")
+    p.add_argument("--op", help="só esta operação (ex.: emitir_nf)")
+    p.add_argument("--desde", default="", help="só linhas a partir desta data YYYY-MM-DD")
+
+    args = ap.parse_args(argv)
+    if args.metricas:
+        ativar_metricas()
+    t0 = time.perf_counter()
+    # mensagens das rotinas do menu vão para stderr; stdout fica só com o JSON
+    with redirect_stdout(sys.stderr):
+        bootstrap_files()
+        try:
+            if args.cmd == "criar-nf":
+                jobs = _ler_job(args.job, "nfs")
+                if args.job.lower().endswith(".csv"):
+                    jobs = _nfs_de_linhas_csv(jobs)
+                resultados = executar_job_nfs(jobs, calcular=args.calcular, emitir=args.emitir)
+            elif args.cmd == "adicionar-itens":
+                resultados = executar_job_itens(_ler_job(args.job, "itens"))
+            elif args.cmd == "calcular":
+                resultados = resultado_operacoes(calcular_nfs(load_store(FILE_NFS), parse_ids(args.ids), completo=args.completo))
+            elif args.cmd == "emitir":
+                resultados = resultado_operacoes(emitir_nfs(load_store(FILE_NFS), parse_ids(args.ids)))
+            elif args.cmd == "cancelar":
+                resultados = resultado_operacoes(cancelar_nfs(load_store(FILE_NFS), parse_ids(args.ids)))
+            elif args.cmd == "relatorio-fiscal":
+                resultados = [{"ok": True, **r} for r in relatorio_fiscal(
+                    args.de, args.ate, [x.strip() for x in args.por.split(",") if x.strip()],
+                    args.filial, args.uf_destino, args.cfop, args.tipo,
+                )]
+            elif args.cmd == "reconstruir-resumo":
+                resultados = [{"ok": True, **reconstruir_resumo_fiscal()}]
+            elif args.cmd == "simular-st":
+                status = [] if args.status.upper() in ("TODOS", "*") else [x.strip().upper() for x in args.status.split(",") if x.strip()]
+                resultados = [{"ok": True, **simular_regras_st(
+                    carregar_regras_st_candidatas(args.regras), args.de, args.ate, status, args.filial, args.workers,
+                )}]
+            elif args.cmd == "metricas":
+                resultados = [{"ok": True, **r} for r in resumo_metricas(args.op, args.desde)]
+            else:
+                ids = parse_ids(args.ids) if args.ids else None
+                status = [x.strip().upper() for x in args.status.split(",")] if args.status else None
+                res = exportar_nfs_lote(args.destino, args.formato, None, None, args.de, args.ate, status, ids=ids)
+                resultados = [{"ok": bool(res), **res}] if res else [{"ok": False, "erro": "Nenhuma NF exportada."}]
+            erro_geral = None
+        except (OperacaoInvalida, OSError, ValueError, ConflitoVersao) as e:
+            resultados, erro_geral = [], str(e)
+        aguardar_compactacoes()
+
+    ok = erro_geral is None and all(r.get("ok") for r in resultados)
+    saida = {
+        "comando": args.cmd,
+        "ok": ok,
+        "total": len(resultados),
+        "falhas": sum(1 for r in resultados if not r.get("ok")),
+        "tempo_s": round(time.perf_counter() - t0, 3),
+        "resultados": resultados,
+    }
+    if erro_geral is not None:
+        saida["erro"] = erro_geral
+    texto = json.dumps(saida, ensure_ascii=False, indent=2)
+    if args.saida:
+        Path(args.saida).write_text(texto, encoding="utf-8")
+    else:
+        print(texto)
+    return 0 if ok else 1
+
+# =========================================================
+# MÉTRICAS: tempo por fase das operações de NF (opcional)
+# =========================================================
+# Ligadas com SISTEMA_NFE_METRICAS=1, --metricas na CLI ou ativar_metricas().
+# Cada operação medida grava uma linha em data/metricas.jsonl:
+#   {"ts", "op", "total_s", "fases": {"store.load": {"n": 2, "s": 0.031}, ...}}
+# As fases e operações ficam marcadas com @medir_fase/@medir_operacao (seção
+# de instrumentação, no início). Os tempos são inclusivos (impostos.item
+# inclui st.regra) e só contam chamadas feitas na thread da operação, no
+# próprio processo (os workers do pool de recálculo/exportação entram só no
+# total da operação).
+FILE_METRICAS = DATA_DIR / "metricas.jsonl"
+METRICAS_MAX_BYTES = 2 * 1024 * 1024
+METRICAS_ARQUIVOS = 5
+
+def ativar_metricas() -> None:
+    """Liga a medição por fase neste processo."""
+    _METRICAS["ativas"] = True
+
+def desativar_metricas() -> None:
+    _METRICAS["ativas"] = False
+
+def _arquivos_metricas() -> List[Path]:
+    """Do mais antigo para o atual: metricas.jsonl.N ... metricas.jsonl.1, metricas.jsonl."""
+    girados = [FILE_METRICAS.with_name(f"{FILE_METRICAS.name}.{i}") for i in range(METRICAS_ARQUIVOS - 1, 0, -1)]
+    return [p for p in girados + [FILE_METRICAS] if p.exists()]
+
+def _girar_metricas() -> None:
+    for i in range(METRICAS_ARQUIVOS - 1, 0, -1):
+        origem = FILE_METRICAS if i == 1 else FILE_METRICAS.with_name(f"{FILE_METRICAS.name}.{i - 1}")
+        if origem.exists():
+            os.replace(origem, FILE_METRICAS.with_name(f"{FILE_METRICAS.name}.{i}"))
+
+def gravar_metrica(op: str, total_s: float, fases: Dict[str, Dict[str, Any]]) -> None:
+    linha = {
+        "ts": datetime.now().isoformat(timespec="milliseconds"),
+        "op": op,
+        "total_s": round(total_s, 6),
+        "fases": {f: {**v, "s": round(v["s"], 6)} for f, v in fases.items()},
+    }
+    try:
+        ensure_data_dir()
+        with FILE_METRICAS.open("a", encoding="utf-8") as f:
+            f.write(json.dumps(linha, ensure_ascii=False, separators=(",", ":")) + "\n")
+            tamanho = f.tell()
+        if tamanho >= METRICAS_MAX_BYTES:
+            with trava_dados():
+                if FILE_METRICAS.exists() and FILE_METRICAS.stat().st_size >= METRICAS_MAX_BYTES:
+                    _girar_metricas()
+    except (OSError, TimeoutError):
+        pass  # métrica perdida não pode derrubar a operação
+
+def _percentil(valores: List[float], p: float) -> float:
+    """Percentil por posição (nearest-rank) de uma lista já ordenada."""
+    k = max(0, min(len(valores) - 1, int(-(-p * len(valores) // 1)) - 1))
+    return valores[k]
+
+def resumo_metricas(op: Optional[str] = None, desde: str = "") -> List[Dict[str, Any]]:
+    """
+    p50/p95 por operação e fase, a partir de metricas.jsonl (e dos girados).
+    Para cada fase, o valor de uma operação é o tempo somado da fase nela.
+    desde: só linhas com ts >= desde (ex.: "2025-06-01").
+    """
+    por: Dict[Tuple[str, str], Dict[str, List[float]]] = {}
+    for path in _arquivos_metricas():
+        with path.open("r", encoding="utf-8") as f:
+            for raw in f:
+                try:
+                    linha = json.loads(raw)
+                except ValueError:
+                    continue
+                if (op and linha.get("op") != op) or (desde and str(linha.get("ts", "")) < desde):
+                    continue
+                nome = str(linha.get("op"))
+                acc = por.setdefault((nome, "total"), {"s": [], "n": []})
+                acc["s"].append(float(linha.get("total_s", 0.0)))
+                acc["n"].append(1)
+                for fase, v in (linha.get("fases") or {}).items():
+                    acc = por.setdefault((nome, fase), {"s": [], "n": [], "examinadas": []})
+                    acc["s"].append(float(v.get("s", 0.0)))
+                    acc["n"].append(int(v.get("n", 0)))
+                    if "examinadas" in v:
+                        acc["examinadas"].append(int(v["examinadas"]))
+
+    out = []
+    for (nome, fase), acc in sorted(por.items(), key=lambda kv: (kv[0][0], kv[0][1] != "total", kv[0][1])):
+        s = sorted(acc["s"])
+        row = {
+            "op": nome, "fase": fase, "ops": len(s),
+            "chamadas_op": round(sum(acc["n"]) / len(s), 2),
+            "p50_ms": round(_percentil(s, 0.50) * 1000, 3),
+            "p95_ms": round(_percentil(s, 0.95) * 1000, 3),
+            "total_s": round(sum(s), 3),
+        }
+        if acc.get("examinadas"):
+            row["examinadas_chamada"] = round(sum(acc["examinadas"]) / max(1, sum(acc["n"])), 2)
+        out.append(row)
+    return out
+
+def imprimir_resumo_metricas(op: Optional[str] = None, desde: str = "") -> None:
+    title("Métricas por fase (p50/p95)")
+    linhas = resumo_metricas(op, desde)
+    if not linhas:
+        print(f"Sem métricas em {FILE_METRICAS}. Ligue com SISTEMA_NFE_METRICAS=1 (ou --metricas na CLI).")
+        return
+    atual = None
+    for r in linhas:
+        if r["op"] != atual:
+            atual = r["op"]
+            print(f"\n{atual}  ({r['ops']} operações)")
+            print(f"  {'fase':<16}{'cham/op':>9}{'p50 ms':>11}{'p95 ms':>11}{'total s':>10}")
+        extra = f"  regras/chamada={r['examinadas_chamada']}" if "examinadas_chamada" in r else ""
+        print(f"  {r['fase']:<16}{r['chamadas_op']:>9}{r['p50_ms']:>11.3f}{r['p95_ms']:>11.3f}{r['total_s']:>10.3f}{extra}")
+
+def metricas_menu() -> None:
+    op = ask_str("Operação (ex.: emitir_nf) [todas]: ", required=False).strip() or None
+    desde = ask_str("Desde (YYYY-MM-DD) [tudo]: ", required=False).strip()
+    imprimir_resumo_metricas(op, desde)
+
+if os.environ.get("SISTEMA_NFE_METRICAS", "").strip() not in ("", "0"):
+    ativar_metricas()
+
 def main() -> None:
     title(APP_NAME)
     bootstrap_files()
@@ -1763,7 +5851,8 @@ def main() -> None:
                 remove_item_nf(int(nf_id))
             elif op == "16":
                 nf_id = ask_int("NF ID: ", required=True, min_v=1) or 0
-                calcular_nf(int(nf_id))
+                completo = (ask_str("Recalcular todos os itens? (S/N) [N]: ", required=False) or "N").strip().upper() == "S"
+                calcular_nf(int(nf_id), completo=completo)
             elif op == "17":
                 nf_id = ask_int("NF ID: ", required=True, min_v=1) or 0
                 emitir_nf(int(nf_id))
@@ -1798,6 +5887,26 @@ def main() -> None:
                 export_nf_pdf_reportlab(int(nf_id), out)
             elif op == "25":
                 auditar_e_corrigir_ufs(apenas_ativos=True)
+            elif op == "26":
+                compactar_todos_stores()
+            elif op == "27":
+                migrar_json_para_sqlite()
+            elif op == "28":
+                recalcular_nfs_lote_menu()
+            elif op == "29":
+                visualizar_estoque_em_data()
+            elif op == "30":
+                exportar_nfs_lote_menu()
+            elif op == "31":
+                compactar_regras_st()
+            elif op == "32":
+                metricas_menu()
+            elif op == "33":
+                relatorio_fiscal_menu()
+            elif op == "34":
+                reconstruir_resumo_fiscal_menu()
+            elif op == "35":
+                simular_regras_st_menu()
             else:
                 print("Opção inválida.")
         except KeyboardInterrupt:
@@ -1805,7 +5914,10 @@ def main() -> None:
         except Exception as e:
             print(f"Erro: {e}")
 
+    aguardar_compactacoes()
     print("Encerrado.")
 
 if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        sys.exit(cli(sys.argv[1:]))
     main()
\ No newline at end of file
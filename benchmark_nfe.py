@@ -0,0 +1,380 @@
+# benchmark_nfe.py - benchmark do Sistema_nfe com base sintética
+#
+# Exemplos:
+#   python benchmark_nfe.py --tiers p,m --saida bench_atual.json
+#   python benchmark_nfe.py --tiers p,m --comparar bench_base.json --limite 0.25
+#   python benchmark_nfe.py --gerar C:/temp/base_m --tier m      (só gera os dados)
+#
+# Cada tier roda numa pasta de dados temporária (SISTEMA_NFE_DATA) com uma
+# cópia nova do Sistema_nfe; a pasta data/ do sistema não é tocada.
+# Com SISTEMA_NFE_BACKEND=sqlite a base gerada é migrada para o SQLite antes.
+
+from __future__ import annotations
+
+import argparse
+import importlib.util
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+from contextlib import contextmanager, redirect_stdout
+from datetime import date, datetime, timedelta
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+# produtos, regras ST avulsas, conjuntos 27x26 explodidos (uma regra por par),
+# NFs e quantas NFs entram nos casos medidos uma a uma
+TIERS: Dict[str, Dict[str, int]] = {
+    "p": {"produtos": 1000, "regras": 500, "conjuntos": 1, "nfs": 200, "amostra": 50},
+    "m": {"produtos": 10000, "regras": 5000, "conjuntos": 5, "nfs": 2000, "amostra": 100},
+    "g": {"produtos": 50000, "regras": 20000, "conjuntos": 20, "nfs": 10000, "amostra": 200},
+}
+
+LIMITE_PADRAO = 0.25  # variação relativa de ms/op tolerada na comparação
+MIN_TOTAL_S = 0.005   # casos mais rápidos que isso são ruído: não entram na comparação
+
+def carregar_sistema(pasta_dados: Path) -> Any:
+    """Cópia nova do Sistema_nfe apontando para pasta_dados (caches zerados)."""
+    os.environ["SISTEMA_NFE_DATA"] = str(pasta_dados)
+    spec = importlib.util.spec_from_file_location("Sistema_nfe", Path(__file__).parent / "Sistema_nfe.py.py")
+    mod = importlib.util.module_from_spec(spec)
+    sys.modules["Sistema_nfe"] = mod
+    spec.loader.exec_module(mod)
+    return mod
+
+@contextmanager
+def sem_saida() -> Iterator[None]:
+    """Descarta o que o Sistema_nfe imprime (menus, avisos) durante o bloco."""
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        yield
+
+# =========================================================
+# Base sintética
+# =========================================================
+PALAVRAS = [
+    "Cabo", "Carregador", "Fone", "Smartphone", "Notebook", "Mouse", "Teclado", "Monitor",
+    "Roteador", "Caixa de Som", "Película", "Capa", "Bateria", "Adaptador", "Hub", "Webcam",
+    "Tablet", "Impressora", "Cartucho", "SSD", "Pendrive", "Memória", "Placa", "Fonte",
+]
+MARCAS = ["Alfa", "Beta", "Gama", "Delta", "Ômega", "Sigma", "Kappa", "Zeta"]
+CFOPS_SAIDA = ["5102", "6102", "5405", "6404"]
+
+def _qtd_itens(rnd: random.Random) -> int:
+    """Itens por NF: maioria com poucos itens, cauda de notas grandes."""
+    faixa = rnd.choices([(1, 3), (4, 10), (11, 40)], weights=[50, 35, 15])[0]
+    return rnd.randint(*faixa)
+
+def gerar_base(m: Any, produtos: int, regras: int, conjuntos: int, nfs: int, seed: int = 1, **_: Any) -> Dict[str, int]:
+    """
+    Grava em m.DATA_DIR filiais, pessoas, produtos, estoque, regras ST
+    (avulsas + conjuntos explodidos em 27x26 regras por par) e NFs em
+    RASCUNHO com itens. Retorna as contagens geradas.
+    """
+    rnd = random.Random(seed)
+    with sem_saida():
+        m.bootstrap_files()
+
+    filiais = [{"id": i, "nome": f"Filial {i}", "uf": uf, "ativo": 1} for i, uf in enumerate(["SP", "MG", "PR"], start=1)]
+    pessoas = []
+    for i in range(1, 201):
+        pessoas.append({
+            "id": i, "nome": f"Cliente {i}", "tipo": rnd.choice("CFA"), "documento": f"{rnd.randrange(10**13, 10**14)}",
+            "uf": rnd.choice(m.UFS_BRASIL), "ind_ie_dest": rnd.choice([1, 1, 2, 9, 9, 9]), "ativo": 1,
+        })
+    ncms = [f"{rnd.randrange(10**7, 10**8)}" for _ in range(max(20, produtos // 50))]
+    cests = [f"{rnd.randrange(10**6, 10**7)}" for _ in range(max(10, len(ncms) // 4))]
+    prods = []
+    for i in range(1, produtos + 1):
+        prods.append({
+            "id": i, "sku": f"SKU{i:06d}",
+            "descricao": f"{rnd.choice(PALAVRAS)} {rnd.choice(MARCAS)} {rnd.randint(1, 999)}",
+            "ncm": rnd.choice(ncms), "cest": rnd.choice(cests) if rnd.random() < 0.4 else "",
+            "preco_venda": round(rnd.uniform(5, 3000), 2), "flag_importado": 1 if rnd.random() < 0.2 else 0, "ativo": 1,
+        })
+    m.write_json(m.FILE_FILIAIS, {"seq": len(filiais), "items": filiais})
+    m.write_json(m.FILE_PESSOAS, {"seq": len(pessoas), "items": pessoas})
+    m.write_json(m.FILE_PRODUTOS, {"seq": len(prods), "items": prods})
+    m.write_json(m.FILE_ESTOQUE, {"by_filial": {str(f["id"]): {str(p["id"]): 100000.0 for p in prods} for f in filiais}})
+
+    lista = []
+    for _ in range(regras):
+        o, d = rnd.choice(m.UFS_BRASIL), rnd.choice(m.UFS_BRASIL)
+        ini = date(2024, 1, 1) + timedelta(days=rnd.randrange(365))
+        lista.append({
+            "uf_origem": o, "uf_destino": d,
+            "ncm": rnd.choice(ncms) if rnd.random() < 0.8 else "",
+            "cest": rnd.choice(cests) if rnd.random() < 0.3 else "",
+            "cfop": rnd.choice(CFOPS_SAIDA) if rnd.random() < 0.3 else "",
+            "mva": round(rnd.uniform(20, 70), 2), "red_bc_st": rnd.choice([0.0, 0.0, 10.0]),
+            "aliq_icms_interna_dest": None, "aliq_fcp_dest": None,
+            "vig_ini": ini.isoformat(), "vig_fim": (ini + timedelta(days=730)).isoformat() if rnd.random() < 0.3 else "",
+            "prioridade": rnd.randint(0, 10), "ativo": 1,
+        })
+    for _ in range(conjuntos):
+        # como duplicar_regra_st_em_lote gerava antes das regras em conjunto
+        ncm, mva = rnd.choice(ncms), round(rnd.uniform(20, 70), 2)
+        for o in m.UFS_BRASIL:
+            for d in m.UFS_BRASIL:
+                if o != d:
+                    lista.append({
+                        "uf_origem": o, "uf_destino": d, "ncm": ncm, "cest": "", "cfop": "",
+                        "mva": mva, "red_bc_st": 0.0, "aliq_icms_interna_dest": None, "aliq_fcp_dest": None,
+                        "vig_ini": "2024-01-01", "vig_fim": "", "prioridade": 5, "ativo": 1,
+                    })
+    for i, r in enumerate(lista, start=1):
+        r["id"] = i
+    m.save_tabela_st_data({"seq": len(lista), "regras": lista})
+
+    notas = []
+    for k in range(1, nfs + 1):
+        filial = rnd.choice(filiais)
+        dest = rnd.choice(pessoas)
+        tipo = "ENTRADA" if rnd.random() < 0.2 else "SAIDA"
+        mesma_uf = filial["uf"] == dest["uf"]
+        itens = []
+        for j in range(1, _qtd_itens(rnd) + 1):
+            p = rnd.choice(prods)
+            itens.append({
+                "id": j, "produto_id": p["id"], "sku": p["sku"], "descricao": p["descricao"],
+                "ncm": p["ncm"], "cest": p["cest"],
+                "cfop": m.cfop_sugerido(tipo, filial["uf"], dest["uf"]) if rnd.random() < 0.8 else rnd.choice(CFOPS_SAIDA),
+                "qtd": float(rnd.randint(1, 10)), "v_unit": p["preco_venda"],
+                "desconto": round(rnd.uniform(0, 5), 2) if rnd.random() < 0.2 else 0.0,
+                "frete": round(rnd.uniform(0, 30), 2) if rnd.random() < 0.3 else 0.0,
+                "seguro": 0.0, "outras": 0.0, "v_bruto": 0.0, "v_total": 0.0, "impostos": None,
+            })
+        notas.append({
+            "id": k, "tipo_operacao": tipo, "filial_id": filial["id"], "emitente_id": dest["id"],
+            "destinatario_id": dest["id"], "uf_origem": filial["uf"], "uf_destino": dest["uf"],
+            "ind_final": 1 if rnd.random() < 0.5 and not mesma_uf else 0, "modelo": "55", "serie": 1, "numero": k,
+            "data_emissao": (date(2025, 1, 1) + timedelta(days=rnd.randrange(365))).isoformat(),
+            "status": "RASCUNHO", "estoque_postado": 0, "itens": itens, "totais": {},
+        })
+    m.write_json(m.FILE_NFS, {"seq": len(notas), "items": notas})
+
+    if m.usa_sqlite():
+        with sem_saida():
+            m.migrar_json_para_sqlite()
+    return {"produtos": len(prods), "regras_st": len(lista), "nfs": len(notas),
+            "itens": sum(len(n["itens"]) for n in notas)}
+
+# =========================================================
+# Medições
+# =========================================================
+def _medir(func: Callable[[], int], repeticoes: int = 1) -> Dict[str, Any]:
+    """func executa o caso e devolve quantas operações fez; vale a repetição mais rápida."""
+    melhor, n = None, 0
+    for _ in range(max(1, repeticoes)):
+        t0 = time.perf_counter()
+        n = func()
+        dt = time.perf_counter() - t0
+        melhor = dt if melhor is None else min(melhor, dt)
+    return {
+        "n": n,
+        "total_s": round(melhor, 6),
+        "ms_op": round(melhor * 1000 / n, 6) if n else None,
+        "ops_s": round(n / melhor, 1) if melhor else None,
+    }
+
+def rodar_tier(nome: str, cfg: Dict[str, int], seed: int, repeticoes: int, pasta: Path) -> Dict[str, Any]:
+    m = carregar_sistema(pasta)
+    t0 = time.perf_counter()
+    contagens = gerar_base(m, seed=seed, **cfg)
+    out: Dict[str, Any] = {"config": cfg, "base": contagens, "gerar_base_s": round(time.perf_counter() - t0, 3), "casos": {}}
+    casos = out["casos"]
+    rnd = random.Random(seed + 1)
+
+    store_nf = m.load_store(m.FILE_NFS)
+    notas = list(store_nf["items"])
+    amostra_ids = [int(nf["id"]) for nf in rnd.sample(notas, min(cfg["amostra"], len(notas)))]
+
+    # escolher_regra_st: consultas dos itens reais das NFs
+    t0 = time.perf_counter()
+    regras = m.load_tabela_st()
+    casos["load_tabela_st"] = {"n": 1, "total_s": round(time.perf_counter() - t0, 6)}
+    consultas = [
+        (nf["uf_origem"], nf["uf_destino"], it["ncm"], it["cest"], it["cfop"], nf["data_emissao"])
+        for nf in notas for it in nf["itens"]
+    ]
+    consultas = [rnd.choice(consultas) for _ in range(20000)]
+
+    def escolher() -> int:
+        for c in consultas:
+            m.escolher_regra_st(regras, *c)
+        return len(consultas)
+    casos["escolher_regra_st"] = _medir(escolher, repeticoes)
+
+    # search_produtos: primeira chamada monta o índice
+    prods = m.load_store(m.FILE_PRODUTOS)["items"]
+    termos = [rnd.choice([p["sku"], p["descricao"].split()[0], p["descricao"][:6]]) for p in rnd.sample(prods, min(500, len(prods)))]
+
+    def indexar() -> int:
+        m.search_produtos(termos[0], 10)
+        return 1
+    casos["search_produtos_indice"] = _medir(indexar)
+
+    def buscar() -> int:
+        for t in termos:
+            m.search_produtos(t, 10)
+        return len(termos)
+    casos["search_produtos"] = _medir(buscar, repeticoes)
+
+    # calcular_nf (menu: recarrega stores e tabelas a cada NF), completo e incremental
+    def calcular(completo: bool) -> Callable[[], int]:
+        def rodar() -> int:
+            with sem_saida():
+                for nf_id in amostra_ids:
+                    m.calcular_nf(nf_id, completo=completo)
+            return len(amostra_ids)
+        return rodar
+    casos["calcular_nf"] = _medir(calcular(True))
+    casos["calcular_nf_incremental"] = _medir(calcular(False))
+
+    def calcular_lote() -> int:
+        st = m.load_store(m.FILE_NFS)
+        m.calcular_nfs(st, [int(nf["id"]) for nf in st["items"]], completo=True)
+        return len(st["items"])
+    casos["calcular_nfs_lote"] = _medir(calcular_lote)
+
+    def emitir() -> int:
+        with sem_saida():
+            for nf_id in amostra_ids:
+                m.emitir_nf(nf_id)
+        return len(amostra_ids)
+    casos["emitir_nf"] = _medir(emitir)
+
+    def cancelar() -> int:
+        with sem_saida():
+            for nf_id in amostra_ids:
+                m.cancelar_nf(nf_id)
+        return len(amostra_ids)
+    casos["cancelar_nf"] = _medir(cancelar)
+
+    # write_json do store de NFs inteiro (gravação completa / snapshot)
+    st = m.load_store(m.FILE_NFS)
+    snapshot = {"seq": st.get("seq", 0), "items": st.get("items", [])}
+    destino_json = pasta / "bench_write.json"
+
+    def gravar() -> int:
+        m.write_json(destino_json, snapshot)
+        return 1
+    casos["write_json_nfs"] = _medir(gravar, repeticoes)
+    casos["write_json_nfs"]["bytes"] = destino_json.stat().st_size
+
+    with sem_saida():
+        formatos = ["html", "pdf"] if m._reportlab_disponivel() else ["html"]
+    for formato in formatos:
+        zip_path = str(pasta / f"bench_export_{formato}.zip")
+
+        def exportar() -> int:
+            with sem_saida():
+                res = m.exportar_nfs_lote(zip_path, formato)
+            return int(res.get("nfs", 0))
+        casos[f"exportar_{formato}"] = _medir(exportar)
+
+    with sem_saida():
+        m.aguardar_compactacoes()
+    return out
+
+# =========================================================
+# Comparação
+# =========================================================
+def comparar(atual: Dict[str, Any], base: Dict[str, Any], limite: float) -> List[Dict[str, Any]]:
+    """
+    Compara ms/op por tier/caso. Acima de base*(1+limite) é regressão; abaixo
+    de base/(1+limite) é ganho (vale atualizar a base). Casos ausentes em
+    um dos lados ou com total abaixo de MIN_TOTAL_S ficam de fora.
+    """
+    linhas = []
+    for tier, dados in atual.get("tiers", {}).items():
+        casos_base = base.get("tiers", {}).get(tier, {}).get("casos", {})
+        for caso, med in dados["casos"].items():
+            ref = casos_base.get(caso)
+            if not ref or not ref.get("ms_op") or not med.get("ms_op"):
+                continue
+            if min(ref["total_s"], med["total_s"]) < MIN_TOTAL_S:
+                continue
+            razao = med["ms_op"] / ref["ms_op"]
+            if razao > 1 + limite:
+                status = "REGRESSAO"
+            elif razao < 1 / (1 + limite):
+                status = "GANHO"
+            else:
+                status = "ok"
+            linhas.append({"tier": tier, "caso": caso, "base_ms_op": ref["ms_op"], "ms_op": med["ms_op"],
+                           "razao": round(razao, 3), "status": status})
+    return linhas
+
+def imprimir(resultado: Dict[str, Any]) -> None:
+    for tier, dados in resultado["tiers"].items():
+        b = dados["base"]
+        print(f"\n== tier {tier}: {b['produtos']} produtos | {b['regras_st']} regras ST | {b['nfs']} NFs ({b['itens']} itens)"
+              f" | base gerada em {dados['gerar_base_s']}s")
+        for caso, med in dados["casos"].items():
+            if med.get("ms_op") is None:
+                print(f"  {caso:<26} {med['total_s']:>10.4f}s")
+            else:
+                print(f"  {caso:<26} {med['ms_op']:>12.4f} ms/op  {med['ops_s']:>12.1f} op/s  (n={med['n']})")
+
+def main(argv: Optional[List[str]] = None) -> int:
+    ap = argparse.ArgumentParser(description="Benchmark do Sistema_nfe com base sintética")
+    ap.add_argument("--tiers", default="p", help=f"tiers separados por vírgula ({','.join(TIERS)})")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--repeticoes", type=int, default=3, help="repetições dos casos que não alteram dados (vale a melhor)")
+    ap.add_argument("--saida", help="grava o resultado em JSON")
+    ap.add_argument("--comparar", help="JSON de uma execução anterior (base)")
+    ap.add_argument("--limite", type=float, default=LIMITE_PADRAO, help="variação tolerada (0.25 = 25%%)")
+    ap.add_argument("--gerar", metavar="PASTA", help="só gera a base sintética do --tier nesta pasta")
+    ap.add_argument("--tier", default="p", choices=sorted(TIERS), help="tier usado com --gerar")
+    args = ap.parse_args(argv)
+
+    if args.gerar:
+        pasta = Path(args.gerar)
+        pasta.mkdir(parents=True, exist_ok=True)
+        contagens = gerar_base(carregar_sistema(pasta), seed=args.seed, **TIERS[args.tier])
+        print(json.dumps({"pasta": str(pasta), **contagens}, ensure_ascii=False))
+        return 0
+
+    tiers = [t.strip() for t in args.tiers.split(",") if t.strip()]
+    invalidos = [t for t in tiers if t not in TIERS]
+    if invalidos:
+        ap.error(f"tier inválido: {', '.join(invalidos)}")
+
+    resultado: Dict[str, Any] = {
+        "versao": 1,
+        "quando": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "plataforma": platform.platform(),
+        "cpus": os.cpu_count(),
+        "backend": os.environ.get("SISTEMA_NFE_BACKEND", "json"),
+        "seed": args.seed,
+        "tiers": {},
+    }
+    for tier in tiers:
+        pasta = Path(tempfile.mkdtemp(prefix=f"bench_nfe_{tier}_"))
+        try:
+            resultado["tiers"][tier] = rodar_tier(tier, TIERS[tier], args.seed, args.repeticoes, pasta)
+        finally:
+            shutil.rmtree(pasta, ignore_errors=True)
+    imprimir(resultado)
+
+    rc = 0
+    if args.comparar:
+        base = json.loads(Path(args.comparar).read_text(encoding="utf-8"))
+        linhas = comparar(resultado, base, args.limite)
+        resultado["comparacao"] = {"base": args.comparar, "limite": args.limite, "casos": linhas}
+        print(f"\n== comparação com {args.comparar} (limite {args.limite:.0%})")
+        for ln in linhas:
+            print(f"  [{ln['status']:<9}] {ln['tier']}/{ln['caso']:<26} {ln['base_ms_op']:.4f} -> {ln['ms_op']:.4f} ms/op (x{ln['razao']})")
+        if any(ln["status"] == "REGRESSAO" for ln in linhas):
+            rc = 1
+    if args.saida:
+        Path(args.saida).write_text(json.dumps(resultado, ensure_ascii=False, indent=2), encoding="utf-8")
+    return rc
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,439 @@
+# main.py - API local (FastAPI) do Sistema_nfe
+#
+# Iniciar: START_API.bat  (uvicorn main:app --host 127.0.0.1 --port 8000)
+# Documentação interativa: http://127.0.0.1:8000/docs
+#
+# Dependências: pip install fastapi uvicorn
+
+from __future__ import annotations
+
+import asyncio
+import importlib.util
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from fastapi import Body, FastAPI, Query, Request
+from fastapi.responses import JSONResponse
+
+# =========================================================
+# Sistema_nfe (o arquivo tem dois pontos no nome: carrega pelo caminho)
+# =========================================================
+def _carregar_sistema() -> Any:
+    if "Sistema_nfe" in sys.modules:
+        return sys.modules["Sistema_nfe"]
+    spec = importlib.util.spec_from_file_location("Sistema_nfe", Path(__file__).parent / "Sistema_nfe.py.py")
+    mod = importlib.util.module_from_spec(spec)
+    sys.modules["Sistema_nfe"] = mod
+    spec.loader.exec_module(mod)
+    return mod
+
+nfe = _carregar_sistema()
+
+# =========================================================
+# Estado em memória
+# =========================================================
+# Leituras rodam na thread do event loop, direto nos stores carregados.
+# Gravações só pelo Escritor, numa thread própria e com os SEUS stores: o loop
+# segue atendendo leituras enquanto um lote grava, e ninguém lê um store no
+# meio de uma gravação. O que o Escritor grava chega às leituras como as
+# gravações de outros processos (menu, CLI, robô): pelo sincronizar_store de
+# cada leitura. No SQLite cada thread tem a sua conexão. As tabelas UF/ST
+# ficam compiladas nos caches do Sistema_nfe (recompiladas quando o arquivo muda).
+ESCRITOR_LOTE_MAX = 500  # pedidos agrupados por rodada do Escritor
+IDS_LOTE_MAX = 10_000    # IDs por pedido em /nfs/lote (lista ou faixas)
+
+class Estado:
+    """Cadastros, NFs e estoque mantidos entre requisições."""
+
+    def __init__(self) -> None:
+        self.stores: Dict[Path, Dict[str, Any]] = {}
+        self.estoque: Optional[Dict[str, Any]] = None
+        self.recarregar()
+
+    def recarregar(self) -> None:
+        for path in (nfe.FILE_FILIAIS, nfe.FILE_PESSOAS, nfe.FILE_PRODUTOS, nfe.FILE_NFS):
+            self.stores[path] = nfe.load_store(path)
+        self.estoque = None
+
+    def store(self, path: Path) -> Dict[str, Any]:
+        st = self.stores[path]
+        nfe.sincronizar_store(path, st)
+        return st
+
+    def saldos(self) -> Dict[str, Any]:
+        self.estoque = nfe.estoque_atualizado(self.estoque)
+        return self.estoque
+
+# =========================================================
+# Escritor: fila única de gravações
+# =========================================================
+# Pedidos do mesmo tipo que estão na fila ao mesmo tempo viram UMA chamada
+# do Sistema_nfe (ex.: 40 "emitir" -> um emitir_nfs, uma transação e um
+# save_store). A ordem de chegada é mantida: o lote só junta pedidos
+# consecutivos do mesmo tipo.
+def _em_lote(func: Callable[[List[Any]], List[Any]]) -> Callable[[List[List[Any]]], List[List[Any]]]:
+    """Junta as listas de vários pedidos numa chamada e devolve a fatia de cada um."""
+    def lote(pedidos: List[List[Any]]) -> List[List[Any]]:
+        res = func([x for p in pedidos for x in p])
+        out, ini = [], 0
+        for p in pedidos:
+            out.append(res[ini:ini + len(p)])
+            ini += len(p)
+        return out
+    return lote
+
+class Escritor:
+    def __init__(self) -> None:
+        self.estado = Estado()
+        self.fila: asyncio.Queue = asyncio.Queue()
+        self.task: Optional[asyncio.Task] = None
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="escritor")
+
+    def iniciar(self) -> None:
+        self.task = asyncio.create_task(self._rodar())
+
+    async def parar(self) -> None:
+        await self.fila.join()
+        if self.task is not None:
+            self.task.cancel()
+        self.executor.shutdown(wait=True)
+
+    async def enviar(self, tipo: Tuple, dados: List[Any]) -> List[Any]:
+        fut = asyncio.get_running_loop().create_future()
+        await self.fila.put((tipo, dados, fut))
+        return await fut
+
+    async def _rodar(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            pedidos = [await self.fila.get()]
+            while len(pedidos) < ESCRITOR_LOTE_MAX and not self.fila.empty():
+                pedidos.append(self.fila.get_nowait())
+            ini = 0
+            for fim in range(1, len(pedidos) + 1):
+                if fim == len(pedidos) or pedidos[fim][0] != pedidos[ini][0]:
+                    # o lote grava na thread do Escritor; o que chegar nesse meio forma o próximo
+                    grupo = pedidos[ini:fim]
+                    try:
+                        resultados = await loop.run_in_executor(
+                            self.executor, self._executar, grupo[0][0], [dados for _, dados, _ in grupo])
+                    except Exception as e:
+                        for _, _, fut in grupo:
+                            if not fut.done():
+                                fut.set_exception(e)
+                    else:
+                        for (_, _, fut), res in zip(grupo, resultados):
+                            if not fut.done():
+                                fut.set_result(res)
+                    ini = fim
+            for _ in pedidos:
+                self.fila.task_done()
+
+    def _executar(self, tipo: Tuple, dados: List[List[Any]]) -> List[List[Any]]:
+        """Roda na thread do Escritor."""
+        try:
+            return self._operacao(tipo)(dados)
+        except Exception:
+            # gravação interrompida: o que ficou em memória pode não estar em disco
+            self.estado.recarregar()
+            raise
+
+    def _operacao(self, tipo: Tuple) -> Callable[[List[List[Any]]], List[List[Any]]]:
+        est = self.estado
+        nome = tipo[0]
+        if nome == "criar_nf":
+            return _em_lote(lambda jobs: nfe.executar_job_nfs(
+                jobs, calcular=tipo[1], emitir=tipo[2],
+                store_nf=est.store(nfe.FILE_NFS), store_prod=est.store(nfe.FILE_PRODUTOS)))
+        if nome == "itens":
+            # um pedido grava todos os seus itens ou nenhum: não junta pedidos numa chamada
+            return lambda pedidos: [nfe.executar_job_itens(
+                jobs, store_nf=est.store(nfe.FILE_NFS), store_prod=est.store(nfe.FILE_PRODUTOS),
+                tudo_ou_nada=True) for jobs in pedidos]
+        if nome == "calcular":
+            return _em_lote(lambda ids: nfe.calcular_nfs(est.store(nfe.FILE_NFS), ids, completo=tipo[1]))
+        if nome == "emitir":
+            return _em_lote(lambda ids: nfe.emitir_nfs(est.store(nfe.FILE_NFS), ids))
+        if nome == "cancelar":
+            return _em_lote(lambda ids: nfe.cancelar_nfs(est.store(nfe.FILE_NFS), ids))
+        if nome == "produto":
+            return _em_lote(lambda lista: self._cadastrar(nfe.FILE_PRODUTOS, lista))
+        if nome == "pessoa":
+            return _em_lote(lambda lista: self._cadastrar(nfe.FILE_PESSOAS, lista))
+        raise ValueError(f"operação desconhecida: {nome}")
+
+    def _cadastrar(self, path: Path, lista: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Cadastra produtos/pessoas num save_store; cada um tem o seu resultado."""
+        store = self.estado.store(path)
+        resultados: List[Dict[str, Any]] = []
+        novos: List[Dict[str, Any]] = []
+        for dados in lista:
+            try:
+                if path == nfe.FILE_PRODUTOS:
+                    rec = nfe.montar_produto(store, dados, 0)
+                else:
+                    rec = nfe.montar_pessoa(dados, 0)
+            except nfe.OperacaoInvalida as e:
+                resultados.append({"ok": False, "erro": str(e)})
+                continue
+            rec["id"] = nfe.next_id(store)
+            nfe.append_record(store, rec)
+            novos.append(rec)
+            resultados.append({"ok": True, "registro": rec})
+        if novos:
+            # o índice de busca é das leituras (thread do loop): pega os novos
+            # produtos pelo journal na próxima busca
+            nfe.save_store(path, store, changed=novos)
+        return resultados
+
+# =========================================================
+# App
+# =========================================================
+@asynccontextmanager
+async def _ciclo(app: FastAPI) -> Any:
+    nfe.bootstrap_files()
+    nfe.load_contexto_fiscal()
+    nfe.load_tabela_st()
+    app.state.estado = Estado()
+    app.state.escritor = Escritor()
+    app.state.escritor.iniciar()
+    yield
+    await app.state.escritor.parar()
+    nfe.aguardar_compactacoes()
+
+app = FastAPI(title="Sistema NF-e (API local)", lifespan=_ciclo)
+
+def _estado(request: Request) -> Estado:
+    return request.app.state.estado
+
+def _escritor(request: Request) -> Escritor:
+    return request.app.state.escritor
+
+def _json(conteudo: Any, status: int = 200) -> JSONResponse:
+    # os registros já são JSON puro (vêm dos stores): dispensa o jsonable_encoder
+    return JSONResponse(conteudo, status_code=status)
+
+def _erro(msg: str, status: int) -> JSONResponse:
+    return _json({"ok": False, "erro": msg}, status)
+
+@app.exception_handler(nfe.OperacaoInvalida)
+async def _operacao_invalida(request: Request, exc: Exception) -> JSONResponse:
+    return _erro(str(exc), 422)
+
+@app.exception_handler(nfe.ConflitoVersao)
+async def _conflito(request: Request, exc: Exception) -> JSONResponse:
+    return _erro(str(exc), 409)
+
+@app.exception_handler(TimeoutError)
+async def _trava_ocupada(request: Request, exc: Exception) -> JSONResponse:
+    return _erro(str(exc), 503)
+
+def _resultado_nf(res: Dict[str, Any]) -> JSONResponse:
+    """Resultado de uma NF só: falha vira 404 (NF inexistente) ou 409 (estado/estoque)."""
+    if res.get("ok"):
+        return _json(res)
+    msg = res.get("erro") or res.get("msg") or ""
+    return _erro(msg, 404 if "não encontrada" in msg else 409)
+
+def _ids_corpo(dados: Dict[str, Any]) -> List[int]:
+    ids = dados.get("ids")
+    if isinstance(ids, str):
+        return nfe.parse_ids(ids, IDS_LOTE_MAX)
+    if not isinstance(ids, list) or not ids:
+        raise nfe.OperacaoInvalida("ids obrigatório (lista ou \"1,2,10-20\")")
+    if len(ids) > IDS_LOTE_MAX:
+        raise nfe.OperacaoInvalida(f"lista de IDs grande demais (máximo {IDS_LOTE_MAX})")
+    try:
+        return [int(x) for x in ids]
+    except (TypeError, ValueError):
+        raise nfe.OperacaoInvalida("ids deve conter inteiros") from None
+
+def _pagina(items: List[Dict[str, Any]], offset: int, limit: int) -> Dict[str, Any]:
+    return {"total": len(items), "offset": offset, "items": items[offset:offset + limit]}
+
+# =========================================================
+# Saúde
+# =========================================================
+@app.get("/saude")
+async def saude(request: Request) -> JSONResponse:
+    return _json({
+        "ok": True,
+        "backend": nfe.STORE_BACKEND,
+        "regras_st": len(nfe.load_tabela_st()),
+        "fila_gravacao": _escritor(request).fila.qsize(),
+    })
+
+# =========================================================
+# Cadastros
+# =========================================================
+def _listar(store: Dict[str, Any], ativos: bool, offset: int, limit: int) -> Dict[str, Any]:
+    items = store.get("items", [])
+    if ativos:
+        items = [x for x in items if int(x.get("ativo", 1)) == 1]
+    return _pagina(items, offset, limit)
+
+@app.get("/filiais")
+async def filiais(request: Request, ativos: bool = True,
+                  offset: int = Query(0, ge=0), limit: int = Query(100, ge=1, le=1000)) -> JSONResponse:
+    return _json(_listar(_estado(request).store(nfe.FILE_FILIAIS), ativos, offset, limit))
+
+@app.get("/produtos")
+async def produtos(request: Request, q: str = "", ativos: bool = True,
+                   offset: int = Query(0, ge=0), limit: int = Query(100, ge=1, le=1000)) -> JSONResponse:
+    """q: busca por SKU/descrição (índice de busca; só produtos ativos)."""
+    if q.strip():
+        total, hits = nfe.search_produtos_pagina(q, offset, limit)
+        return _json({"total": total, "offset": offset, "items": hits})
+    return _json(_listar(_estado(request).store(nfe.FILE_PRODUTOS), ativos, offset, limit))
+
+@app.get("/produtos/sku/{sku}")
+async def produto_por_sku(request: Request, sku: str) -> JSONResponse:
+    rec = nfe.find_by_sku(_estado(request).store(nfe.FILE_PRODUTOS), sku)
+    return _json(rec) if rec else _erro("Produto não encontrado.", 404)
+
+@app.get("/produtos/{produto_id}")
+async def produto(request: Request, produto_id: int) -> JSONResponse:
+    rec = nfe.find_by_id(_estado(request).store(nfe.FILE_PRODUTOS), produto_id)
+    return _json(rec) if rec else _erro("Produto não encontrado.", 404)
+
+@app.post("/produtos")
+async def criar_produto(request: Request, dados: Dict[str, Any] = Body(...)) -> JSONResponse:
+    """Campos: sku, descricao, ncm, cest, preco_venda, flag_importado."""
+    res = (await _escritor(request).enviar(("produto",), [dados]))[0]
+    return _json(res["registro"], 201) if res["ok"] else _erro(res["erro"], 422)
+
+@app.get("/pessoas")
+async def pessoas(request: Request, ativos: bool = True,
+                  offset: int = Query(0, ge=0), limit: int = Query(100, ge=1, le=1000)) -> JSONResponse:
+    return _json(_listar(_estado(request).store(nfe.FILE_PESSOAS), ativos, offset, limit))
+
+@app.get("/pessoas/{pessoa_id}")
+async def pessoa(request: Request, pessoa_id: int) -> JSONResponse:
+    rec = nfe.find_by_id(_estado(request).store(nfe.FILE_PESSOAS), pessoa_id)
+    return _json(rec) if rec else _erro("Pessoa não encontrada.", 404)
+
+@app.post("/pessoas")
+async def criar_pessoa(request: Request, dados: Dict[str, Any] = Body(...)) -> JSONResponse:
+    """Campos: nome, tipo (C/F/A), documento, uf, ind_ie_dest (1/2/9)."""
+    res = (await _escritor(request).enviar(("pessoa",), [dados]))[0]
+    return _json(res["registro"], 201) if res["ok"] else _erro(res["erro"], 422)
+
+# =========================================================
+# NFs
+# =========================================================
+@app.get("/nfs")
+async def nfs(request: Request, status: str = "", de: str = "", ate: str = "", filial_id: Optional[int] = None,
+              offset: int = Query(0, ge=0), limit: int = Query(50, ge=1, le=1000)) -> JSONResponse:
+    """Mais recentes primeiro. status: ex. EMITIDA,CANCELADA; de/ate: YYYY-MM-DD."""
+    items = _estado(request).store(nfe.FILE_NFS).get("items", [])
+    lista_status = [x.strip().upper() for x in status.split(",") if x.strip()] or None
+    if lista_status or de or ate or filial_id is not None:
+        items = nfe.filtrar_nfs(items, de, ate, lista_status, filial_id)
+    items = sorted(items, key=lambda x: int(x.get("id", 0)), reverse=True)
+    return _json(_pagina(items, offset, limit))
+
+@app.get("/nfs/{nf_id}")
+async def nf(request: Request, nf_id: int) -> JSONResponse:
+    rec = nfe.find_by_id(_estado(request).store(nfe.FILE_NFS), nf_id)
+    return _json(rec) if rec else _erro("NF não encontrada.", 404)
+
+@app.post("/nfs")
+async def criar_nf(request: Request, dados: Dict[str, Any] = Body(...),
+                   calcular: bool = False, emitir: bool = False) -> JSONResponse:
+    """
+    Campos de criar_nf (tipo_operacao, filial_id, emitente_id, destinatario_id,
+    uf_origem, uf_destino, ind_final, serie, numero, data_emissao) e
+    "itens": [{"sku" ou "produto_id", "qtd", "v_unit", "cfop", ...}].
+    """
+    res = (await _escritor(request).enviar(("criar_nf", calcular or emitir, emitir), [dados]))[0]
+    if not res["ok"]:
+        # com nf_id a NF foi criada e falhou no cálculo/emissão
+        return _json(res, 409) if "nf_id" in res else _erro(res.get("erro", ""), 422)
+    return _json(nfe.find_by_id(_estado(request).store(nfe.FILE_NFS), res["nf_id"]), 201)
+
+@app.post("/nfs/{nf_id}/itens")
+async def adicionar_itens(request: Request, nf_id: int, dados: Dict[str, Any] = Body(...)) -> JSONResponse:
+    """{"itens": [...]} ou um item só; a NF precisa estar em RASCUNHO."""
+    itens = dados.get("itens") if "itens" in dados else [dados]
+    if not isinstance(itens, list) or not itens:
+        raise nfe.OperacaoInvalida("itens obrigatório (lista)")
+    res = await _escritor(request).enviar(("itens",), [{**it, "nf_id": nf_id} for it in itens])
+    # tudo_ou_nada: com uma falha nenhum item foi gravado; reporta o item inválido
+    falha = next((r for r in res if not r["ok"] and not r.get("desfeito")), None)
+    if falha is not None:
+        return _erro(falha["erro"], 404 if "não encontrada" in falha["erro"] else 422)
+    return _json(nfe.find_by_id(_estado(request).store(nfe.FILE_NFS), nf_id))
+
+@app.post("/nfs/lote/{acao}")
+async def nfs_em_lote(request: Request, acao: str, dados: Dict[str, Any] = Body(...)) -> JSONResponse:
+    """
+    acao: calcular | emitir | cancelar. Corpo: {"ids": [...] ou "1,2,10-20", "completo": false}.
+    Declarada antes das rotas /nfs/{nf_id}/... para "lote" não ser lido como nf_id.
+    """
+    if acao not in ("calcular", "emitir", "cancelar"):
+        return _erro(f"ação inválida: {acao}", 404)
+    tipo = ("calcular", bool(dados.get("completo"))) if acao == "calcular" else (acao,)
+    res = nfe.resultado_operacoes(await _escritor(request).enviar(tipo, _ids_corpo(dados)))
+    return _json({"ok": all(r["ok"] for r in res), "total": len(res),
+                  "falhas": sum(1 for r in res if not r["ok"]), "resultados": res})
+
+@app.post("/nfs/{nf_id}/calcular")
+async def calcular_nf(request: Request, nf_id: int, completo: bool = False) -> JSONResponse:
+    return _resultado_nf((await _escritor(request).enviar(("calcular", completo), [nf_id]))[0])
+
+@app.post("/nfs/{nf_id}/emitir")
+async def emitir_nf(request: Request, nf_id: int) -> JSONResponse:
+    return _resultado_nf((await _escritor(request).enviar(("emitir",), [nf_id]))[0])
+
+@app.post("/nfs/{nf_id}/cancelar")
+async def cancelar_nf(request: Request, nf_id: int) -> JSONResponse:
+    return _resultado_nf((await _escritor(request).enviar(("cancelar",), [nf_id]))[0])
+
+# =========================================================
+# Estoque
+# =========================================================
+@app.get("/estoque")
+async def estoque(request: Request, filial_id: Optional[int] = None, produto_id: Optional[int] = None) -> JSONResponse:
+    """Saldo atual. Com filial_id e produto_id devolve só esse saldo."""
+    est = _estado(request).saldos()
+    if filial_id is not None and produto_id is not None:
+        return _json({"filial_id": filial_id, "produto_id": produto_id,
+                      "qtd": nfe.get_stock(est, filial_id, produto_id)})
+    by_filial = est.get("by_filial", {})
+    if filial_id is not None:
+        by_filial = {str(filial_id): by_filial.get(str(filial_id), {})}
+    if produto_id is not None:
+        by_filial = {f: {str(produto_id): p[str(produto_id)]} for f, p in by_filial.items() if str(produto_id) in p}
+    return _json({"by_filial": by_filial})
+
+@app.get("/estoque/em/{data_ref}")
+async def estoque_em(request: Request, data_ref: str, filial_id: Optional[int] = None) -> JSONResponse:
+    """Saldo no fim do dia data_ref (YYYY-MM-DD), a partir dos snapshots + ledger."""
+    if not nfe._data_iso_valida(data_ref):
+        return _erro("data fora do formato YYYY-MM-DD", 422)
+    by_filial = nfe.estoque_em(data_ref)
+    if filial_id is not None:
+        by_filial = {str(filial_id): by_filial.get(str(filial_id), {})}
+    return _json({"data": data_ref, "by_filial": by_filial})
+
+# =========================================================
+# Cotação de impostos (sem gravar)
+# =========================================================
+@app.post("/impostos/cotacao")
+async def cotacao(request: Request, dados: Dict[str, Any] = Body(...)) -> JSONResponse:
+    """
+    {"uf_origem", "uf_destino", "ind_final", "ind_ie_dest" ou "destinatario_id",
+     "data_emissao", "itens": [{"sku"/"produto_id" ou "ncm"/"cest"/"flag_importado",
+     "qtd", "v_unit", "cfop", ...}]} -> impostos por item e totais.
+    """
+    est = _estado(request)
+    return _json(nfe.cotar_impostos(
+        dados,
+        est.store(nfe.FILE_PRODUTOS),
+        est.store(nfe.FILE_PESSOAS),
+        nfe.load_contexto_fiscal(),
+        nfe.load_tabela_st(),
+    ))
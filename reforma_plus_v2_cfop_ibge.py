@@ -2,12 +2,14 @@ import csv
 import json
 import re
 import sys
+import unicodedata
 import uuid
+from bisect import bisect_left
+from array import array
 from dataclasses import dataclass, asdict
 from datetime import datetime
 from pathlib import Path
 from typing import Any, Dict, List, Optional, Tuple
-from collections import defaultdict
 
 from PySide6.QtCore import (
     QAbstractTableModel,
@@ -15,12 +17,14 @@ from PySide6.QtCore import (
     Qt,
     QSortFilterProxyModel,
     QStandardPaths,
+    QStringListModel,
 )
 from PySide6.QtGui import QAction
 from PySide6.QtWidgets import (
     QApplication,
     QCheckBox,
     QComboBox,
+    QCompleter,
     QDialog,
     QDoubleSpinBox,
     QFileDialog,
@@ -90,6 +94,18 @@ def municipios_path() -> Path:
     return app_data_dir() / "municipios.json"
 
 
+def log_path() -> Path:
+    return app_data_dir() / "db.log.jsonl"
+
+
+def movimentos_dir() -> Path:
+    return app_data_dir() / "movimentos"
+
+
+def cubo_path() -> Path:
+    return app_data_dir() / "cubo_fiscal.json"
+
+
 def normalize_prefix(category: str) -> str:
     s = re.sub(r"[^A-Za-z0-9]", "", (category or "").strip().upper())
     s = s[:3]
@@ -202,6 +218,67 @@ def load_municipios() -> List[Municipality]:
     return []
 
 
+def fold_name(name: str) -> str:
+    """Nome para comparação: sem acentos, minúsculo e com espaços normalizados."""
+    s = unicodedata.normalize("NFKD", name or "")
+    s = "".join(c for c in s if not unicodedata.combining(c))
+    return " ".join(s.casefold().split())
+
+
+class MunicipioIndex:
+    """
+    Índices da lista de municípios, montados uma vez no load: tupla por UF já
+    ordenada, (UF, nome) -> município, código IBGE -> município e busca por
+    prefixo do nome (autocompletar). Com registros repetidos vale o primeiro
+    da lista.
+
+    find compara o nome como sempre foi (sem espaços nas pontas, ignorando
+    maiúsculas); com sem_acento=True compara pelo fold_name, que também
+    ignora acentos e espaços repetidos ("Sao  Paulo" acha "São Paulo").
+    A busca por prefixo usa sempre o fold_name.
+    """
+
+    def __init__(self, muns: List[Municipality]) -> None:
+        por_uf: Dict[str, List[Municipality]] = {}
+        self.por_nome: Dict[Tuple[str, str], Municipality] = {}
+        self.por_nome_sem_acento: Dict[Tuple[str, str], Municipality] = {}
+        self.por_ibge: Dict[str, Municipality] = {}
+        for m in muns:
+            por_uf.setdefault(m.uf, []).append(m)
+            self.por_nome.setdefault((m.uf, m.name.strip().lower()), m)
+            self.por_nome_sem_acento.setdefault((m.uf, fold_name(m.name)), m)
+            if m.ibge:
+                self.por_ibge.setdefault(m.ibge, m)
+        self.por_uf: Dict[str, Tuple[Municipality, ...]] = {}
+        self._prefixos: Dict[str, Tuple[List[str], List[Municipality]]] = {}
+        for uf, lst in por_uf.items():
+            lst.sort(key=lambda x: x.name.lower())
+            self.por_uf[uf] = tuple(lst)
+            pares = sorted(((fold_name(m.name), i) for i, m in enumerate(lst)))
+            self._prefixos[uf] = ([k for k, _ in pares], [lst[i] for _, i in pares])
+
+    def by_uf(self, uf: str) -> Tuple[Municipality, ...]:
+        return self.por_uf.get(uf, ())
+
+    def find(self, uf: str, name: str, sem_acento: bool = False) -> Optional[Municipality]:
+        if sem_acento:
+            return self.por_nome_sem_acento.get((uf, fold_name(name)))
+        return self.por_nome.get((uf, (name or "").strip().lower()))
+
+    def by_ibge(self, ibge: str) -> Optional[Municipality]:
+        return self.por_ibge.get((ibge or "").strip())
+
+    def search_prefix(self, uf: str, prefix: str, limit: int = 20) -> List[Municipality]:
+        chaves, muns = self._prefixos.get(uf, ([], []))
+        prefix = fold_name(prefix)
+        out: List[Municipality] = []
+        i = bisect_left(chaves, prefix)
+        while i < len(chaves) and len(out) < limit and chaves[i].startswith(prefix):
+            out.append(muns[i])
+            i += 1
+        return out
+
+
 def save_municipios(muns: List[Municipality]) -> None:
     municipios_path().write_text(
         json.dumps([asdict(m) for m in muns], ensure_ascii=False, indent=2),
@@ -572,6 +649,298 @@ class Movement:
         )
 
 
+# ============================================================
+# Movimentações em colunas + cubo fiscal
+# ============================================================
+# MovementColumns é a cópia colunar de DataStore.movements: chaves das
+# dimensões fiscais normalizadas como códigos inteiros e valores em arrays de
+# double, na ordem das movimentações. FiscalCube guarda os agregados das
+# SAÍDAS por mês e dimensão e é atualizado a cada movimentação; os relatórios
+# leem só o cubo. Reconstruir o cubo é uma passada agrupada sobre as colunas
+# (NumPy bincount, que soma cada grupo na ordem dos dados, como o laço
+# incremental); sem NumPy o cubo é refeito movimentação a movimentação.
+# Toda célula é somada movimentação a movimentação, na ordem: o resultado é
+# o mesmo (bit a bit) da agregação feita do zero sobre as movimentações.
+FISCAL_DIMS = ["UF", "MUNICIPIO", "NATUREZA", "FINALIDADE", "CFOP", "TIPO", "NCM", "NBS"]
+FISCAL_CAMPOS = ["base", "cbs", "ibs", "iss", "taxes", "total"]
+CUBE_DIMS = FISCAL_DIMS + ["TOTAL"]
+# TIPO/NCM/NBS vêm do cadastro atual do produto: o cubo guarda a
+# classificação com que somou cada produto e é refeito quando ela muda
+PRODUCT_DIMS = ["TIPO", "NCM", "NBS"]
+MES_TODOS = "*"  # mês do cubo com o histórico todo ("" = movimentações sem data)
+
+
+def _numpy() -> Any:
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+def product_keys(p: Optional["Product"]) -> Dict[str, str]:
+    """TIPO e NCM (bens) ou NBS (serviços) de um produto; sem cadastro só TIPO "Desconhecido"."""
+    if p is None:
+        return {"TIPO": "Desconhecido"}
+    if p.kind == "Bem":
+        return {"TIPO": p.kind, "NCM": p.ncm.strip() or "(sem NCM)"}
+    return {"TIPO": p.kind, "NBS": p.nbs.strip() or "(sem NBS)"}
+
+
+def fiscal_keys(m: "Movement") -> Dict[str, str]:
+    """Chaves de agrupamento de uma movimentação (as que não dependem do cadastro do produto)."""
+    uf = (m.dest_uf or "").strip().upper() or "(sem UF)"
+    city = (m.dest_city or "").strip() or "(sem município)"
+    return {
+        "mov_type": m.mov_type,
+        "mes": (m.created_at or "")[:7],
+        "UF": uf,
+        "MUNICIPIO": f"{uf} - {city}",
+        "NATUREZA": (m.natureza or "Outros").strip(),
+        "FINALIDADE": (m.finalidade or "Normal").strip(),
+        "CFOP": (m.cfop or "").strip() or "(sem CFOP)",
+        "PRODUTO": m.product_id,
+        "TOTAL": "",
+    }
+
+
+class Categorias:
+    """Texto -> código inteiro, na ordem de primeira aparição."""
+
+    def __init__(self) -> None:
+        self.codigos: Dict[str, int] = {}
+        self.valores: List[str] = []
+
+    def codigo(self, valor: str) -> int:
+        c = self.codigos.get(valor)
+        if c is None:
+            c = self.codigos[valor] = len(self.valores)
+            self.valores.append(valor)
+        return c
+
+
+class MovementColumns:
+    CHAVES = ["mov_type", "mes", "UF", "MUNICIPIO", "NATUREZA", "FINALIDADE", "CFOP", "PRODUTO", "TOTAL"]
+
+    def __init__(self, movements: Optional[List["Movement"]] = None) -> None:
+        self.cats = {k: Categorias() for k in self.CHAVES}
+        self.codes = {k: array("i") for k in self.CHAVES}
+        self.vals = {k: array("d") for k in FISCAL_CAMPOS}
+        for m in movements or []:
+            self.append(m)
+
+    def __len__(self) -> int:
+        return len(self.vals["base"])
+
+    def append(self, m: "Movement") -> None:
+        for k, v in fiscal_keys(m).items():
+            self.codes[k].append(self.cats[k].codigo(v))
+        self.vals["base"].append(m.base_value)
+        self.vals["cbs"].append(m.cbs_value)
+        self.vals["ibs"].append(m.ibs_value)
+        self.vals["iss"].append(m.iss_value)
+        self.vals["taxes"].append(m.total_taxes)
+        self.vals["total"].append(m.total_value)
+
+    def cube_cells(self, np: Any, pmap: Dict[str, "Product"]) -> Tuple[Dict[str, Dict[str, Dict[str, List[float]]]], Dict[str, Dict[str, str]]]:
+        """Células do FiscalCube e a classificação usada por produto, numa passada agrupada."""
+        saida = self.cats["mov_type"].codigos.get("Saída")
+        if saida is None:
+            return {}, {}
+        # frombuffer(...)[sel] copia: nada fica preso ao buffer dos arrays (que continuam crescendo)
+        sel = np.flatnonzero(np.frombuffer(self.codes["mov_type"], dtype=np.int32) == saida)
+        pesos = [np.frombuffer(self.vals[k], dtype=np.float64)[sel] for k in FISCAL_CAMPOS]
+        mes = np.frombuffer(self.codes["mes"], dtype=np.int32)[sel].astype(np.int64)
+        meses = self.cats["mes"].valores
+        prod = np.frombuffer(self.codes["PRODUTO"], dtype=np.int32)[sel].astype(np.int64)
+
+        # TIPO/NCM/NBS: código por produto (-1 = o produto não entra na dimensão)
+        pids = self.cats["PRODUTO"].valores
+        classes = {pids[c]: product_keys(pmap.get(pids[c])) for c in np.unique(prod).tolist()}
+        cats_prod = {dim: Categorias() for dim in PRODUCT_DIMS}
+        por_prod = {dim: np.full(len(pids), -1, dtype=np.int64) for dim in PRODUCT_DIMS}
+        for pid, ks in classes.items():
+            for dim, chave in ks.items():
+                por_prod[dim][self.cats["PRODUTO"].codigos[pid]] = cats_prod[dim].codigo(chave)
+
+        cells: Dict[str, Dict[str, Dict[str, List[float]]]] = {}
+        for dim in CUBE_DIMS:
+            if dim in por_prod:
+                chaves = cats_prod[dim].valores
+                codes = por_prod[dim][prod]
+            else:
+                chaves = self.cats[dim].valores
+                codes = np.frombuffer(self.codes[dim], dtype=np.int32)[sel].astype(np.int64)
+            usar = codes >= 0
+            if usar.all():
+                ws, ms = pesos, mes
+            else:
+                codes = codes[usar]
+                ws, ms = [w[usar] for w in pesos], mes[usar]
+            n = len(chaves)
+            for grupo, nomes in ((codes, [MES_TODOS]), (ms * n + codes, meses)):
+                tam = n * len(nomes)
+                cols = [np.bincount(grupo, weights=w, minlength=tam).tolist() for w in ws]
+                cols.append(np.bincount(grupo, minlength=tam).astype(np.float64).tolist())
+                for g, cnt in enumerate(cols[-1]):
+                    if cnt:
+                        b = cells.setdefault(nomes[g // n], {}).setdefault(dim, {})
+                        b[chaves[g % n]] = [c[g] for c in cols]
+        return cells, classes
+
+
+class FiscalCube:
+    """
+    Agregados das SAÍDAS: cells[mês][dimensão][chave] = [base, cbs, ibs, iss,
+    taxes, total, count], com mês "AAAA-MM" ("" sem data) e MES_TODOS para o
+    histórico todo. `classes` é a classificação (product_keys) com que cada
+    produto foi somado em TIPO/NCM/NBS. `movs` conta as movimentações (de
+    qualquer tipo) já incluídas, na ordem de DataStore.movements; `gen` é a
+    geração do snapshot em que foi gravado.
+    """
+    FORMATO = 2
+
+    def __init__(self) -> None:
+        self.cells: Dict[str, Dict[str, Dict[str, List[float]]]] = {}
+        self.classes: Dict[str, Dict[str, str]] = {}
+        self.movs = 0
+        self.gen = 0
+
+    def add(self, m: "Movement", p: Optional["Product"]) -> None:
+        self.movs += 1
+        if m.mov_type != "Saída":
+            return
+        pk = self.classes.setdefault(m.product_id, product_keys(p))
+        k = {**fiscal_keys(m), **pk}
+        vals = (m.base_value, m.cbs_value, m.ibs_value, m.iss_value, m.total_taxes, m.total_value, 1.0)
+        for mes in (MES_TODOS, k["mes"]):
+            cubo = self.cells.setdefault(mes, {})
+            for dim in CUBE_DIMS:
+                chave = k.get(dim)
+                if chave is None:
+                    continue
+                b = cubo.setdefault(dim, {}).get(chave)
+                if b is None:
+                    b = cubo[dim][chave] = [0.0] * 7
+                for i, v in enumerate(vals):
+                    b[i] += v
+
+    def classe_mudou(self, pid: str, p: Optional["Product"]) -> bool:
+        ks = self.classes.get(pid)
+        return ks is not None and ks != product_keys(p)
+
+    def desatualizado(self, pmap: Dict[str, "Product"]) -> bool:
+        """Algum produto já somado mudou de TIPO/NCM/NBS (ou saiu do cadastro)?"""
+        return any(ks != product_keys(pmap.get(pid)) for pid, ks in self.classes.items())
+
+    @staticmethod
+    def rebuild(movements: List["Movement"], cols: MovementColumns, pmap: Dict[str, "Product"]) -> "FiscalCube":
+        cube = FiscalCube()
+        np = _numpy()
+        if np is not None:
+            cube.cells, cube.classes = cols.cube_cells(np, pmap)
+            cube.movs = len(movements)
+        else:
+            for m in movements:
+                cube.add(m, pmap.get(m.product_id))
+        return cube
+
+    def months(self) -> List[str]:
+        return sorted((m for m in self.cells if m != MES_TODOS), reverse=True)
+
+    def aggregates(self, month: str = MES_TODOS) -> Tuple[Dict[str, Dict[str, Dict[str, float]]], Dict[str, float]]:
+        """
+        {dim: {chave: {base, cbs, ibs, iss, taxes, total, count}}} para FISCAL_DIMS
+        e o total geral, do mês pedido (MES_TODOS = histórico todo).
+        """
+        cubo = self.cells.get(month, {})
+        campos = FISCAL_CAMPOS + ["count"]
+        aggs = {dim: {k: dict(zip(campos, b)) for k, b in cubo.get(dim, {}).items()} for dim in FISCAL_DIMS}
+        tot = cubo.get("TOTAL", {}).get("", [0.0] * 7)
+        return aggs, dict(zip(campos, tot))
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"formato": self.FORMATO, "gen": self.gen, "movs": self.movs, "classes": self.classes, "cells": self.cells}
+
+    @staticmethod
+    def from_dict(d: Dict[str, Any]) -> Optional["FiscalCube"]:
+        """None para um cubo de outro formato (é refeito no load)."""
+        if d.get("formato") != FiscalCube.FORMATO:
+            return None
+        cube = FiscalCube()
+        cube.gen = int(d.get("gen", 0))
+        cube.movs = int(d.get("movs", 0))
+        cube.classes = d.get("classes", {})
+        cube.cells = d.get("cells", {})
+        return cube
+
+
+# ============================================================
+# Persistência: snapshot + log + segmentos de movimentações
+# ============================================================
+LOG_COMPACT_BYTES = 4 * 1024 * 1024
+LOG_COMPACT_MIN_REGISTROS = 1000  # delta acima disso (e do tamanho do cadastro) vai direto para snapshot
+MOV_SEGMENTO_BYTES = 64 * 1024 * 1024
+
+
+def _gravar_atomico(path: Path, texto: str) -> None:
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.write_text(texto, encoding="utf-8")
+    tmp.replace(path)
+
+
+def _ler_jsonl(path: Path, limite: Optional[int] = None) -> Tuple[List[Dict[str, Any]], int]:
+    """
+    Lê um arquivo JSON por linha até `limite` bytes. Para na primeira linha
+    incompleta/inválida (gravação interrompida) e devolve também o tamanho
+    em bytes da parte válida.
+    """
+    try:
+        with path.open("rb") as f:
+            dados = f.read() if limite is None else f.read(limite)
+    except FileNotFoundError:
+        return [], 0
+    out: List[Dict[str, Any]] = []
+    valido = 0
+    for linha in dados.splitlines(keepends=True):
+        if not linha.endswith(b"\n"):
+            break
+        try:
+            out.append(json.loads(linha))
+        except ValueError:
+            break
+        valido += len(linha)
+    return out, valido
+
+
+def _gravar_movimentos(pasta: Path, segmentos: List[List[Any]], novas: List["Movement"], gen: int) -> None:
+    """
+    Acrescenta movimentações ao último segmento (cortando antes o que uma
+    compactação interrompida tenha deixado além do tamanho registrado) e
+    abre segmentos novos a cada MOV_SEGMENTO_BYTES. Atualiza `segmentos`.
+    """
+    i = 0
+    k = 0
+    while i < len(novas):
+        if not segmentos or segmentos[-1][1] >= MOV_SEGMENTO_BYTES:
+            segmentos.append([f"mov_{gen:06d}_{k:03d}.jsonl", 0])
+            k += 1
+        nome, tam = segmentos[-1]
+        path = pasta / nome
+        bloco: List[bytes] = []
+        fim = tam
+        while i < len(novas) and fim < MOV_SEGMENTO_BYTES:
+            linha = (json.dumps(asdict(novas[i]), ensure_ascii=False) + "\n").encode("utf-8")
+            bloco.append(linha)
+            fim += len(linha)
+            i += 1
+        with path.open("r+b" if path.exists() else "wb") as f:
+            f.truncate(tam)
+            f.seek(tam)
+            f.write(b"".join(bloco))
+        segmentos[-1][1] = fim
+
+
 # ============================================================
 # DataStore
 # ============================================================
@@ -582,30 +951,189 @@ class DataStore:
         self.products: List[Product] = []
         self.movements: List[Movement] = []
         self.municipios: List[Municipality] = []
+        self.mun_index = MunicipioIndex([])
+        self._gen = 0  # geração do snapshot incremental (0 = ainda não existe)
+        self._segmentos: List[List[Any]] = []
+        self._movs_em_segmentos = 0
+        self._reescrever_movs = False
+        self._log_bytes = 0
+        self._log_ok = False
+        self.cols = MovementColumns()
+        self.cube = FiscalCube()
+        self.reindex()
+        self._limpar_pendentes()
+
+    # Índices id/SKU -> objeto. Alterações em suppliers/products passam pelos
+    # métodos abaixo para os dicionários não ficarem defasados; com IDs ou SKUs
+    # repetidos vale o primeiro da lista (como na busca linear de antes).
+    def reindex(self) -> None:
+        self._suppliers_by_id = {s.id: s for s in reversed(self.suppliers)}
+        self._products_by_id = {p.id: p for p in reversed(self.products)}
+        self._products_by_sku = {p.sku: p for p in reversed(self.products)}
+        self._product_rows = {p.id: i for i, p in reversed(list(enumerate(self.products)))}
 
     def supplier_name(self, supplier_id: str) -> str:
-        for s in self.suppliers:
-            if s.id == supplier_id:
-                return s.name
-        return ""
+        s = self._suppliers_by_id.get(supplier_id)
+        return s.name if s else ""
 
     def product_by_id(self, pid: str) -> Optional[Product]:
-        for p in self.products:
-            if p.id == pid:
-                return p
-        return None
+        return self._products_by_id.get(pid)
+
+    def product_by_sku(self, sku: str) -> Optional[Product]:
+        return self._products_by_sku.get(sku)
+
+    def add_product(self, p: Product) -> None:
+        self.products.append(p)
+        self._marcar("products", p.id)
+        self._products_by_id.setdefault(p.id, p)
+        self._products_by_sku.setdefault(p.sku, p)
+        self._product_rows.setdefault(p.id, len(self.products) - 1)
+
+    def replace_product(self, row: int, p: Product) -> None:
+        old = self.products[row]
+        self.products[row] = p
+        self._marcar("products", old.id)
+        self._marcar("products", p.id)
+        if old.id != p.id or old.sku != p.sku:
+            self.reindex()
+            return
+        if self._products_by_id.get(p.id) is old:
+            self._products_by_id[p.id] = p
+        if self._products_by_sku.get(p.sku) is old:
+            self._products_by_sku[p.sku] = p
+
+    def update_product(self, p: Product) -> None:
+        row = self._product_rows.get(p.id)
+        if row is not None:
+            self.replace_product(row, p)
+
+    def remove_products(self, rows: List[int]) -> None:
+        """Exclui os produtos das linhas informadas e as movimentações deles."""
+        rows = sorted(set(rows), reverse=True)
+        pids = {self.products[r].id for r in rows}
+        manter = []
+        for m in self.movements:
+            if m.product_id in pids:
+                self._movs_excluidos.append(m.id)
+            else:
+                manter.append(m)
+        self.movements = manter
+        self._movs_pendentes = [m for m in self._movs_pendentes if m.product_id not in pids]
+        for r in rows:
+            self.products.pop(r)
+        for pid in pids:
+            self._marcar("products", pid)
+        self.reindex()
+        if len(self.movements) != len(self.cols):
+            self.cols = MovementColumns(self.movements)
+            self.cube = FiscalCube.rebuild(self.movements, self.cols, self._products_by_id)
+
+    def merge_products(self, imported: List[Product]) -> None:
+        """Importação: substitui os produtos de mesmo id e acrescenta os novos."""
+        cur = {p.id: p for p in self.products}
+        for p in imported:
+            cur[p.id] = p
+            self._marcar("products", p.id)
+        self.products = list(cur.values())
+        self.reindex()
+
+    def add_supplier(self, s: Supplier) -> None:
+        self.suppliers.append(s)
+        self._marcar("suppliers", s.id)
+        self._suppliers_by_id.setdefault(s.id, s)
+
+    def replace_supplier(self, row: int, s: Supplier) -> None:
+        old = self.suppliers[row]
+        self.suppliers[row] = s
+        self._marcar("suppliers", old.id)
+        self._marcar("suppliers", s.id)
+        if old.id != s.id:
+            self.reindex()
+        elif self._suppliers_by_id.get(s.id) is old:
+            self._suppliers_by_id[s.id] = s
+
+    def remove_suppliers(self, rows: List[int]) -> None:
+        """Exclui os fornecedores das linhas informadas; produtos vinculados ficam sem fornecedor."""
+        rows = sorted(set(rows), reverse=True)
+        sids = {self.suppliers[r].id for r in rows}
+        for i, p in enumerate(self.products):
+            if p.supplier_id in sids:
+                self.products[i] = Product(**{**asdict(p), "supplier_id": "", "updated_at": now_iso()})
+                self._marcar("products", p.id)
+        for r in rows:
+            self.suppliers.pop(r)
+        for sid in sids:
+            self._marcar("suppliers", sid)
+        self.reindex()
 
     def load_municipios(self) -> None:
         self.municipios = load_municipios()
-
-    def to_dict(self) -> Dict[str, Any]:
-        return {
-            "meta": {"version": 3, "updated_at": now_iso()},
-            "tax_defaults": asdict(self.tax_defaults),
-            "suppliers": [asdict(s) for s in self.suppliers],
-            "products": [asdict(p) for p in self.products],
-            "movements": [asdict(m) for m in self.movements],
-        }
+        self.mun_index = MunicipioIndex(self.municipios)
+
+    # ---------------- persistência incremental ----------------
+    # db.json é o snapshot (parâmetros, fornecedores, produtos e a lista de
+    # segmentos de movimentações com o tamanho válido de cada um). save()
+    # acrescenta em db.log.jsonl só os registros alterados e as movimentações
+    # novas; a compactação grava um snapshot novo, passa as movimentações do
+    # log para o fim do último segmento e zera o log. Segmentos só são
+    # reescritos quando movimentações são excluídas (exclusão de produto).
+    def _limpar_pendentes(self) -> None:
+        self._sujos: Dict[Tuple[str, str], None] = {}
+        self._movs_pendentes: List[Movement] = []
+        self._movs_excluidos: List[str] = []
+        self._tax_gravado = asdict(self.tax_defaults)
+
+    def _marcar(self, tabela: str, rid: str) -> None:
+        self._sujos[(tabela, rid)] = None
+
+    def add_movement(self, m: Movement) -> None:
+        self.movements.append(m)
+        self.cols.append(m)
+        p = self.product_by_id(m.product_id)
+        if self.cube.classe_mudou(m.product_id, p):
+            self.cube = FiscalCube.rebuild(self.movements, self.cols, self._products_by_id)
+        else:
+            self.cube.add(m, p)
+        self._movs_pendentes.append(m)
+
+    def fiscal_aggregates(self, month: str = MES_TODOS) -> Tuple[Dict[str, Dict[str, Dict[str, float]]], Dict[str, float]]:
+        if self.cube.desatualizado(self._products_by_id):
+            self.cube = FiscalCube.rebuild(self.movements, self.cols, self._products_by_id)
+        return self.cube.aggregates(month)
+
+    # ---------------- cubo fiscal ----------------
+    # cubo_fiscal.json é gravado junto com o snapshot (compact) e na
+    # reconstrução manual. Vale no load se for da mesma geração e formato,
+    # cobrir um prefixo das movimentações e tiver a classificação atual dos
+    # produtos; as movimentações do log entram por cube.add. Produto que muda
+    # de TIPO/NCM/NBS refaz o cubo na próxima leitura (ou movimentação dele).
+    def rebuild_cube(self) -> None:
+        self.cols = MovementColumns(self.movements)
+        self.cube = FiscalCube.rebuild(self.movements, self.cols, self._products_by_id)
+        self.save_cube()
+
+    def save_cube(self) -> None:
+        self.cube.gen = self._gen
+        _gravar_atomico(cubo_path(), json.dumps(self.cube.to_dict(), ensure_ascii=False))
+
+    def _carregar_cubo(self) -> None:
+        cube = None
+        if self._gen and not self._reescrever_movs:
+            try:
+                cube = FiscalCube.from_dict(json.loads(cubo_path().read_text(encoding="utf-8")))
+            except Exception:
+                cube = None
+        if (cube is None or cube.gen != self._gen or cube.movs > len(self.movements)
+                or cube.desatualizado(self._products_by_id)):
+            self.cube = FiscalCube.rebuild(self.movements, self.cols, self._products_by_id)
+            return
+        for m in self.movements[cube.movs:]:
+            p = self.product_by_id(m.product_id)
+            if cube.classe_mudou(m.product_id, p):
+                self.cube = FiscalCube.rebuild(self.movements, self.cols, self._products_by_id)
+                return
+            cube.add(m, p)
+        self.cube = cube
 
     @staticmethod
     def load() -> "DataStore":
@@ -619,31 +1147,151 @@ class DataStore:
 
         try:
             raw = json.loads(path.read_text(encoding="utf-8"))
+            meta = raw.get("meta", {})
             ds.tax_defaults = TaxDefaults.from_dict(raw.get("tax_defaults", {}))
             ds.suppliers = [Supplier.from_dict(x) for x in raw.get("suppliers", []) if isinstance(x, dict)]
             ds.products = [Product.from_dict(x) for x in raw.get("products", []) if isinstance(x, dict)]
+            # db.json antigo (version 3) traz as movimentações no próprio arquivo
             ds.movements = [Movement.from_dict(x) for x in raw.get("movements", []) if isinstance(x, dict)]
+            ds._reescrever_movs = bool(ds.movements)
+            ds._gen = int(meta.get("gen", 0))
+            ds._segmentos = [[str(n), int(b)] for n, b in meta.get("segmentos", [])]
+            for nome, tam in ds._segmentos:
+                for d in _ler_jsonl(movimentos_dir() / nome, tam)[0]:
+                    ds.movements.append(Movement.from_dict(d))
+            ds._movs_em_segmentos = len(ds.movements)
+            ds._aplicar_log()
         except Exception:
             pass
 
+        ds.cols = MovementColumns(ds.movements)
+        ds.reindex()
+        ds._carregar_cubo()
+        ds._limpar_pendentes()
         return ds
 
+    def _aplicar_log(self) -> None:
+        if not self._gen:
+            return
+        entradas, tam = _ler_jsonl(log_path())
+        if not entradas or entradas[0].get("gen") != self._gen:
+            return  # log de uma geração anterior: já está no snapshot
+        if tam < log_path().stat().st_size:
+            # sobra de uma gravação interrompida: corta para o próximo save não emendar nela
+            with log_path().open("r+b") as f:
+                f.truncate(tam)
+        self._log_bytes = tam
+        tabelas = {"suppliers": (self.suppliers, Supplier), "products": (self.products, Product)}
+        pos = {t: {x.id: i for i, x in reversed(list(enumerate(lst)))} for t, (lst, _) in tabelas.items()}
+        for e in entradas[1:]:
+            if "mov" in e:
+                self.movements.append(Movement.from_dict(e["mov"]))
+            elif "t" in e:
+                lst, cls = tabelas[e["t"]]
+                if "put" in e:
+                    rec = cls.from_dict(e["put"])
+                    i = pos[e["t"]].get(rec.id)
+                    if i is None:
+                        pos[e["t"]][rec.id] = len(lst)
+                        lst.append(rec)
+                    else:
+                        lst[i] = rec
+                else:
+                    i = pos[e["t"]].pop(e["del"], None)
+                    if i is not None:
+                        lst[i] = None
+            elif "tax" in e:
+                self.tax_defaults = TaxDefaults.from_dict(e["tax"])
+            elif "del_movs" in e:
+                ids = set(e["del_movs"])
+                self.movements = [m for m in self.movements if m.id not in ids]
+                self._reescrever_movs = True
+        self.suppliers = [x for x in self.suppliers if x is not None]
+        self.products = [x for x in self.products if x is not None]
+        self._log_ok = True
+
     def save(self) -> None:
-        db_path().write_text(json.dumps(self.to_dict(), ensure_ascii=False, indent=2), encoding="utf-8")
-
-    def municipios_by_uf(self, uf: str) -> List[Municipality]:
-        uf = (uf or "").strip().upper()
-        if not uf:
-            return []
-        return sorted([m for m in self.municipios if m.uf == uf], key=lambda x: x.name.lower())
-
-    def find_municipio(self, uf: str, name: str) -> Optional[Municipality]:
-        uf = (uf or "").strip().upper()
-        name = (name or "").strip().lower()
-        for m in self.municipios:
-            if m.uf == uf and m.name.strip().lower() == name:
-                return m
-        return None
+        """Grava só o que mudou desde o último save; compacta quando o log passa de LOG_COMPACT_BYTES."""
+        linhas: List[Dict[str, Any]] = []
+        for tabela, rid in self._sujos:
+            idx = self._suppliers_by_id if tabela == "suppliers" else self._products_by_id
+            rec = idx.get(rid)
+            linhas.append({"t": tabela, "put": asdict(rec)} if rec is not None else {"t": tabela, "del": rid})
+        tax = asdict(self.tax_defaults)
+        if tax != self._tax_gravado:
+            linhas.append({"tax": tax})
+        if self._movs_excluidos:
+            linhas.append({"del_movs": self._movs_excluidos})
+            self._reescrever_movs = True
+
+        # sem snapshot incremental ainda, ou delta maior que o próprio cadastro: snapshot direto
+        if not self._gen or len(linhas) > max(LOG_COMPACT_MIN_REGISTROS, len(self.products) + len(self.suppliers)):
+            self.compact()
+            return
+        linhas.extend({"mov": asdict(m)} for m in self._movs_pendentes)
+        if not linhas:
+            return
+
+        texto = "".join(json.dumps(x, ensure_ascii=False) + "\n" for x in linhas)
+        if not self._log_ok:
+            _gravar_atomico(log_path(), json.dumps({"gen": self._gen}) + "\n")
+            self._log_bytes = log_path().stat().st_size
+            self._log_ok = True
+        with log_path().open("a", encoding="utf-8", newline="\n") as f:
+            f.write(texto)
+        self._log_bytes += len(texto.encode("utf-8"))
+        self._limpar_pendentes()
+        if self._log_bytes > LOG_COMPACT_BYTES:
+            self.compact()
+
+    def compact(self) -> None:
+        """Grava snapshot novo, leva as movimentações do log para os segmentos e zera o log."""
+        gen = self._gen + 1
+        pasta = movimentos_dir()
+        pasta.mkdir(parents=True, exist_ok=True)
+        if self._reescrever_movs:
+            segmentos: List[List[Any]] = []
+            novas = self.movements
+        else:
+            segmentos = [list(s) for s in self._segmentos]
+            novas = self.movements[self._movs_em_segmentos:]
+        _gravar_movimentos(pasta, segmentos, novas, gen)
+
+        snap = {
+            "meta": {"version": 4, "updated_at": now_iso(), "gen": gen, "segmentos": segmentos},
+            "tax_defaults": asdict(self.tax_defaults),
+            "suppliers": [asdict(s) for s in self.suppliers],
+            "products": [asdict(p) for p in self.products],
+        }
+        _gravar_atomico(db_path(), json.dumps(snap, ensure_ascii=False))
+        _gravar_atomico(log_path(), json.dumps({"gen": gen}) + "\n")
+        self._gen = gen
+        self.save_cube()
+
+        validos = {n for n, _ in segmentos}
+        for f in pasta.glob("*.jsonl"):
+            if f.name not in validos:
+                f.unlink(missing_ok=True)
+        self._segmentos = segmentos
+        self._movs_em_segmentos = len(self.movements)
+        self._reescrever_movs = False
+        self._log_bytes = log_path().stat().st_size
+        self._log_ok = True
+        self._limpar_pendentes()
+
+    def municipios_by_uf(self, uf: str) -> Tuple[Municipality, ...]:
+        """Municípios da UF ordenados por nome."""
+        return self.mun_index.by_uf((uf or "").strip().upper())
+
+    def find_municipio(self, uf: str, name: str, sem_acento: bool = False) -> Optional[Municipality]:
+        """Busca por UF + nome ignorando maiúsculas (e acentos, com sem_acento=True)."""
+        return self.mun_index.find((uf or "").strip().upper(), name, sem_acento)
+
+    def municipio_by_ibge(self, ibge: str) -> Optional[Municipality]:
+        return self.mun_index.by_ibge(ibge)
+
+    def search_municipios(self, uf: str, prefix: str, limit: int = 20) -> List[Municipality]:
+        return self.mun_index.search_prefix((uf or "").strip().upper(), prefix, limit)
 
 
 # ============================================================
@@ -879,15 +1527,12 @@ class ProductsFilterProxy(QSortFilterProxyModel):
         if model is None:
             return True
 
-        def get_user(col_key: str) -> Any:
-            col_idx = [k for _, k in model.COLS].index(col_key)
-            idx = model.index(source_row, col_idx, source_parent)
-            return model.data(idx, Qt.UserRole)
-
-        active = bool(get_user("active"))
-        kind = str(get_user("kind") or "")
-        category = str(get_user("category") or "")
-        brand = str(get_user("brand") or "")
+        # lê o Product direto (sem montar QModelIndex por coluna a cada linha)
+        p = model.ds.products[source_row]
+        active = bool(p.active)
+        kind = str(p.kind or "")
+        category = str(p.category or "")
+        brand = str(p.brand or "")
 
         if self._only_active and not active:
             return False
@@ -899,14 +1544,8 @@ class ProductsFilterProxy(QSortFilterProxyModel):
             return False
 
         if self._search:
-            sku = str(get_user("sku") or "")
-            name = str(get_user("name") or "")
-            supplier = str(get_user("supplier_id") or "")
-            ncm = str(get_user("ncm") or "")
-            nbs = str(get_user("nbs") or "")
-            ean = str(get_user("ean") or "")
-
-            hay = f"{sku} {name} {kind} {category} {brand} {supplier} {ncm} {nbs} {ean}".lower()
+            supplier = model.ds.supplier_name(p.supplier_id)
+            hay = f"{p.sku} {p.name} {kind} {category} {brand} {supplier} {p.ncm} {p.nbs} {p.ean}".lower()
             if self._search not in hay:
                 return False
 
@@ -1295,6 +1934,11 @@ class MovementDialog(QDialog):
         self.dest_city.setEditable(True)
         self.dest_city.setInsertPolicy(QComboBox.NoInsert)
         self.dest_city.setMinimumContentsLength(28)
+        # autocompletar pelo índice de municípios (prefixo sem acento: "sao" acha "São Paulo")
+        self._city_model = QStringListModel(self)
+        self._city_completer = QCompleter(self._city_model, self)
+        self._city_completer.setCompletionMode(QCompleter.UnfilteredPopupCompletion)
+        self.dest_city.setCompleter(self._city_completer)
 
         self.dest_city_ibge = QLineEdit()
         self.dest_city_ibge.setPlaceholderText("Auto (se selecionado pela lista) ou manual")
@@ -1363,6 +2007,8 @@ class MovementDialog(QDialog):
         self.finalidade.currentTextChanged.connect(self._update_preview)
         self.dest_uf.currentTextChanged.connect(self._reload_municipios_for_uf)
         self.dest_city.currentTextChanged.connect(self._sync_ibge_from_city)
+        self.dest_city.lineEdit().textEdited.connect(self._complete_city)
+        self._city_completer.activated.connect(self._select_city)
         self.qty.valueChanged.connect(self._update_preview)
         self.unit_price.valueChanged.connect(self._update_preview)
         self.cbs.valueChanged.connect(self._update_preview)
@@ -1405,6 +2051,16 @@ class MovementDialog(QDialog):
         self._sync_ibge_from_city()
         self._update_preview_and_cfop()
 
+    def _complete_city(self, text: str) -> None:
+        uf = (self.dest_uf.currentText() or "").strip().upper()
+        muns = self.ds.search_municipios(uf, text) if uf and text.strip() else []
+        self._city_model.setStringList([m.name for m in muns])
+
+    def _select_city(self, name: str) -> None:
+        idx = self.dest_city.findText(name)
+        if idx >= 0:
+            self.dest_city.setCurrentIndex(idx)
+
     def _sync_ibge_from_city(self) -> None:
         ibge = self.dest_city.currentData()
         if ibge:
@@ -1725,6 +2381,9 @@ class MainWindow(QMainWindow):
         self.sp_low.setRange(0, 10**9)
         self.sp_low.setValue(5)
 
+        self.cmb_mes = QComboBox()
+        self.cmb_mes.addItem("Todos", MES_TODOS)
+
         btn = QPushButton("Gerar relatórios fiscais (didático)")
         btn.clicked.connect(self.generate_report)
 
@@ -1734,12 +2393,18 @@ class MainWindow(QMainWindow):
         btn_export_csv = QPushButton("Exportar fiscal (CSV)")
         btn_export_csv.clicked.connect(self.export_fiscal_csv)
 
+        btn_cubo = QPushButton("Reconstruir cubo fiscal")
+        btn_cubo.clicked.connect(self.rebuild_fiscal_cube)
+
         top.addWidget(QLabel("Baixo estoque ≤"))
         top.addWidget(self.sp_low)
+        top.addWidget(QLabel("Mês"))
+        top.addWidget(self.cmb_mes)
         top.addStretch(1)
         top.addWidget(btn)
         top.addWidget(btn_export_txt)
         top.addWidget(btn_export_csv)
+        top.addWidget(btn_cubo)
 
         self.txt_report = QPlainTextEdit()
         self.txt_report.setReadOnly(True)
@@ -1784,6 +2449,21 @@ class MainWindow(QMainWindow):
             f"Produtos: {total_p} (Ativos {active_p}) | Fornecedores: {total_s} | Movs: {total_m} | "
             f"Municípios(IBGE): {mun_count} | Exibindo produtos (filtro): {showing} | DB: {db_path()}"
         )
+        self._refresh_report_months()
+
+    def _refresh_report_months(self) -> None:
+        cur = self._report_month()
+        months = self.ds.cube.months()
+        if [self.cmb_mes.itemData(i) for i in range(1, self.cmb_mes.count())] == months:
+            return
+        self.cmb_mes.blockSignals(True)
+        self.cmb_mes.clear()
+        self.cmb_mes.addItem("Todos", MES_TODOS)
+        for mes in months:
+            self.cmb_mes.addItem(mes or "(sem data)", mes)
+        idx = self.cmb_mes.findData(cur)
+        self.cmb_mes.setCurrentIndex(idx if idx >= 0 else 0)
+        self.cmb_mes.blockSignals(False)
 
     def _refresh_product_filters(self) -> None:
         cur_kind = self.cmb_kind.currentText() or "Todos"
@@ -1853,7 +2533,7 @@ class MainWindow(QMainWindow):
         if not p:
             return
 
-        self.ds.products.append(p)
+        self.ds.add_product(p)
         self.ds.save()
         self.prod_model.refresh()
         self._refresh_product_filters()
@@ -1873,7 +2553,7 @@ class MainWindow(QMainWindow):
         if not updated:
             return
 
-        self.ds.products[row] = updated
+        self.ds.replace_product(row, updated)
         self.ds.save()
         self.prod_model.refresh()
         self._refresh_product_filters()
@@ -1890,7 +2570,7 @@ class MainWindow(QMainWindow):
 
         for r in rows:
             p = self.ds.products[r]
-            self.ds.products[r] = Product(**{**asdict(p), "active": target, "updated_at": now_iso()})
+            self.ds.replace_product(r, Product(**{**asdict(p), "active": target, "updated_at": now_iso()}))
 
         self.ds.save()
         self.prod_model.refresh()
@@ -1913,10 +2593,7 @@ class MainWindow(QMainWindow):
         if resp != QMessageBox.Yes:
             return
 
-        for r in sorted(set(rows), reverse=True):
-            pid = self.ds.products[r].id
-            self.ds.movements = [m for m in self.ds.movements if m.product_id != pid]
-            self.ds.products.pop(r)
+        self.ds.remove_products(rows)
 
         self.ds.save()
         self.prod_model.refresh()
@@ -1967,10 +2644,7 @@ class MainWindow(QMainWindow):
                     d["iss_rate"] = float(str(d.get("iss_rate", "0")).replace(",", "."))
                     imported.append(Product.from_dict(d))
 
-            cur = {p.id: p for p in self.ds.products}
-            for p in imported:
-                cur[p.id] = p
-            self.ds.products = list(cur.values())
+            self.ds.merge_products(imported)
 
             self.ds.save()
             self.prod_model.refresh()
@@ -1989,7 +2663,7 @@ class MainWindow(QMainWindow):
         if not s:
             return
 
-        self.ds.suppliers.append(s)
+        self.ds.add_supplier(s)
         self.ds.save()
         self.sup_model.refresh()
         self.prod_model.refresh()
@@ -2009,7 +2683,7 @@ class MainWindow(QMainWindow):
         if not updated:
             return
 
-        self.ds.suppliers[row] = updated
+        self.ds.replace_supplier(row, updated)
         self.ds.save()
         self.sup_model.refresh()
         self.prod_model.refresh()
@@ -2026,7 +2700,7 @@ class MainWindow(QMainWindow):
 
         for r in rows:
             s = self.ds.suppliers[r]
-            self.ds.suppliers[r] = Supplier(**{**asdict(s), "active": target, "updated_at": now_iso()})
+            self.ds.replace_supplier(r, Supplier(**{**asdict(s), "active": target, "updated_at": now_iso()}))
 
         self.ds.save()
         self.sup_model.refresh()
@@ -2049,12 +2723,7 @@ class MainWindow(QMainWindow):
         if resp != QMessageBox.Yes:
             return
 
-        for r in sorted(set(rows), reverse=True):
-            sid = self.ds.suppliers[r].id
-            for i, p in enumerate(self.ds.products):
-                if p.supplier_id == sid:
-                    self.ds.products[i] = Product(**{**asdict(p), "supplier_id": "", "updated_at": now_iso()})
-            self.ds.suppliers.pop(r)
+        self.ds.remove_suppliers(rows)
 
         self.ds.save()
         self.sup_model.refresh()
@@ -2090,12 +2759,9 @@ class MainWindow(QMainWindow):
         else:
             new_stock = m.qty  # Ajuste
 
-        for i, px in enumerate(self.ds.products):
-            if px.id == p.id:
-                self.ds.products[i] = Product(**{**asdict(px), "stock": int(new_stock), "updated_at": now_iso()})
-                break
+        self.ds.update_product(Product(**{**asdict(p), "stock": int(new_stock), "updated_at": now_iso()}))
 
-        self.ds.movements.append(m)
+        self.ds.add_movement(m)
         self.ds.save()
 
         self.prod_model.refresh()
@@ -2152,64 +2818,13 @@ class MainWindow(QMainWindow):
         Retorna agregações para SAÍDAS:
         dims: UF, Município, Natureza, Finalidade, CFOP, Tipo, NCM, NBS
         Cada item: base, cbs, ibs, iss, taxes, total, count
+        Lidas do cubo fiscal, no mês selecionado (ou todo o histórico).
         """
-        pmap = {p.id: p for p in self.ds.products}
-        sales = [m for m in self.ds.movements if m.mov_type == "Saída"]
-
-        def new_bucket() -> Dict[str, float]:
-            return {"base": 0.0, "cbs": 0.0, "ibs": 0.0, "iss": 0.0, "taxes": 0.0, "total": 0.0, "count": 0.0}
-
-        aggs: Dict[str, Dict[str, Dict[str, float]]] = {
-            "UF": defaultdict(new_bucket),
-            "MUNICIPIO": defaultdict(new_bucket),
-            "NATUREZA": defaultdict(new_bucket),
-            "FINALIDADE": defaultdict(new_bucket),
-            "CFOP": defaultdict(new_bucket),
-            "TIPO": defaultdict(new_bucket),
-            "NCM": defaultdict(new_bucket),
-            "NBS": defaultdict(new_bucket),
-        }
+        return self.ds.fiscal_aggregates(self._report_month())[0]
 
-        for m in sales:
-            p = pmap.get(m.product_id)
-            kind = p.kind if p else "Desconhecido"
-
-            uf = (m.dest_uf or "").strip().upper() or "(sem UF)"
-            city = (m.dest_city or "").strip() or "(sem município)"
-            key_city = f"{uf} - {city}"
-
-            natureza = (m.natureza or "Outros").strip()
-            finalidade = (m.finalidade or "Normal").strip()
-            cfop = (m.cfop or "").strip() or "(sem CFOP)"
-
-            def add(dim: str, key: str) -> None:
-                b = aggs[dim][key]
-                b["base"] += m.base_value
-                b["cbs"] += m.cbs_value
-                b["ibs"] += m.ibs_value
-                b["iss"] += m.iss_value
-                b["taxes"] += m.total_taxes
-                b["total"] += m.total_value
-                b["count"] += 1.0
-
-            add("UF", uf)
-            add("MUNICIPIO", key_city)
-            add("NATUREZA", natureza)
-            add("FINALIDADE", finalidade)
-            add("CFOP", cfop)
-            add("TIPO", kind)
-
-            if p:
-                if p.kind == "Bem":
-                    add("NCM", p.ncm.strip() or "(sem NCM)")
-                else:
-                    add("NBS", p.nbs.strip() or "(sem NBS)")
-
-        # convert defaultdict -> dict normal
-        out: Dict[str, Dict[str, Dict[str, float]]] = {}
-        for dim, mp in aggs.items():
-            out[dim] = dict(mp)
-        return out
+    def _report_month(self) -> str:
+        mes = self.cmb_mes.currentData()
+        return MES_TODOS if mes is None else mes
 
     def generate_report(self) -> None:
         low = int(self.sp_low.value())
@@ -2235,16 +2850,18 @@ class MainWindow(QMainWindow):
         lines.append("")
         lines.append(f"Valor de estoque (referência): {inv_value:.2f}")
 
-        sales = [m for m in self.ds.movements if m.mov_type == "Saída"]
+        mes = self._report_month()
+        aggs, tot = self.ds.fiscal_aggregates(mes)
         lines.append("")
-        lines.append(f"Saídas registradas: {len(sales)}")
+        lines.append(f"Período: {self.cmb_mes.currentText() if mes != MES_TODOS else 'todo o histórico'}")
+        lines.append(f"Saídas registradas: {int(tot['count'])}")
 
-        base_total = sum(m.base_value for m in sales)
-        cbs_total = sum(m.cbs_value for m in sales)
-        ibs_total = sum(m.ibs_value for m in sales)
-        iss_total = sum(m.iss_value for m in sales)
-        taxes_total = sum(m.total_taxes for m in sales)
-        total_total = sum(m.total_value for m in sales)
+        base_total = tot["base"]
+        cbs_total = tot["cbs"]
+        ibs_total = tot["ibs"]
+        iss_total = tot["iss"]
+        taxes_total = tot["taxes"]
+        total_total = tot["total"]
 
         lines.append("")
         lines.append("Totais (Saídas)")
@@ -2255,8 +2872,6 @@ class MainWindow(QMainWindow):
         lines.append(f"- Impostos: {taxes_total:.2f}")
         lines.append(f"- Total (Base+Impostos): {total_total:.2f}")
 
-        aggs = self._compute_fiscal_aggregates()
-
         def top_lines(dim: str, title: str, top_n: int = 15) -> None:
             lines.append("")
             lines.append(title)
@@ -2316,7 +2931,7 @@ class MainWindow(QMainWindow):
             with open(path, "w", newline="", encoding="utf-8") as f:
                 w = csv.writer(f, delimiter=";")
                 w.writerow(["dimension", "key", "count", "base", "cbs", "ibs", "iss", "taxes", "total"])
-                for dim in ["UF", "MUNICIPIO", "NATUREZA", "FINALIDADE", "CFOP", "TIPO", "NCM", "NBS"]:
+                for dim in FISCAL_DIMS:
                     items = list(aggs.get(dim, {}).items())
                     items.sort(key=lambda x: (-x[1]["base"], x[0]))
                     for k, d in items:
@@ -2335,6 +2950,17 @@ class MainWindow(QMainWindow):
         except Exception as e:
             QMessageBox.critical(self, "Exportar Fiscal", f"Falha:\n{e}")
 
+    def rebuild_fiscal_cube(self) -> None:
+        try:
+            self.ds.rebuild_cube()
+        except Exception as e:
+            QMessageBox.critical(self, "Cubo fiscal", f"Falha ao reconstruir:\n{e}")
+            return
+        self._update_status()
+        QMessageBox.information(
+            self, "Cubo fiscal", f"Cubo reconstruído: {len(self.ds.movements)} movimentação(ões), {len(self.ds.cube.months())} mês(es)."
+        )
+
     # ----------------- Geral -----------------
     def reload_db(self) -> None:
         self.ds = DataStore.load()
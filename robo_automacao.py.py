@@ -235,7 +235,10 @@ def cmd_import_csv(csv_path: Path, mode: str):
                 produtos[idx_exist] = produto
                 updated += 1
 
-        sysnfe.save_produtos(produtos)
+        try:
+            sysnfe.save_produtos(produtos)
+        except sysnfe.ConflitoVersao as e:
+            raise SystemExit(f"[ERRO] {e} (nada foi gravado; rode a importação de novo)")
         sysnfe.append_audit(f"ROBÔ: import_csv({csv_path.name}) inserted={inserted} updated={updated} skipped={skipped} invalid={invalid}")
 
     print("[OK] Importação finalizada.")
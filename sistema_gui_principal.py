@@ -1,6 +1,8 @@
+import importlib.util
 import json
 import re
 import shlex
+import sys
 from pathlib import Path
 from datetime import datetime
 
@@ -20,9 +22,27 @@ ctk.set_default_color_theme("blue")
 # Persistência JSON + Auditoria
 # =========================
 BASE_DIR = Path(__file__).resolve().parent
-DATA_DIR = BASE_DIR / "data"
 
-PRODUTOS_JSON = DATA_DIR / "produtos.json"
+
+def _carregar_sistema():
+    """Sistema_nfe (o arquivo tem dois pontos no nome: carrega pelo caminho)."""
+    if "Sistema_nfe" in sys.modules:
+        return sys.modules["Sistema_nfe"]
+    spec = importlib.util.spec_from_file_location("Sistema_nfe", BASE_DIR / "Sistema_nfe.py.py")
+    mod = importlib.util.module_from_spec(spec)
+    sys.modules["Sistema_nfe"] = mod
+    spec.loader.exec_module(mod)
+    return mod
+
+
+# produtos.json é do Sistema_nfe ({"seq", "items"} + produtos.json.journal):
+# leitura e gravação passam por load_store/save_store, com a mesma trava e o
+# mesmo controle de versão do menu, da CLI e da API
+nfe = _carregar_sistema()
+ConflitoVersao = nfe.ConflitoVersao
+
+DATA_DIR = nfe.DATA_DIR
+PRODUTOS_JSON = nfe.FILE_PRODUTOS
 AUDIT_LOG = DATA_DIR / "audit.log"
 
 DEFAULT_FILIAL = "001-Matriz"
@@ -54,14 +74,29 @@ def read_last_audit(n: int = 8) -> list[str]:
         return []
 
 
-def load_produtos() -> list[dict]:
-    """Carrega produtos do JSON. Se não existir, retorna lista vazia."""
-    if not PRODUTOS_JSON.exists():
-        return []
+# store lido no último load_produtos e os ids que ele tinha (para o save)
+_LIDO: dict = {"store": None, "ids": set()}
 
-    try:
+
+def _converter_lista_antiga() -> None:
+    """produtos.json gravado pelas versões antigas da GUI (só a lista) vira {"seq", "items"}."""
+    with PRODUTOS_JSON.open("rb") as f:
+        if not f.read(64).lstrip().startswith(b"["):
+            return
+    with nfe.trava_dados():
         data = json.loads(PRODUTOS_JSON.read_text(encoding="utf-8"))
-        return data if isinstance(data, list) else []
+        if isinstance(data, list):
+            seq = max((int(p.get("id", 0)) for p in data), default=0)
+            nfe.save_store(PRODUTOS_JSON, {"seq": seq, "items": data})
+
+
+def load_produtos() -> list[dict]:
+    """Carrega produtos do JSON (snapshot + journal). Se não existir, retorna lista vazia."""
+    _LIDO.update(store=None, ids=set())
+    try:
+        if PRODUTOS_JSON.exists():
+            _converter_lista_antiga()
+        store = nfe.load_store(PRODUTOS_JSON)
     except json.JSONDecodeError:
         # Backup do arquivo corrompido e retorna vazio
         DATA_DIR.mkdir(parents=True, exist_ok=True)
@@ -71,14 +106,31 @@ def load_produtos() -> list[dict]:
             encoding="utf-8",
         )
         return []
+    _LIDO.update(store=store, ids={int(p.get("id", 0)) for p in store["items"]})
+    return store["items"]
 
 
 def save_produtos(produtos: list[dict]) -> None:
-    """Salva lista de produtos no JSON (write atômico)."""
-    DATA_DIR.mkdir(parents=True, exist_ok=True)
-    tmp = DATA_DIR / "produtos.tmp.json"
-    tmp.write_text(json.dumps(produtos, ensure_ascii=False, indent=2), encoding="utf-8")
-    tmp.replace(PRODUTOS_JSON)
+    """
+    Grava a lista de produtos pelo save_store do Sistema_nfe: só o que mudou
+    desde o load_produtos vai para o journal, e o que outros processos
+    gravaram nesse meio é incorporado. Produto novo recebe o próximo id livre
+    (o dict é atualizado); produto alterado aqui e lá fora levanta
+    ConflitoVersao - recarregue e repita.
+    """
+    store = _LIDO["store"]
+    if store is None:
+        # arquivo corrompido (ou nunca lido): a lista passa a ser o conteúdo
+        seq = max((int(p.get("id", 0)) for p in produtos), default=0)
+        nfe.save_store(PRODUTOS_JSON, {"seq": seq, "items": produtos})
+        load_produtos()
+        return
+    for p in produtos:
+        if int(p.get("id", 0)) not in _LIDO["ids"]:
+            p["id"] = nfe.next_id(store)
+    store["items"] = produtos
+    nfe.save_store(PRODUTOS_JSON, store)
+    _LIDO["ids"] = {int(p.get("id", 0)) for p in store["items"]}
 
 
 # =========================
@@ -1071,7 +1123,13 @@ class CadastroProdutoScreen(ctk.CTkFrame):
         if not updated:
             self._produtos_cache.append(produto)
 
-        save_produtos(self._produtos_cache)
+        try:
+            save_produtos(self._produtos_cache)
+        except ConflitoVersao as e:
+            self._produtos_cache = load_produtos()
+            self._set_app_status("Produto alterado em outro terminal: recarregado.")
+            messagebox.showwarning("Conflito", f"{e}\n\nOs dados foram recarregados; refaça a alteração.")
+            return
 
         msg = f"Produto {'atualizado' if updated else 'salvo'}: {produto['sku']}"
         self._set_app_status(msg)
@@ -1328,7 +1386,12 @@ class ListarProdutosScreen(ctk.CTkFrame):
         else:
             found["inativado_at"] = ""
 
-        save_produtos(produtos)
+        try:
+            save_produtos(produtos)
+        except ConflitoVersao as e:
+            self.reload()
+            messagebox.showwarning("Conflito", f"{e}\n\nA lista foi recarregada; repita a operação.")
+            return
         self.reload()
 
         msg = f"Produto {'ativado' if novo else 'inativado'}: {sku}"
@@ -0,0 +1,125 @@
+# Testes do Sistema_nfe (e dos módulos que dependem dele).
+# Rodar na raiz do projeto: python -m pytest -q tests
+import importlib.util
+import sys
+from pathlib import Path
+
+import pytest
+
+RAIZ = Path(__file__).resolve().parents[1]
+
+
+def carregar(nome: str, arquivo: str):
+    """Carrega um módulo da raiz pelo caminho (Sistema_nfe.py.py tem dois pontos no nome)."""
+    spec = importlib.util.spec_from_file_location(nome, RAIZ / arquivo)
+    mod = importlib.util.module_from_spec(spec)
+    sys.modules[nome] = mod
+    spec.loader.exec_module(mod)
+    return mod
+
+
+@pytest.fixture
+def nfe(tmp_path, monkeypatch):
+    """Sistema_nfe recém-carregado com a pasta de dados em tmp_path."""
+    monkeypatch.setenv("SISTEMA_NFE_DATA", str(tmp_path))
+    monkeypatch.delenv("SISTEMA_NFE_BACKEND", raising=False)
+    mod = carregar("Sistema_nfe", "Sistema_nfe.py.py")
+    mod.bootstrap_files()
+    yield mod
+    mod.aguardar_compactacoes()
+    sys.modules.pop("Sistema_nfe", None)
+
+
+def montar_base(nfe, n_prod: int = 30, seed: int = 0) -> None:
+    """Filial, duas pessoas, produtos com estoque e regras ST para SP -> outras UFs."""
+    import random
+    rnd = random.Random(seed)
+    nfe.write_json(nfe.FILE_FILIAIS, {"seq": 1, "items": [{"id": 1, "nome": "F1", "uf": "SP", "ativo": 1}]})
+    nfe.write_json(nfe.FILE_PESSOAS, {"seq": 2, "items": [
+        {"id": 1, "nome": "P1", "tipo": "C", "documento": "", "uf": "MG", "ind_ie_dest": 9, "ativo": 1},
+        {"id": 2, "nome": "P2", "tipo": "C", "documento": "", "uf": "SP", "ind_ie_dest": 1, "ativo": 1},
+    ]})
+    prods = [{
+        "id": i, "sku": f"SKU{i:05d}", "descricao": f"Produto {i}",
+        "ncm": rnd.choice(["85171231", "12345678"]), "cest": rnd.choice(["", "0210690"]),
+        "preco_venda": round(rnd.uniform(1, 500), 2), "flag_importado": rnd.choice([0, 1]), "ativo": 1,
+    } for i in range(1, n_prod + 1)]
+    nfe.write_json(nfe.FILE_PRODUTOS, {"seq": n_prod, "items": prods})
+    nfe.write_json(nfe.FILE_ESTOQUE, {"by_filial": {"1": {str(p["id"]): 10000.0 for p in prods}}})
+    regras = [{
+        "id": i + 1, "uf_origem": "SP", "uf_destino": d, "ncm": "85171231", "cest": "0210690", "cfop": "6102",
+        "mva": 40.0, "red_bc_st": 0.0, "aliq_icms_interna_dest": 18.0, "aliq_fcp_dest": 2.0,
+        "vig_ini": "2025-01-01", "vig_fim": "", "prioridade": 10, "ativo": 1,
+    } for i, d in enumerate(u for u in nfe.UFS_BRASIL if u != "SP")]
+    regras.append({
+        "id": len(regras) + 1, "uf_origem": "SP", "uf_destino": "MG", "ncm": "", "cest": "", "cfop": "",
+        "mva": 30.0, "red_bc_st": 10.0, "aliq_icms_interna_dest": None, "aliq_fcp_dest": None,
+        "vig_ini": "2025-01-01", "vig_fim": "2025-06-30", "prioridade": 5, "ativo": 1,
+    })
+    nfe.save_tabela_st_data({"seq": len(regras), "regras": regras})
+
+
+def jobs_nfs(n: int, n_prod: int = 30, itens: int = 4, seed: int = 1):
+    """Jobs de criar NF (formato de executar_job_nfs) com UFs, datas e CFOPs variados."""
+    import random
+    rnd = random.Random(seed)
+    jobs = []
+    for i in range(n):
+        uf = rnd.choice(["MG", "RJ", "BA", "SP"])
+        jobs.append({
+            "ref": f"J{i}", "tipo_operacao": "SAIDA", "filial_id": 1, "emitente_id": 2,
+            "destinatario_id": rnd.choice([1, 2]), "uf_origem": "SP", "uf_destino": uf,
+            "ind_final": rnd.choice([0, 1]),
+            "data_emissao": rnd.choice(["2025-03-10", "2025-06-30", "2025-07-15"]),
+            "itens": [{
+                "sku": f"SKU{rnd.randint(1, n_prod):05d}", "qtd": rnd.randint(1, 3),
+                "frete": round(rnd.uniform(0, 10), 2),
+            } for _ in range(itens)],
+        })
+    return jobs
+
+
+@pytest.fixture
+def reforma(tmp_path, monkeypatch):
+    """reforma_plus_v2_cfop_ibge (precisa do PySide6) com os dados do app em tmp_path."""
+    pytest.importorskip("PySide6")
+    monkeypatch.setenv("QT_QPA_PLATFORM", "offscreen")
+    monkeypatch.setenv("XDG_DATA_HOME", str(tmp_path))
+    mod = carregar("reforma_plus_v2_cfop_ibge", "reforma_plus_v2_cfop_ibge.py")
+    assert str(mod.app_data_dir()).startswith(str(tmp_path))
+    yield mod
+    sys.modules.pop("reforma_plus_v2_cfop_ibge", None)
+
+
+def produtos_reforma(reforma, n: int = 40, seed: int = 0):
+    """Bens e serviços com NCM/NBS variados (alguns em branco)."""
+    import random
+    rnd = random.Random(seed)
+    return [reforma.Product.from_dict({
+        "id": f"P{i}", "sku": f"SKU{i:04d}", "name": f"Produto {i}",
+        "kind": rnd.choice(["Bem", "Serviço"]),
+        "ncm": rnd.choice(["", "85171231", "22030000"]), "nbs": rnd.choice(["", "1.0101", "1.1502"]),
+        "price": round(rnd.uniform(1, 900), 2), "stock": 100,
+    }) for i in range(n)]
+
+
+def movimentos_reforma(reforma, n: int, n_prod: int = 40, seed: int = 1):
+    """Movimentações de vários tipos, meses e UFs; algumas sem data e de produto inexistente."""
+    import random
+    rnd = random.Random(seed)
+    out = []
+    for i in range(n):
+        base = rnd.uniform(0, 5000)
+        cbs, ibs, iss = base * 0.009, base * 0.001, rnd.choice([0.0, base * 0.05])
+        out.append(reforma.Movement.from_dict({
+            "id": f"M{i}",
+            "created_at": rnd.choice(["2025-01-05 10:00:00", "2025-02-11 09:30:00", "2025-03-20 18:00:00", ""]),
+            "product_id": f"P{rnd.randrange(n_prod + 2)}",
+            "mov_type": rnd.choice(["Saída", "Saída", "Entrada", "Ajuste"]),
+            "natureza": rnd.choice(["Venda", "Devolução", ""]), "finalidade": rnd.choice(["Normal", "Ajuste"]),
+            "cfop": rnd.choice(["5102", "6102", ""]), "dest_uf": rnd.choice(["SP", "mg", ""]),
+            "dest_city": rnd.choice(["São Paulo", "Belo Horizonte", ""]),
+            "qty": 1, "unit_price": base, "base_value": base, "cbs_value": cbs, "ibs_value": ibs,
+            "iss_value": iss, "total_taxes": cbs + ibs + iss, "total_value": base + cbs + ibs + iss,
+        }))
+    return out
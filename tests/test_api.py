@@ -0,0 +1,62 @@
+import sys
+
+import pytest
+
+from conftest import carregar, jobs_nfs, montar_base
+
+pytest.importorskip("fastapi")
+pytest.importorskip("httpx")
+from fastapi.testclient import TestClient  # noqa: E402
+
+
+@pytest.fixture
+def api(nfe):
+    montar_base(nfe)
+    main = carregar("main", "main.py")
+    with TestClient(main.app) as cli:
+        yield cli
+    sys.modules.pop("main", None)
+
+
+def _rascunho(nfe, api):
+    job = jobs_nfs(1)[0]
+    r = api.post("/nfs", json=job)
+    assert r.status_code == 201, r.text
+    return r.json()
+
+
+def test_itens_tudo_ou_nada(nfe, api):
+    nf = _rascunho(nfe, api)
+    n = len(nf["itens"])
+    r = api.post(f"/nfs/{nf['id']}/itens", json={"itens": [
+        {"sku": "SKU00001", "qtd": 1}, {"sku": "NAOEXISTE", "qtd": 1}]})
+    assert r.status_code == 422
+    assert "NAOEXISTE" in r.json()["erro"]
+    assert len(api.get(f"/nfs/{nf['id']}").json()["itens"]) == n
+    assert len(nfe.find_by_id(nfe.load_store(nfe.FILE_NFS), nf["id"])["itens"]) == n
+
+    r = api.post(f"/nfs/{nf['id']}/itens", json={"itens": [
+        {"sku": "SKU00001", "qtd": 1}, {"sku": "SKU00002", "qtd": 2}]})
+    assert r.status_code == 200, r.text
+    assert len(r.json()["itens"]) == n + 2
+
+
+def test_busca_total_real(api):
+    r = api.get("/produtos", params={"q": "produto", "offset": 5, "limit": 3})
+    corpo = r.json()
+    assert corpo["total"] == 30
+    assert [p["sku"] for p in corpo["items"]] == ["SKU00006", "SKU00007", "SKU00008"]
+
+    r = api.post("/produtos", json={"sku": "NOVO1", "descricao": "Produto novo", "ncm": "12345678", "preco_venda": 1})
+    assert r.status_code == 201, r.text
+    assert api.get("/produtos", params={"q": "novo"}).json()["total"] == 1
+
+
+def test_lote_limita_faixa(api):
+    r = api.post("/nfs/lote/calcular", json={"ids": "1-1000000000"})
+    assert r.status_code == 422
+    r = api.post("/nfs/lote/calcular", json={"ids": "1-x"})
+    assert r.status_code == 422
+    r = api.post("/nfs/lote/calcular", json={"ids": "999-1000"})
+    assert r.status_code == 200
+    assert r.json()["falhas"] == 2
@@ -0,0 +1,43 @@
+import json
+import sys
+
+import pytest
+
+from conftest import carregar
+
+
+@pytest.fixture
+def bench(tmp_path, monkeypatch):
+    """benchmark_nfe; carregar_sistema troca SISTEMA_NFE_DATA e sys.modules["Sistema_nfe"]."""
+    monkeypatch.setenv("SISTEMA_NFE_DATA", str(tmp_path / "data"))
+    monkeypatch.delenv("SISTEMA_NFE_BACKEND", raising=False)
+    mod = carregar("benchmark_nfe", "benchmark_nfe.py")
+    yield mod
+    sys.modules.pop("benchmark_nfe", None)
+    sys.modules.pop("Sistema_nfe", None)
+
+
+def test_menor_tier_roda_e_grava_resultado(bench, tmp_path, capsys):
+    tier = min(bench.TIERS, key=lambda t: bench.TIERS[t]["nfs"])
+    saida = tmp_path / "bench.json"
+    assert bench.main(["--tiers", tier, "--repeticoes", "1", "--saida", str(saida)]) == 0
+    assert f"== tier {tier}:" in capsys.readouterr().out
+
+    res = json.loads(saida.read_text(encoding="utf-8"))
+    dados = res["tiers"][tier]
+    assert dados["base"]["nfs"] == bench.TIERS[tier]["nfs"]
+    casos = dados["casos"]
+    for caso in ("escolher_regra_st", "search_produtos", "calcular_nf", "calcular_nf_incremental",
+                 "calcular_nfs_lote", "emitir_nf", "cancelar_nf", "write_json_nfs", "exportar_html"):
+        assert casos[caso]["n"] > 0 and casos[caso]["ms_op"] is not None, caso
+    assert casos["exportar_html"]["n"] == bench.TIERS[tier]["nfs"]
+    assert {ln["status"] for ln in bench.comparar(res, res, bench.LIMITE_PADRAO)} == {"ok"}
+
+
+def test_tier_invalido(bench, tmp_path, capsys):
+    for argv in (["--gerar", str(tmp_path / "base"), "--tier", "xg"], ["--tiers", "p,xg"]):
+        with pytest.raises(SystemExit) as exc:
+            bench.main(argv)
+        assert exc.value.code == 2
+        assert "xg" in capsys.readouterr().err
+    assert not (tmp_path / "base").exists()
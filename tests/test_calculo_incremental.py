@@ -0,0 +1,102 @@
+import copy
+
+from conftest import jobs_nfs, montar_base
+
+
+def _calcular_completo(nfe, nfs):
+    """Recálculo completo de cópias das NFs (referência)."""
+    ref = copy.deepcopy(nfs)
+    pes = nfe.load_store(nfe.FILE_PESSOAS)
+    prod = nfe.load_store(nfe.FILE_PRODUTOS)
+    for nf in ref:
+        dest = nfe.find_by_id(pes, int(nf["destinatario_id"]))
+        nfe.aplicar_calculo_nf(
+            nf, nfe.load_contexto_fiscal(), nfe.load_tabela_st(), int(dest.get("ind_ie_dest", 9)),
+            lambda pid: int(nfe.find_by_id(prod, pid).get("flag_importado", 0)), completo=True)
+    return ref
+
+
+def _sem_calc(nf):
+    return {**nf, "itens": [{k: v for k, v in it.items() if k != "calc"} for it in nf["itens"]], "somas": None}
+
+
+def test_incremental_igual_ao_completo(nfe, capsys):
+    montar_base(nfe)
+    res = nfe.executar_job_nfs(jobs_nfs(30, itens=6))
+    ids = [r["nf_id"] for r in res]
+    for nf_id in ids:
+        nfe.calcular_nf(nf_id)
+
+    # altera itens de algumas NFs (fora do store aberto, como outro terminal)
+    st = nfe.load_store(nfe.FILE_NFS)
+    alteradas = []
+    for nf in st["items"][::3]:
+        nf["itens"][0]["qtd"] = float(nf["itens"][0]["qtd"]) + 1
+        nf["itens"][-1]["desconto"] = 0.37
+        alteradas.append(nf)
+    nfe.save_store(nfe.FILE_NFS, st, changed=alteradas)
+
+    for nf_id in ids:
+        nfe.calcular_nf(nf_id)
+    saida = capsys.readouterr().out
+    assert "Itens recalculados: 2 de 6" in saida and "Itens recalculados: 0 de 6" in saida
+
+    nfs = nfe.load_store(nfe.FILE_NFS)["items"]
+    ref = _calcular_completo(nfe, nfs)
+    for nf, esperado in zip(nfs, ref):
+        assert nf["totais"] == esperado["totais"] == nfe.totais_nf(nf["itens"])
+        assert _sem_calc(nf) == _sem_calc(esperado)
+
+
+def test_calcular_nf_nao_recarrega_os_stores(nfe, monkeypatch):
+    montar_base(nfe)
+    ids = [r["nf_id"] for r in nfe.executar_job_nfs(jobs_nfs(5))]
+    nfe.calcular_nf(ids[0])
+
+    cargas = []
+    load_store = nfe.load_store
+    monkeypatch.setattr(nfe, "load_store", lambda path: cargas.append(path) or load_store(path))
+    for nf_id in ids:
+        nfe.calcular_nf(nf_id, completo=True)
+        nfe.calcular_nf(nf_id)
+    assert cargas == []
+
+    # gravação de outro processo chega ao store aberto pelo journal
+    st = load_store(nfe.FILE_NFS)
+    st["items"][0]["itens"][0]["qtd"] = 50.0
+    nfe.save_store(nfe.FILE_NFS, st, changed=[st["items"][0]])
+    nfe.calcular_nf(int(st["items"][0]["id"]))
+    nf = nfe.find_by_id(load_store(nfe.FILE_NFS), int(st["items"][0]["id"]))
+    assert nf["itens"][0]["qtd"] == 50.0
+    assert nf["totais"] == nfe.totais_nf(nf["itens"])
+
+
+def test_emitir_e_cancelar_nao_recarregam_store_nem_estoque(nfe, monkeypatch):
+    montar_base(nfe)
+    ids = [r["nf_id"] for r in nfe.executar_job_nfs(jobs_nfs(6), calcular=True)]
+    nfe.emitir_nf(ids[0])
+
+    cargas = []
+    load_store, load_estoque = nfe.load_store, nfe.load_estoque
+    monkeypatch.setattr(nfe, "load_store", lambda path: cargas.append(path) or load_store(path))
+    monkeypatch.setattr(nfe, "load_estoque", lambda: cargas.append("estoque") or load_estoque())
+    for nf_id in ids[1:]:
+        nfe.emitir_nf(nf_id)
+    nfe.cancelar_nf(ids[2])
+    assert cargas == []
+
+    # movimento de estoque gravado por fora chega ao estoque aberto pelo ledger
+    est = load_estoque()
+    nfe.set_stock(est, 1, 1, 3.0)
+    nfe.save_estoque(est)
+    nfe.cancelar_nf(ids[3])
+    assert nfe.estoque_aberto()["by_filial"] == load_estoque()["by_filial"]
+
+    # emissão que falha no meio (2º item sem saldo) não deixa movimento no estoque aberto
+    job = {**jobs_nfs(1)[0], "itens": [{"sku": "SKU00002", "qtd": 1}, {"sku": "SKU00001", "qtd": 500}]}
+    nf_id = nfe.executar_job_nfs([job])[0]["nf_id"]
+    nfe.emitir_nf(nf_id)
+    assert nfe.find_by_id(load_store(nfe.FILE_NFS), nf_id)["status"] == "RASCUNHO"
+    assert nfe.estoque_aberto()["by_filial"] == load_estoque()["by_filial"]
+    assert [nfe.find_by_id(load_store(nfe.FILE_NFS), i)["status"] for i in ids] == [
+        "EMITIDA", "EMITIDA", "CANCELADA", "CANCELADA", "EMITIDA", "EMITIDA"]
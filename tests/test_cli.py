@@ -0,0 +1,96 @@
+import json
+
+import pytest
+
+from conftest import jobs_nfs, montar_base
+
+
+def _cli(nfe, capsys, *argv):
+    codigo = nfe.cli(list(argv))
+    saida = json.loads(capsys.readouterr().out)
+    assert saida["comando"] == argv[0]
+    assert saida["total"] == len(saida["resultados"])
+    return codigo, saida
+
+
+@pytest.fixture
+def base(nfe, tmp_path):
+    montar_base(nfe)
+    job = tmp_path / "job.json"
+    job.write_text(json.dumps({"nfs": jobs_nfs(5)}), encoding="utf-8")
+    return job
+
+
+def test_criar_calcular_emitir_cancelar(nfe, capsys, base):
+    codigo, saida = _cli(nfe, capsys, "criar-nf", str(base))
+    assert codigo == 0 and saida["ok"] and saida["falhas"] == 0
+    assert [r["nf_id"] for r in saida["resultados"]] == [1, 2, 3, 4, 5]
+    assert all(r["status"] == "RASCUNHO" for r in saida["resultados"])
+
+    codigo, saida = _cli(nfe, capsys, "calcular", "1-3,5")
+    assert codigo == 0 and [r["nf_id"] for r in saida["resultados"]] == [1, 2, 3, 5]
+    codigo, saida = _cli(nfe, capsys, "emitir", "1,2")
+    assert codigo == 0 and all(r["ok"] and "msg" in r for r in saida["resultados"])
+    assert nfe.find_by_id(nfe.load_store(nfe.FILE_NFS), 2)["status"] == "EMITIDA"
+
+    codigo, saida = _cli(nfe, capsys, "cancelar", "2,99")
+    assert codigo == 1 and not saida["ok"] and saida["falhas"] == 1
+    assert saida["resultados"][0]["ok"] and "erro" in saida["resultados"][1]
+    assert nfe.find_by_id(nfe.load_store(nfe.FILE_NFS), 2)["status"] == "CANCELADA"
+
+
+def test_ids_invalidos_e_job_invalido(nfe, capsys, base, tmp_path):
+    codigo, saida = _cli(nfe, capsys, "emitir", "1-x")
+    assert codigo == 1 and saida["resultados"] == [] and "erro" in saida
+    ruim = tmp_path / "ruim.json"
+    ruim.write_text('{"nfs": 3}', encoding="utf-8")
+    codigo, saida = _cli(nfe, capsys, "criar-nf", str(ruim))
+    assert codigo == 1 and "job inválido" in saida["erro"]
+
+
+def test_criar_com_emissao_e_adicionar_itens(nfe, capsys, base, tmp_path):
+    codigo, saida = _cli(nfe, capsys, "criar-nf", str(base), "--emitir")
+    assert codigo == 0 and all(r["status"] == "EMITIDA" for r in saida["resultados"])
+
+    _cli(nfe, capsys, "criar-nf", str(base))  # NFs 6-10 em rascunho
+    itens = tmp_path / "itens.json"
+    itens.write_text(json.dumps({"itens": [
+        {"nf_id": 6, "sku": "SKU00001", "qtd": 2}, {"nf_id": 1, "sku": "SKU00002", "qtd": 1}]}), encoding="utf-8")
+    codigo, saida = _cli(nfe, capsys, "adicionar-itens", str(itens))
+    assert codigo == 1 and saida["falhas"] == 1
+    assert saida["resultados"][0]["ok"] and not saida["resultados"][1]["ok"]
+
+
+def test_exportar_lista_de_ids_nao_continua(nfe, capsys, base, tmp_path):
+    _cli(nfe, capsys, "criar-nf", str(base), "--calcular")
+    destino = tmp_path / "exp"
+    codigo, saida = _cli(nfe, capsys, "exportar", "--destino", str(destino), "--ids", "1,3,5")
+    assert codigo == 0 and saida["resultados"][0]["nfs"] == 3
+    assert sorted(p.name for p in destino.iterdir()) == ["index.html", "nf_000001.html", "nf_000003.html", "nf_000005.html"]
+
+    codigo, saida = _cli(nfe, capsys, "exportar", "--destino", str(tmp_path / "nada"), "--ids", "90-99")
+    assert codigo == 1 and saida["resultados"] == [{"ok": False, "erro": "Nenhuma NF exportada."}]
+
+
+def test_relatorio_resumo_simulacao_e_metricas(nfe, capsys, base, tmp_path):
+    saida_arq = tmp_path / "saida.json"
+    assert nfe.cli(["--metricas", "--saida", str(saida_arq), "criar-nf", str(base), "--emitir"]) == 0
+    assert capsys.readouterr().out == ""
+    assert json.loads(saida_arq.read_text(encoding="utf-8"))["ok"]
+
+    codigo, saida = _cli(nfe, capsys, "relatorio-fiscal", "--por", "uf_destino")
+    assert codigo == 0 and sum(r["nfs"] for r in saida["resultados"]) == 5
+    codigo, saida = _cli(nfe, capsys, "relatorio-fiscal", "--por", "nada")
+    assert codigo == 1 and "dimensão inválida" in saida["erro"]
+
+    codigo, saida = _cli(nfe, capsys, "reconstruir-resumo")
+    assert codigo == 0 and saida["resultados"][0]["nfs"] == 5
+
+    regras = tmp_path / "regras.json"
+    regras.write_text(json.dumps(nfe.load_tabela_st_data()), encoding="utf-8")
+    codigo, saida = _cli(nfe, capsys, "simular-st", str(regras))
+    assert codigo == 0
+    assert saida["resultados"][0]["nfs"] == 5 and saida["resultados"][0]["nfs_afetadas"] == 0
+
+    codigo, saida = _cli(nfe, capsys, "metricas", "--op", "executar_job_nfs")
+    assert codigo == 0 and saida["resultados"][0]["op"] == "executar_job_nfs"
@@ -0,0 +1,39 @@
+import json
+import sys
+
+import pytest
+
+from conftest import carregar
+
+pytest.importorskip("customtkinter")
+
+
+@pytest.fixture
+def gui(nfe):
+    mod = carregar("sistema_gui_principal", "sistema_gui_principal.py")
+    yield mod
+    sys.modules.pop("sistema_gui_principal", None)
+
+
+def test_lista_antiga_vira_store_e_save_usa_journal(nfe, gui):
+    gui.PRODUTOS_JSON.write_text(json.dumps([{"id": 1, "sku": "A"}, {"id": 3, "sku": "C"}]), encoding="utf-8")
+    produtos = gui.load_produtos()
+    assert [p["sku"] for p in produtos] == ["A", "C"]
+    produtos.append({"id": 2, "sku": "N"})  # id do formulário (max+1 da tela)
+    gui.save_produtos(produtos)
+    assert produtos[-1]["id"] == 4  # próximo id livre do store (seq)
+    assert nfe._journal_path(gui.PRODUTOS_JSON).exists()
+    assert [(p["id"], p["sku"]) for p in nfe.load_store(gui.PRODUTOS_JSON)["items"]] == [(1, "A"), (3, "C"), (4, "N")]
+
+
+def test_mesmo_produto_alterado_em_dois_terminais(nfe, gui):
+    nfe.save_store(gui.PRODUTOS_JSON, {"seq": 1, "items": [{"id": 1, "sku": "A", "preco_venda": 1.0}]})
+    produtos = gui.load_produtos()
+    outro = nfe.load_store(gui.PRODUTOS_JSON)
+    outro["items"][0]["preco_venda"] = 2.0
+    nfe.save_store(gui.PRODUTOS_JSON, outro)
+
+    produtos[0]["preco_venda"] = 3.0
+    with pytest.raises(gui.ConflitoVersao):
+        gui.save_produtos(produtos)
+    assert gui.load_produtos()[0]["preco_venda"] == 2.0
@@ -0,0 +1,131 @@
+import csv
+
+import pytest
+
+from conftest import montar_base
+
+CAB_PRODUTOS = ["sku", "descricao", "ncm", "cest", "preco_venda", "flag_importado"]
+CAB_ST = ["uf_origem", "uf_destino", "ncm", "cest", "cfop", "mva", "red_bc_st", "aliq_icms_interna_dest",
+          "aliq_fcp_dest", "vig_ini", "vig_fim", "prioridade", "ativo"]
+
+
+def _csv(path, cab, linhas):
+    with path.open("w", encoding="utf-8", newline="") as f:
+        w = csv.writer(f, delimiter=";")
+        w.writerow(cab)
+        w.writerows(linhas)
+    return path
+
+
+def _recusas(path):
+    rej = path.with_suffix(".rejeitados.csv")
+    if not rej.exists():
+        return None
+    with rej.open(encoding="utf-8", newline="") as f:
+        return [(int(r["linha"]), r["motivo"]) for r in csv.DictReader(f, delimiter=";")]
+
+
+def _produtos(nfe):
+    return {p["sku"]: {k: p[k] for k in ["id"] + CAB_PRODUTOS} for p in nfe.load_store(nfe.FILE_PRODUTOS)["items"]}
+
+
+def _linhas_produtos(nfe):
+    p1 = nfe.find_by_sku(nfe.load_store(nfe.FILE_PRODUTOS), "SKU00001")
+    return [
+        ["NOVO1", "Novo 1", "85171231", "", "10,5", "0"],                                   # 2 inserido
+        ["sku00002", "Trocado", "12345678", "", "99", "1"],                                 # 3 SKU existente
+        [p1["sku"], p1["descricao"], p1["ncm"], p1["cest"], str(p1["preco_venda"]), str(p1["flag_importado"])],  # 4
+        ["", "Sem SKU", "", "", "1", "0"],                                                  # 5
+        ["NOVO2", "Novo 2", "", "", "-3", "0"],                                             # 6
+        ["NOVO3", "Novo 3", "", "", "abc", "0"],                                            # 7
+        ["NOVO4", "Novo 4", "", "", "4", "x"],                                              # 8
+        ["novo1", "Novo 1 de novo", "85171231", "", "11", "1"],                             # 9 repetido no arquivo
+        ["NOVO5", "Novo 5", "", "", "5", "0"],                                              # 10
+    ]
+
+
+@pytest.mark.parametrize("lote", [1, 2, 5000])
+def test_produtos_motivos_repetidos_e_lotes(nfe, tmp_path, monkeypatch, capsys, lote):
+    montar_base(nfe)
+    antes = _produtos(nfe)
+    arq = _csv(tmp_path / "produtos.csv", CAB_PRODUTOS, _linhas_produtos(nfe))
+
+    gravacoes = []
+    save_store = nfe.save_store
+    monkeypatch.setattr(nfe, "save_store", lambda *a, **kw: (gravacoes.append(len(kw["changed"])), save_store(*a, **kw)))
+    nfe.import_produtos_csv(str(arq), lote=lote)
+    assert "Inseridos: 2 | Atualizados: 2" in capsys.readouterr().out
+
+    assert _recusas(arq) == [(5, "sku vazio"), (6, "preco_venda negativo"), (7, "preco_venda não numérico"),
+                             (8, "flag_importado não inteiro")]
+    # uma gravação por lote com alteração; NOVO1 (linhas 2 e 9) conta uma vez por lote
+    assert gravacoes == {1: [1, 1, 1, 1], 2: [2, 1, 1], 5000: [3]}[lote]
+
+    depois = _produtos(nfe)
+    assert len(depois) == len(antes) + 2
+    assert depois["SKU00001"] == antes["SKU00001"]
+    assert depois["SKU00002"] == {**antes["SKU00002"], "descricao": "Trocado", "ncm": "12345678", "cest": "",
+                                  "preco_venda": 99.0, "flag_importado": 1}
+    assert depois["NOVO1"] == {"id": 31, "sku": "NOVO1", "descricao": "Novo 1 de novo", "ncm": "85171231",
+                               "cest": "", "preco_venda": 11.0, "flag_importado": 1}
+    assert depois["NOVO5"]["id"] == 32
+    assert nfe.search_produtos("NOVO5")[0]["id"] == 32
+
+
+def test_rejeitados_da_importacao_anterior_sao_apagados(nfe, tmp_path, capsys):
+    montar_base(nfe)
+    arq = _csv(tmp_path / "produtos.csv", CAB_PRODUTOS, [["", "Sem SKU", "", "", "1", "0"]])
+    nfe.import_produtos_csv(str(arq))
+    assert _recusas(arq) == [(2, "sku vazio")]
+    capsys.readouterr()
+
+    _csv(arq, CAB_PRODUTOS, [["OK1", "Ok", "", "", "1", "0"]])
+    nfe.import_produtos_csv(str(arq))
+    assert _recusas(arq) is None
+    assert "Linhas recusadas" not in capsys.readouterr().out
+
+
+def _regra(uf_de="RJ", ncm="11111111", **kw):
+    r = {"uf_origem": "SP", "uf_destino": uf_de, "ncm": ncm, "cest": "", "cfop": "6102", "mva": "35",
+         "red_bc_st": "0", "aliq_icms_interna_dest": "", "aliq_fcp_dest": "", "vig_ini": "2025-01-01",
+         "vig_fim": "", "prioridade": "1", "ativo": "1", **kw}
+    return [r[c] for c in CAB_ST]
+
+
+def test_regras_st_motivos_repetidas_e_lotes(nfe, tmp_path, capsys):
+    montar_base(nfe)
+    antes = nfe.load_tabela_st_data()
+    n_antes = len(antes["regras"])
+    linhas = [
+        _regra(),                                                                    # 2 importada
+        _regra(uf_de="MG", ncm="85171231", cest="0210690", mva="40", aliq_icms_interna_dest="18",
+               aliq_fcp_dest="2", prioridade="10"),                                  # 3 igual a uma cadastrada
+        _regra(uf_de=""),                                                            # 4
+        _regra(uf_de="XX"),                                                          # 5
+        _regra(vig_ini="01/02/2025"),                                                # 6
+        _regra(mva="muito"),                                                         # 7
+        _regra(mva="35.0"),                                                          # 8 repetida no arquivo
+        _regra(uf_de="BA"),                                                          # 9 importada
+        _regra(uf_de="BA", prioridade="2"),                                          # 10 importada
+    ]
+    arq = _csv(tmp_path / "st.csv", CAB_ST, linhas)
+    nfe.import_st_regras_csv(str(arq), lote=3)
+    assert "Regras ST importadas: 3" in capsys.readouterr().out
+
+    assert _recusas(arq) == [(3, "regra duplicada (mesma assinatura)"), (4, "uf_origem/uf_destino vazia"),
+                             (5, "uf_destino inválida"), (6, "vig_ini fora do formato YYYY-MM-DD"),
+                             (7, "mva não numérico"), (8, "regra duplicada (mesma assinatura)")]
+    depois = nfe.load_tabela_st_data()
+    assert depois["regras"][:n_antes] == antes["regras"]
+    novas = depois["regras"][n_antes:]
+    assert [r["id"] for r in novas] == [antes["seq"] + 1, antes["seq"] + 2, antes["seq"] + 3]
+    assert [(r["uf_destino"], r["prioridade"]) for r in novas] == [("RJ", 1), ("BA", 1), ("BA", 2)]
+    assert depois["seq"] == antes["seq"] + 3
+    assert nfe.load_tabela_st() is not None and len(nfe.load_tabela_st()) == n_antes + 3
+
+    # lote de 1 e lote padrão gravam a mesma tabela
+    for lote in (1, nfe.IMPORT_LOTE):
+        nfe.save_tabela_st_data(antes)
+        nfe.import_st_regras_csv(str(arq), lote=lote)
+        assert nfe.load_tabela_st_data()["regras"] == depois["regras"]
+        assert len(_recusas(arq)) == 6
@@ -0,0 +1,100 @@
+import pytest
+
+
+def _dobro(itens):
+    return [x * 2 for x in itens]
+
+
+def _quebra(itens):
+    raise AttributeError("erro de verdade no bloco")
+
+
+def test_em_pool_funcao_local_roda_no_processo(nfe, capsys):
+    itens = list(range(4 * nfe.LOTE_MIN_POR_PROCESSO))
+    assert nfe._em_pool(lambda xs: [x + 1 for x in xs], itens, 2) == [x + 1 for x in itens]
+    assert "pool de processos indisponível" in capsys.readouterr().out
+    assert nfe._em_pool(_dobro, itens, 2) == [x * 2 for x in itens]
+
+
+def test_em_pool_nao_esconde_erro_de_func(nfe, capsys):
+    itens = list(range(4 * nfe.LOTE_MIN_POR_PROCESSO))
+    with pytest.raises(AttributeError, match="erro de verdade"):
+        nfe._em_pool(_quebra, itens, 2)
+    assert "indisponível" not in capsys.readouterr().out
+
+
+def test_impostos_lote_igual_ao_item(nfe):
+    import random
+
+    from conftest import montar_base
+
+    pytest.importorskip("numpy")
+    montar_base(nfe)
+    tabela_uf, regras = nfe.load_contexto_fiscal(), nfe.load_tabela_st()
+    rnd = random.Random(3)
+    linhas = [{
+        "uf_origem": rnd.choice(["SP", "sp", "MG", "PR"]), "uf_destino": rnd.choice(nfe.UFS_BRASIL),
+        "ind_final": rnd.choice([0, 1]), "ind_ie_dest": rnd.choice([1, 2, 9]),
+        "flag_importado": rnd.choice([0, 1]),
+        "data_emissao": rnd.choice(["2024-12-31", "2025-03-10", "2025-06-30", "2025-07-15"]),
+        "cfop": rnd.choice(["6102", "5102", ""]), "ncm": rnd.choice(["85171231", "12345678"]),
+        "cest": rnd.choice(["0210690", ""]),
+        "v_operacao": rnd.choice([0.0, 0.01, 0.005, 1.125, round(rnd.uniform(0, 20000), 2), rnd.uniform(0, 999)]),
+        "aplicar_st": rnd.choice([0, 1, 1]),
+    } for _ in range(4 * nfe.VETOR_MIN_ITENS)]
+
+    lote = nfe.calcular_impostos_lote(linhas, tabela_uf, regras)
+    assert any(o["st"] for o in lote) and any(o["difal"] for o in lote)
+    for ln, out in zip(linhas, lote):
+        assert out == nfe.calcular_impostos_item(tabela_uf=tabela_uf, tabela_st_regras=regras, **ln), ln
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_exportar_lote_igual_a_exportacao_de_cada_nf(nfe, tmp_path, monkeypatch, capsys, workers):
+    import re
+    import zipfile
+
+    from conftest import jobs_nfs, montar_base
+
+    montar_base(nfe)
+    res = nfe.executar_job_nfs(jobs_nfs(8), calcular=True)
+    for r in res[:5]:
+        nfe.emitir_nf(r["nf_id"])
+    nfe.cancelar_nf(res[2]["nf_id"])
+    monkeypatch.setattr(nfe, "LOTE_MIN_POR_PROCESSO", 1)  # workers=2 usa o pool mesmo com poucas NFs
+
+    ids = [1, 3, 4, 6, 8]
+    avulsas = {}
+    for nf_id in ids:
+        out = tmp_path / f"avulsa_{nf_id}.html"
+        nfe.export_nf_html(nf_id, str(out))
+        avulsas[nfe.nome_arquivo_nf({"id": nf_id}, "html")] = out.read_bytes()
+
+    pasta = tmp_path / "pasta"
+    r_pasta = nfe.exportar_nfs_lote(str(pasta), ids=ids, status=["EMITIDA", "CANCELADA", "RASCUNHO"], workers=workers)
+    r_zip = nfe.exportar_nfs_lote(str(tmp_path / "sub" / "lote.zip"), ids=ids, workers=workers)
+    assert "pool de processos indisponível" not in capsys.readouterr().out
+    assert r_pasta["nfs"] == r_zip["nfs"] == len(ids)
+    assert r_pasta["arquivos"] == r_zip["arquivos"] == sorted(avulsas)
+
+    with zipfile.ZipFile(tmp_path / "sub" / "lote.zip") as zf:
+        no_zip = {n: zf.read(n) for n in zf.namelist()}
+    na_pasta = {p.name: p.read_bytes() for p in pasta.iterdir()}
+    assert sorted(na_pasta) == sorted(no_zip) == sorted([*avulsas, "index.html"])
+    for nome, dados in avulsas.items():
+        assert na_pasta[nome] == no_zip[nome] == dados, nome
+
+    def sem_hora(b):
+        return re.sub(r"Gerado em [^<]*", "", b.decode("utf-8"))
+
+    indice = sem_hora(na_pasta["index.html"])
+    assert indice == sem_hora(no_zip["index.html"])
+    assert "NFs exportadas: 5" in indice
+    assert re.findall(r"href='([^']+)'", indice) == sorted(avulsas)
+    store = nfe.load_store(nfe.FILE_NFS)
+    linhas = re.findall(r"<tr><td>(\d+)</td>.*?<td>(\w+)</td><td>[A-Z]{2} ->", indice)
+    assert linhas == [(str(i), nfe.find_by_id(store, i)["status"]) for i in ids]
+
+    # filtro de status junto com ids
+    so_emitidas = nfe.exportar_nfs_lote(str(tmp_path / "emitidas"), ids=ids, status=["EMITIDA"], workers=workers)
+    assert so_emitidas["arquivos"] == ["nf_000001.html", "nf_000004.html"]
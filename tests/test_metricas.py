@@ -0,0 +1,59 @@
+import json
+import threading
+
+from conftest import jobs_nfs, montar_base
+
+
+def _linhas(nfe):
+    if not nfe.FILE_METRICAS.exists():
+        return []
+    return [json.loads(l) for l in nfe.FILE_METRICAS.read_text(encoding="utf-8").splitlines()]
+
+
+def test_desligadas_nao_gravam_nem_contam(nfe):
+    montar_base(nfe)
+    nf_id = nfe.executar_job_nfs(jobs_nfs(1))[0]["nf_id"]
+    nfe.calcular_nf(nf_id)
+    assert _linhas(nfe) == []
+    assert not hasattr(nfe.load_tabela_st().indice, "examinadas")
+
+
+def test_ligadas_gravam_fases_da_operacao(nfe):
+    montar_base(nfe)
+    job = {**jobs_nfs(1)[0], "uf_destino": "MG", "data_emissao": "2025-03-10"}
+    nf_id = nfe.executar_job_nfs([job])[0]["nf_id"]
+    nfe.ativar_metricas()
+    try:
+        nfe.calcular_nf(nf_id, completo=True)
+    finally:
+        nfe.desativar_metricas()
+    nfe.calcular_nf(nf_id, completo=True)
+
+    linhas = _linhas(nfe)
+    assert [l["op"] for l in linhas] == ["calcular_nf"]
+    fases = linhas[0]["fases"]
+    assert fases["st.regra"]["n"] == 4
+    assert fases["st.regra"]["examinadas"] >= 4
+    assert "impostos.item" in fases
+
+
+def test_outra_thread_nao_entra_na_operacao(nfe):
+    def fora():
+        nfe.write_json(nfe.DATA_DIR / "x.json", {})
+        nfe.read_json(nfe.DATA_DIR / "x.json", {})
+
+    @nfe.medir_operacao
+    def operacao():
+        th = threading.Thread(target=fora)
+        th.start()
+        th.join()
+        nfe.read_json(nfe.FILE_FILIAIS, {})
+
+    nfe.ativar_metricas()
+    try:
+        operacao()
+    finally:
+        nfe.desativar_metricas()
+    (linha,) = _linhas(nfe)
+    assert linha["op"] == "operacao"
+    assert linha["fases"] == {"json.read": {"n": 1, "s": linha["fases"]["json.read"]["s"]}}
@@ -0,0 +1,81 @@
+import random
+
+
+NOMES = ["São Paulo", "Sao Paulo", "santos", "Santo André", "Santa Bárbara d'Oeste", "Águas de Lindóia",
+         "Aguaí", "Itu", "Itú", "Ilhabela", "Belo Horizonte", "Betim", "Ubá", "Uberaba", "Uberlândia"]
+
+
+def _municipios(reforma, n=300, seed=0):
+    """Nomes com e sem acento, caixa e espaços variados, repetidos e em várias UFs."""
+    rnd = random.Random(seed)
+    out = []
+    for i in range(n):
+        nome = rnd.choice(NOMES)
+        nome = rnd.choice([nome, nome.upper(), nome.lower(), nome.replace(" ", "  ")])
+        out.append(reforma.Municipality(uf=rnd.choice(["SP", "MG", "RJ"]), name=nome,
+                                        ibge=rnd.choice(["", str(3500000 + i)])))
+    return out
+
+
+# busca linear de antes do índice
+def _by_uf_linear(muns, uf):
+    uf = (uf or "").strip().upper()
+    if not uf:
+        return []
+    return sorted([m for m in muns if m.uf == uf], key=lambda x: x.name.lower())
+
+
+def _find_linear(muns, uf, name):
+    uf = (uf or "").strip().upper()
+    name = (name or "").strip().lower()
+    for m in muns:
+        if m.uf == uf and m.name.strip().lower() == name:
+            return m
+    return None
+
+
+def _prefixo_linear(reforma, muns, uf, prefix, limit=20):
+    pre = reforma.fold_name(prefix)
+    lst = sorted(_by_uf_linear(muns, uf), key=lambda m: reforma.fold_name(m.name))
+    return [m for m in lst if reforma.fold_name(m.name).startswith(pre)][:limit]
+
+
+def _store(reforma, muns):
+    ds = reforma.DataStore()
+    ds.municipios = muns
+    ds.mun_index = reforma.MunicipioIndex(muns)
+    return ds
+
+
+def test_ordem_por_uf_igual_a_linear(reforma):
+    muns = _municipios(reforma)
+    ds = _store(reforma, muns)
+    for uf in ["SP", " mg ", "rj", "BA", "", None]:
+        got = ds.municipios_by_uf(uf)
+        assert isinstance(got, tuple)
+        assert [id(m) for m in got] == [id(m) for m in _by_uf_linear(muns, uf)]
+
+
+def test_find_exato_igual_a_linear(reforma):
+    muns = _municipios(reforma, seed=1)
+    ds = _store(reforma, muns)
+    consultas = [m.name for m in muns] + [n.lower() for n in NOMES] + [f"  {n.upper()} " for n in NOMES] + ["", "Nada"]
+    for uf in ["SP", "mg", "RJ", "BA"]:
+        for nome in consultas:
+            assert ds.find_municipio(uf, nome) is _find_linear(muns, uf, nome), (uf, nome)
+
+    # acentos só são ignorados quando pedido
+    sp = _store(reforma, [reforma.Municipality(uf="SP", name="São Paulo", ibge="3550308")])
+    assert sp.find_municipio("sp", "Sao Paulo") is None
+    assert sp.find_municipio("sp", " sao  PAULO ", sem_acento=True).ibge == "3550308"
+
+
+def test_busca_por_prefixo_igual_a_linear(reforma):
+    muns = _municipios(reforma, seed=2)
+    ds = _store(reforma, muns)
+    for uf in ["SP", "MG", "RJ", "BA"]:
+        for pre in ["", "s", "Sa", "SÃO", "santo", "it", "Ub", "águas", "x", "belo  h"]:
+            for limit in (1, 5, 20):
+                got = ds.search_municipios(uf, pre, limit)
+                assert [id(m) for m in got] == [id(m) for m in _prefixo_linear(reforma, muns, uf, pre, limit)], (uf, pre)
+
@@ -0,0 +1,129 @@
+from conftest import movimentos_reforma, produtos_reforma
+
+
+def _estado(reforma, ds):
+    return (reforma.asdict(ds.tax_defaults), [reforma.asdict(s) for s in ds.suppliers],
+            [reforma.asdict(p) for p in ds.products], [reforma.asdict(m) for m in ds.movements])
+
+
+def _fornecedor(reforma, i):
+    return reforma.Supplier.from_dict({"id": f"S{i}", "name": f"Fornecedor {i}", "uf": "SP", "active": True})
+
+
+def test_snapshot_log_e_segmentos_voltam_iguais(reforma, monkeypatch):
+    monkeypatch.setattr(reforma, "MOV_SEGMENTO_BYTES", 20_000)  # vários segmentos
+    ds = reforma.DataStore.load()
+    for p in produtos_reforma(reforma):
+        ds.add_product(p)
+    for i in range(3):
+        ds.add_supplier(_fornecedor(reforma, i))
+    movs = movimentos_reforma(reforma, 600)
+    for m in movs[:300]:
+        ds.add_movement(m)
+    ds.save()
+    assert _estado(reforma, reforma.DataStore.load()) == _estado(reforma, ds)  # snapshot + log
+
+    ds.compact()
+    assert len(ds._segmentos) > 1
+    for m in movs[300:]:
+        ds.add_movement(m)
+        ds.save()  # uma linha de log por venda
+    p = ds.product_by_id("P5")
+    ds.update_product(reforma.Product.from_dict({**reforma.asdict(p), "price": 1.5}))
+    ds.replace_supplier(1, reforma.Supplier.from_dict({**reforma.asdict(ds.suppliers[1]), "name": "Outro"}))
+    ds.remove_suppliers([0])
+    ds.tax_defaults = reforma.TaxDefaults(cbs_rate=0.9, ibs_rate=0.1, uf_origem="SP")
+    ds.save()
+    assert ds._gen == 2  # tudo no log
+    ds2 = reforma.DataStore.load()
+    assert _estado(reforma, ds2) == _estado(reforma, ds)
+
+    # exclusão de produto leva as movimentações dele e regrava os segmentos na compactação
+    ds2.remove_products([ds2._product_rows["P7"]])
+    ds2.save()
+    ds3 = reforma.DataStore.load()
+    assert _estado(reforma, ds3) == _estado(reforma, ds2)
+    assert not any(m.product_id == "P7" for m in ds3.movements)
+    ds3.compact()
+    assert _estado(reforma, reforma.DataStore.load()) == _estado(reforma, ds2)
+
+
+def test_gravacao_interrompida_no_log_e_descartada(reforma):
+    ds = reforma.DataStore.load()
+    for p in produtos_reforma(reforma, n=5):
+        ds.add_product(p)
+    ds.save()
+    movs = movimentos_reforma(reforma, 3, n_prod=5)
+    ds.add_movement(movs[0])
+    ds.save()
+    valido = reforma.log_path().stat().st_size
+    with reforma.log_path().open("ab") as f:
+        f.write(b'{"mov": {"id": "M9"')  # queda no meio de uma gravação
+
+    ds2 = reforma.DataStore.load()
+    assert _estado(reforma, ds2) == _estado(reforma, ds)
+    assert reforma.log_path().stat().st_size == valido
+    for m in movs[1:]:
+        ds2.add_movement(m)
+    ds2.save()
+    assert [m.id for m in reforma.DataStore.load().movements] == [m.id for m in movs]
+
+
+def _conferir_indices(reforma, ds, pids, skus, sids):
+    """Índices do DataStore contra a busca linear (vale o primeiro da lista)."""
+    for pid in pids:
+        linha = next((i for i, p in enumerate(ds.products) if p.id == pid), None)
+        assert ds.product_by_id(pid) is (ds.products[linha] if linha is not None else None), pid
+        assert ds._product_rows.get(pid) == linha, pid
+    for sku in skus:
+        assert ds.product_by_sku(sku) is next((p for p in ds.products if p.sku == sku), None), sku
+    for sid in sids:
+        assert ds.supplier_name(sid) == next((s.name for s in ds.suppliers if s.id == sid), ""), sid
+    cols = ds.cols
+    assert len(cols) == len(ds.movements)
+    for i, m in enumerate(ds.movements):
+        assert {k: cols.cats[k].valores[cols.codes[k][i]] for k in cols.CHAVES} == reforma.fiscal_keys(m)
+        assert cols.vals["base"][i] == m.base_value and cols.vals["total"][i] == m.total_value
+
+
+def test_indices_iguais_a_busca_linear_depois_de_edicoes(reforma):
+    import random
+    rnd = random.Random(7)
+    ds = reforma.DataStore.load()
+    movs = iter(movimentos_reforma(reforma, 400, n_prod=12, seed=3))
+    pids, skus, sids = {f"P{i}" for i in range(14)}, {f"SKU{i:04d}" for i in range(14)}, {f"S{i}" for i in range(6)}
+
+    def produto(**kw):
+        base = reforma.asdict(produtos_reforma(reforma, n=1, seed=rnd.randrange(99))[0])
+        # IDs e SKUs se repetem de propósito
+        return reforma.Product.from_dict({**base, "id": f"P{rnd.randrange(14)}", "sku": f"SKU{rnd.randrange(14):04d}", **kw})
+
+    for passo in range(300):
+        op = rnd.choice(["add", "add", "replace", "update", "remove", "merge", "sup_add", "sup_replace",
+                         "sup_remove", "mov", "mov"])
+        if op == "add":
+            ds.add_product(produto())
+        elif op == "replace" and ds.products:
+            ds.replace_product(rnd.randrange(len(ds.products)), produto())
+        elif op == "update" and ds.products:
+            p = rnd.choice(ds.products)
+            ds.update_product(reforma.Product.from_dict({**reforma.asdict(p), "name": f"Editado {passo}"}))
+        elif op == "remove" and ds.products:
+            ds.remove_products(rnd.sample(range(len(ds.products)), min(len(ds.products), rnd.randint(1, 3))))
+        elif op == "merge":
+            ds.merge_products([produto() for _ in range(rnd.randint(1, 4))])
+        elif op == "sup_add":
+            ds.add_supplier(reforma.Supplier.from_dict(
+                {"id": f"S{rnd.randrange(6)}", "name": f"Fornecedor {passo}", "uf": "SP", "active": True}))
+        elif op == "sup_replace" and ds.suppliers:
+            ds.replace_supplier(rnd.randrange(len(ds.suppliers)), reforma.Supplier.from_dict(
+                {"id": f"S{rnd.randrange(6)}", "name": f"Trocado {passo}", "uf": "MG", "active": True}))
+        elif op == "sup_remove" and ds.suppliers:
+            ds.remove_suppliers([rnd.randrange(len(ds.suppliers))])
+        elif op == "mov":
+            ds.add_movement(next(movs))
+        _conferir_indices(reforma, ds, pids, skus, sids)
+
+    assert len({p.id for p in ds.products}) < len(ds.products)  # houve duplicados
+    ds.save()
+    _conferir_indices(reforma, reforma.DataStore.load(), pids, skus, sids)
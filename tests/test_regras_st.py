@@ -0,0 +1,84 @@
+import random
+
+UFS = ["SP", "MG", "RJ", "BA"]
+
+
+def _regras(n, seed=1):
+    rnd = random.Random(seed)
+    regras = []
+    for i in range(n):
+        regras.append({
+            "id": i + 1,
+            "uf_origem": rnd.choice(UFS),
+            "uf_destino": rnd.choice(UFS),
+            "ncm": rnd.choice(["", "85171231", "8517.12.31", "12345678"]),
+            "cest": rnd.choice(["", "0210690", "1234567"]),
+            "cfop": rnd.choice(["", "6102", "5102"]),
+            "mva": 40.0,
+            "vig_ini": rnd.choice(["2024-01-01", "2025-01-01", "2025-07-01"]),
+            "vig_fim": rnd.choice(["", "", "2025-06-30"]),
+            "prioridade": rnd.choice([0, 5, 10]),
+            "ativo": rnd.choice([1, 1, 1, 0]),
+        })
+    return regras
+
+
+def _consultas(n, seed=2):
+    rnd = random.Random(seed)
+    for _ in range(n):
+        yield (
+            rnd.choice(UFS + ["sp", "XX"]),
+            rnd.choice(UFS),
+            rnd.choice(["85171231", "12345678", "99999999"]),
+            rnd.choice(["0210690", "1234567", ""]),
+            rnd.choice(["6102", "5102", ""]),
+            rnd.choice(["2024-06-01", "2025-03-10", "2025-06-30", "2025-07-15"]),
+        )
+
+
+def test_indice_escolhe_a_mesma_regra_que_a_varredura(nfe):
+    regras = _regras(400)
+    compiladas = nfe.compilar_regras_st(regras)
+    for consulta in _consultas(3000):
+        esperado = nfe.escolher_regra_st(regras, *consulta)
+        assert nfe.escolher_regra_st(compiladas, *consulta) is esperado, consulta
+
+
+def test_indice_desempata_pela_posicao_como_o_sort_estavel(nfe):
+    base = {"uf_origem": "SP", "uf_destino": "MG", "ncm": "", "cest": "", "cfop": "",
+            "vig_ini": "2025-01-01", "vig_fim": "", "prioridade": 10, "ativo": 1}
+    regras = [dict(base, id=1), dict(base, id=2), dict(base, id=3, ncm="85171231", prioridade=0)]
+    compiladas = nfe.compilar_regras_st(regras)
+    achou = nfe.escolher_regra_st(compiladas, "SP", "MG", "85171231", "", "6102", "2025-02-01")
+    assert achou is nfe.escolher_regra_st(regras, "SP", "MG", "85171231", "", "6102", "2025-02-01")
+    assert achou["id"] == 1
+
+
+def test_regras_compactadas_escolhem_como_as_copias(nfe):
+    # uma regra explodida por par de UFs (como o modo 4 de duplicar_regra_st_em_lote)
+    # no meio de regras avulsas, algumas para os mesmos pares
+    base = {"ncm": "85171231", "cest": "", "cfop": "", "mva": 40.0, "vig_ini": "2025-01-01",
+            "vig_fim": "", "prioridade": 5, "ativo": 1}
+    avulsas = _regras(60, seed=7)
+    copias = [dict(base, uf_origem=o, uf_destino=d) for o in nfe.UFS_BRASIL for d in nfe.UFS_BRASIL if o != d]
+    regras = avulsas[:30] + copias + avulsas[30:]
+    for i, r in enumerate(regras, 1):
+        r["id"] = i
+
+    compactas = nfe.compactar_regras_st_lista(regras)
+    assert len(compactas) < len(avulsas) + 10
+    assert {r["id"] for r in compactas} <= {r["id"] for r in regras}
+
+    def carga(r):
+        return None if r is None else nfe._carga_regra_st(r)
+
+    rnd = random.Random(4)
+    a, b = nfe.compilar_regras_st(regras), nfe.compilar_regras_st(compactas)
+    for _ in range(4000):
+        consulta = (rnd.choice(nfe.UFS_BRASIL), rnd.choice(nfe.UFS_BRASIL),
+                    rnd.choice(["85171231", "12345678"]), rnd.choice(["0210690", "1234567", ""]),
+                    rnd.choice(["6102", "5102", ""]), rnd.choice(["2024-06-01", "2025-03-10", "2025-07-15"]))
+        esperado = nfe.escolher_regra_st(regras, *consulta)
+        assert carga(nfe.escolher_regra_st(b, *consulta)) == carga(esperado), consulta
+        assert carga(nfe.escolher_regra_st(compactas, *consulta)) == carga(esperado), consulta
+        assert nfe.escolher_regra_st(a, *consulta) is esperado
@@ -0,0 +1,65 @@
+import json
+
+from conftest import jobs_nfs, montar_base
+
+
+def _emitidas(nfe, n=20):
+    montar_base(nfe)
+    res = nfe.executar_job_nfs(jobs_nfs(n), emitir=True)
+    assert all(r["ok"] for r in res), res
+    return [r["nf_id"] for r in res]
+
+
+def _resumo_recalculado(nfe):
+    chaves, _ = nfe._montar_resumo_de_nfs(nfe.load_store(nfe.FILE_NFS))
+    return chaves
+
+
+def test_resumo_acompanha_emissao_e_cancelamento(nfe):
+    ids = _emitidas(nfe)
+    assert nfe.load_resumo_fiscal() == _resumo_recalculado(nfe)
+
+    out = nfe.cancelar_nfs(nfe.load_store(nfe.FILE_NFS), ids[::3])
+    assert all(r["ok"] for r in out), out
+    assert nfe.load_resumo_fiscal() == _resumo_recalculado(nfe)
+
+    # outro processo (cache vazio) chega ao mesmo resumo
+    nfe._RESUMO_CACHE.update(snap=None, chaves=None)
+    assert nfe.load_resumo_fiscal() == _resumo_recalculado(nfe)
+    assert nfe.reconstruir_resumo_fiscal()["divergentes"] == 0
+
+
+def test_snapshot_do_resumo_zera_o_log(nfe, monkeypatch):
+    monkeypatch.setattr(nfe, "RESUMO_SNAPSHOT_CADA", 5)
+    _emitidas(nfe, 12)
+    log = nfe.FILE_RESUMO_FISCAL_LOG.read_bytes().splitlines()
+    gen = json.loads(nfe.FILE_RESUMO_FISCAL.read_text(encoding="utf-8"))["gen"]
+    assert json.loads(log[0]) == {"gen": gen}
+    assert len(log) - 1 < 5
+    nfe._RESUMO_CACHE.update(snap=None, chaves=None)
+    assert nfe.load_resumo_fiscal() == _resumo_recalculado(nfe)
+
+
+def test_log_de_geracao_anterior_e_ignorado(nfe, monkeypatch):
+    monkeypatch.setattr(nfe, "RESUMO_SNAPSHOT_CADA", 5)
+    _emitidas(nfe, 7)
+    antes = nfe.FILE_RESUMO_FISCAL_LOG.read_bytes()
+    # queda entre gravar o snapshot e zerar o log: o log antigo continua lá
+    with nfe.trava_dados():
+        nfe._gravar_resumo(dict(nfe.load_resumo_fiscal()))
+    nfe.FILE_RESUMO_FISCAL_LOG.write_bytes(antes)
+    nfe._RESUMO_CACHE.update(snap=None, chaves=None)
+    assert nfe.load_resumo_fiscal() == _resumo_recalculado(nfe)
+    nfe.executar_job_nfs(jobs_nfs(3, seed=9), emitir=True)
+    nfe._RESUMO_CACHE.update(snap=None, chaves=None)
+    assert nfe.load_resumo_fiscal() == _resumo_recalculado(nfe)
+
+
+def test_linha_incompleta_no_log_nao_quebra_a_emissao(nfe):
+    _emitidas(nfe, 5)
+    with nfe.FILE_RESUMO_FISCAL_LOG.open("ab") as f:
+        f.write(b'{"nf":99,"s":1,"d":{"2025-03|1|MG|6102|SAIDA":[1,')
+    res = nfe.executar_job_nfs(jobs_nfs(4, seed=7), emitir=True)
+    assert all(r["ok"] for r in res), res
+    nfe._RESUMO_CACHE.update(snap=None, chaves=None)
+    assert nfe.load_resumo_fiscal() == _resumo_recalculado(nfe)
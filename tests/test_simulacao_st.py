@@ -0,0 +1,58 @@
+import csv
+import json
+import random
+
+from conftest import jobs_nfs, montar_base
+
+CAMPOS_CSV = ["uf_origem", "uf_destino", "ncm", "cest", "cfop", "mva", "red_bc_st",
+              "aliq_icms_interna_dest", "aliq_fcp_dest", "vig_ini", "vig_fim", "prioridade", "ativo"]
+
+
+def _base(nfe):
+    montar_base(nfe)
+    res = nfe.executar_job_nfs(jobs_nfs(25), emitir=True)
+    assert all(r["ok"] for r in res)
+    return nfe.load_tabela_st_data()["regras"]
+
+
+def test_tabela_igual_com_outros_ids_nao_troca_nada(nfe, tmp_path):
+    regras = _base(nfe)
+    copia = [dict(r, id=1000 + i) for i, r in enumerate(random.Random(3).sample(regras, len(regras)))]
+    path = tmp_path / "candidata.json"
+    path.write_text(json.dumps({"regras": copia}), encoding="utf-8")
+
+    res = nfe.simular_regras_st(nfe.carregar_regras_st_candidatas(str(path)))
+    assert res["itens"] == 100
+    assert res["itens_afetados"] == 0 and res["trocas_regra"] == []
+    assert res["antes"] == res["depois"] and res["antes"]["icms_st"] > 0
+
+
+def test_csv_sem_vig_ini_vale_para_nfs_passadas(nfe, tmp_path):
+    regras = _base(nfe)
+    path = tmp_path / "candidata.csv"
+    with path.open("w", encoding="utf-8", newline="") as f:
+        w = csv.DictWriter(f, fieldnames=CAMPOS_CSV, delimiter=";", extrasaction="ignore")
+        w.writeheader()
+        for r in regras:
+            w.writerow({**r, "vig_ini": "", "aliq_icms_interna_dest": r["aliq_icms_interna_dest"] or "",
+                        "aliq_fcp_dest": r["aliq_fcp_dest"] or ""})
+
+    candidatas = nfe.carregar_regras_st_candidatas(str(path))
+    assert {r["vig_ini"] for r in candidatas} == {nfe.VIG_INI_SIMULACAO}
+    res = nfe.simular_regras_st(candidatas)
+    # a regra SP->MG genérica vence em 30/06; sem vig_ini a candidata não some das NFs anteriores
+    assert res["depois"]["icms_st"] >= res["antes"]["icms_st"] > 0
+
+
+def test_troca_de_regra_e_pelo_conteudo(nfe, tmp_path):
+    regras = _base(nfe)
+    alvo = next(r for r in regras if r["uf_destino"] == "MG" and r["ncm"])
+    candidata = [dict(r, mva=60.0) if r is alvo else dict(r) for r in regras]
+    path = tmp_path / "candidata.json"
+    path.write_text(json.dumps(candidata), encoding="utf-8")
+
+    res = nfe.simular_regras_st(nfe.carregar_regras_st_candidatas(str(path)))
+    assert res["itens_afetados"] > 0
+    assert [(t["regra_atual"], t["regra_nova"]) for t in res["trocas_regra"]] == [(alvo["id"], f"C{alvo['id']}")]
+    assert res["depois"]["icms_st"] > res["antes"]["icms_st"]
+    assert res["delta"]["difal"] == 0
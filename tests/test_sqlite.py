@@ -0,0 +1,101 @@
+import sys
+from datetime import date
+
+import pytest
+
+from conftest import carregar, jobs_nfs, montar_base
+
+
+@pytest.fixture
+def bases(tmp_path, monkeypatch):
+    """A mesma base (montar_base) em dois Sistema_nfe: um em JSON e outro migrado para SQLite."""
+    mods = {}
+    for backend in ("json", "sqlite"):
+        pasta = tmp_path / backend
+        pasta.mkdir()
+        monkeypatch.setenv("SISTEMA_NFE_DATA", str(pasta))
+        monkeypatch.delenv("SISTEMA_NFE_BACKEND", raising=False)
+        mod = carregar(f"Sistema_nfe_{backend}", "Sistema_nfe.py.py")
+        mod.bootstrap_files()
+        montar_base(mod)
+        if backend == "sqlite":
+            mod.migrar_json_para_sqlite()
+            mod.STORE_BACKEND = "sqlite"
+        mods[backend] = mod
+    yield mods
+    for backend, mod in mods.items():
+        mod.aguardar_compactacoes()
+        sys.modules.pop(f"Sistema_nfe_{backend}", None)
+
+
+def test_estoque_em_igual_depois_da_migracao(bases):
+    hoje = date.today().strftime("%Y-%m-%d")
+    for nfe in bases.values():
+        res = nfe.executar_job_nfs(jobs_nfs(4), calcular=True, emitir=True)
+        assert all(r["ok"] for r in res), res
+        nfe.cancelar_nf(res[0]["nf_id"])
+
+    js, sq = bases["json"], bases["sqlite"]
+    assert sq.estoque_em(hoje) == js.estoque_em(hoje)
+    assert sq.estoque_em(hoje) == js.load_estoque()["by_filial"]
+    assert sq.estoque_em("2000-01-01") == js.estoque_em("2000-01-01") == {
+        "1": {str(i): 10000.0 for i in range(1, 31)}}
+
+
+def _sem_fp(it):
+    # calc["fp"] é chave de cache (entra o carimbo das tabelas em disco), não resultado
+    return {**it, "calc": {k: v for k, v in (it.get("calc") or {}).items() if k != "fp"}}
+
+
+def _estado(nfe):
+    nfs = [{**{k: nf.get(k) for k in ("id", "status", "totais", "somas")}, "itens": [_sem_fp(it) for it in nf["itens"]]}
+           for nf in nfe.load_store(nfe.FILE_NFS)["items"]]
+    return {
+        "nfs": sorted(nfs, key=lambda nf: nf["id"]),
+        "saldos": nfe.load_estoque()["by_filial"],
+        "relatorio": nfe.relatorio_fiscal(),
+        "relatorio_periodo": nfe.relatorio_fiscal(por=["periodo", "tipo_operacao", "filial_id"]),
+    }
+
+
+def _operar(nfe):
+    res = nfe.executar_job_nfs(jobs_nfs(8, itens=5), calcular=True)
+    ids = [r["nf_id"] for r in res]
+    for nf_id in ids[:6]:
+        nfe.emitir_nf(nf_id)
+    nfe.cancelar_nf(ids[1])  # emitida: estorna o estoque
+    nfe.cancelar_nf(ids[7])  # rascunho
+    nfe.emitir_nf(ids[1])    # cancelada não volta
+    out = nfe.emitir_nfs(nfe.load_store(nfe.FILE_NFS), [ids[6]])
+    assert out[0]["ok"]
+
+
+def test_mesmas_operacoes_mesmo_resultado_nos_dois_backends(bases):
+    for nfe in bases.values():
+        _operar(nfe)
+    js, sq = _estado(bases["json"]), _estado(bases["sqlite"])
+    assert [nf["status"] for nf in js["nfs"]] == ["EMITIDA", "CANCELADA"] + ["EMITIDA"] * 5 + ["CANCELADA"]
+    assert js["relatorio"]
+    assert sq == js
+
+
+def test_migracao_de_base_com_nfs_e_ledger(nfe):
+    montar_base(nfe)
+    _operar(nfe)
+    antes = _estado(nfe)
+    cadastros = {p: nfe.load_store(p) for p in (nfe.FILE_FILIAIS, nfe.FILE_PESSOAS, nfe.FILE_PRODUTOS)}
+    hoje = date.today().strftime("%Y-%m-%d")
+    estoque_hoje = nfe.estoque_em(hoje)
+
+    nfe.migrar_json_para_sqlite()
+    nfe.STORE_BACKEND = "sqlite"
+    assert _estado(nfe) == antes
+    assert nfe.estoque_em(hoje) == estoque_hoje
+    for path, st in cadastros.items():
+        lido = nfe.load_store(path)
+        assert lido["items"] == st["items"] and lido["seq"] == st["seq"], path.name
+
+    # continua operando igual depois da migração
+    res = nfe.executar_job_nfs(jobs_nfs(2, seed=5), calcular=True, emitir=True)
+    assert all(r["ok"] for r in res)
+    assert res[0]["nf_id"] == len(antes["nfs"]) + 1
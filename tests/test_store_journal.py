@@ -0,0 +1,123 @@
+import json
+
+import pytest
+
+
+def _novo(nfe, store, **campos):
+    rec = {"id": nfe.next_id(store), **campos}
+    nfe.append_record(store, rec)
+    return rec
+
+
+def test_journal_replica_puts_e_deletes(nfe):
+    path = nfe.FILE_PRODUTOS
+    st = nfe.load_store(path)
+    a = _novo(nfe, st, sku="A", preco_venda=1.0)
+    b = _novo(nfe, st, sku="B", preco_venda=2.0)
+    nfe.save_store(path, st)
+    a["preco_venda"] = 3.0
+    st["items"].remove(b)
+    nfe.save_store(path, st)
+
+    assert nfe._journal_path(path).exists()
+    assert json.loads(path.read_text(encoding="utf-8"))["items"] == []  # tudo ainda só no journal
+    lido = nfe.load_store(path)
+    assert lido["items"] == [{"id": 1, "sku": "A", "preco_venda": 3.0}]
+    assert lido["seq"] == 2
+
+    nfe.compactar_store(path)
+    assert not nfe._journal_path(path).exists()
+    assert nfe.load_store(path)["items"] == lido["items"]
+
+
+def test_gravacao_de_outro_processo_e_incorporada(nfe):
+    path = nfe.FILE_PESSOAS
+    st1 = nfe.load_store(path)
+    st2 = nfe.load_store(path)
+    _novo(nfe, st1, nome="um")
+    nfe.save_store(path, st1)
+    _novo(nfe, st2, nome="dois")
+    nfe.save_store(path, st2)  # id 1 já foi usado lá fora: o registro novo vira 2
+    assert [(p["id"], p["nome"]) for p in nfe.load_store(path)["items"]] == [(1, "um"), (2, "dois")]
+
+
+def test_linha_incompleta_no_fim_nao_engole_gravacoes_seguintes(nfe):
+    path = nfe.FILE_PRODUTOS
+    jpath = nfe._journal_path(path)
+    st = nfe.load_store(path)
+    _novo(nfe, st, sku="A")
+    nfe.save_store(path, st)
+    with jpath.open("ab") as f:
+        f.write(b'{"seq":9,"v":9,"put":[{"id":9')  # queda no meio de uma gravação
+    _novo(nfe, st, sku="B")
+    nfe.save_store(path, st)
+
+    assert [p["sku"] for p in nfe.load_store(path)["items"]] == ["A", "B"]
+    assert jpath.read_bytes().endswith(b"\n")
+
+
+def test_load_corta_linha_incompleta(nfe):
+    path = nfe.FILE_PRODUTOS
+    jpath = nfe._journal_path(path)
+    st = nfe.load_store(path)
+    _novo(nfe, st, sku="A")
+    nfe.save_store(path, st)
+    valido = jpath.stat().st_size
+    with jpath.open("ab") as f:
+        f.write(b'{"seq":2,"put":[')
+
+    st = nfe.load_store(path)
+    assert jpath.stat().st_size == valido
+    _novo(nfe, st, sku="B")
+    nfe.save_store(path, st)
+    assert [p["sku"] for p in nfe.load_store(path)["items"]] == ["A", "B"]
+
+
+def test_gravacao_completa_incorpora_journal_de_outro_processo(nfe, monkeypatch):
+    path = nfe.FILE_PRODUTOS
+    st = nfe.load_store(path)
+    a = _novo(nfe, st, sku="A", preco_venda=1.0)
+    nfe.save_store(path, st)
+
+    outro = nfe.load_store(path)
+    _novo(nfe, outro, sku="B")
+    nfe.save_store(path, outro)  # vai para o journal
+
+    monkeypatch.setattr(nfe, "STORE_JOURNAL", False)  # save_store grava o snapshot inteiro
+    a["preco_venda"] = 5.0
+    nfe.save_store(path, st)
+    assert not nfe._journal_path(path).exists()
+    assert [(p["sku"], p.get("preco_venda")) for p in nfe.load_store(path)["items"]] == [("A", 5.0), ("B", None)]
+
+
+def test_gravacao_completa_conflito_no_mesmo_registro(nfe, monkeypatch):
+    path = nfe.FILE_PRODUTOS
+    st = nfe.load_store(path)
+    _novo(nfe, st, sku="A", preco_venda=1.0)
+    nfe.save_store(path, st)
+    outro = nfe.load_store(path)
+    outro["items"][0]["preco_venda"] = 2.0
+    nfe.save_store(path, outro)
+
+    monkeypatch.setattr(nfe, "STORE_JOURNAL", False)
+    st["items"][0]["preco_venda"] = 3.0
+    with pytest.raises(nfe.ConflitoVersao):
+        nfe.save_store(path, st)
+    assert nfe.load_store(path)["items"][0]["preco_venda"] == 2.0
+
+
+def test_indice_ve_append_depois_de_remocao(nfe):
+    path = nfe.FILE_PRODUTOS
+    st = nfe.load_store(path)
+    for sku in ("A", "B", "C"):
+        _novo(nfe, st, sku=sku)
+    assert nfe.find_by_id(st, 3)["sku"] == "C"
+
+    st["items"].remove(nfe.find_by_id(st, 2))  # mesmo tamanho depois do append abaixo
+    _novo(nfe, st, sku="D")
+    assert nfe.find_by_id(st, 4)["sku"] == "D"
+    assert nfe.find_by_sku(st, "D")["id"] == 4
+    assert nfe.find_by_id(st, 2) is None
+
+    st["items"][0] = {"id": 9, "sku": "Z"}  # troca no lugar
+    assert nfe.find_by_id(st, 9)["sku"] == "Z"